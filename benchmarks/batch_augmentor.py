@@ -0,0 +1,45 @@
+""" Time and point statistics of BatchPointAugmentor against the flip + volumentations pipeline of get_scene
+
+python -m benchmarks.batch_augmentor
+"""
+import random
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import volumentations as V
+
+from data.datasets.batch_augmentor import BatchPointAugmentor
+
+
+def compare_with_volumentations(path, num_samples=2000, num_points=4096, seed=0):
+    # statistics of the transformed points over many samples, old per sample pipeline vs one batched call
+    random.seed(seed)
+    np.random.seed(seed)
+    generator = torch.Generator().manual_seed(seed)
+    points = (np.random.rand(num_points, 3) * [6, 4, 2.5]).astype(np.float32)
+    volume_augmentations = V.load(Path(path), data_format="yaml")
+    start = time.time()
+    old = []
+    for _ in range(num_samples):
+        coordinates = points.copy()
+        for i in (0, 1):
+            if random.random() < 0.5:
+                coordinates[:, i] = coordinates[:, i].max() - coordinates[:, i] + coordinates[:, i].min()
+        old.append(volume_augmentations(points=coordinates, normals=None, features=None, labels=None)['points'])
+    old_time = time.time() - start
+    augmentor = BatchPointAugmentor.from_volumentations(path)
+    batch_ids = torch.arange(num_samples).repeat_interleave(num_points)
+    start = time.time()
+    new = augmentor(torch.from_numpy(points).repeat(num_samples, 1), batch_ids, num_samples, generator)
+    new_time = time.time() - start
+    old = np.stack(old).reshape(-1, 3)
+    new = new.numpy()
+    print(f"volumentations {old_time * 1000 / num_samples:.2f} ms/sample, batched {new_time * 1000 / num_samples:.2f} ms/sample")
+    for name, value in [('volumentations', old), ('batched', new)]:
+        print(f"{name}: mean {value.mean(0)}, std {value.std(0)}, abs max {np.abs(value).max(0)}")
+
+
+if __name__ == '__main__':
+    compare_with_volumentations('configs/instseg/augmentation/volumentations_aug.yaml')
@@ -0,0 +1,69 @@
+""" Collate time and host to device copy time of the per field python loop the wrappers used before vs SchemaCollator
+
+from benchmarks.collator import benchmark_collator; benchmark_collator(wrapper), wrapper e.g. an EmbodiedScanInstSegDatasetWrapper
+"""
+import time
+
+import torch
+from torch.utils.data import default_collate
+
+from data.data_utils import pad_sequence
+
+
+def reference_collate(schema, pad_values=None):
+    # per field python loop collation as the wrappers did before, ME.utils.sparse_collate and pad_sequence
+    import MinkowskiEngine as ME
+    pad_values = pad_values if pad_values is not None else {}
+
+    def collate_fn(batch):
+        new_batch = {}
+        if 'voxel_coordinates' in batch[0]:
+            new_batch['voxel_coordinates'], new_batch['voxel_features'] = ME.utils.sparse_collate(
+                coords=[sample.pop('voxel_coordinates') for sample in batch], feats=[sample.pop('voxel_features') for sample in batch], dtype=torch.int32)
+        for key, kind in schema.items():
+            if key not in batch[0]:
+                continue
+            values = [sample.pop(key) for sample in batch]
+            if kind == 'list':
+                new_batch[key] = values
+            elif kind == 'concat':
+                new_batch[key] = torch.cat(values, dim=0)
+            else:
+                new_batch[key] = pad_sequence(values, pad=pad_values.get(key, 0))
+        new_batch.update(default_collate(batch))
+        return new_batch
+    return collate_fn
+
+
+def benchmark_collator(wrapper, batch_size=4, num_batches=20):
+    # collate time and host to device copy time of the per field loop vs the wrapper's schema collator
+    reference_collate_fn = reference_collate(wrapper.collator.schema, wrapper.collator.pad_values)
+    device = torch.device('cuda') if torch.cuda.is_available() else None
+    samples = [wrapper[i % len(wrapper)] for i in range(batch_size * num_batches)]
+
+    def tensors_of(obj):
+        if isinstance(obj, torch.Tensor):
+            return [obj]
+        if isinstance(obj, dict):
+            return [t for v in obj.values() for t in tensors_of(v)]
+        if isinstance(obj, (list, tuple)):
+            return [t for v in obj for t in tensors_of(v)]
+        return []
+
+    for name, collate_fn in [('reference', reference_collate_fn), ('schema', wrapper.collate_fn)]:
+        collate_time, copy_time, num_tensors = 0, 0, 0
+        for i in range(num_batches):
+            batch = [{k: v.clone() if isinstance(v, torch.Tensor) else v for k, v in sample.items()} for sample in samples[i * batch_size:(i + 1) * batch_size]]
+            start = time.time()
+            batch = collate_fn(batch)
+            collate_time += time.time() - start
+            tensors = tensors_of(batch)
+            num_tensors += len(tensors)
+            if device is not None:
+                start = time.time()
+                for t in tensors:
+                    t.to(device, non_blocking=t.is_pinned())
+                torch.cuda.synchronize()
+                copy_time += time.time() - start
+        print(f"{name}: collate {collate_time / num_batches * 1000:.2f} ms/batch, host to device {copy_time / num_batches * 1000:.2f} ms/batch, "
+              f"{num_tensors / num_batches:.0f} tensors/batch")
@@ -0,0 +1,50 @@
+""" Per process resident memory while iterating a dataset with several dataloader worker counts, RssAnon is what
+grows with scan data copied into the workers, scans in shared memory (load_scan_options.shared_memory) count as RssShmem
+
+python -m benchmarks.dataloader_memory --config configs/embodied-pq3d-final/embodied_scan_instseg.yaml --dataset EmbodiedScanInstSegHM3D \
+    data.load_scan_options.shared_memory=true data.embodied_base=... data.scene_verse_base=...
+"""
+import os
+import argparse
+
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader
+
+from data.shared_memory import process_memory
+
+
+def _memory_collate(batch):
+    return os.getpid(), process_memory()
+
+
+def measure_dataloader_memory(dataset, num_workers_list=(0, 4, 16), num_batches=50):
+    results = {}
+    for num_workers in num_workers_list:
+        loader = DataLoader(dataset, batch_size=1, num_workers=num_workers, shuffle=True, collate_fn=_memory_collate)
+        per_process = {}
+        for i, (pid, memory) in enumerate(loader):
+            per_process[pid] = memory
+            if i + 1 >= num_batches:
+                break
+        per_process[os.getpid()] = process_memory()
+        total_anon = sum(m['RssAnon'] for m in per_process.values())
+        max_anon = max(m['RssAnon'] for m in per_process.values())
+        print(f"workers {num_workers}: processes {len(per_process)}, total RssAnon {total_anon / 2 ** 20:.0f} MB, max per process RssAnon {max_anon / 2 ** 20:.0f} MB")
+        results[num_workers] = per_process
+        del loader
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/embodied-pq3d-final/embodied_scan_instseg.yaml')
+    parser.add_argument('--dataset', default='EmbodiedScanInstSegHM3D')
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 4, 16])
+    parser.add_argument('--num_batches', type=int, default=50)
+    args, overrides = parser.parse_known_args()
+    cfg = OmegaConf.merge(OmegaConf.load(args.config), OmegaConf.from_dotlist(overrides))
+    import data  # noqa: F401, fills the dataset registry
+    from data.build import DATASET_REGISTRY
+    dataset = DATASET_REGISTRY.get(args.dataset)(cfg, args.split)
+    measure_dataloader_memory(dataset, num_workers_list=args.num_workers, num_batches=args.num_batches)
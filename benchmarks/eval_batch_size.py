@@ -0,0 +1,56 @@
+""" Wall clock of one evaluation pass per eval batch size, batches > 1 stream frames of different scans
+(cfg.dataloader.scan_stream_eval), the target metric should not change with the batch size
+
+python -m benchmarks.eval_batch_size --config configs/embodied-pq3d-final/embodied_scan_instseg.yaml \
+    exp_dir=<dir> pretrain_ckpt_path=<ckpt> data.embodied_base=... data.scene_verse_base=...
+"""
+import argparse
+from time import time
+
+import torch
+from omegaconf import OmegaConf, open_dict
+
+
+@torch.no_grad()
+def benchmark_eval_batch_size(trainer, cfg, batch_sizes=(1, 2, 4, 8), split='val'):
+    from data.build import build_dataloader
+    trainer.model.eval()
+    results = {}
+    for batch_size in batch_sizes:
+        with open_dict(cfg):
+            cfg.dataloader.batchsize_eval = batch_size
+            cfg.dataloader.scan_stream_eval = batch_size > 1
+        # build_dataloader returns a list with several eval datasets, all of them go through the one evaluator
+        loaders = build_dataloader(cfg, split=split)
+        loaders = [trainer.prepare_loader(loader) for loader in (loaders if isinstance(loaders, list) else [loaders])]
+        trainer.evaluator.scan_stream = batch_size > 1
+        trainer.evaluator.reset()
+        trainer.evaluator.cur_scan_id = None
+        st = time()
+        for loader in loaders:
+            for data_dict in loader:
+                trainer.evaluator.update(trainer.forward(data_dict))
+        # frames merged by this rank, repeated frames of finished scans are not counted
+        frames = trainer.evaluator.total_count
+        _, eval_results = trainer.evaluator.record()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        steps = sum(len(loader) for loader in loaders)
+        results[batch_size] = {'time': time() - st, 'steps': steps, 'frames': frames, 'target_metric': eval_results['target_metric']}
+        trainer.accelerator.print(f"eval batch size {batch_size}: {results[batch_size]['time']:.1f} s over {steps} steps and {frames} frames, "
+                                  f"target metric {eval_results['target_metric']:.4f}")
+        trainer.evaluator.reset()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/embodied-pq3d-final/embodied_scan_instseg.yaml')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--split', default='val')
+    args, overrides = parser.parse_known_args()
+    cfg = OmegaConf.merge(OmegaConf.load(args.config), OmegaConf.from_dotlist(overrides))
+    OmegaConf.resolve(cfg)
+    from trainer.build import build_trainer
+    trainer = build_trainer(cfg)
+    benchmark_eval_batch_size(trainer, cfg, batch_sizes=args.batch_sizes, split=args.split)
@@ -0,0 +1,44 @@
+""" Per sample EmbodiedScanInstseg get_scene time on the frozen scan data, with the per sample deep copies of the scan
+frame it replaced timed separately as the old overhead
+
+python -m benchmarks.get_scene --config configs/embodied-pq3d-final/embodied_scan_instseg.yaml --dataset EmbodiedScanInstSegHM3D \
+    data.embodied_base=... data.scene_verse_base=...
+"""
+import time
+import argparse
+from copy import deepcopy
+
+import numpy as np
+from omegaconf import OmegaConf
+
+
+def profile_get_scene(dataset, num_samples=100):
+    indices = np.random.choice(len(dataset), min(num_samples, len(dataset)), replace=False)
+    copy_time, scene_time = 0, 0
+    for index in indices:
+        scan_id, sub_frame_id = dataset.data_id_mapper[index]
+        start = time.time()
+        deepcopy(dataset.scan_data[scan_id]['sub_frames'][sub_frame_id])
+        if dataset.compute_local_box:
+            deepcopy(dataset.scan_data[scan_id]['pcds_global'])
+            deepcopy(dataset.scan_data[scan_id]['instance_labels_global'])
+        copy_time += time.time() - start
+        start = time.time()
+        dataset.get_scene(scan_id, sub_frame_id)
+        scene_time += time.time() - start
+    scene_ms = scene_time / len(indices) * 1000
+    copy_ms = copy_time / len(indices) * 1000
+    print(f"get_scene {scene_ms:.1f} ms/sample, with deep copies {scene_ms + copy_ms:.1f} ms/sample")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/embodied-pq3d-final/embodied_scan_instseg.yaml')
+    parser.add_argument('--dataset', default='EmbodiedScanInstSegHM3D')
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--num_samples', type=int, default=100)
+    args, overrides = parser.parse_known_args()
+    cfg = OmegaConf.merge(OmegaConf.load(args.config), OmegaConf.from_dotlist(overrides))
+    import data  # noqa: F401, fills the dataset registry
+    from data.build import DATASET_REGISTRY
+    profile_get_scene(DATASET_REGISTRY.get(args.dataset)(cfg, args.split), num_samples=args.num_samples)
@@ -0,0 +1,43 @@
+""" Instance info memory of the cached scans, collate time and batch bytes of EmbodiedScanInstseg with compact
+(per point instance ids, bool segment masks) and dense (long full and segment masks) instance masks
+
+python -m benchmarks.instseg_collate --config configs/embodied-pq3d-final/embodied_scan_instseg.yaml --dataset EmbodiedScanInstSegHM3D \
+    data.embodied_base=... data.scene_verse_base=...
+"""
+import time
+import argparse
+
+from omegaconf import OmegaConf
+
+
+def profile_instseg_collate(wrapper, num_batches=10, batch_size=4):
+    from data.scan_cache import nbytes_of
+    dataset = wrapper.dataset
+    inst_info_bytes = sum(nbytes_of(sub_frame['inst_info']) for scan_id in dataset.scan_ids for sub_frame in dataset.scan_data[scan_id]['sub_frames'].values())
+    collate_time, batch_bytes = 0, 0
+    for i in range(num_batches):
+        batch = [wrapper[(i * batch_size + j) % len(wrapper)] for j in range(batch_size)]
+        start = time.time()
+        batch = wrapper.collate_fn(batch)
+        collate_time += time.time() - start
+        batch_bytes += nbytes_of(batch)
+    print(f"inst info {inst_info_bytes / 2 ** 20:.1f} MB, collate {collate_time / num_batches * 1000:.1f} ms/batch, batch {batch_bytes / num_batches / 2 ** 20:.1f} MB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/embodied-pq3d-final/embodied_scan_instseg.yaml')
+    parser.add_argument('--dataset', default='EmbodiedScanInstSegHM3D')
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--num_batches', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=4)
+    args, overrides = parser.parse_known_args()
+    cfg = OmegaConf.merge(OmegaConf.load(args.config), OmegaConf.from_dotlist(overrides))
+    import data  # noqa: F401, fills the dataset registry
+    from data.build import DATASET_REGISTRY
+    from data.datasets.embodied_scan_instseg_wrapper import EmbodiedScanInstSegDatasetWrapper
+    for compact_instance_masks in [True, False]:
+        OmegaConf.update(cfg, 'data.instseg_options.compact_instance_masks', compact_instance_masks, force_add=True)
+        print(f'compact_instance_masks {compact_instance_masks}')
+        dataset = DATASET_REGISTRY.get(args.dataset)(cfg, args.split)
+        profile_instseg_collate(EmbodiedScanInstSegDatasetWrapper(cfg, dataset), num_batches=args.num_batches, batch_size=args.batch_size)
@@ -0,0 +1,76 @@
+""" Init time, per sample get_scene latency, resident memory and open files of the Ovon / Goat / SG3D VLE datasets
+with the per object feature dicts and with the columnar store of data/object_feature_store.py
+
+python -m benchmarks.object_feature_store --object_feature_dir <store> --out object_feature_store.json \
+    data.embodied_base=... data.embodied_feat=... data.embodied_vle=... data.scene_verse_base=...
+
+every (dataset, layout) runs in a fresh process, SCAN_DATA and the page cache of one run do not leak into the next
+"""
+import json
+import time
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+from omegaconf import OmegaConf
+
+DATASETS = ['EmbodiedVLEOvon', 'EmbodiedVLEGoat', 'EmbodiedVLESG3D']
+
+
+def _run(cfg, dataset_name, split, num_samples, queue):
+    import data  # noqa: F401, fills the dataset registry
+    from data.build import DATASET_REGISTRY
+    from data.scan_store import open_fd_count
+    from data.shared_memory import process_memory
+    fds = open_fd_count()
+    start = time.time()
+    dataset = DATASET_REGISTRY.get(dataset_name)(cfg, split)
+    init_time = time.time() - start
+    init_memory = process_memory()
+    indices = np.random.RandomState(0).choice(len(dataset), min(num_samples, len(dataset)), replace=False)
+    start = time.time()
+    for index in indices:
+        dataset[index]
+    memory = process_memory()
+    queue.put({
+        'init_s': init_time,
+        'ms_per_sample': (time.time() - start) * 1000 / len(indices),
+        'init_VmRSS_mb': init_memory['VmRSS'] / 2 ** 20,
+        'VmRSS_mb': memory['VmRSS'] / 2 ** 20,
+        'RssAnon_mb': memory['RssAnon'] / 2 ** 20,
+        'open_fds': open_fd_count() - fds,
+        'num_scans': len(dataset.scan_ids),
+    })
+
+
+def benchmark_object_features(cfg, object_feature_dir, datasets=DATASETS, split='train', num_samples=500):
+    results = []
+    ctx = mp.get_context('spawn')
+    for dataset_name in datasets:
+        for layout, feature_dir in [('dict', None), ('columnar', object_feature_dir)]:
+            run_cfg = cfg.copy()
+            OmegaConf.update(run_cfg, 'data.load_scan_options.object_feature_dir', feature_dir, force_add=True)
+            queue = ctx.Queue()
+            process = ctx.Process(target=_run, args=(run_cfg, dataset_name, split, num_samples, queue))
+            process.start()
+            result = dict(dataset=dataset_name, layout=layout, **queue.get())
+            process.join()
+            print(f"{dataset_name} {layout}: init {result['init_s']:.1f} s, {result['ms_per_sample']:.2f} ms/sample, "
+                  f"VmRSS {result['VmRSS_mb']:.0f} MB, RssAnon {result['RssAnon_mb']:.0f} MB, open fds {result['open_fds']}")
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='configs/embodied-pq3d-final/embodied_vle.yaml')
+    parser.add_argument('--object_feature_dir', required=True)
+    parser.add_argument('--split', default='train')
+    parser.add_argument('--num_samples', type=int, default=500)
+    parser.add_argument('--out', default=None, help='json file the results are written to')
+    args, overrides = parser.parse_known_args()
+    cfg = OmegaConf.merge(OmegaConf.load(args.config), OmegaConf.from_dotlist(overrides))
+    results = benchmark_object_features(cfg, args.object_feature_dir, split=args.split, num_samples=args.num_samples)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,43 @@
+""" CPU forward time and peak memory of QueryMaskEncoder with per-layer predictions and with last_layer_only_eval
+
+python -m benchmarks.query_mask_encoder
+"""
+import time
+from functools import partial
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from modules.grounding.query_encoder import QueryMaskEncoder
+from modules.heads.mask_head import MaskHeadSegLevelWithBox
+from modules.utils import calc_pairwise_locs, profiler_peak_cpu_memory
+
+
+def benchmark_query_mask_encoder(num_layers_list=(1, 2, 4, 8), batch_size=4, num_queries=120, num_segments=400, hidden_size=768, repeat=3):
+    mask_head = MaskHeadSegLevelWithBox(None, hidden_size, 201, memories_for_match=['voxel', 'mv'], filter_out_classes=[]).eval()
+    query_locs = torch.rand(batch_size, num_queries, 3)
+    pairwise_locs = calc_pairwise_locs(query_locs, None, pairwise_rel_type='center', spatial_dist_norm=True, spatial_dim=5)
+    seg_masks = torch.zeros(batch_size, num_segments, dtype=torch.bool)
+    for num_layers in num_layers_list:
+        encoder = QueryMaskEncoder(None, memories=['voxel', 'mv'], hidden_size=hidden_size, num_layers=num_layers, spatial_selfattn=True,
+                                   structure='parallel', use_self_mask=True).eval()
+        for last_layer_only in [False, True]:
+            encoder.last_layer_only_eval = last_layer_only
+            elapsed = []
+            for _ in range(repeat):
+                seg_fts = {m: torch.randn(batch_size, num_segments, hidden_size) for m in ['voxel', 'mv']}
+                input_dict = {'query': (torch.randn(batch_size, num_queries, hidden_size), seg_masks[:, :num_queries], torch.randn(batch_size, num_queries, hidden_size))}
+                for m in ['voxel', 'mv']:
+                    input_dict[m] = [seg_fts[m], seg_masks, torch.randn(batch_size, num_segments, hidden_size)]
+                seg_fts_for_match = [[seg_fts[m], seg_masks, None] for m in ['voxel', 'mv']]
+                mask_head_partial = partial(mask_head, query_locs=query_locs, seg_fts_for_match=seg_fts_for_match, seg_masks=seg_masks)
+                with torch.no_grad(), profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+                    start = time.time()
+                    query = encoder(input_dict, pairwise_locs, mask_head_partial)[0]
+                    mask_head_partial(query=query)
+                    elapsed.append(time.time() - start)
+            print(f"layers {num_layers} last_layer_only {last_layer_only}: {min(elapsed) * 1000:.1f} ms, peak memory {profiler_peak_cpu_memory(prof) / 2 ** 20:.1f} MB")
+
+
+if __name__ == '__main__':
+    benchmark_query_mask_encoder()
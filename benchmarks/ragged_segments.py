@@ -0,0 +1,52 @@
+""" CPU time and peak memory of padded multi head cross attention over segments, with per head repeated masks as the
+query encoder ran it, vs ragged_cross_attention (modules/layers/ragged.py) with the same weights, the max abs diff of
+the outputs is reported
+
+python -m benchmarks.ragged_segments
+"""
+import time
+
+import torch
+import torch.nn as nn
+from torch.profiler import profile, ProfilerActivity
+
+from modules.layers.ragged import lengths_to_cu_seqlens, ragged_cross_attention, ragged_to_padded
+from modules.utils import profiler_peak_cpu_memory
+
+
+def benchmark_ragged_segments(segment_counts=(6000, 800, 400, 200), num_queries=120, hidden_size=768, num_heads=12, repeat=3, seed=0):
+    torch.manual_seed(seed)
+    attn = nn.MultiheadAttention(hidden_size, num_heads, batch_first=True, add_zero_attn=True).eval()
+    lengths = torch.tensor(segment_counts)
+    cu_seqlens = lengths_to_cu_seqlens(lengths)
+    query = torch.randn(len(lengths), num_queries, hidden_size)
+    flat = torch.randn(int(cu_seqlens[-1]), hidden_size)
+    flat_mask = torch.rand(len(flat), num_queries) < 0.7
+    padded = ragged_to_padded(flat, cu_seqlens)
+    padded_mask = ragged_to_padded(flat_mask, cu_seqlens, pad=True).permute(0, 2, 1)
+
+    def run_padded():
+        mask = padded_mask.clone()
+        mask[mask.all(-1)] = False
+        mask = mask.repeat_interleave(num_heads, 0)
+        return attn(query, padded, padded, attn_mask=mask)[0]
+
+    def run_ragged():
+        return ragged_cross_attention(attn, query, flat, flat, cu_seqlens, flat_mask)
+
+    outputs = {}
+    for name, run_fn in [('padded', run_padded), ('ragged', run_ragged)]:
+        elapsed = []
+        for _ in range(repeat):
+            with torch.no_grad(), profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+                start = time.time()
+                outputs[name] = run_fn()
+                elapsed.append(time.time() - start)
+        print(f"segments {list(segment_counts)} {name}: {min(elapsed) * 1000:.1f} ms, peak memory {profiler_peak_cpu_memory(prof) / 2 ** 20:.1f} MB")
+    # rows whose segments are all masked differ by design, the padded path lets them attend to padding
+    full = padded_mask.all(-1).logical_not()
+    print(f"segments {list(segment_counts)} max abs diff {(outputs['padded'] - outputs['ragged']).abs()[full].max().item():.2e}")
+
+
+if __name__ == '__main__':
+    benchmark_ragged_segments()
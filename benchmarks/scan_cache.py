@@ -0,0 +1,35 @@
+""" Iterate a synthetic split larger than the scan cache budget (data/scan_cache.py), resident bytes must stay bounded
+
+python -m benchmarks.scan_cache --num_scans 200 --points_per_scan 200000 --max_mb 256
+"""
+import argparse
+
+import numpy as np
+
+from data.scan_cache import ScanCache, nbytes_of
+
+
+def stress_scan_cache(num_scans=200, points_per_scan=200000, max_bytes=256 * 2 ** 20, num_epochs=2):
+    def load_fn(scan_id):
+        return {'sub_frames': {0: {'pcds': np.random.rand(points_per_scan, 6).astype(np.float32),
+                                   'segment_id': np.random.randint(0, 100, points_per_scan)}}}
+    cache = ScanCache([f'scan{i:04d}' for i in range(num_scans)], load_fn, max_bytes)
+    split_bytes = num_scans * nbytes_of(load_fn(None))
+    peak_bytes = 0
+    for _ in range(num_epochs):
+        for scan_id in np.random.permutation(cache.scan_ids):
+            cache[scan_id]['sub_frames'][0]['pcds'].sum()
+            peak_bytes = max(peak_bytes, cache.total_bytes)
+    print(f"split {split_bytes / 2 ** 20:.0f} MB, budget {max_bytes / 2 ** 20:.0f} MB, peak resident {peak_bytes / 2 ** 20:.0f} MB, cached scans {len(cache.scans)}")
+    assert peak_bytes <= max_bytes
+    return {'split_bytes': split_bytes, 'peak_bytes': peak_bytes}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_scans', type=int, default=200)
+    parser.add_argument('--points_per_scan', type=int, default=200000)
+    parser.add_argument('--max_mb', type=int, default=256)
+    parser.add_argument('--num_epochs', type=int, default=2)
+    args = parser.parse_args()
+    stress_scan_cache(args.num_scans, args.points_per_scan, args.max_mb * 2 ** 20, args.num_epochs)
@@ -0,0 +1,88 @@
+""" Scan directory index: per scan listdir vs the grouped index on a synthetic tree, and dataset __init__ end to end
+without a manifest, building the manifest and reading it back
+
+python -m benchmarks.scan_index
+python -m benchmarks.scan_index --config configs/embodied-pq3d-final/embodied_scan_instseg.yaml --datasets EmbodiedScanInstSegHM3D \
+    --scan_index_dir <manifest dir> data.embodied_base=... data.scene_verse_base=...
+
+every dataset __init__ runs in a fresh process, the index cache of one run does not leak into the next
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing as mp
+
+from omegaconf import OmegaConf
+
+from data import scan_index
+from data.scan_index import ScanDirectoryIndex, get_scan_index
+
+
+def benchmark_scan_index(num_scans=2000, files_per_scan=50):
+    # per scan listdir + startswith filter vs one indexed listing on a synthetic tree of num_scans * files_per_scan files
+    root = tempfile.mkdtemp()
+    try:
+        scan_ids = [f'{i:05d}-scan{i:07d}' for i in range(num_scans)]
+        for scan_id in scan_ids:
+            for j in range(files_per_scan):
+                open(os.path.join(root, f'{scan_id}_{j:03d}.pth'), 'w').close()
+        start = time.time()
+        listed = {scan_id: sorted(x for x in os.listdir(root) if x.startswith(scan_id)) for scan_id in scan_ids}
+        listdir_time = time.time() - start
+        scan_index._SCAN_INDEX.clear()
+        start = time.time()
+        indexed = get_scan_index(root).group(scan_ids)
+        index_time = time.time() - start
+        assert listed == indexed
+        manifest_dir = os.path.join(root + '_manifest')
+        ScanDirectoryIndex(root, manifest_dir)
+        start = time.time()
+        ScanDirectoryIndex(root, manifest_dir).group(scan_ids)
+        manifest_time = time.time() - start
+        shutil.rmtree(manifest_dir)
+        print(f"{num_scans * files_per_scan} files: listdir per scan {listdir_time:.2f} s, index {index_time:.3f} s, from manifest {manifest_time:.3f} s")
+    finally:
+        shutil.rmtree(root)
+
+
+def _init_dataset(cfg, dataset_name, split, queue):
+    import data  # noqa: F401, fills the dataset registry
+    from data.build import DATASET_REGISTRY
+    start = time.time()
+    dataset = DATASET_REGISTRY.get(dataset_name)(cfg, split)
+    queue.put((time.time() - start, len(dataset)))
+
+
+def benchmark_dataset_init(cfg, datasets, scan_index_dir, split='train'):
+    ctx = mp.get_context('spawn')
+    results = []
+    for dataset_name in datasets:
+        if os.path.exists(scan_index_dir):
+            shutil.rmtree(scan_index_dir)
+        for name, manifest_dir in [('listdir', None), ('build manifest', scan_index_dir), ('read manifest', scan_index_dir)]:
+            run_cfg = cfg.copy()
+            OmegaConf.update(run_cfg, 'data.load_scan_options.scan_index_dir', manifest_dir, force_add=True)
+            queue = ctx.Queue()
+            process = ctx.Process(target=_init_dataset, args=(run_cfg, dataset_name, split, queue))
+            process.start()
+            elapsed, size = queue.get()
+            process.join()
+            print(f"{dataset_name} {name}: __init__ {elapsed:.1f} s, {size} samples")
+            results.append({'dataset': dataset_name, 'index': name, 'init_s': elapsed, 'size': size})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=None, help='time dataset __init__ of this config, otherwise the synthetic tree only')
+    parser.add_argument('--datasets', nargs='+', default=['EmbodiedScanInstSegHM3D'])
+    parser.add_argument('--scan_index_dir', default=None)
+    parser.add_argument('--split', default='train')
+    args, overrides = parser.parse_known_args()
+    benchmark_scan_index()
+    if args.config is not None:
+        assert args.scan_index_dir is not None
+        cfg = OmegaConf.merge(OmegaConf.load(args.config), OmegaConf.from_dotlist(overrides))
+        benchmark_dataset_init(cfg, args.datasets, args.scan_index_dir, args.split)
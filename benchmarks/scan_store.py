@@ -0,0 +1,86 @@
+""" Load throughput and descriptors left open of loose embodied scan files vs packed scans (data/scan_store.py),
+read as copies and as mmap views (load_scan_options.packed_scan_mmap), every array is touched once
+
+python -m data.scan_store --embodied_base <embodied_base> --dataset ScanNet --out_dir <packed_dir>
+python -m benchmarks.scan_store --embodied_base <embodied_base> --dataset ScanNet --packed_dir <packed_dir>
+"""
+import os
+import time
+import argparse
+from functools import partial
+
+import numpy as np
+
+from data.scan_store import EMBODIED_SCAN_KINDS, PackedScan, open_fd_count, packed_scan_path
+
+
+def drop_page_cache(paths):
+    # evict files from the page cache so that reads hit the disk, without root unlike /proc/sys/vm/drop_caches
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def benchmark_scan_store(embodied_base_dir, dataset_name, scan_ids, packed_dir, cold=True):
+    # cold: page cache of the benchmarked files is dropped before each layout
+    def load_loose(scan_id):
+        base = os.path.join(embodied_base_dir, dataset_name)
+        nbytes = 0
+        for sub_frame in os.listdir(os.path.join(base, 'points', scan_id)):
+            for kind, (dtype, _) in EMBODIED_SCAN_KINDS.items():
+                array = np.fromfile(os.path.join(base, kind, scan_id, sub_frame), dtype=dtype)
+                array.sum()
+                nbytes += array.nbytes
+            img_feat_path = os.path.join(base, 'img_feat', scan_id, sub_frame.split('.')[0] + '.npy')
+            if os.path.exists(img_feat_path):
+                array = np.load(img_feat_path)
+                array.sum()
+                nbytes += array.nbytes
+        for kind in ['points_global', 'instance_mask_global']:
+            global_path = os.path.join(base, kind, f'{scan_id}.bin')
+            if os.path.exists(global_path):
+                array = np.fromfile(global_path, dtype=EMBODIED_SCAN_KINDS[kind.replace('_global', '')][0])
+                array.sum()
+                nbytes += array.nbytes
+        return nbytes
+
+    def load_packed(scan_id, mmap):
+        nbytes = 0
+        with PackedScan(packed_scan_path(packed_dir, dataset_name, scan_id), mmap=mmap) as scan:
+            for name in scan.keys():
+                array = scan.get(name)
+                array.sum()
+                nbytes += array.nbytes
+        return nbytes
+
+    def loose_paths():
+        for root, _, files in os.walk(os.path.join(embodied_base_dir, dataset_name)):
+            yield from (os.path.join(root, f) for f in files)
+
+    packed_paths = [packed_scan_path(packed_dir, dataset_name, scan_id) for scan_id in scan_ids]
+    results = {}
+    for name, load_fn, paths in [('loose', load_loose, loose_paths), ('packed', partial(load_packed, mmap=False), lambda: packed_paths),
+                                 ('packed mmap', partial(load_packed, mmap=True), lambda: packed_paths)]:
+        if cold:
+            drop_page_cache(paths())
+        fds = open_fd_count()
+        start = time.time()
+        nbytes = sum(load_fn(scan_id) for scan_id in scan_ids)
+        elapsed = time.time() - start
+        results[name] = {'scans_per_s': len(scan_ids) / elapsed, 'mb_per_s': nbytes / elapsed / 2 ** 20, 'open_fds': open_fd_count() - fds}
+        print(f"{name}: {results[name]['scans_per_s']:.2f} scans/s, {results[name]['mb_per_s']:.1f} MB/s, {results[name]['open_fds']} fds left open")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--embodied_base', required=True)
+    parser.add_argument('--dataset', default='ScanNet', choices=['ScanNet', 'HM3D'])
+    parser.add_argument('--packed_dir', required=True)
+    parser.add_argument('--warm', action='store_true', help='benchmark with the page cache kept')
+    args = parser.parse_args()
+    scan_ids = sorted(os.listdir(os.path.join(args.embodied_base, args.dataset, 'points')))
+    benchmark_scan_store(args.embodied_base, args.dataset, scan_ids, args.packed_dir, cold=not args.warm)
@@ -0,0 +1,40 @@
+""" CPU time and peak memory of full vs chunked spatial self attention (MultiHeadAttentionSpatial chunk_size),
+the max abs diff of the outputs is reported
+
+python -m benchmarks.spatial_attention
+"""
+import time
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+from modules.layers.transformers import MultiHeadAttentionSpatial
+from modules.utils import calc_pairwise_locs, profiler_peak_cpu_memory
+
+
+def benchmark_spatial_attention(lengths=(100, 400, 1000), chunk_size=128, batch_size=2, d_model=768, n_head=12, repeat=3):
+    attn = MultiHeadAttentionSpatial(d_model, n_head, spatial_dim=5, spatial_attn_fusion='mul').eval()
+    for length in lengths:
+        x = torch.randn(batch_size, length, d_model)
+        obj_centers = torch.rand(batch_size, length, 3) * 10
+        key_padding_mask = torch.zeros(batch_size, length, dtype=torch.bool)
+        key_padding_mask[0, length // 2:] = True
+        outputs = {}
+        for chunk in [None, chunk_size]:
+            attn.chunk_size = chunk
+            elapsed = []
+            for _ in range(repeat):
+                with torch.no_grad(), profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+                    start = time.time()
+                    if chunk is None:
+                        pairwise_locs = calc_pairwise_locs(obj_centers, None, pairwise_rel_type='center', spatial_dist_norm=True, spatial_dim=5)
+                    else:
+                        pairwise_locs = obj_centers
+                    outputs[chunk] = attn(x, x, x, pairwise_locs, key_padding_mask=key_padding_mask)[0]
+                    elapsed.append(time.time() - start)
+            print(f"L {length} chunk {chunk}: {min(elapsed) * 1000:.1f} ms, peak memory {profiler_peak_cpu_memory(prof) / 2 ** 20:.1f} MB")
+        print(f"L {length} max abs diff {(outputs[None] - outputs[chunk_size]).abs().max().item():.2e}")
+
+
+if __name__ == '__main__':
+    benchmark_spatial_attention()
@@ -0,0 +1,30 @@
+""" Throughput of data/voxelize.py sparse_quantize against MinkowskiEngine sparse_quantize on random room sized clouds,
+with the same call as get_scene
+
+python -m benchmarks.voxelizer
+"""
+import time
+
+import torch
+import MinkowskiEngine as ME
+
+from data.voxelize import sparse_quantize
+
+
+def benchmark_voxelizer(num_points_list=(100000, 500000, 1000000, 2000000), voxel_size=0.02, repeat=5):
+    for num_points in num_points_list:
+        coordinates = torch.rand(num_points, 3) * torch.tensor([8.0, 8.0, 3.0])
+        voxel_coordinates = torch.floor(coordinates / voxel_size)
+        timing = {}
+        for name, fn in [('minkowski', ME.utils.sparse_quantize), ('torch', sparse_quantize)]:
+            start = time.time()
+            for _ in range(repeat):
+                unique_coords, unique_map, inverse_map = fn(voxel_coordinates, return_index=True, return_inverse=True)
+            timing[name] = (time.time() - start) / repeat
+            # both must describe the same voxelization
+            assert torch.equal(voxel_coordinates[unique_map][inverse_map].long(), voxel_coordinates.long())
+        print(f"{num_points} points, {len(unique_map)} voxels: " + ", ".join(f"{k} {v * 1000:.1f} ms ({num_points / v / 1e6:.1f} M pts/s)" for k, v in timing.items()))
+
+
+if __name__ == '__main__':
+    benchmark_voxelizer()
@@ -13,7 +13,9 @@ import json
 from uuid import uuid4
 import numpy as np
 
-def eval_instseg_flexible(pred, gt_ids, CLASS_LABELS):
+from common.dist_utils import all_gather_unaligned
+
+def instseg_meta(CLASS_LABELS):
     # preparse meta data
     VALID_CLASS_IDS = np.array([(i + 1) for i in range(len(CLASS_LABELS))])
     ID_TO_LABEL = {}
@@ -29,6 +31,10 @@ def eval_instseg_flexible(pred, gt_ids, CLASS_LABELS):
     opt['distance_threshes']    = np.array( [  float('inf') ] )
     # distance confidences
     opt['distance_confs']       = np.array( [ -float('inf') ] )
+    return VALID_CLASS_IDS, ID_TO_LABEL, opt
+
+def eval_instseg_flexible(pred, gt_ids, CLASS_LABELS):
+    VALID_CLASS_IDS, ID_TO_LABEL, opt = instseg_meta(CLASS_LABELS)
     # get matches
     matches = {}
     for scan_id in pred.keys():
@@ -41,7 +47,112 @@ def eval_instseg_flexible(pred, gt_ids, CLASS_LABELS):
     ap_scores = evaluate_matches(matches, CLASS_LABELS, opt)
     avgs = compute_averages(ap_scores, CLASS_LABELS, opt)
     return avgs
-    
+
+'''
+compact AP statistics, what evaluate_matches needs from a set of scans:
+    true / score: per class and overlap the true positive flags (uint8) and scores (float64) of the matched entries
+    counts: (classes, overlaps, 3) hard false negatives, scans with gt, scans with pred
+statistics of disjoint scan sets are merged by concatenating the entries and summing the counts, AP only depends on
+the merged multiset of entries so the result equals eval_instseg_flexible over all scans
+'''
+def empty_instseg_stats(CLASS_LABELS):
+    _, _, opt = instseg_meta(CLASS_LABELS)
+    shape = (len(CLASS_LABELS), len(opt['overlaps']))
+    return {'true': [[np.empty(0, dtype=np.uint8) for _ in range(shape[1])] for _ in range(shape[0])],
+            'score': [[np.empty(0) for _ in range(shape[1])] for _ in range(shape[0])],
+            'counts': np.zeros((*shape, 3), dtype=np.int64)}
+
+def scan_instseg_stats(pred, gt_ids, CLASS_LABELS):
+    # statistics of one scan, its masks are not needed afterwards
+    VALID_CLASS_IDS, ID_TO_LABEL, opt = instseg_meta(CLASS_LABELS)
+    cur_pred = {'pred_scores': pred['pred_scores'], 'pred_masks': pred['pred_masks'], 'pred_classes': pred['pred_classes']}
+    gt2pred, pred2gt = assign_instances_for_scan(cur_pred, gt_ids, VALID_CLASS_IDS, CLASS_LABELS, ID_TO_LABEL, opt)
+    stats = empty_instseg_stats(CLASS_LABELS)
+    for oi, overlap_th in enumerate(opt['overlaps']):
+        # prediction uuids are unique to the scan, so the visited flags of other scans never interact
+        pred_visited = {p['uuid']: False for label_name in CLASS_LABELS for p in pred2gt[label_name]}
+        for li, label_name in enumerate(CLASS_LABELS):
+            cur_true, cur_score, hard_false_negatives, has_gt, has_pred = scan_match_scores(
+                gt2pred[label_name], pred2gt[label_name], pred_visited, overlap_th,
+                opt['min_region_sizes'][0], opt['distance_threshes'][0], opt['distance_confs'][0])
+            stats['true'][li][oi] = cur_true.astype(np.uint8)
+            stats['score'][li][oi] = cur_score
+            stats['counts'][li, oi] = [hard_false_negatives, has_gt, has_pred]
+    return stats
+
+def merge_instseg_stats(stats_list, CLASS_LABELS):
+    merged = empty_instseg_stats(CLASS_LABELS)
+    if len(stats_list) == 0:
+        return merged
+    num_classes, num_overlaps = merged['counts'].shape[:2]
+    for li in range(num_classes):
+        for oi in range(num_overlaps):
+            merged['true'][li][oi] = np.concatenate([merged['true'][li][oi]] + [stats['true'][li][oi] for stats in stats_list])
+            merged['score'][li][oi] = np.concatenate([merged['score'][li][oi]] + [stats['score'][li][oi] for stats in stats_list])
+    merged['counts'] = sum(stats['counts'] for stats in stats_list)
+    return merged
+
+def eval_instseg_stats(stats, CLASS_LABELS):
+    _, _, opt = instseg_meta(CLASS_LABELS)
+    ap = np.zeros( (1, len(CLASS_LABELS), len(opt['overlaps'])) , float )
+    for li in range(len(CLASS_LABELS)):
+        for oi in range(len(opt['overlaps'])):
+            hard_false_negatives, has_gt, has_pred = stats['counts'][li, oi]
+            if has_gt and has_pred:
+                ap[0, li, oi] = average_precision(stats['true'][li][oi].astype(np.float64), stats['score'][li][oi], int(hard_false_negatives))
+            elif has_gt:
+                ap[0, li, oi] = 0.0
+            else:
+                ap[0, li, oi] = float('nan')
+    return compute_averages(ap, CLASS_LABELS, opt)
+
+class InstSegAPAccumulator:
+    ''' Streaming AP, add() reduces one scan's predictions and gt ids to its statistics, the masks can be freed right after
+    only the non empty (class, overlap) entries of a scan are kept, compute() equals eval_instseg_flexible over the added scans
+    '''
+    def __init__(self, CLASS_LABELS):
+        self.CLASS_LABELS = CLASS_LABELS
+        self.reset()
+
+    def reset(self):
+        stats = empty_instseg_stats(self.CLASS_LABELS)
+        self.true = [[[] for _ in row] for row in stats['true']]
+        self.score = [[[] for _ in row] for row in stats['score']]
+        self.counts = stats['counts']
+        self.num_scans = 0
+
+    def add(self, pred, gt_ids):
+        stats = scan_instseg_stats(pred, gt_ids, self.CLASS_LABELS)
+        for li, oi in zip(*np.nonzero([[len(score) > 0 for score in row] for row in stats['score']])):
+            self.true[li][oi].append(stats['true'][li][oi])
+            self.score[li][oi].append(stats['score'][li][oi])
+        self.counts += stats['counts']
+        self.num_scans += 1
+
+    def stats(self):
+        stats = empty_instseg_stats(self.CLASS_LABELS)
+        for li in range(len(self.true)):
+            for oi in range(len(self.true[li])):
+                if self.true[li][oi]:
+                    stats['true'][li][oi] = np.concatenate(self.true[li][oi])
+                    stats['score'][li][oi] = np.concatenate(self.score[li][oi])
+        stats['counts'] = self.counts.copy()
+        return stats
+
+    def compute(self, reduce=False):
+        # reduce: every rank added its own scans, the statistics of all ranks are gathered
+        stats = self.stats()
+        if reduce:
+            stats = merge_instseg_stats(all_gather_unaligned(stats), self.CLASS_LABELS)
+        return eval_instseg_stats(stats, self.CLASS_LABELS)
+
+def eval_instseg_reduced(pred, gt_ids, CLASS_LABELS):
+    # scan sharded evaluation, every rank passes only its own scans and only their statistics are gathered
+    accumulator = InstSegAPAccumulator(CLASS_LABELS)
+    for scan_id in pred.keys():
+        accumulator.add(pred[scan_id], gt_ids[scan_id])
+    return accumulator.compute(reduce=True)
+
 def make_pred_info(pred: dict):
     # pred = {'pred_scores' = 100, 'pred_classes' = 100 'pred_masks' = Nx100}
     pred_info = {}
@@ -168,6 +279,128 @@ def assign_instances_for_scan(pred: dict, gt_ids: dict, VALID_CLASS_IDS: np.arra
 
     return gt2pred, pred2gt
 
+def scan_match_scores(gt_instances, pred_instances, pred_visited, overlap_th, min_region_size, distance_thresh, distance_conf):
+    # true / false positive flags and scores of one scan and class at one overlap, as the scans loop of evaluate_matches
+    has_gt = False
+    has_pred = False
+    hard_false_negatives = 0
+    # filter groups in ground truth
+    gt_instances = [ gt for gt in gt_instances if gt['instance_id']>=1000 and gt['vert_count']>=min_region_size and gt['med_dist']<=distance_thresh and gt['dist_conf']>=distance_conf ]
+    if gt_instances:
+        has_gt = True
+    if pred_instances:
+        has_pred = True
+
+    cur_true  = np.ones ( len(gt_instances) )
+    cur_score = np.ones ( len(gt_instances) ) * (-float("inf"))
+    cur_match = np.zeros( len(gt_instances) , dtype=bool )
+    # collect matches
+    for (gti,gt) in enumerate(gt_instances):
+        found_match = False
+        num_pred = len(gt['matched_pred'])
+        for pred in gt['matched_pred']:
+            # greedy assignments
+            if pred_visited[pred['uuid']]:
+                continue
+            overlap = float(pred['intersection']) / (gt['vert_count']+pred['vert_count']-pred['intersection'])
+            if overlap > overlap_th:
+                confidence = pred['confidence']
+                # if already have a prediction for this gt,
+                # the prediction with the lower score is automatically a false positive
+                if cur_match[gti]:
+                    max_score = max( cur_score[gti] , confidence )
+                    min_score = min( cur_score[gti] , confidence )
+                    cur_score[gti] = max_score
+                    # append false positive
+                    cur_true  = np.append(cur_true,0)
+                    cur_score = np.append(cur_score,min_score)
+                    cur_match = np.append(cur_match,True)
+                # otherwise set score
+                else:
+                    found_match = True
+                    cur_match[gti] = True
+                    cur_score[gti] = confidence
+                    pred_visited[pred['uuid']] = True
+        if not found_match:
+            hard_false_negatives += 1
+    # remove non-matched ground truth instances
+    cur_true  = cur_true [ cur_match==True ]
+    cur_score = cur_score[ cur_match==True ]
+
+    # collect non-matched predictions as false positive
+    for pred in pred_instances:
+        found_gt = False
+        for gt in pred['matched_gt']:
+            overlap = float(gt['intersection']) / (gt['vert_count']+pred['vert_count']-gt['intersection'])
+            if overlap > overlap_th:
+                found_gt = True
+                break
+        if not found_gt:
+            num_ignore = pred['void_intersection']
+            for gt in pred['matched_gt']:
+                # group?
+                if gt['instance_id'] < 1000:
+                    num_ignore += gt['intersection']
+                # small ground truth instances
+                if gt['vert_count'] < min_region_size or gt['med_dist']>distance_thresh or gt['dist_conf']<distance_conf:
+                    num_ignore += gt['intersection']
+            proportion_ignore = float(num_ignore)/pred['vert_count']
+            # if not ignored append false positive
+            if proportion_ignore <= overlap_th:
+                cur_true = np.append(cur_true,0)
+                confidence = pred["confidence"]
+                cur_score = np.append(cur_score,confidence)
+    return cur_true, cur_score, hard_false_negatives, has_gt, has_pred
+
+def average_precision(y_true, y_score, hard_false_negatives):
+    # compute precision recall curve first
+
+    # sorting and cumsum
+    score_arg_sort      = np.argsort(y_score)
+    y_score_sorted      = y_score[score_arg_sort]
+    y_true_sorted       = y_true[score_arg_sort]
+    y_true_sorted_cumsum = np.cumsum(y_true_sorted)
+
+    # unique thresholds
+    (thresholds,unique_indices) = np.unique( y_score_sorted , return_index=True )
+    num_prec_recall = len(unique_indices) + 1
+
+    # prepare precision recall
+    num_examples      = len(y_score_sorted)
+    # https://github.com/ScanNet/ScanNet/pull/26
+    # all predictions are non-matched but also all of them are ignored and not counted as FP
+    # y_true_sorted_cumsum is empty
+    # num_true_examples = y_true_sorted_cumsum[-1]
+    num_true_examples = y_true_sorted_cumsum[-1] if len(y_true_sorted_cumsum) > 0 else 0
+    precision         = np.zeros(num_prec_recall)
+    recall            = np.zeros(num_prec_recall)
+
+    # deal with the first point
+    y_true_sorted_cumsum = np.append( y_true_sorted_cumsum , 0 )
+    # deal with remaining
+    for idx_res,idx_scores in enumerate(unique_indices):
+        cumsum = y_true_sorted_cumsum[idx_scores-1]
+        tp = num_true_examples - cumsum
+        fp = num_examples      - idx_scores - tp
+        fn = cumsum + hard_false_negatives
+        p  = float(tp)/(tp+fp)
+        r  = float(tp)/(tp+fn)
+        precision[idx_res] = p
+        recall   [idx_res] = r
+
+    # first point in curve is artificial
+    precision[-1] = 1.
+    recall   [-1] = 0.
+
+    # compute average of precision-recall curve
+    recall_for_conv = np.copy(recall)
+    recall_for_conv = np.append(recall_for_conv[0], recall_for_conv)
+    recall_for_conv = np.append(recall_for_conv, 0.)
+
+    stepWidths = np.convolve(recall_for_conv,[-0.5,0,0.5],'valid')
+    # integrate is now simply a dot product
+    return np.dot(precision, stepWidths)
+
 def evaluate_matches(matches, CLASS_LABELS, opt):
     overlaps = opt['overlaps']
     min_region_sizes = [ opt['min_region_sizes'][0] ]
@@ -192,129 +425,18 @@ def evaluate_matches(matches, CLASS_LABELS, opt):
                 has_gt = False
                 has_pred = False
                 for m in matches:
-                    pred_instances = matches[m]['pred'][label_name]
-                    gt_instances = matches[m]['gt'][label_name]
-                    # filter groups in ground truth
-                    gt_instances = [ gt for gt in gt_instances if gt['instance_id']>=1000 and gt['vert_count']>=min_region_size and gt['med_dist']<=distance_thresh and gt['dist_conf']>=distance_conf ]
-                    if gt_instances:
-                        has_gt = True
-                    if pred_instances:
-                        has_pred = True
-
-                    cur_true  = np.ones ( len(gt_instances) )
-                    cur_score = np.ones ( len(gt_instances) ) * (-float("inf"))
-                    cur_match = np.zeros( len(gt_instances) , dtype=bool )
-                    # collect matches
-                    for (gti,gt) in enumerate(gt_instances):
-                        found_match = False
-                        num_pred = len(gt['matched_pred'])
-                        for pred in gt['matched_pred']:
-                            # greedy assignments
-                            if pred_visited[pred['uuid']]:
-                                continue
-                            overlap = float(pred['intersection']) / (gt['vert_count']+pred['vert_count']-pred['intersection'])
-                            if overlap > overlap_th:
-                                confidence = pred['confidence']
-                                # if already have a prediction for this gt,
-                                # the prediction with the lower score is automatically a false positive
-                                if cur_match[gti]:
-                                    max_score = max( cur_score[gti] , confidence )
-                                    min_score = min( cur_score[gti] , confidence )
-                                    cur_score[gti] = max_score
-                                    # append false positive
-                                    cur_true  = np.append(cur_true,0)
-                                    cur_score = np.append(cur_score,min_score)
-                                    cur_match = np.append(cur_match,True)
-                                # otherwise set score
-                                else:
-                                    found_match = True
-                                    cur_match[gti] = True
-                                    cur_score[gti] = confidence
-                                    pred_visited[pred['uuid']] = True
-                        if not found_match:
-                            hard_false_negatives += 1
-                    # remove non-matched ground truth instances
-                    cur_true  = cur_true [ cur_match==True ]
-                    cur_score = cur_score[ cur_match==True ]
-
-                    # collect non-matched predictions as false positive
-                    for pred in pred_instances:
-                        found_gt = False
-                        for gt in pred['matched_gt']:
-                            overlap = float(gt['intersection']) / (gt['vert_count']+pred['vert_count']-gt['intersection'])
-                            if overlap > overlap_th:
-                                found_gt = True
-                                break
-                        if not found_gt:
-                            num_ignore = pred['void_intersection']
-                            for gt in pred['matched_gt']:
-                                # group?
-                                if gt['instance_id'] < 1000:
-                                    num_ignore += gt['intersection']
-                                # small ground truth instances
-                                if gt['vert_count'] < min_region_size or gt['med_dist']>distance_thresh or gt['dist_conf']<distance_conf:
-                                    num_ignore += gt['intersection']
-                            proportion_ignore = float(num_ignore)/pred['vert_count']
-                            # if not ignored append false positive
-                            if proportion_ignore <= overlap_th:
-                                cur_true = np.append(cur_true,0)
-                                confidence = pred["confidence"]
-                                cur_score = np.append(cur_score,confidence)
-
+                    cur_true, cur_score, cur_false_negatives, cur_has_gt, cur_has_pred = scan_match_scores(
+                        matches[m]['gt'][label_name], matches[m]['pred'][label_name], pred_visited, overlap_th, min_region_size, distance_thresh, distance_conf)
+                    hard_false_negatives += cur_false_negatives
+                    has_gt = has_gt or cur_has_gt
+                    has_pred = has_pred or cur_has_pred
                     # append to overall results
                     y_true  = np.append(y_true,cur_true)
                     y_score = np.append(y_score,cur_score)
 
                 # compute average precision
                 if has_gt and has_pred:
-                    # compute precision recall curve first
-
-                    # sorting and cumsum
-                    score_arg_sort      = np.argsort(y_score)
-                    y_score_sorted      = y_score[score_arg_sort]
-                    y_true_sorted       = y_true[score_arg_sort]
-                    y_true_sorted_cumsum = np.cumsum(y_true_sorted)
-
-                    # unique thresholds
-                    (thresholds,unique_indices) = np.unique( y_score_sorted , return_index=True )
-                    num_prec_recall = len(unique_indices) + 1
-
-                    # prepare precision recall
-                    num_examples      = len(y_score_sorted)
-                    # https://github.com/ScanNet/ScanNet/pull/26
-                    # all predictions are non-matched but also all of them are ignored and not counted as FP
-                    # y_true_sorted_cumsum is empty
-                    # num_true_examples = y_true_sorted_cumsum[-1]
-                    num_true_examples = y_true_sorted_cumsum[-1] if len(y_true_sorted_cumsum) > 0 else 0
-                    precision         = np.zeros(num_prec_recall)
-                    recall            = np.zeros(num_prec_recall)
-
-                    # deal with the first point
-                    y_true_sorted_cumsum = np.append( y_true_sorted_cumsum , 0 )
-                    # deal with remaining
-                    for idx_res,idx_scores in enumerate(unique_indices):
-                        cumsum = y_true_sorted_cumsum[idx_scores-1]
-                        tp = num_true_examples - cumsum
-                        fp = num_examples      - idx_scores - tp
-                        fn = cumsum + hard_false_negatives
-                        p  = float(tp)/(tp+fp)
-                        r  = float(tp)/(tp+fn)
-                        precision[idx_res] = p
-                        recall   [idx_res] = r
-
-                    # first point in curve is artificial
-                    precision[-1] = 1.
-                    recall   [-1] = 0.
-
-                    # compute average of precision-recall curve
-                    recall_for_conv = np.copy(recall)
-                    recall_for_conv = np.append(recall_for_conv[0], recall_for_conv)
-                    recall_for_conv = np.append(recall_for_conv, 0.)
-
-                    stepWidths = np.convolve(recall_for_conv,[-0.5,0,0.5],'valid')
-                    # integrate is now simply a dot product
-                    ap_current = np.dot(precision, stepWidths)
-
+                    ap_current = average_precision(y_true, y_score, hard_false_negatives)
                 elif has_gt:
                     ap_current = 0.0
                 else:
@@ -339,4 +461,4 @@ def compute_averages(aps, CLASS_LABELS, opt):
         avg_dict["classes"][label_name]["ap"]       = np.average(aps[ d_inf,li,oAllBut25])
         avg_dict["classes"][label_name]["ap50%"]    = np.average(aps[ d_inf,li,o50])
         avg_dict["classes"][label_name]["ap25%"]    = np.average(aps[ d_inf,li,o25])
-    return avg_dict
\ No newline at end of file
+    return avg_dict
@@ -0,0 +1,216 @@
+import time
+from collections import deque
+
+import numpy as np
+from torch.utils.data import Sampler, ConcatDataset, DataLoader
+
+from data.rank_shard import assign_scans
+
+
+def get_sample_sizes(dataset):
+    # per index cost columns (e.g. voxel and segment counts), looked up through ConcatDataset and wrappers holding .dataset
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([get_sample_sizes(d) for d in dataset.datasets], axis=0)
+    if hasattr(dataset, 'sample_sizes'):
+        sizes = np.asarray(dataset.sample_sizes())
+    elif hasattr(dataset, 'dataset'):
+        sizes = get_sample_sizes(dataset.dataset)
+    else:
+        raise NotImplementedError(f"Unknow sample sizes of {dataset.__class__.__name__}")
+    assert len(sizes) == len(dataset), f'{len(sizes)} sizes for {len(dataset)} samples of {dataset.__class__.__name__}'
+    return sizes.reshape(len(sizes), -1)
+
+
+def get_sample_scan_ids(dataset):
+    # scan id of every index in dataset order, looked up as get_sample_sizes
+    if isinstance(dataset, ConcatDataset):
+        return [scan_id for d in dataset.datasets for scan_id in get_sample_scan_ids(d)]
+    if hasattr(dataset, 'sample_scan_ids'):
+        scan_ids = list(dataset.sample_scan_ids())
+    elif hasattr(dataset, 'dataset'):
+        scan_ids = get_sample_scan_ids(dataset.dataset)
+    else:
+        raise NotImplementedError(f"Unknow sample scan ids of {dataset.__class__.__name__}")
+    assert len(scan_ids) == len(dataset), f'{len(scan_ids)} scan ids for {len(dataset)} samples of {dataset.__class__.__name__}'
+    return scan_ids
+
+
+def supports_scan_stream(dataset):
+    # ScanStreamBatchSampler needs the scan id of every index and the evaluators need last_frame, datasets with
+    # sample_scan_ids provide both (data/datasets/embodied_scan.py EmbodiedScanInstseg)
+    if isinstance(dataset, ConcatDataset):
+        return all(supports_scan_stream(d) for d in dataset.datasets)
+    if hasattr(dataset, 'sample_scan_ids'):
+        return True
+    if hasattr(dataset, 'dataset'):
+        return supports_scan_stream(dataset.dataset)
+    return False
+
+
+def padding_efficiency(sizes, batches):
+    # real / padded cost per column, a batch pads every sample to its largest one
+    real = np.zeros(sizes.shape[1])
+    padded = np.zeros(sizes.shape[1])
+    for batch in batches:
+        batch_sizes = sizes[batch]
+        real += batch_sizes.sum(0)
+        padded += len(batch) * batch_sizes.max(0)
+    return real / np.maximum(padded, 1)
+
+
+class BudgetBatchSampler(Sampler):
+    ''' Batches of indices whose padded cost stays within a budget instead of a fixed batch size
+    sizes: (N, K) per sample costs, budgets: K bounds on len(batch) * max cost of the batch (None for no bound)
+    an epoch shuffles the indices, sorts them by cost inside buckets of bucket_size samples and fills batches greedily,
+    batches are then sorted by cost into groups of num_replicas and the groups are shuffled, rank r takes batch r of
+    every group so the ranks of one step get batches of similar cost and all ranks the same number of batches
+    drop_last drops a random remainder of batches instead of repeating the cheapest ones, unless that leaves no group
+    the epoch is set with set_epoch before iterating, the seed must match across ranks
+    '''
+    splits_ranks = True
+
+    def __init__(self, sizes, budgets, max_batch_size=None, num_replicas=1, rank=None, bucket_size=1000, shuffle=True, seed=0, drop_last=False):
+        self.sizes = np.asarray(sizes).reshape(len(sizes), -1)
+        assert len(budgets) == self.sizes.shape[1]
+        self.budgets = np.array([np.inf if b is None else b for b in budgets], dtype=np.float64)
+        self.max_batch_size = max_batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.batch_size = None
+        self.epoch = 0
+        self._batches = None # (epoch, batches of all ranks)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _fill(self, indices):
+        batches, batch, batch_max = [], [], np.zeros(self.sizes.shape[1])
+        for index in indices:
+            new_max = np.maximum(batch_max, self.sizes[index])
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if len(batch) > 0 and (full or np.any((len(batch) + 1) * new_max > self.budgets)):
+                batches.append(batch)
+                batch, new_max = [], self.sizes[index].astype(np.float64)
+            batch.append(int(index))
+            batch_max = new_max
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def all_batches(self):
+        # batches of all ranks for the current epoch, rank r owns batches[r::num_replicas]
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.sizes)) if self.shuffle else np.arange(len(self.sizes))
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.sizes[bucket, 0], kind='stable')]
+            batches += self._fill(bucket)
+        # groups of num_replicas batches of similar padded cost
+        costs = np.array([len(batch) * self.sizes[batch, 0].max() for batch in batches])
+        batches = [batches[i] for i in np.argsort(costs, kind='stable')]
+        assert len(batches) > 0, 'no batches to split across ranks'
+        num_groups = len(batches) // self.num_replicas
+        remainder = len(batches) % self.num_replicas
+        if self.drop_last and remainder != 0 and num_groups > 0:
+            # random batches, dropping the end of the cost order would always drop the most expensive ones
+            keep = np.sort(rng.permutation(len(batches))[remainder:])
+            batches = [batches[i] for i in keep]
+        elif remainder != 0:
+            # repeat the cheapest batches, cyclically when there are fewer batches than ranks, so that every rank gets
+            # the same number of steps and at least one, drop_last keeps this one group
+            batches = [batches[i % len(batches)] for i in range(self.num_replicas - remainder)] + batches
+            num_groups += 1
+        assert num_groups > 0
+        groups = [batches[i * self.num_replicas:(i + 1) * self.num_replicas] for i in range(num_groups)]
+        if self.shuffle:
+            groups = [groups[i] for i in rng.permutation(len(groups))]
+        batches = [batch for group in groups for batch in group]
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def rank_batches(self):
+        batches = self.all_batches()
+        return batches if self.rank is None else batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.rank_batches())
+
+    def __len__(self):
+        return len(self.rank_batches())
+
+    def stats(self):
+        batches = self.all_batches()
+        efficiency = padding_efficiency(self.sizes, batches)
+        return {'num_batches': len(batches), 'mean_batch_size': float(np.mean([len(b) for b in batches])),
+                'padding_efficiency': efficiency.tolist()}
+
+
+class ScanStreamBatchSampler(Sampler):
+    ''' Evaluation batches of frames from different scans, every scan keeps its frame order
+    scan_ids: scan id of every index, the indices of a scan are in frame order
+    batch item i is a lane playing one scan at a time from its first to its last frame, an emptied lane takes the next
+    scan (longest first), so consecutive batches carry consecutive frames of the same scans
+    with num_replicas > 1 whole scans are assigned to ranks by frame count (data/rank_shard.py), ranks with fewer
+    batches repeat their last index so that all ranks run the same number of steps, the repeated frame belongs to an
+    already finished scan and is skipped by the evaluators
+    '''
+    splits_ranks = True
+
+    def __init__(self, scan_ids, batch_size, num_replicas=1, rank=0):
+        self.scan_frames = {}
+        for index, scan_id in enumerate(scan_ids):
+            self.scan_frames.setdefault(scan_id, []).append(index)
+        assert len(self.scan_frames) >= num_replicas, f'{len(self.scan_frames)} scans for {num_replicas} ranks'
+        self.lanes = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.batch_size = None
+        scans = list(self.scan_frames.keys())
+        shards = assign_scans(scans, [len(self.scan_frames[s]) for s in scans], num_replicas)
+        rank_batches = [self._stream(shard) for shard in shards]
+        self.num_batches = max(len(batches) for batches in rank_batches)
+        self.batches = rank_batches[rank]
+        self.batches += [[self.batches[-1][-1]]] * (self.num_batches - len(self.batches))
+
+    def _stream(self, scans):
+        queue = deque(sorted(scans, key=lambda s: -len(self.scan_frames[s])))
+        lanes = [deque() for _ in range(self.lanes)]
+        batches = []
+        while True:
+            for lane in lanes:
+                if not lane and queue:
+                    lane.extend(self.scan_frames[queue.popleft()])
+            batch = [lane.popleft() for lane in lanes if lane]
+            if not batch:
+                return batches
+            batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return self.num_batches
+
+
+def benchmark_batch_sampler(dataset, batch_sampler, batch_size, collate_fn=None, num_batches=50, num_workers=0):
+    # padding efficiency of fixed size shuffled batches vs budget batches, and samples/second through a DataLoader
+    sizes = batch_sampler.sizes
+    fixed = np.random.permutation(len(sizes))
+    fixed = [fixed[i:i + batch_size].tolist() for i in range(0, len(fixed) - batch_size + 1, batch_size)]
+    print(f"fixed batch size {batch_size}: {len(fixed)} batches, padding efficiency {padding_efficiency(sizes, fixed)}")
+    print(f"budget batches: {batch_sampler.stats()}")
+    for name, batches in [('fixed', fixed), ('budget', batch_sampler.rank_batches())]:
+        batches = batches[:num_batches]
+        loader = DataLoader(dataset, batch_sampler=batches, collate_fn=collate_fn, num_workers=num_workers)
+        start = time.time()
+        for _ in loader:
+            pass
+        elapsed = time.time() - start
+        print(f"{name}: {sum(len(b) for b in batches) / elapsed:.1f} samples/s over {len(batches)} batches")
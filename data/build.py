@@ -3,6 +3,10 @@ from torch.utils.data import DataLoader, default_collate, ConcatDataset
 from fvcore.common.registry import Registry
 
 from .datasets.dataset_wrapper import DATASETWRAPPER_REGISTRY
+from .batch_sampler import BudgetBatchSampler, ScanStreamBatchSampler, get_sample_sizes, get_sample_scan_ids, supports_scan_stream
+from .rank_shard import RankShardSampler
+from .scan_cache import scan_cache_worker_init
+from common.dist_utils import get_rank, get_world_size, is_root_proc
 
 DATASET_REGISTRY = Registry("dataset")
 DATASET_REGISTRY.__doc__ = """
@@ -55,10 +59,45 @@ def build_dataloader(cfg, split='train'):
     """
     if split == 'train':
         dataset = get_dataset(cfg, split)
+        budget_sampler = cfg.dataloader.get('budget_sampler', None)
+        if cfg.data.get('load_scan_options', {}).get('rank_shard', False):
+            # every rank holds only its own scans, the sampler shuffles the local dataset and evens out the steps
+            assert budget_sampler is None, 'budget_sampler splits a global dataset across ranks'
+            return DataLoader(dataset,
+                              batch_size=cfg.dataloader.batchsize,
+                              sampler=RankShardSampler(len(dataset), seed=cfg.rng_seed),
+                              num_workers=cfg.dataloader.num_workers,
+                              persistent_workers=True if cfg.dataloader.num_workers > 0 else False,
+                              worker_init_fn=scan_cache_worker_init,
+                              collate_fn=getattr(dataset.datasets[0], 'collate_fn', default_collate),
+                              pin_memory=True,
+                              prefetch_factor=cfg.dataloader.get('prefetch_factor', None),
+                              drop_last=True)
+        if budget_sampler is not None:
+            # batches bounded by voxel / segment budgets instead of a fixed batch size, split across ranks by the sampler
+            batch_sampler = BudgetBatchSampler(get_sample_sizes(dataset),
+                                               [budget_sampler.get('voxel_budget', None), budget_sampler.get('segment_budget', None)],
+                                               max_batch_size=budget_sampler.get('max_batch_size', None),
+                                               num_replicas=get_world_size(),
+                                               rank=get_rank(),
+                                               bucket_size=budget_sampler.get('bucket_size', 1000),
+                                               seed=cfg.rng_seed,
+                                               drop_last=True)
+            if is_root_proc():
+                print(f'budget batch sampler: {batch_sampler.stats()}')
+            return DataLoader(dataset,
+                              batch_sampler=batch_sampler,
+                              num_workers=cfg.dataloader.num_workers,
+                              persistent_workers=True if cfg.dataloader.num_workers > 0 else False,
+                              worker_init_fn=scan_cache_worker_init,
+                              collate_fn=getattr(dataset.datasets[0], 'collate_fn', default_collate),
+                              pin_memory=True,
+                              prefetch_factor=cfg.dataloader.get('prefetch_factor', None))
         return DataLoader(dataset,
                           batch_size=cfg.dataloader.batchsize,
                           num_workers=cfg.dataloader.num_workers,
                           persistent_workers=True if cfg.dataloader.num_workers > 0 else False,
+                          worker_init_fn=scan_cache_worker_init,
                           collate_fn=getattr(dataset.datasets[0], 'collate_fn', default_collate),
                           pin_memory=True, # TODO: Test speed
                           prefetch_factor=cfg.dataloader.get('prefetch_factor', None),
@@ -67,11 +106,30 @@ def build_dataloader(cfg, split='train'):
     else:
         loader_list = []
         for dataset in get_dataset(cfg, split):
+            if cfg.dataloader.get('scan_stream_eval', False):
+                # the evaluator streams every loader once scan_stream_eval is set, so a dataset without scan ids can not fall back
+                assert supports_scan_stream(dataset), f'scan_stream_eval is not supported by {dataset.__class__.__name__}, its frames have no scan ids'
+                # batches of frames from different scans, each scan in frame order and on one rank
+                batch_sampler = ScanStreamBatchSampler(get_sample_scan_ids(dataset),
+                                                       cfg.dataloader.get('batchsize_eval', cfg.dataloader.batchsize),
+                                                       num_replicas=get_world_size(),
+                                                       rank=get_rank())
+                loader_list.append(
+                    DataLoader(dataset,
+                        batch_sampler=batch_sampler,
+                        num_workers=cfg.dataloader.num_workers,
+                        persistent_workers=True if cfg.dataloader.num_workers > 0 else False,
+                        worker_init_fn=scan_cache_worker_init,
+                        collate_fn=getattr(dataset, 'collate_fn', default_collate),
+                        pin_memory=True,
+                        prefetch_factor=cfg.dataloader.get('prefetch_factor', None)))
+                continue
             loader_list.append(
                 DataLoader(dataset,
                     batch_size=cfg.dataloader.get('batchsize_eval', cfg.dataloader.batchsize),
                     num_workers=cfg.dataloader.num_workers,
                     persistent_workers=True if cfg.dataloader.num_workers > 0 else False,
+                    worker_init_fn=scan_cache_worker_init,
                     collate_fn=getattr(dataset, 'collate_fn', default_collate),
                     pin_memory=True, # TODO: Test speed
                     prefetch_factor=cfg.dataloader.get('prefetch_factor', None),
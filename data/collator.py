@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+from torch.utils.data import default_collate, get_worker_info
+
+'''
+Schema driven collation, every field of a sample is collated by its declared kind:
+    sparse_coords: (N_i, 3) voxel coordinates concatenated with the batch index in front, int32, as ME.utils.sparse_collate
+    concat: (N_i, ...) concatenated along dim 0
+    pad: (N_i, ...) padded to (B, max N_i, ...) with the field's pad value
+    stack: same shape tensors stacked to (B, ...)
+    list: kept as a list of samples
+fields not in the schema go through default_collate
+with ragged_offsets, sparse_coords, concat and pad fields also get their (B + 1,) cumulative lengths in batch['ragged_offsets'][key],
+so ragged consumers (cu_seqlens of modules/layers/ragged.py) read the offsets instead of reducing the padded masks
+outputs are written into buffers allocated once per batch, pinned when collating in the main process
+(in dataloader workers the pin memory thread of the DataLoader pins them)
+'''
+FIELD_KINDS = ['sparse_coords', 'concat', 'pad', 'stack', 'list']
+
+
+def _as_tensor(x):
+    return torch.from_numpy(x) if isinstance(x, np.ndarray) else x
+
+
+class SchemaCollator:
+    def __init__(self, schema, pad_values=None, pin_memory=True, ragged_offsets=False):
+        # schema: {key: kind}, pad_values: {key: value} for pad fields, 0 by default
+        for key, kind in schema.items():
+            assert kind in FIELD_KINDS, f'Unknow field kind {kind} of {key}'
+        self.schema = schema
+        self.pad_values = pad_values if pad_values is not None else {}
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.ragged_offsets = ragged_offsets
+
+    def empty(self, shape, dtype):
+        pin = self.pin_memory and get_worker_info() is None
+        return torch.empty(shape, dtype=dtype, pin_memory=pin)
+
+    def ragged(self, tensors):
+        lengths = torch.tensor([len(t) for t in tensors], dtype=torch.long)
+        offsets = torch.zeros(len(tensors) + 1, dtype=torch.long)
+        torch.cumsum(lengths, 0, out=offsets[1:])
+        return lengths, offsets
+
+    def concat(self, tensors, offsets):
+        out = self.empty((int(offsets[-1]), *tensors[0].shape[1:]), tensors[0].dtype)
+        torch.cat(tensors, dim=0, out=out)
+        return out
+
+    def sparse_coords(self, tensors, offsets):
+        out = self.empty((int(offsets[-1]), 1 + tensors[0].shape[1]), torch.int32)
+        out[:, 1:] = torch.cat(tensors, dim=0)
+        out[:, 0] = torch.repeat_interleave(torch.arange(len(tensors), dtype=torch.int32), offsets[1:] - offsets[:-1])
+        return out
+
+    def pad(self, tensors, lengths, offsets, pad_value):
+        # one concat and one indexed copy instead of a python loop of slice writes
+        max_len = int(lengths.max()) if len(lengths) else 0
+        out = self.empty((len(tensors), max_len, *tensors[0].shape[1:]), tensors[0].dtype)
+        out.fill_(pad_value)
+        flat = torch.cat(tensors, dim=0)
+        batch_ids = torch.repeat_interleave(torch.arange(len(tensors)), lengths)
+        rows = torch.arange(len(flat)) - offsets[batch_ids] + batch_ids * max_len
+        out.view(len(tensors) * max_len, *out.shape[2:])[rows] = flat.to(out.dtype)
+        return out
+
+    def stack(self, tensors):
+        out = self.empty((len(tensors), *tensors[0].shape), tensors[0].dtype)
+        torch.stack(tensors, dim=0, out=out)
+        return out
+
+    def __call__(self, batch):
+        new_batch = {'ragged_offsets': {}} if self.ragged_offsets else {}
+        for key, kind in self.schema.items():
+            if key not in batch[0]:
+                continue
+            values = [sample.pop(key) for sample in batch]
+            if kind == 'list':
+                new_batch[key] = values
+                continue
+            tensors = [_as_tensor(v) for v in values]
+            if kind == 'stack':
+                new_batch[key] = self.stack(tensors)
+                continue
+            lengths, offsets = self.ragged(tensors)
+            if self.ragged_offsets:
+                new_batch['ragged_offsets'][key] = offsets
+            if kind == 'sparse_coords':
+                new_batch[key] = self.sparse_coords(tensors, offsets)
+            elif kind == 'concat':
+                new_batch[key] = self.concat(tensors, offsets)
+            else:
+                new_batch[key] = self.pad(tensors, lengths, offsets, self.pad_values.get(key, 0))
+        new_batch.update(default_collate(batch))
+        return new_batch
+
@@ -2,6 +2,7 @@ import random
 import csv
 from collections import Counter
 import re
+import warnings
 
 import numpy as np
 import torch
@@ -47,6 +48,77 @@ def convert_pc_to_box(obj_pc):
     return center, box_size
 
 
+def convert_pcs_to_boxes(coordinates, instance_ids, num_instances=None):
+    # boxes of all instances in one pass of scatter reductions keyed by instance id, numpy or torch
+    # returns box centers, box sizes, point means and point counts for ids in [0, num_instances), negative ids are ignored
+    # ids without points get zero boxes and count 0
+    is_numpy = isinstance(coordinates, np.ndarray)
+    coordinates = frozen_to_tensor(coordinates)[:, :3] if is_numpy else coordinates[:, :3]
+    instance_ids = frozen_to_tensor(instance_ids).long() if isinstance(instance_ids, np.ndarray) else instance_ids.long()
+    if num_instances is None:
+        num_instances = int(instance_ids.max()) + 1 if len(instance_ids) else 0
+    valid = (instance_ids >= 0) & (instance_ids < num_instances)
+    coordinates, instance_ids = coordinates[valid], instance_ids[valid]
+    index = instance_ids[:, None].expand(-1, 3)
+    box_min = coordinates.new_zeros(num_instances, 3).scatter_reduce(0, index, coordinates, 'amin', include_self=False)
+    box_max = coordinates.new_zeros(num_instances, 3).scatter_reduce(0, index, coordinates, 'amax', include_self=False)
+    counts = torch.bincount(instance_ids, minlength=num_instances)
+    means = coordinates.new_zeros(num_instances, 3).index_add(0, instance_ids, coordinates) / counts.clamp(min=1)[:, None]
+    outputs = ((box_min + box_max) / 2, box_max - box_min, means, counts)
+    if is_numpy:
+        outputs = tuple(x.numpy() for x in outputs)
+    return outputs
+
+
+def group_instance_points(coordinates, instance_ids, query_ids):
+    # point indices of every query id from one stable argsort, ascending like np.nonzero(instance_ids == i)[0],
+    # and box centers, box sizes, point means and point counts of the groups in one pass, any id value works
+    # query ids without points get an empty index array, zero boxes and count 0
+    order = np.argsort(instance_ids, kind='stable')
+    sorted_ids = instance_ids[order]
+    starts = np.searchsorted(sorted_ids, query_ids, side='left')
+    ends = np.searchsorted(sorted_ids, query_ids, side='right')
+    indices = [order[s:e] for s, e in zip(starts, ends)]
+    group_ids = np.full(len(instance_ids), -1, dtype=np.int64)
+    for i, index in enumerate(indices):
+        group_ids[index] = i
+    return (indices,) + convert_pcs_to_boxes(coordinates, group_ids, len(indices))
+
+
+def local_instance_boxes(instance_ids, coordinates, local_masks, global_coordinates, global_inst_labels):
+    # (n_inst, 6) center + size boxes of the instance ids from the global points of the scan,
+    # instances without global points fall back to their local points
+    # instance ids, coordinates and local_masks are tensors, local_masks are point instance ids (npoint,), -1 for none,
+    # or disjoint instance masks (n_inst, npoint), the global points and labels are numpy or torch
+    instance_ids = instance_ids.long()
+    if len(instance_ids) == 0:
+        return torch.empty((0, 6), dtype=torch.float32)
+    num_instances = max(int(global_inst_labels.max()) if len(global_inst_labels) else -1, int(instance_ids.max())) + 1
+    global_centers, global_sizes, _, global_counts = (torch.as_tensor(x) for x in convert_pcs_to_boxes(global_coordinates, global_inst_labels, num_instances))
+    if local_masks.dim() == 2:
+        local_masks = local_masks.bool()
+        local_masks = torch.where(local_masks.any(0), local_masks.long().argmax(0), -1)
+    local_centers, local_sizes, _, _ = convert_pcs_to_boxes(coordinates, local_masks, len(instance_ids))
+    global_ids = instance_ids.clamp(min=0)
+    use_global = ((instance_ids >= 0) & (global_counts[global_ids] > 0))[:, None]
+    centers = torch.where(use_global, global_centers[global_ids].to(local_centers.dtype), local_centers)
+    sizes = torch.where(use_global, global_sizes[global_ids].to(local_sizes.dtype), local_sizes)
+    return torch.cat([centers, sizes], dim=1).float()
+
+
+def instance_mask_info(inverse_indices, valid, segment_masks, compact_instance_masks=True):
+    # point and segment masks of the kept instances for inst_info, inverse_indices is the instance index of every point
+    # and valid the kept instances, segment_masks (n_kept, nsegment) are already filtered by valid
+    # compact: per point index of the kept instance (int32, -1 for none) and bool segment masks
+    # otherwise the dense long (n_kept, npoint) full masks and long segment masks
+    if compact_instance_masks:
+        kept_index = np.full(len(valid), -1, dtype=np.int32)
+        kept_index[valid] = np.arange(valid.sum(), dtype=np.int32)
+        return {'point_instance_ids': torch.from_numpy(kept_index[inverse_indices]), 'segment_masks': torch.BoolTensor(segment_masks)}
+    full_masks = (np.arange(len(valid))[:, None] == inverse_indices)[valid]
+    return {'full_masks': torch.LongTensor(full_masks), 'segment_masks': torch.LongTensor(segment_masks)}
+
+
 # input txt_ids, txt_masks
 def random_word(tokens, tokens_mask, tokenizer, mask_ratio):
     output_label = []
@@ -319,6 +391,24 @@ def load_matrix_from_txt(path, shape=(4, 4)):
     matrix = [float(v) for v in txt.split()]
     return np.array(matrix).reshape(shape)
 
+def freeze_arrays(obj):
+    # mark numpy arrays of nested scan data read only, samples take views instead of copies
+    if isinstance(obj, np.ndarray):
+        obj.flags.writeable = False
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            freeze_arrays(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            freeze_arrays(v)
+    return obj
+
+def frozen_to_tensor(array):
+    # zero copy tensor of a frozen array, the tensor must not be written in place
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        return torch.from_numpy(array)
+
 def pad_tensors(tensors, lens=None, pad=0):
     assert tensors.shape[0] <= lens
     if tensors.shape[0] == lens:
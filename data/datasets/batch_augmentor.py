@@ -0,0 +1,152 @@
+import yaml
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch_scatter import scatter_mean, scatter_min, scatter_max
+
+
+def rotation_matrix_3d(axis, theta):
+    # euler rodrigues, same convention as volumentations, points are rotated by points @ R
+    axis = torch.as_tensor(axis, dtype=theta.dtype)
+    axis = axis / torch.sqrt(torch.dot(axis, axis))
+    a = torch.cos(theta / 2.0)
+    b, c, d = (-axis[None, :] * torch.sin(theta / 2.0)[:, None]).unbind(1)
+    aa, bb, cc, dd = a * a, b * b, c * c, d * d
+    bc, ad, ac, ab, bd, cd = b * c, a * d, a * c, a * b, b * d, c * d
+    return torch.stack([
+        torch.stack([aa + bb - cc - dd, 2 * (bc + ad), 2 * (bd - ac)], dim=1),
+        torch.stack([2 * (bc - ad), aa + cc - bb - dd, 2 * (cd + ab)], dim=1),
+        torch.stack([2 * (bd + ac), 2 * (cd - ab), aa + dd - bb - cc], dim=1),
+    ], dim=1)
+
+
+def elastic_noise(coordinates, batch_ids, batch_size, granularity, generator=None):
+    # smoothed gaussian displacement on a per sample grid with spacing granularity, trilinear at the points
+    # grid point k of a sample sits at coord_min + (k - 1) * granularity, as in mask3d elastic_distortion
+    dtype = coordinates.dtype
+    coord_min = scatter_min(coordinates, batch_ids, dim=0, dim_size=batch_size)[0]
+    coord_max = scatter_max(coordinates, batch_ids, dim=0, dim_size=batch_size)[0]
+    noise_dim = torch.div(coord_max - coord_min, granularity, rounding_mode='floor').long() + 3
+    max_dim = noise_dim.max(0)[0].tolist()
+    # samples are padded to the largest grid, cells outside a sample's own grid stay zero
+    valid = torch.ones(batch_size, 1, *max_dim, dtype=dtype)
+    for axis in range(3):
+        shape = [1, 1, 1, 1, 1]
+        shape[axis + 2] = max_dim[axis]
+        valid = valid * (torch.arange(max_dim[axis]).view(shape) < noise_dim[:, axis].view(-1, 1, 1, 1, 1)).to(dtype)
+    noise = torch.randn(batch_size, 3, *max_dim, generator=generator, dtype=dtype) * valid
+    for _ in range(2):
+        for axis in range(3):
+            kernel_shape = [3, 1, 1, 1, 1]
+            kernel_shape[axis + 2] = 3
+            padding = [0, 0, 0]
+            padding[axis] = 1
+            noise = F.conv3d(noise, torch.full(kernel_shape, 1 / 3, dtype=dtype), padding=padding, groups=3) * valid
+    # pad points per sample and sample the grid, grid_sample takes (z, y, x) order
+    index = (coordinates - coord_min[batch_ids]) / granularity + 1
+    grid = index / (torch.tensor(max_dim, dtype=dtype) - 1) * 2 - 1
+    counts = torch.bincount(batch_ids, minlength=batch_size)
+    order = torch.argsort(batch_ids, stable=True)
+    rank = torch.empty_like(batch_ids)
+    rank[order] = torch.arange(len(batch_ids)) - (torch.cumsum(counts, 0) - counts)[batch_ids[order]]
+    padded_grid = torch.zeros(batch_size, int(counts.max()), 1, 1, 3, dtype=dtype)
+    padded_grid[batch_ids, rank, 0, 0] = grid.flip(-1)
+    sampled = F.grid_sample(noise, padded_grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+    return sampled[batch_ids, :, rank, 0, 0]
+
+
+class BatchPointAugmentor:
+    ''' Batched geometric point cloud augmentation in torch
+    flip, scale and axis rotations are composed into one affine transform per sample (x' = x @ A + t),
+    jitter and elastic distortion are added as noise afterwards
+    points of all samples are concatenated, batch_ids gives the sample of each point
+    parameters follow the existing transforms: flip around the box center as in get_scene,
+    volumentations Scale3d / RotateAroundAxis3d (rotation around the point mean), DataAugmentor jitter_fn
+    and mask3d elastic distortion
+    '''
+    def __init__(self, flip_axes=(0, 1), flip_p=0.5, scale=None, rotations=(), jitter=None, elastic=None, elastic_p=0.95):
+        # scale: {'limit': 3 x [low, high], 'bias': 3, 'p': float}
+        # rotations: [{'axis': 3, 'limit': [low, high], 'p': float}, ...]
+        # elastic: [[granularity, magnitude], ...]
+        self.flip_axes = list(flip_axes)
+        self.flip_p = flip_p
+        self.scale = scale
+        self.rotations = list(rotations)
+        self.jitter = jitter
+        self.elastic = elastic
+        self.elastic_p = elastic_p
+
+    @classmethod
+    def from_volumentations(cls, path, **kwargs):
+        # build from a volumentations yaml such as configs/instseg/augmentation/volumentations_aug.yaml
+        with open(path) as f:
+            transforms = yaml.safe_load(f)['transform']['transforms']
+        scale, rotations = None, []
+        for transform in transforms:
+            name = transform['__class_fullname__'].split('.')[-1]
+            p = 1.0 if transform.get('always_apply', False) else transform.get('p', 0.5)
+            if name == 'Scale3d':
+                limit = np.array(transform.get('scale_limit', [0.1, 0.1, 0.1]), dtype=np.float64)
+                if limit.ndim == 1:
+                    limit = np.stack([-np.abs(limit), np.abs(limit)], axis=1)
+                scale = {'limit': limit.tolist(), 'bias': transform.get('bias', [1, 1, 1]), 'p': p}
+            elif name == 'RotateAroundAxis3d':
+                limit = transform.get('rotation_limit', np.pi)
+                if not isinstance(limit, (list, tuple)):
+                    limit = [-limit, limit]
+                rotations.append({'axis': transform.get('axis', [1, 0, 0]), 'limit': list(limit), 'p': p})
+            else:
+                raise NotImplementedError(f"Unknow volumentations transform {name}")
+        return cls(scale=scale, rotations=rotations, **kwargs)
+
+    def sample_affine(self, coordinates, batch_ids, batch_size, generator=None):
+        def uniform(low, high, size):
+            return torch.rand(size, generator=generator, dtype=torch.float64) * (high - low) + low
+
+        def apply(p):
+            return torch.rand(batch_size, generator=generator, dtype=torch.float64) < p
+
+        A = torch.eye(3, dtype=torch.float64).repeat(batch_size, 1, 1)
+        t = torch.zeros(batch_size, 3, dtype=torch.float64)
+        # the rotation center is the point mean, tracked through the transforms instead of recomputed
+        center = scatter_mean(coordinates, batch_ids, dim=0, dim_size=batch_size)
+        if len(self.flip_axes) > 0:
+            coord_max = scatter_max(coordinates, batch_ids, dim=0, dim_size=batch_size)[0]
+            coord_min = scatter_min(coordinates, batch_ids, dim=0, dim_size=batch_size)[0]
+            flip = torch.zeros(batch_size, 3, dtype=torch.bool)
+            for i in self.flip_axes:
+                flip[:, i] = apply(self.flip_p)
+            sign = 1 - 2 * flip.double()
+            offset = (coord_max + coord_min) * flip
+            A, t, center = A * sign[:, None, :], t * sign + offset, center * sign + offset
+        if self.scale is not None:
+            limit = torch.tensor(self.scale['limit'], dtype=torch.float64)
+            factor = uniform(limit[:, 0], limit[:, 1], (batch_size, 3)) + torch.tensor(self.scale['bias'], dtype=torch.float64)
+            factor = torch.where(apply(self.scale['p'])[:, None], factor, torch.ones_like(factor))
+            A, t, center = A * factor[:, None, :], t * factor, center * factor
+        for rotation in self.rotations:
+            angle = uniform(rotation['limit'][0], rotation['limit'][1], (batch_size,))
+            angle = torch.where(apply(rotation['p']), angle, torch.zeros_like(angle))
+            R = rotation_matrix_3d(rotation['axis'], angle)
+            A = A @ R
+            t = ((t - center)[:, None, :] @ R)[:, 0] + center
+        return A, t
+
+    def __call__(self, coordinates, batch_ids=None, batch_size=None, generator=None):
+        # returns new coordinates, the input is never written
+        if batch_ids is None:
+            batch_ids = torch.zeros(len(coordinates), dtype=torch.long)
+        if batch_size is None:
+            batch_size = int(batch_ids.max()) + 1 if len(batch_ids) else 1
+        coords = coordinates.double()
+        A, t = self.sample_affine(coords, batch_ids, batch_size, generator)
+        out = torch.einsum('ni,nij->nj', coords, A[batch_ids]) + t[batch_ids]
+        if self.jitter is not None:
+            out = out + (torch.randn(out.shape, generator=generator, dtype=out.dtype) - 0.5) * self.jitter
+        if self.elastic is not None:
+            apply = torch.rand(batch_size, generator=generator, dtype=torch.float64) < self.elastic_p
+            for granularity, magnitude in self.elastic:
+                noise = elastic_noise(out, batch_ids, batch_size, granularity, generator)
+                out = out + noise * magnitude * apply[batch_ids, None]
+        return out.to(coordinates.dtype)
+
@@ -16,7 +16,6 @@ from tqdm import tqdm
 from scipy import sparse
 import volumentations as V
 import albumentations as A
-import MinkowskiEngine as ME
 from transformers import AutoTokenizer
 
 from common.misc import rgetattr
@@ -25,9 +24,10 @@ from ..data_utils import (
     construct_bbox_corners, eval_ref_one_sample
 )
 from data.build import DATASET_REGISTRY
+from data.voxelize import sparse_quantize
 from data.datasets.scannet_base import ScanNetBase
 from data.datasets.constant import CLASS_LABELS_200, PromptType
-from data.data_utils import make_bce_label
+from data.data_utils import make_bce_label, instance_mask_info, local_instance_boxes
 import fpsample
 from data.datasets.hm3d_label_convert import convert_gpt4
 
@@ -220,6 +220,8 @@ class EmbodiedHM3DInstSegFrontier(EmbodiedHM3DFrontier):
             self.query_sample_strategy = instseg_options.get('query_sample_strategy', 'segment')
         self.offline_mask_source = instseg_options.get('offline_mask_source', None)
         self.compute_local_box = instseg_options.get('compute_local_box', False)
+        # store per point instance ids (int32) and bool segment masks instead of dense long masks
+        self.compact_instance_masks = instseg_options.get('compact_instance_masks', True)
         assert self.query_sample_strategy in ['fps', 'gt', 'segment', 'random_segment']
         # load augmentations
         self.volume_augmentations = V.NoOp()
@@ -290,9 +292,6 @@ class EmbodiedHM3DInstSegFrontier(EmbodiedHM3DFrontier):
                 unique_inst_ids, indices, inverse_indices = np.unique(instance_labels_continous, return_index=True, return_inverse=True)
                 unique_inst_labels = sem_labels[indices]
                 n_inst = len(unique_inst_ids)
-                # instance to point mask
-                instance_range = np.arange(n_inst)[:, None]
-                full_masks = instance_range == inverse_indices
                 # instance to segment mask
                 n_segments = segment_id.max() + 1
                 segment_masks = np.zeros((n_inst, n_segments), dtype=bool)
@@ -310,7 +309,6 @@ class EmbodiedHM3DInstSegFrontier(EmbodiedHM3DFrontier):
                     valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (unique_inst_labels != self.ignore_label) & (segment_masks.sum(1) > 0)
                 unique_inst_ids = unique_inst_ids[valid]
                 unique_inst_labels = unique_inst_labels[valid]
-                full_masks = full_masks[valid]
                 segment_masks = segment_masks[valid]
                
                 inverse_inst_label_mapper = {v: k for k, v in inst_label_mapper.items()}
@@ -319,11 +317,11 @@ class EmbodiedHM3DInstSegFrontier(EmbodiedHM3DFrontier):
                     'instance_ids_ori': torch.LongTensor([inverse_inst_label_mapper[inst_id] for inst_id in unique_inst_ids]), 
                     'instance_ids': torch.LongTensor(unique_inst_ids),
                     'instance_labels': torch.LongTensor(unique_inst_labels),
-                    'full_masks': torch.LongTensor(full_masks),
-                    'segment_masks': torch.LongTensor(segment_masks),
                     'segment_labels': torch.LongTensor(segment_labels),
                     'instance_hm3d_labels': instance_hm3d_labels
                 }
+                # per point kept instance ids (int32) and bool segment masks, or dense long masks
+                inst_info.update(instance_mask_info(inverse_indices, valid, segment_masks, self.compact_instance_masks))
                 scan_data['inst_info'] = inst_info
     
     def sample_query(self, voxel_coordinates, coordinates, obj_center, segment_center):
@@ -417,7 +415,7 @@ class EmbodiedHM3DInstSegFrontier(EmbodiedHM3DFrontier):
 
         # voxelize coorinates, features and labels
         voxel_coordinates = np.floor(coordinates / self.voxel_size)
-        _, unique_map, inverse_map = ME.utils.sparse_quantize(coordinates=voxel_coordinates, return_index=True, return_inverse=True)
+        _, unique_map, inverse_map = sparse_quantize(voxel_coordinates, return_index=True, return_inverse=True)
         voxel_coordinates = voxel_coordinates[unique_map]
         voxel_features = features[unique_map]
         voxel2seg_id = point2seg_id[unique_map]
@@ -468,20 +466,10 @@ class EmbodiedHM3DInstSegFrontier(EmbodiedHM3DFrontier):
             
         # compute box
         if self.compute_local_box:
-            local_instance_ids = data_dict['instance_ids_ori']
-            instance_boxes = []
-            for j, instance_id in enumerate(local_instance_ids):
-                mask = global_inst_labels == instance_id.item()
-                local_pcds = global_coordinates[mask]
-                if local_pcds.shape[0] == 0:
-                    local_box = convert_pc_to_box(coordinates[data_dict['full_masks'][j].bool()].numpy())
-                else:
-                    local_box = convert_pc_to_box(local_pcds)
-                instance_boxes.append(torch.tensor(local_box[0] + local_box[1], dtype=torch.float32))
-            if instance_boxes:
-                data_dict['instance_boxes'] = torch.stack(instance_boxes, dim=0)
-            else:
-                data_dict['instance_boxes'] = torch.empty((0, 6), dtype=torch.float32)
+            # boxes from the global points, instances without global points fall back to the local points
+            local_masks = data_dict['point_instance_ids'] if self.compact_instance_masks else data_dict['full_masks']
+            data_dict['instance_boxes'] = local_instance_boxes(data_dict['instance_ids_ori'], coordinates, local_masks,
+                                                               global_coordinates, global_inst_labels)
 
         return data_dict
         
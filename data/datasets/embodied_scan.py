@@ -4,7 +4,6 @@ import random
 import pickle
 import jsonlines
 import collections
-from copy import deepcopy
 from pathlib import Path
 from abc import ABC, abstractmethod
 
@@ -16,7 +15,6 @@ from tqdm import tqdm
 from scipy import sparse
 import volumentations as V
 import albumentations as A
-import MinkowskiEngine as ME
 from transformers import AutoTokenizer
 
 from common.misc import rgetattr
@@ -25,9 +23,18 @@ from ..data_utils import (
     construct_bbox_corners, eval_ref_one_sample
 )
 from data.build import DATASET_REGISTRY
+from data.voxelize import sparse_quantize, ravel_hash_vec
 from data.datasets.constant import CLASS_LABELS_200, PromptType
-from data.data_utils import make_bce_label
+from data.data_utils import make_bce_label, freeze_arrays, frozen_to_tensor, local_instance_boxes, instance_mask_info
 from data.datasets.hm3d_label_convert import convert_gpt4
+from data.datasets.batch_augmentor import BatchPointAugmentor
+from data.scan_store import PackedScan, packed_scan_path
+from data.scan_cache import ScanCache
+from data.shared_memory import share_arrays
+from data.derived_cache import DerivedCache, config_hash
+from data.scan_index import get_scan_index
+from data.rank_shard import shard_scan_ids
+from common.dist_utils import get_rank, get_world_size
 import fpsample
 
 SCAN_DATA = {'ScanNet': {}, 'HM3D': {}}
@@ -49,6 +56,8 @@ class EmbodiedScanBase(Dataset, ABC):
         self.base_dir = cfg.data.scene_verse_base
         self.embodied_base_dir = cfg.data.embodied_base
         self.load_scan_options = cfg.data.get('load_scan_options', {})
+        # rank_shard: every rank loads only its own train scans (data/rank_shard.py)
+        self.rank, self.world_size = get_rank(), get_world_size()
         # label converter for scannet
         self.int2cat = json.load(open(os.path.join(self.base_dir,
                                             "ScanNet/annotations/meta_data/scannetv2_raw_categories.json"),
@@ -94,10 +103,10 @@ class EmbodiedScanBase(Dataset, ABC):
             train_val_split = json.load(open(os.path.join(self.embodied_base_dir, 'HM3D', 'hm3d_annotated_basis.scene_dataset_config.json')))
             scan_ids = [pa.split('/')[1] for pa in train_val_split['scene_instances']['paths']['.json'] if pa.startswith(split)]
             # add sub trajectory to scan id, the scan_id we save in one_scan is actually scan_id + sub_trajectory_id
-            all_sub_trajectory_ids = os.listdir(os.path.join(self.embodied_base_dir, 'HM3D', 'points'))
+            scan_index = get_scan_index(os.path.join(self.embodied_base_dir, 'HM3D', 'points'), self.load_scan_options.get('scan_index_dir', None))
             selected_sub_trajectory_ids = []
             for scan_id in scan_ids:
-                cur_sub_trajecotry = [sub_id for sub_id in all_sub_trajectory_ids if sub_id.startswith(scan_id)]
+                cur_sub_trajecotry = scan_index.startswith(scan_id)
                 assert len(cur_sub_trajecotry) > 0, f'scan id {scan_id} not found'
                 selected_sub_trajectory_ids += cur_sub_trajecotry
             scan_ids = selected_sub_trajectory_ids
@@ -110,11 +119,68 @@ class EmbodiedScanBase(Dataset, ABC):
         
         if cfg.debug.flag and cfg.debug.debug_size != -1:
             scan_ids = list(scan_ids)[:cfg.debug.debug_size]
+
+        if self.split == 'train' and self.load_scan_options.get('rank_shard', False):
+            scan_ids = shard_scan_ids(list(scan_ids), self.scan_size, self.rank, self.world_size)
         
         return scan_ids
+
+    def scan_size(self, scan_id):
+        # number of sub frames, the samples a scan contributes
+        return len(self._load_sub_frame_list(scan_id))
+
+    def _open_packed_scan(self, scan_id):
+        # packed scan (data/scan_store.py) if load_scan_options.packed_scan_dir is set, arrays are read as copies
+        # packed_scan_mmap: arrays are read only views of the mapped pack, each loaded scan keeps its mapping (one descriptor) alive
+        if self.load_scan_options.get('packed_scan_dir', None) is None:
+            return None
+        return PackedScan(packed_scan_path(self.load_scan_options['packed_scan_dir'], self.dataset_name, scan_id),
+                          mmap=self.load_scan_options.get('packed_scan_mmap', False))
+
+    def _load_sub_frame_list(self, scan_id):
+        # sub frames used at load_frame_interval, without loading the scan
+        packed_scan = self._open_packed_scan(scan_id)
+        sub_frame_list = self._get_sub_frame_list(scan_id, packed_scan)[::self.load_frame_interval]
+        if packed_scan is not None:
+            packed_scan.close()
+        return sub_frame_list
         
     def init_scan_data(self):
-        self.scan_data = self._load_scans(self.scan_ids)
+        # lazy_load: scans are loaded on first access into an LRU cache bounded by scan_cache_bytes
+        # scan_cache_bytes is per dataset and rank, dataloader workers split it evenly (data/scan_cache.py)
+        self.lazy_load = self.load_scan_options.get('lazy_load', False)
+        if self.lazy_load:
+            self.scan_data = ScanCache(self.scan_ids, self._load_one_scan_lazy, self.load_scan_options.get('scan_cache_bytes', 16 * 2 ** 30))
+        else:
+            self.scan_data = self._load_scans(self.scan_ids)
+
+    def _load_one_scan_lazy(self, scan_id):
+        _, one_scan = self._load_one_scan(scan_id)
+        self.process_one_scan(scan_id, one_scan)
+        return freeze_arrays(one_scan)
+
+    def process_one_scan(self, scan_id, one_scan):
+        # per scan post processing after loading, e.g. instance info extraction
+        pass
+
+    def label_mapping_hash(self):
+        # content of the maps instance names go through: scannetv2_raw_categories.json, scannetv2-labels.combined.tsv,
+        # convert_gpt4 and hm3dsem_category_mappings.tsv
+        return config_hash([self.cat2int, self.label_converter.raw_name_to_scannet_raw_id, self.label_converter.scannet_raw_id_to_scannet200_id,
+                            self.hm3d_raw_to_scannet607, self.hm3d_raw_to_cat])
+
+    def _scan_source_paths(self, scan_id):
+        # raw files the per scan labels are derived from, their mtime keys the derived cache
+        options = self.load_scan_options
+        if options.get('packed_scan_dir', None) is not None:
+            paths = [packed_scan_path(options['packed_scan_dir'], self.dataset_name, scan_id)]
+        else:
+            paths = [os.path.join(self.embodied_base_dir, self.dataset_name, kind, scan_id) for kind in ['instance_mask', 'super_points']]
+        if self.dataset_name == 'ScanNet':
+            paths.append(os.path.join(self.base_dir, 'ScanNet', 'scan_data/instance_id_to_label', f'{scan_id}.pth'))
+        else:
+            paths.append(os.path.join(self.embodied_base_dir, 'HM3D', 'instance_id_to_label', f"{scan_id.split('_')[0]}_00.pth"))
+        return paths
         
     def _load_scans(self, scan_ids):
         process_num = self.load_scan_options.get('process_num', 0)
@@ -136,20 +202,45 @@ class EmbodiedScanBase(Dataset, ABC):
         scans = {scan_id: SCAN_DATA[self.dataset_name][scan_id] for scan_id in scan_ids}
         return scans
     
-    def _load_one_scan(self, scan_id):
+    def _get_sub_frame_list(self, scan_id, packed_scan=None):
         options = self.load_scan_options
-        one_scan = {'sub_frames': {}}
-        # get sub frame list
         if self.dataset_name == 'ScanNet':
-            sub_frame_list = os.listdir(os.path.join(self.embodied_base_dir, 'ScanNet', 'points', scan_id))
+            if packed_scan is not None:
+                sub_frame_list = [name.split('/')[1] for name in packed_scan.keys() if name.startswith('points/')]
+            else:
+                sub_frame_list = os.listdir(os.path.join(self.embodied_base_dir, 'ScanNet', 'points', scan_id))
         elif self.dataset_name == 'HM3D':
-            sub_frame_list = []
-            meta_path = os.path.join(self.embodied_base_dir, 'HM3D', 'meta', scan_id + ".json")
-            meta_info = json.load(open(meta_path))
+            if packed_scan is not None and f'meta/{scan_id}.json' in packed_scan:
+                meta_info = json.loads(packed_scan.get(f'meta/{scan_id}.json').tobytes().decode('utf-8'))
+            else:
+                meta_path = os.path.join(self.embodied_base_dir, 'HM3D', 'meta', scan_id + ".json")
+                meta_info = json.load(open(meta_path))
             sub_frame_list = []
             for sub_frame_id, ratio in meta_info.items():
                 if ratio < options.get('max_invalid_point_ratio', 5):
                     sub_frame_list.append(sub_frame_id + ".bin")
+        return sub_frame_list
+
+    def get_sub_frame_ids(self, scan_id):
+        # sub frame ids without loading the scan
+        if not self.lazy_load:
+            return sorted(list(self.scan_data[scan_id]['sub_frames'].keys()))
+        sub_frame_list = self._load_sub_frame_list(scan_id)
+        return sorted([int(sub_frame.split('.')[0]) for sub_frame in sub_frame_list])
+
+    def _load_one_scan(self, scan_id):
+        options = self.load_scan_options
+        one_scan = {'sub_frames': {}}
+        # read from a packed scan (data/scan_store.py) if available, otherwise from loose files
+        # packed arrays are private copies unless packed_scan_mmap, the file is closed once the scan is loaded
+        packed_scan = self._open_packed_scan(scan_id)
+        def load_array(kind, name, dtype):
+            if packed_scan is not None:
+                return packed_scan.get(f'{kind}/{name}')
+            path = os.path.join(self.embodied_base_dir, self.dataset_name, kind, name if kind.endswith('_global') else os.path.join(scan_id, name))
+            return np.load(path) if name.endswith('.npy') else np.fromfile(path, dtype=dtype)
+        # get sub frame list
+        sub_frame_list = self._get_sub_frame_list(scan_id, packed_scan)
         # get inst_to_label
         if self.dataset_name == 'ScanNet':
             inst_to_label = torch.load(os.path.join(self.base_dir, 'ScanNet', 'scan_data/instance_id_to_label', f'{scan_id}.pth')) 
@@ -170,15 +261,15 @@ class EmbodiedScanBase(Dataset, ABC):
             
             if options.get('load_pc_info', True):
                 # load pcd data
-                pcd_data = np.fromfile(os.path.join(self.embodied_base_dir, self.dataset_name, 'points', scan_id, sub_frame), dtype=np.float32).reshape(-1, 6)
-                instance_labels = np.fromfile(os.path.join(self.embodied_base_dir, self.dataset_name, 'instance_mask', scan_id, sub_frame), dtype=np.int64)
+                pcd_data = load_array('points', sub_frame, np.float32).reshape(-1, 6)
+                instance_labels = load_array('instance_mask', sub_frame, np.int64)
                 # instance_labels in range 0-max_instance_id, change to -100, 0, 1, 2,...
-                instance_labels -= 1
+                instance_labels = instance_labels - 1
                 instance_labels[instance_labels == -1] = -100
-                # pre process
+                # pre process, not in place since packed arrays are read only
                 points, colors = pcd_data[:, :3], pcd_data[:, 3:]  
                 if self.dataset_name == 'HM3D':
-                    points[:, [1, 2]] = points[:, [2, 1]]
+                    points = points[:, [0, 2, 1]]
                 colors = colors / 127.5 - 1
                 pcds = np.concatenate([points, colors], 1)
                 one_scan['sub_frames'][sub_frame_id]['pcds'] = pcds
@@ -186,32 +277,34 @@ class EmbodiedScanBase(Dataset, ABC):
                 one_scan['sub_frames'][sub_frame_id]['inst_to_label'] = inst_to_label
                     
             if options.get('load_segment_info', False):
-                segment_id = np.fromfile(os.path.join(self.embodied_base_dir, self.dataset_name, 'super_points', scan_id, sub_frame), dtype=np.int64)
+                segment_id = load_array('super_points', sub_frame, np.int64)
                 unique_ids = np.unique(segment_id)
                 assert unique_ids.max() == len(unique_ids) - 1
                 one_scan['sub_frames'][sub_frame_id]["segment_id"] = segment_id
             
             if options.get('load_image_segment_feat', False):
-                img_feat = np.load(os.path.join(self.embodied_base_dir, self.dataset_name, 'img_feat', scan_id, f'{sub_frame_id}.npy'))
+                img_feat = load_array('img_feat', f'{sub_frame_id}.npy', None)
                 img_feat = img_feat[unique_ids]
                 one_scan['sub_frames'][sub_frame_id]['image_segment_feat'] = img_feat
             
         if options.get('load_global_pc', False):
             # load global pcd
-            pcd_data = np.fromfile(os.path.join(self.embodied_base_dir, self.dataset_name, 'points_global', f'{scan_id}.bin'), dtype=np.float32).reshape(-1, 6)
-            instance_labels = np.fromfile(os.path.join(self.embodied_base_dir, self.dataset_name, 'instance_mask_global', f'{scan_id}.bin'), dtype=np.int64)
+            pcd_data = load_array('points_global', f'{scan_id}.bin', np.float32).reshape(-1, 6)
+            instance_labels = load_array('instance_mask_global', f'{scan_id}.bin', np.int64)
             # instance_labels in range 0-max_instance_id, change to -100, 0, 1, 2,...
-            instance_labels -= 1
+            instance_labels = instance_labels - 1
             instance_labels[instance_labels == -1] = -100
             # pre process
             points, colors = pcd_data[:, :3], pcd_data[:, 3:]
             if self.dataset_name == 'HM3D':
-                points[:, [1, 2]] = points[:, [2, 1]]
+                points = points[:, [0, 2, 1]]
             colors = colors / 127.5 - 1
             pcds = np.concatenate([points, colors], 1)
             one_scan['pcds_global'] = pcds
             one_scan['instance_labels_global'] = instance_labels
-                    
+
+        if packed_scan is not None:
+            packed_scan.close()
         return (scan_id, one_scan)
 
 @DATASET_REGISTRY.register()
@@ -235,7 +328,30 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
         else:
             self.query_sample_strategy = instseg_options.get('query_sample_strategy', 'segment')
         self.compute_local_box = instseg_options.get('compute_local_box', False)
+        # store per point instance ids (int32) and bool segment masks instead of dense long masks
+        self.compact_instance_masks = instseg_options.get('compact_instance_masks', True)
         assert self.query_sample_strategy in ['fps', 'gt', 'segment', 'random_segment']
+        # derived_cache_dir: persist extracted instance info per scan, keyed by the options and label maps it depends on and the source mtime
+        self.derived_keys = ['sem_labels', 'inst_label_mapper', 'instance_labels_continuous', 'inst_info']
+        # and the per frame sample sizes of data/batch_sampler.py, keyed by the loading options and the voxel size
+        self.derived_cache = None
+        self.sample_size_cache = None
+        if self.load_scan_options.get('derived_cache_dir', None) is not None:
+            namespace = f'{self.__class__.__name__}_{dataset_name}'
+            load_config = {
+                'load_frame_interval': self.load_frame_interval,
+                'max_invalid_point_ratio': self.load_scan_options.get('max_invalid_point_ratio', 5),
+            }
+            self.derived_cache = DerivedCache(self.load_scan_options['derived_cache_dir'], namespace, dict(load_config, **{
+                'ignore_label': self.ignore_label,
+                'filter_out_classes': list(self.filter_out_classes),
+                'num_labels': self.num_labels,
+                'use_open_vocabulary': self.use_open_vocabulary,
+                'compact_instance_masks': self.compact_instance_masks,
+                'label_mapping': self.label_mapping_hash(),
+            }))
+            self.sample_size_cache = DerivedCache(self.load_scan_options['derived_cache_dir'], namespace + '_sample_sizes',
+                                                  dict(load_config, voxel_size=self.voxel_size))
         # load augmentations
         self.volume_augmentations = V.NoOp()
         self.image_augmentations = A.NoOp()
@@ -243,6 +359,11 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
             self.volume_augmentations = V.load(
                 Path(instseg_options.get('volume_augmentations_path', None)), data_format="yaml"
             )
+        # flip, scale and rotations as one affine transform in torch instead of the volumentations chain
+        self.batch_augmentor = None
+        if instseg_options.get('batch_augmentation', False):
+            assert instseg_options.get('volume_augmentations_path', None) is not None
+            self.batch_augmentor = BatchPointAugmentor.from_volumentations(instseg_options['volume_augmentations_path'])
         if instseg_options.get('image_augmentations_path', None) is not None:
             self.image_augmentations = A.load(
                 Path(instseg_options.get('image_augmentations_path', None)), data_format="yaml"
@@ -253,11 +374,17 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
         # init data
         self.scan_ids = self._load_split(self.cfg, self.split)
         self.init_scan_data()
-        self.extract_inst_info()
+        if not self.lazy_load:
+            self.extract_inst_info()
+            # move scan arrays to shared memory so that dataloader workers get handles instead of copies
+            if self.load_scan_options.get('shared_memory', False):
+                share_arrays(self.scan_data)
+            # scan data is read only from here on, get_scene takes views instead of deep copies
+            freeze_arrays(self.scan_data)
         # build data id mapper, one scene has many sub frame
         self.data_id_mapper = {}
         for scan_id in self.scan_ids:
-            sub_frame_ids = sorted(list(self.scan_data[scan_id]['sub_frames'].keys()))
+            sub_frame_ids = self.get_sub_frame_ids(scan_id)
             for sub_frame_id in sub_frame_ids:
                 self.data_id_mapper[len(self.data_id_mapper)] = (scan_id, sub_frame_id) 
         
@@ -267,82 +394,128 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
     def __getitem__(self, index):
         scan_id, sub_frame_id = self.data_id_mapper[index]
         data_dict = self.get_scene(scan_id, sub_frame_id)
+        # the evaluators flush a scan after its last frame
+        data_dict['last_frame'] = index + 1 == len(self) or self.data_id_mapper[index + 1][0] != scan_id
         return data_dict
 
+    def sample_scan_ids(self):
+        # scan id of every index, the frames of a scan are consecutive and in order
+        return [self.data_id_mapper[index][0] for index in range(len(self))]
+
+    def scan_sample_sizes(self, scan_id):
+        # (voxel count, segment count) of every sub frame of a scan before augmentation
+        scan_frames = self.scan_data[scan_id]['sub_frames']
+        sub_frame_ids = list(self.get_sub_frame_ids(scan_id))
+        sizes = np.zeros((len(sub_frame_ids), 2), dtype=np.int64)
+        for i, sub_frame_id in enumerate(sub_frame_ids):
+            scan_frame = scan_frames[sub_frame_id]
+            voxel_coordinates = np.floor(scan_frame['pcds'][:, :3] / self.voxel_size).astype(np.int64)
+            sizes[i, 0] = len(np.unique(ravel_hash_vec(voxel_coordinates))) if len(voxel_coordinates) else 0
+            sizes[i, 1] = int(scan_frame['segment_id'].max()) + 1 if len(scan_frame['segment_id']) else 0
+        return {'sub_frame_ids': sub_frame_ids, 'sizes': sizes}
+
+    def sample_sizes(self):
+        # per index cost data/batch_sampler.py batches by, persisted per scan with derived_cache_dir
+        # otherwise, and for scans missing from the cache, every scan is loaded once here (lazy_load included)
+        rows = {}
+        for scan_id in tqdm(self.scan_ids, desc='sample sizes'):
+            if self.sample_size_cache is None:
+                scan_sizes = self.scan_sample_sizes(scan_id)
+            else:
+                scan_sizes = self.sample_size_cache.get_or_compute(scan_id, self._scan_source_paths(scan_id), lambda: self.scan_sample_sizes(scan_id))
+            rows.update({(scan_id, sub_frame_id): row for sub_frame_id, row in zip(scan_sizes['sub_frame_ids'], scan_sizes['sizes'])})
+        return np.stack([rows[self.data_id_mapper[index]] for index in range(len(self))]).reshape(len(self), 2)
+
+    def process_one_scan(self, scan_id, one_scan):
+        self.extract_scan_inst_info_cached(scan_id, one_scan)
+
     def extract_inst_info(self):
         for scan_id in self.scan_ids:
-            if self.scan_data[scan_id].get("extract_inst_info", False):
-                continue
-            for sub_frame_id in self.scan_data[scan_id]['sub_frames'].keys():
-                # load useful data
-                scan_data = self.scan_data[scan_id]['sub_frames'][sub_frame_id]
-                pcds = scan_data['pcds']
-                segment_id = scan_data['segment_id']
-                instance_labels = scan_data['instance_labels']
-                inst_to_label = self.scan_data[scan_id]['inst_to_label']
-                inst_to_text_label = self.scan_data[scan_id]['inst_to_text_label']
-                # build semantic labels in scannet200
-                # 0-199 for ordinary ones, self.ignore_label for undefined semantic and no object
-                sem_labels = np.zeros(pcds.shape[0]) + self.ignore_label
-                for inst_id in inst_to_label.keys():
-                    if inst_to_label[inst_id] in self.cat2int.keys():
-                        mask = instance_labels == inst_id
-                        if np.sum(mask) == 0:
-                            continue
-                        sem_labels[mask] = int(self.label_converter.raw_name_to_scannet_raw_id[inst_to_label[inst_id]])
-                sem_labels = self.map_to_scannet200_id(sem_labels).astype(int)
-                scan_data['sem_labels'] = sem_labels
-                # build inst label mapper to map inst label to 0...max
-                inst_label_mapper = {}
-                max_inst_id = 0
-                for inst_id in np.unique(instance_labels):
-                    if inst_id in inst_to_label.keys():
-                        inst_label_mapper[inst_id] = max_inst_id
-                        max_inst_id += 1
-                    else:
-                        inst_label_mapper[inst_id] = -1 # -1 for no object, so continuous id is -1, 0, 1,... max_obj
-                scan_data['inst_label_mapper'] = inst_label_mapper
-                instance_labels_continous = np.vectorize(lambda x: inst_label_mapper.get(x, x))(instance_labels)
-                scan_data['instance_labels_continuous'] = instance_labels_continous.astype(int)
-                # get unique instances, indices same shape with unique inst ids, inverse indices same shape with instance labels
-                unique_inst_ids, indices, inverse_indices = np.unique(instance_labels_continous, return_index=True, return_inverse=True)
-                unique_inst_labels = sem_labels[indices]
-                n_inst = len(unique_inst_ids)
-                # instance to point mask
-                instance_range = np.arange(n_inst)[:, None]
-                full_masks = instance_range == inverse_indices
-                # instance to segment mask
-                n_segments = segment_id.max() + 1
-                segment_masks = np.zeros((n_inst, n_segments), dtype=bool)
-                segment_labels = np.ones(n_segments) * self.ignore_label
-                for cur_seg_id in range(n_segments):
-                    cur_inst_id = np.bincount(inverse_indices[segment_id == cur_seg_id]).argmax()
-                    segment_masks[cur_inst_id, cur_seg_id] = True
-                    segment_labels[cur_seg_id] = unique_inst_labels[cur_inst_id]
-                segment_labels[segment_labels == self.ignore_label] = self.num_labels # set to scannet 200
-                # filter out unwanted instances, e.g. wall, floor, and object not in scannet 200
-                if self.use_open_vocabulary:
-                    valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (segment_masks.sum(1) > 0)
-                else:
-                    valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (unique_inst_labels != self.ignore_label) & (segment_masks.sum(1) > 0)
-                unique_inst_ids = unique_inst_ids[valid]
-                unique_inst_labels = unique_inst_labels[valid]
-                full_masks = full_masks[valid]
-                segment_masks = segment_masks[valid]
-                # get text label
-                inverse_inst_label_mapper = {v: k for k, v in inst_label_mapper.items()}
-                instance_text_labels = [inst_to_text_label[inverse_inst_label_mapper[inst_id]] for inst_id in unique_inst_ids]
-                inst_info = {
-                    'instance_ids_ori': torch.LongTensor([inverse_inst_label_mapper[inst_id] for inst_id in unique_inst_ids]), # orignal instance id, note for hm3d, instance id - 1
-                    'instance_ids': torch.LongTensor(unique_inst_ids), # mapped instance id
-                    'instance_labels': torch.LongTensor(unique_inst_labels), # ignore_label, 0-200
-                    'full_masks': torch.LongTensor(full_masks), # (n_inst, npoint)
-                    'segment_masks': torch.LongTensor(segment_masks), # (n_inst, nsegment_)
-                    'segment_labels': torch.LongTensor(segment_labels), # 0-201
-                    'instance_text_labels': instance_text_labels # ['class', ...]
-                }
-                scan_data['inst_info'] = inst_info
-            self.scan_data[scan_id]['extract_inst_info'] = True
+            self.extract_scan_inst_info_cached(scan_id, self.scan_data[scan_id])
+
+    def extract_scan_inst_info_cached(self, scan_id, one_scan):
+        # load the derived per frame labels and instance info from the derived cache if present
+        if self.derived_cache is None or one_scan.get("extract_inst_info", False):
+            self.extract_scan_inst_info(one_scan)
+            return
+        source_paths = self._scan_source_paths(scan_id)
+        derived = self.derived_cache.load(scan_id, source_paths)
+        if derived is None:
+            self.extract_scan_inst_info(one_scan)
+            derived = {sub_frame_id: {k: sub_frame[k] for k in self.derived_keys} for sub_frame_id, sub_frame in one_scan['sub_frames'].items()}
+            self.derived_cache.save(scan_id, source_paths, derived)
+            return
+        assert derived.keys() == one_scan['sub_frames'].keys(), f'derived cache of {scan_id} does not match the loaded sub frames'
+        for sub_frame_id, sub_frame_derived in derived.items():
+            one_scan['sub_frames'][sub_frame_id].update(sub_frame_derived)
+        one_scan['extract_inst_info'] = True
+
+    def extract_scan_inst_info(self, one_scan):
+        if one_scan.get("extract_inst_info", False):
+            return
+        # per annotated instance scannet200 label, sorted by instance id for lookup
+        inst_to_label = one_scan['inst_to_label']
+        inst_to_text_label = one_scan['inst_to_text_label']
+        annotated_ids = np.array(sorted(inst_to_label.keys()), dtype=np.int64)
+        annotated_labels = np.array([self.label_converter.raw_name_to_scannet_raw_id[inst_to_label[inst_id]] if inst_to_label[inst_id] in self.cat2int.keys()
+                                     else self.ignore_label for inst_id in annotated_ids], dtype=np.int64)
+        annotated_labels = self.map_to_scannet200_id(annotated_labels)
+        for sub_frame_id in one_scan['sub_frames'].keys():
+            # load useful data
+            scan_data = one_scan['sub_frames'][sub_frame_id]
+            segment_id = scan_data['segment_id']
+            instance_labels = scan_data['instance_labels']
+            # look up every unique instance id in the annotated ones
+            unique_ids, unique_inverse = np.unique(instance_labels, return_inverse=True)
+            unique_inverse = unique_inverse.reshape(-1)
+            pos = np.searchsorted(annotated_ids, unique_ids).clip(max=max(len(annotated_ids) - 1, 0))
+            is_annotated = annotated_ids[pos] == unique_ids if len(annotated_ids) > 0 else np.zeros(len(unique_ids), dtype=bool)
+            # build semantic labels in scannet200
+            # 0-199 for ordinary ones, self.ignore_label for undefined semantic and no object
+            unique_sem_labels = np.where(is_annotated, annotated_labels[pos] if len(annotated_ids) > 0 else self.ignore_label, self.ignore_label)
+            sem_labels = unique_sem_labels[unique_inverse]
+            scan_data['sem_labels'] = sem_labels
+            # build inst label mapper to map inst label to 0...max
+            unique_continuous_ids = np.where(is_annotated, np.cumsum(is_annotated) - 1, -1) # -1 for no object, so continuous id is -1, 0, 1,... max_obj
+            inst_label_mapper = dict(zip(unique_ids.tolist(), unique_continuous_ids.tolist()))
+            scan_data['inst_label_mapper'] = inst_label_mapper
+            instance_labels_continous = unique_continuous_ids[unique_inverse]
+            scan_data['instance_labels_continuous'] = instance_labels_continous.astype(int)
+            # get unique instances, indices same shape with unique inst ids, inverse indices same shape with instance labels
+            unique_inst_ids, indices, inverse_indices = np.unique(instance_labels_continous, return_index=True, return_inverse=True)
+            inverse_indices = inverse_indices.reshape(-1)
+            unique_inst_labels = sem_labels[indices]
+            n_inst = len(unique_inst_ids)
+            # instance to segment mask, majority instance of each segment from one bincount over (segment, instance) keys
+            n_segments = segment_id.max() + 1
+            seg_inst_counts = np.bincount(segment_id * n_inst + inverse_indices, minlength=n_segments * n_inst).reshape(n_segments, n_inst)
+            seg_to_inst = seg_inst_counts.argmax(1)
+            segment_masks = np.zeros((n_inst, n_segments), dtype=bool)
+            segment_masks[seg_to_inst, np.arange(n_segments)] = True
+            segment_labels = unique_inst_labels[seg_to_inst].astype(float)
+            segment_labels[segment_labels == self.ignore_label] = self.num_labels # set to scannet 200
+            # filter out unwanted instances, e.g. wall, floor, and object not in scannet 200
+            if self.use_open_vocabulary:
+                valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (segment_masks.sum(1) > 0)
+            else:
+                valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (unique_inst_labels != self.ignore_label) & (segment_masks.sum(1) > 0)
+            unique_inst_ids = unique_inst_ids[valid]
+            unique_inst_labels = unique_inst_labels[valid]
+            segment_masks = segment_masks[valid]
+            # get text label
+            inverse_inst_label_mapper = {v: k for k, v in inst_label_mapper.items()}
+            instance_text_labels = [inst_to_text_label[inverse_inst_label_mapper[inst_id]] for inst_id in unique_inst_ids]
+            inst_info = {
+                'instance_ids_ori': torch.LongTensor([inverse_inst_label_mapper[inst_id] for inst_id in unique_inst_ids]), # orignal instance id, note for hm3d, instance id - 1
+                'instance_ids': torch.LongTensor(unique_inst_ids), # mapped instance id
+                'instance_labels': torch.LongTensor(unique_inst_labels), # ignore_label, 0-200
+                'segment_labels': torch.LongTensor(segment_labels), # 0-201
+                'instance_text_labels': instance_text_labels # ['class', ...]
+            }
+            # per point kept instance ids (int32) and bool segment masks, or dense long masks
+            inst_info.update(instance_mask_info(inverse_indices, valid, segment_masks, self.compact_instance_masks))
+            scan_data['inst_info'] = inst_info
+        one_scan['extract_inst_info'] = True
     
     def sample_query(self, voxel_coordinates, coordinates, obj_center, segment_center):
         if self.query_sample_strategy == 'fps':
@@ -363,43 +536,48 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
             raise NotImplementedError(f'{self.query_sample_strategy} is not implemented')
 
     def get_scene(self, scan_id, sub_frame_id):
-        # load local information
-        pcds = deepcopy(self.scan_data[scan_id]['sub_frames'][sub_frame_id]['pcds'])
+        # load local information, scan arrays are frozen views, every op below writes a fresh buffer
+        scan_frame = self.scan_data[scan_id]['sub_frames'][sub_frame_id]
+        pcds = scan_frame['pcds']
         coordinates = pcds[:, :3]
         color = (pcds[:, :3:] + 1) * 127.5
-        point2seg_id = deepcopy(self.scan_data[scan_id]['sub_frames'][sub_frame_id]['segment_id'])
-        sem_labels = deepcopy(self.scan_data[scan_id]['sub_frames'][sub_frame_id]['sem_labels']) # self.ignore_label for undefined semantic
-        inst_label = deepcopy(self.scan_data[scan_id]['sub_frames'][sub_frame_id]['instance_labels_continuous']) # -1 for no object, so continuous id is -1, 0, 1,... max_obj
+        point2seg_id = scan_frame['segment_id']
+        sem_labels = scan_frame['sem_labels'] # self.ignore_label for undefined semantic
+        inst_label = scan_frame['instance_labels_continuous'] # -1 for no object, so continuous id is -1, 0, 1,... max_obj
         labels = np.concatenate([sem_labels.reshape(-1, 1), inst_label.reshape(-1, 1)], axis=1)
         if self.compute_local_box:
             # load global information
-            global_pcds = deepcopy(self.scan_data[scan_id]['pcds_global'])
+            global_pcds = self.scan_data[scan_id]['pcds_global']
             global_coordinates = global_pcds[:, :3]
             global_color = (global_pcds[:, :3:] + 1) * 127.5
-            global_inst_labels = deepcopy(self.scan_data[scan_id]['instance_labels_global'])
+            global_inst_labels = self.scan_data[scan_id]['instance_labels_global']
             # concat 
             coordinates = np.concatenate([coordinates, global_coordinates], axis=0)
             color = np.concatenate([color, global_color], axis=0)
          
         if self.split == 'train' and self.use_aug:
-            # revser x y axis
-            for i in (0, 1):
-                if random.random() < 0.5:
-                    coord_max = np.max(coordinates[:, i])
-                    coord_min = np.min(coordinates[:, i])
-                    coordinates[:, i] = coord_max - coordinates[:, i] + coord_min
-                    
-            # volume augmentation
-            aug = self.volume_augmentations(
-                points=coordinates,
-                normals=None,
-                features=color,
-                labels=None,
-            )
-            coordinates, color = (
-                aug["points"],
-                aug["features"],
-            )
+            if self.batch_augmentor is not None:
+                # per sample on purpose: voxelization, segment / object centers and query sampling below use the
+                # augmented points, so it cannot move to the collated batch. flip, scale and rotations still run as
+                # one affine pass instead of one volumentations pass per transform
+                coordinates = self.batch_augmentor(frozen_to_tensor(coordinates)).numpy()
+            else:
+                # revser x y axis, out of place
+                flip = np.array([random.random() < 0.5 for i in (0, 1)] + [False])
+                if flip.any():
+                    coordinates = np.where(flip, coordinates.max(0) + coordinates.min(0) - coordinates, coordinates)
+                        
+                # volume augmentation
+                aug = self.volume_augmentations(
+                    points=coordinates,
+                    normals=None,
+                    features=color,
+                    labels=None,
+                )
+                coordinates, color = (
+                    aug["points"],
+                    aug["features"],
+                )
             # color augmentation
             pseudo_image = color.astype(np.uint8)[np.newaxis, :, :]
             color = np.squeeze(
@@ -421,22 +599,23 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
 
         features = torch.from_numpy(features).float()
         labels = torch.from_numpy(labels).long()
-        coordinates = torch.from_numpy(coordinates).float()
+        coordinates = frozen_to_tensor(coordinates).float()
 
-        # Calculate object centers and segment centers
-        instance_info = deepcopy(self.scan_data[scan_id]['sub_frames'][sub_frame_id]['inst_info'])
+        # Calculate object centers and segment centers, inst_info is list collated, so it is copied instead of
+        # handing tensors of the scan data to the batch
+        instance_info = {k: v.clone() if isinstance(v, torch.Tensor) else list(v) for k, v in scan_frame['inst_info'].items()}
         instance_ids = instance_info['instance_ids']
         point2inst_id = labels[:, -1]
         point2inst_id[point2inst_id == -1] = (instance_ids.max() if len(instance_ids) else 0) + 1
         obj_center = scatter_mean(coordinates, point2inst_id, dim=0)
         obj_center = obj_center[instance_ids]
-        point2seg_id = torch.from_numpy(point2seg_id).long()
+        point2seg_id = torch.tensor(point2seg_id, dtype=torch.long) # list collated as well, always a copy
         seg_center = scatter_mean(coordinates, point2seg_id, dim=0)
         seg_point_count = scatter_add(torch.ones_like(point2seg_id), point2seg_id, dim=0)
 
         # voxelize coorinates, features and labels
         voxel_coordinates = np.floor(coordinates / self.voxel_size)
-        _, unique_map, inverse_map = ME.utils.sparse_quantize(coordinates=voxel_coordinates, return_index=True, return_inverse=True)
+        _, unique_map, inverse_map = sparse_quantize(voxel_coordinates, return_index=True, return_inverse=True)
         voxel_coordinates = voxel_coordinates[unique_map]
         voxel_features = features[unique_map]
         voxel2seg_id = point2seg_id[unique_map]
@@ -471,14 +650,15 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
             'query_pad_masks': query_pad_masks,
             'query_selection_ids': query_selection_ids
         }
-        # instance_info includes instance_ids_ori', 'instance_ids', 'instance_labels', 'full_masks', 'segment_masks', 'segment_labels', 'instance_text_labels' 
+        # instance_info includes instance_ids_ori', 'instance_ids', 'instance_labels', 'full_masks' or 'point_instance_ids', 'segment_masks', 'segment_labels', 'instance_text_labels' 
         # instance_text_embeds and instance_boxes are optional, torch tensor, list collate
         #  all instance info is list collate
         # instance_text_labels is a list of text
         data_dict.update(instance_info)
         
-        if 'image_segment_feat' in self.scan_data[scan_id]['sub_frames'][sub_frame_id].keys():
-            cur_segment_image = torch.from_numpy(deepcopy(self.scan_data[scan_id]['sub_frames'][sub_frame_id]['image_segment_feat']))
+        if 'image_segment_feat' in scan_frame.keys():
+            # shared with the scan data, the padded collate copies it into the batch
+            cur_segment_image = frozen_to_tensor(scan_frame['image_segment_feat'])
             data_dict['mv_seg_fts'] = cur_segment_image
             data_dict['mv_seg_pad_masks'] = torch.ones(cur_segment_image.shape[0], dtype=torch.bool)
         
@@ -494,28 +674,22 @@ class EmbodiedScanInstseg(EmbodiedScanBase):
             
         # compute box
         if self.compute_local_box:
-            local_instance_ids = data_dict['instance_ids_ori']
-            instance_boxes = []
-            for j, instance_id in enumerate(local_instance_ids):
-                mask = global_inst_labels == instance_id.item()
-                local_pcds = global_coordinates[mask]
-                if local_pcds.shape[0] == 0:
-                    local_box = convert_pc_to_box(coordinates[data_dict['full_masks'][j].bool()].numpy())
-                else:
-                    local_box = convert_pc_to_box(local_pcds)
-                instance_boxes.append(torch.tensor(local_box[0] + local_box[1], dtype=torch.float32))
-            if instance_boxes:
-                data_dict['instance_boxes'] = torch.stack(instance_boxes, dim=0)
-            else:
-                data_dict['instance_boxes'] = torch.empty((0, 6), dtype=torch.float32)
+            # boxes from the global points, instances without global points fall back to the local points
+            local_masks = data_dict['point_instance_ids'] if self.compact_instance_masks else data_dict['full_masks']
+            data_dict['instance_boxes'] = local_instance_boxes(data_dict['instance_ids_ori'], coordinates, local_masks,
+                                                               global_coordinates, global_inst_labels)
 
         return data_dict
         
     def map_to_scannet200_id(self, labels):
-        label_info = self.label_converter.scannet_raw_id_to_scannet200_id
-        labels[~np.isin(labels, list(label_info))] = self.ignore_label
-        for k in label_info:
-            labels[labels == k] = label_info[k]
+        # dense lookup table from scannet raw id to scannet200 id, ignore_label for others
+        if not hasattr(self, 'scannet200_lut'):
+            label_info = self.label_converter.scannet_raw_id_to_scannet200_id
+            self.scannet200_lut = np.full(max(label_info) + 1, self.ignore_label, dtype=np.int64)
+            self.scannet200_lut[list(label_info.keys())] = list(label_info.values())
+        valid = (labels >= 0) & (labels < len(self.scannet200_lut))
+        labels[~valid] = self.ignore_label
+        labels[valid] = self.scannet200_lut[labels[valid].astype(np.int64)]
         return labels
 
 @DATASET_REGISTRY.register()
@@ -532,8 +706,3 @@ class EmbodiedScanInstSegHM3D(EmbodiedScanInstseg):
         dataset_cfg = cfg.data.get(self.__class__.__name__)
         self.init_dataset_params(dataset_cfg)
         super().__init__(cfg, 'HM3D', split)
-
-
-    
-    
-    
\ No newline at end of file
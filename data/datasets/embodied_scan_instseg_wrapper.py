@@ -2,12 +2,20 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset, default_collate
 from transformers import AutoTokenizer
-import MinkowskiEngine as ME
 
 from data.datasets.constant import PromptType
 
 from .dataset_wrapper import DATASETWRAPPER_REGISTRY
 from ..data_utils import pad_sequence, pad_sequence_2d
+from ..collator import SchemaCollator
+
+# sparse collate voxel features, list collate per sample ragged data, pad collate per sample sequences
+INSTSEG_COLLATE_SCHEMA = {
+    'voxel_coordinates': 'sparse_coords', 'voxel_features': 'concat',
+    **{k: 'list' for k in ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_labels', 'instance_boxes', 'instance_ids_ori', 'full_masks', 'point_instance_ids', 'segment_masks', 'scan_id', 'segment_labels', 'query_selection_ids', 'instance_text_labels', 'instance_text_embeds']},
+    'coord_min': 'stack', 'coord_max': 'stack',
+    **{k: 'pad' for k in ['obj_center', 'obj_pad_masks', 'seg_center', 'seg_pad_masks', 'seg_point_count', 'query_locs', 'query_pad_masks', 'voxel_seg_pad_masks', 'mv_seg_fts', 'mv_seg_pad_masks']},
+}
 
 
 @DATASETWRAPPER_REGISTRY.register()
@@ -16,6 +24,8 @@ class EmbodiedScanInstSegDatasetWrapper(Dataset):
         super().__init__()
         self.cfg = cfg
         self.dataset = dataset
+        # segment offsets for the ragged segment path of the model
+        self.collator = SchemaCollator(INSTSEG_COLLATE_SCHEMA, ragged_offsets=cfg.model.get('ragged_segments', False))
         
     def __len__(self):
         return len(self.dataset)
@@ -24,32 +34,5 @@ class EmbodiedScanInstSegDatasetWrapper(Dataset):
         return self.dataset[idx]
     
     def collate_fn(self, batch):
-        new_batch = {}
+        return self.collator(batch)
 
-        # sparse collate voxel features
-        input_dict = {
-            "coords": [sample.pop('voxel_coordinates') for sample in batch], 
-            "feats": [sample.pop('voxel_features') for sample in batch],
-        }
-        voxel_coordinates, voxel_features = ME.utils.sparse_collate(**input_dict, dtype=torch.int32)
-        new_batch['voxel_coordinates'] = voxel_coordinates
-        new_batch['voxel_features'] = voxel_features
-            
-        # list collate
-        list_keys = ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_labels', 'instance_boxes', 'instance_ids_ori', 'full_masks', 'segment_masks', 'scan_id', 'segment_labels', 'query_selection_ids', 'instance_text_labels', 'instance_text_embeds']
-        list_keys = [k for k in list_keys if k in batch[0].keys()]
-        for k in list_keys:
-            new_batch[k] = [sample.pop(k) for sample in batch]
-            
-        # pad collate
-        padding_keys = ['coord_min', 'coord_max', 'obj_center', 'obj_pad_masks', 'seg_center', 'seg_pad_masks', 'seg_point_count', 'query_locs', 'query_pad_masks',
-                        'voxel_seg_pad_masks', 'mv_seg_fts', 'mv_seg_pad_masks']
-        padding_keys =  [k for k in padding_keys if k in batch[0].keys()]
-        for k in padding_keys:
-            tensors = [sample.pop(k) for sample in batch]
-            padded_tensor = pad_sequence(tensors)
-            new_batch[k] = padded_tensor
-        
-        # default collate
-        new_batch.update(default_collate(batch))
-        return new_batch
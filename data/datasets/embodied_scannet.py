@@ -16,7 +16,6 @@ from tqdm import tqdm
 from scipy import sparse
 import volumentations as V
 import albumentations as A
-import MinkowskiEngine as ME
 from transformers import AutoTokenizer
 
 from common.misc import rgetattr
@@ -25,9 +24,10 @@ from ..data_utils import (
     construct_bbox_corners, eval_ref_one_sample
 )
 from data.build import DATASET_REGISTRY
+from data.voxelize import sparse_quantize
 from data.datasets.scannet_base import ScanNetBase
 from data.datasets.constant import CLASS_LABELS_200, PromptType
-from data.data_utils import make_bce_label
+from data.data_utils import make_bce_label, instance_mask_info
 import fpsample
 
 SCAN_DATA = {'ScanNet': {}}
@@ -177,6 +177,8 @@ class EmbodiedScanNetInstSeg(EmbodiedScanNet):
             self.query_sample_strategy = instseg_options.get('query_sample_strategy', 'segment')
         self.offline_mask_source = instseg_options.get('offline_mask_source', None)
         self.compute_local_box = instseg_options.get('compute_local_box', False)
+        # store per point instance ids (int32) and bool segment masks instead of dense long masks
+        self.compact_instance_masks = instseg_options.get('compact_instance_masks', True)
         assert self.query_sample_strategy in ['fps', 'gt', 'segment', 'random_segment']
         # load augmentations
         self.volume_augmentations = V.NoOp()
@@ -246,9 +248,6 @@ class EmbodiedScanNetInstSeg(EmbodiedScanNet):
                 unique_inst_ids, indices, inverse_indices = np.unique(instance_labels_continous, return_index=True, return_inverse=True)
                 unique_inst_labels = sem_labels[indices]
                 n_inst = len(unique_inst_ids)
-                # instance to point mask
-                instance_range = np.arange(n_inst)[:, None]
-                full_masks = instance_range == inverse_indices
                 # instance to segment mask
                 n_segments = segment_id.max() + 1
                 segment_masks = np.zeros((n_inst, n_segments), dtype=bool)
@@ -263,7 +262,6 @@ class EmbodiedScanNetInstSeg(EmbodiedScanNet):
                 valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (unique_inst_labels != self.ignore_label) & (segment_masks.sum(1) > 0)
                 unique_inst_ids = unique_inst_ids[valid]
                 unique_inst_labels = unique_inst_labels[valid]
-                full_masks = full_masks[valid]
                 segment_masks = segment_masks[valid]
                
                 inverse_inst_label_mapper = {v: k for k, v in inst_label_mapper.items()}
@@ -271,10 +269,10 @@ class EmbodiedScanNetInstSeg(EmbodiedScanNet):
                     'instance_ids_ori': torch.LongTensor([inverse_inst_label_mapper[inst_id] for inst_id in unique_inst_ids]), 
                     'instance_ids': torch.LongTensor(unique_inst_ids),
                     'instance_labels': torch.LongTensor(unique_inst_labels),
-                    'full_masks': torch.LongTensor(full_masks),
-                    'segment_masks': torch.LongTensor(segment_masks),
                     'segment_labels': torch.LongTensor(segment_labels)
                 }
+                # per point kept instance ids (int32) and bool segment masks, or dense long masks
+                inst_info.update(instance_mask_info(inverse_indices, valid, segment_masks, self.compact_instance_masks))
                 scan_data['inst_info'] = inst_info
     
     def sample_query(self, voxel_coordinates, coordinates, obj_center, segment_center):
@@ -367,7 +365,7 @@ class EmbodiedScanNetInstSeg(EmbodiedScanNet):
 
         # voxelize coorinates, features and labels
         voxel_coordinates = np.floor(coordinates / self.voxel_size)
-        _, unique_map, inverse_map = ME.utils.sparse_quantize(coordinates=voxel_coordinates, return_index=True, return_inverse=True)
+        _, unique_map, inverse_map = sparse_quantize(voxel_coordinates, return_index=True, return_inverse=True)
         voxel_coordinates = voxel_coordinates[unique_map]
         voxel_features = features[unique_map]
         voxel2seg_id = point2seg_id[unique_map]
@@ -450,6 +448,8 @@ class EmbodiedRecurrentScanNetInstSeg(EmbodiedScanNet):
             self.query_sample_strategy = instseg_options.get('query_sample_strategy', 'segment')
         self.offline_mask_source = instseg_options.get('offline_mask_source', None)
         self.compute_local_box = instseg_options.get('compute_local_box', False)
+        # store per point instance ids (int32) and bool segment masks instead of dense long masks
+        self.compact_instance_masks = instseg_options.get('compact_instance_masks', True)
         assert self.query_sample_strategy in ['fps', 'gt', 'segment', 'random_segment']
         # load augmentations
         self.volume_augmentations = V.NoOp()
@@ -523,9 +523,6 @@ class EmbodiedRecurrentScanNetInstSeg(EmbodiedScanNet):
                 unique_inst_ids, indices, inverse_indices = np.unique(instance_labels_continous, return_index=True, return_inverse=True)
                 unique_inst_labels = sem_labels[indices]
                 n_inst = len(unique_inst_ids)
-                # instance to point mask
-                instance_range = np.arange(n_inst)[:, None]
-                full_masks = instance_range == inverse_indices
                 # instance to segment mask
                 n_segments = segment_id.max() + 1
                 segment_masks = np.zeros((n_inst, n_segments), dtype=bool)
@@ -539,7 +536,6 @@ class EmbodiedRecurrentScanNetInstSeg(EmbodiedScanNet):
                 valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (unique_inst_labels != self.ignore_label) & (segment_masks.sum(1) > 0)
                 unique_inst_ids = unique_inst_ids[valid]
                 unique_inst_labels = unique_inst_labels[valid]
-                full_masks = full_masks[valid]
                 segment_masks = segment_masks[valid]
                 
                 inverse_inst_label_mapper = {v: k for k, v in inst_label_mapper.items()}
@@ -547,10 +543,10 @@ class EmbodiedRecurrentScanNetInstSeg(EmbodiedScanNet):
                     'instance_ids_ori': torch.LongTensor([inverse_inst_label_mapper[inst_id] for inst_id in unique_inst_ids]),
                     'instance_ids': torch.LongTensor(unique_inst_ids),
                     'instance_labels': torch.LongTensor(unique_inst_labels),
-                    'full_masks': torch.LongTensor(full_masks),
-                    'segment_masks': torch.LongTensor(segment_masks),
                     'segment_labels': torch.LongTensor(segment_labels)
                 }
+                # per point kept instance ids (int32) and bool segment masks, or dense long masks
+                inst_info.update(instance_mask_info(inverse_indices, valid, segment_masks, self.compact_instance_masks))
                 scan_data['inst_info'] = inst_info
     
     def sample_query(self, voxel_coordinates, coordinates, obj_center, segment_center):
@@ -655,7 +651,7 @@ class EmbodiedRecurrentScanNetInstSeg(EmbodiedScanNet):
 
             # voxelize coorinates, features and labels
             voxel_coordinates = np.floor(coordinates / self.voxel_size)
-            _, unique_map, inverse_map = ME.utils.sparse_quantize(coordinates=voxel_coordinates, return_index=True, return_inverse=True)
+            _, unique_map, inverse_map = sparse_quantize(voxel_coordinates, return_index=True, return_inverse=True)
             voxel_coordinates = voxel_coordinates[unique_map]
             voxel_features = features[unique_map]
             voxel2seg_id = point2seg_id[unique_map]
@@ -27,7 +27,13 @@ from ..data_utils import (
 from data.build import DATASET_REGISTRY
 from data.datasets.scannet_base import ScanNetBase
 from data.datasets.constant import CLASS_LABELS_200, PromptType
-from data.data_utils import make_bce_label
+from data.data_utils import make_bce_label, freeze_arrays
+from data.object_feature_store import ObjectFeatureTable, object_feature_path
+from data.scan_index import get_scan_index
+from data.rank_shard import shard_scan_ids
+from common.dist_utils import get_rank, get_world_size
+from data.decision_store import DecisionRecords, compile_decision_records
+from data.derived_cache import config_hash
 import fpsample
 from data.datasets.hm3d_label_convert import convert_gpt4
 from collections import defaultdict
@@ -51,6 +57,8 @@ class EmbodiedVLEBase(Dataset, ABC):
         self.embodided_feat_dir = cfg.data.embodied_feat
         self.embodied_vle_dir = cfg.data.embodied_vle
         self.load_scan_options = cfg.data.get('load_scan_options', {})
+        # rank_shard: every rank loads only its own train scans (data/rank_shard.py)
+        self.rank, self.world_size = get_rank(), get_world_size()
         # label converter
         self.int2cat = json.load(open(os.path.join(self.base_dir,
                                             "ScanNet/annotations/meta_data/scannetv2_raw_categories.json"),
@@ -106,10 +114,46 @@ class EmbodiedVLEBase(Dataset, ABC):
         # debug filter
         if cfg.debug.flag and cfg.debug.debug_size != -1:
             scan_ids = list(scan_ids)[:cfg.debug.debug_size]
+        if self.split == 'train' and self.load_scan_options.get('rank_shard', False):
+            scan_ids = shard_scan_ids(list(scan_ids), self.scan_size, self.rank, self.world_size)
         return scan_ids
+
+    def scan_size(self, scan_id):
+        # number of stage 1 feature dumps of the scan, grows with the trajectories and decisions of the scan
+        if self.load_scan_options.get('object_feature_dir', None) is not None:
+            return os.path.getsize(object_feature_path(self.load_scan_options['object_feature_dir'], self.dataset_name, scan_id))
+        scan_index = get_scan_index(os.path.join(self.embodided_feat_dir, self.dataset_name), self.load_scan_options.get('scan_index_dir', None))
+        return len(scan_index.startswith(scan_id))
     
     def init_scan_data(self):
-        self.scan_data = self._load_scans(self.scan_ids)
+        self.scan_data = freeze_arrays(self._load_scans(self.scan_ids))
+
+    def decision_path(self, scan_id):
+        return os.path.join(self.embodied_vle_dir, self.decision_dirs[self.split], f'{scan_id}.json')
+
+    def load_decision_data(self):
+        # decision records of Ovon / SG3D / Goat, compiled once into a struct of arrays store (data/decision_store.py)
+        # when load_scan_options.decision_store_dir is set, read lazily per index instead of held as python dicts
+        store_dir = self.load_scan_options.get('decision_store_dir', None)
+        if store_dir is None:
+            lang_data = self._load_lang()
+        else:
+            # a changed decision json (path, mtime or size) compiles a new store
+            decision_sources = [[path, os.stat(path).st_mtime, os.stat(path).st_size] for path in map(self.decision_path, self.scan_ids) if os.path.exists(path)]
+            key = config_hash({'scan_ids': list(self.scan_ids), 'feat_dir': self.embodided_feat_dir,
+                               'object_feature_dir': self.load_scan_options.get('object_feature_dir', None),
+                               'decision_sources': decision_sources})
+            path = os.path.join(store_dir, f'{self.__class__.__name__}_{self.split}.{key}.pack')
+            if not os.path.exists(path):
+                # ranks without rank_shard share the key and may compile at once, write_pack gives each writer its own
+                # tmp file and publishes the complete store atomically, with rank_shard every rank has its own key
+                os.makedirs(store_dir, exist_ok=True)
+                compile_decision_records(self._load_lang(), path)
+            lang_data = DecisionRecords(path)
+        if self.random_drop_ratio > 0:
+            indices = random.sample(range(len(lang_data)), int(len(lang_data) * (1 - self.random_drop_ratio)))
+            lang_data = lang_data.subset(indices) if isinstance(lang_data, DecisionRecords) else [lang_data[i] for i in indices]
+        return lang_data
         
     def _load_scans(self, scan_ids):
         process_num = self.load_scan_options.get('process_num', 0)
@@ -151,8 +195,12 @@ class EmbodiedVLEBase(Dataset, ABC):
         else:
             raise NotImplemented(f'data set name {self.dataset_name}')
         
-        # load query feat
-        sub_scan_ids =  [sub_scan_id for sub_scan_id in os.listdir(os.path.join(self.embodided_feat_dir, self.dataset_name)) if sub_scan_id.startswith(scan_id)]
+        # load query feat, from a columnar store (data/object_feature_store.py) if available
+        if options.get('object_feature_dir', None) is not None:
+            one_scan['query_feat_dict'] = ObjectFeatureTable(object_feature_path(options['object_feature_dir'], self.dataset_name, scan_id))
+            return (scan_id, one_scan)
+        scan_index = get_scan_index(os.path.join(self.embodided_feat_dir, self.dataset_name), options.get('scan_index_dir', None))
+        sub_scan_ids = scan_index.startswith(scan_id)
         assert len(sub_scan_ids) > 0
         query_feat_dict = defaultdict(lambda : defaultdict(list))
         for sub_scan_id in sub_scan_ids:
@@ -179,7 +227,8 @@ class EmbodiedVLEBase(Dataset, ABC):
     
     def get_scene(self, scan_id, decision_id, is_object_decision, tgt_object_id_list, visible_object_id_list, frontier_list):
         # load basic data
-        scan_data = deepcopy(self.scan_data[scan_id])
+        # read only, features are copied into new tensors below
+        scan_data = self.scan_data[scan_id]
         query_feat_dict = scan_data['query_feat_dict']
         inst_to_label = scan_data['inst_to_label']
          
@@ -188,30 +237,39 @@ class EmbodiedVLEBase(Dataset, ABC):
             obj_ids = list(query_feat_dict.keys())
         else:
             obj_ids = visible_object_id_list
-        obj_fts = []
-        # obj_scores = []
-        obj_vocab_fts = []
-        obj_boxes = []
-        obj_labels = []
-        new_obj_ids = []
-        for obj_id in obj_ids:
-            if obj_id not in query_feat_dict.keys():
-                continue
-            choice_id = random.randint(0, len(query_feat_dict[obj_id]['object_feat']) - 1)
-            obj_feat = query_feat_dict[obj_id]['object_feat'][choice_id]
-            obj_openvocab_feat = query_feat_dict[obj_id]['object_open_vocab_feat'][choice_id]
-            obj_box = query_feat_dict[obj_id]['object_box'][choice_id]
-            # object_score = query_feat_dict[obj_id]['object_score'][choice_id]
-            # obj_scores.append(torch.tensor(object_score))
-            obj_fts.append(torch.tensor(obj_feat))
-            obj_vocab_fts.append(torch.tensor(obj_openvocab_feat))
-            obj_boxes.append(torch.tensor(obj_box))
-            obj_labels.append(self.cat2int[inst_to_label[obj_id]])
-            new_obj_ids.append(obj_id)
-        obj_fts = torch.stack(obj_fts, dim=0).float()
-        obj_vocab_fts = torch.stack(obj_vocab_fts, dim=0).float()
-        # obj_scores = torch.stack(obj_scores, dim=0).float()
-        obj_boxes = torch.stack(obj_boxes, dim=0).float()
+        if isinstance(query_feat_dict, ObjectFeatureTable):
+            # columnar store, one random observation per object gathered in one go
+            new_obj_ids = [obj_id for obj_id in obj_ids if obj_id in query_feat_dict]
+            rows = query_feat_dict.sample_rows(new_obj_ids)
+            obj_fts = query_feat_dict.gather('object_feat', rows)
+            obj_vocab_fts = query_feat_dict.gather('object_open_vocab_feat', rows)
+            obj_boxes = query_feat_dict.gather('object_box', rows)
+            obj_labels = [self.cat2int[inst_to_label[obj_id]] for obj_id in new_obj_ids]
+        else:
+            obj_fts = []
+            # obj_scores = []
+            obj_vocab_fts = []
+            obj_boxes = []
+            obj_labels = []
+            new_obj_ids = []
+            for obj_id in obj_ids:
+                if obj_id not in query_feat_dict.keys():
+                    continue
+                choice_id = random.randint(0, len(query_feat_dict[obj_id]['object_feat']) - 1)
+                obj_feat = query_feat_dict[obj_id]['object_feat'][choice_id]
+                obj_openvocab_feat = query_feat_dict[obj_id]['object_open_vocab_feat'][choice_id]
+                obj_box = query_feat_dict[obj_id]['object_box'][choice_id]
+                # object_score = query_feat_dict[obj_id]['object_score'][choice_id]
+                # obj_scores.append(torch.tensor(object_score))
+                obj_fts.append(torch.tensor(obj_feat))
+                obj_vocab_fts.append(torch.tensor(obj_openvocab_feat))
+                obj_boxes.append(torch.tensor(obj_box))
+                obj_labels.append(self.cat2int[inst_to_label[obj_id]])
+                new_obj_ids.append(obj_id)
+            obj_fts = torch.stack(obj_fts, dim=0).float()
+            obj_vocab_fts = torch.stack(obj_vocab_fts, dim=0).float()
+            # obj_scores = torch.stack(obj_scores, dim=0).float()
+            obj_boxes = torch.stack(obj_boxes, dim=0).float()
         obj_labels = torch.LongTensor(obj_labels).reshape(-1, 1) # N, 1
         obj_ids = new_obj_ids
         obj_locs = obj_boxes.clone()
@@ -274,6 +332,9 @@ class EmbodiedVLEBase(Dataset, ABC):
     
 @DATASET_REGISTRY.register() 
 class EmbodiedVLEOvon(EmbodiedVLEBase):
+    # decision json of a scan, per split under embodied_vle_dir
+    decision_dirs = {'train': 'ovon/train', 'val': 'ovon/val_seen'}
+
     def __init__(self, cfg, split):
         if split == 'test':
             split = 'val'
@@ -282,7 +343,7 @@ class EmbodiedVLEOvon(EmbodiedVLEBase):
         self.init_dataset_params(dataset_cfg)
         self.scan_ids = self._load_split(self.cfg, self.split)
         self.init_scan_data()
-        self.lang_data = self._load_lang()
+        self.lang_data = self.load_decision_data()
      
     def get_lang(self, index):
         item = self.lang_data[index]
@@ -311,10 +372,7 @@ class EmbodiedVLEOvon(EmbodiedVLEBase):
     def _load_lang(self):
         lang_data = []
         for scan_id in self.scan_ids:
-            if self.split == 'train':
-                decision_path = os.path.join(self.embodied_vle_dir, 'ovon', 'train', f'{scan_id}.json')
-            else:
-                decision_path = os.path.join(self.embodied_vle_dir, 'ovon', 'val_seen', f'{scan_id}.json')
+            decision_path = self.decision_path(scan_id)
             if not os.path.exists(decision_path):
                 continue
             decision_info = json.load(open(decision_path, 'r', encoding="utf-8"))
@@ -349,8 +407,6 @@ class EmbodiedVLEOvon(EmbodiedVLEBase):
                         else:
                             cur_dict['tgt_object_id_list'] = [int(decision['best_frontier_idx'])]
                         lang_data.append(cur_dict)
-        if self.random_drop_ratio > 0:
-            lang_data = random.sample(lang_data, int(len(lang_data) * (1 - self.random_drop_ratio)))
         return lang_data
     
 @DATASET_REGISTRY.register()
@@ -764,6 +820,9 @@ class EmbodiedVLEHM3DRefer(EmbodiedVLEBase):
 
 @DATASET_REGISTRY.register()
 class EmbodiedVLESG3D(EmbodiedVLEBase):
+    # decision json of a scan, per split under embodied_vle_dir
+    decision_dirs = {'train': 'sg3d/train', 'val': 'sg3d/val'}
+
     def __init__(self, cfg, split):
         if split == 'test':
             split = 'val'
@@ -772,7 +831,7 @@ class EmbodiedVLESG3D(EmbodiedVLEBase):
         self.init_dataset_params(dataset_cfg)
         self.scan_ids = self._load_split(self.cfg, self.split)
         self.init_scan_data()
-        self.lang_data = self._load_lang()
+        self.lang_data = self.load_decision_data()
         self.use_single_step = dataset_cfg.get('use_single_step', False)
 
     def get_lang(self, index):
@@ -804,10 +863,7 @@ class EmbodiedVLESG3D(EmbodiedVLEBase):
     def _load_lang(self):
         lang_data = []
         for scan_id in self.scan_ids:
-            if self.split == 'train':
-                decision_path = os.path.join(self.embodied_vle_dir, 'sg3d', 'train', f'{scan_id}.json')
-            else:
-                decision_path = os.path.join(self.embodied_vle_dir, 'sg3d', 'val', f'{scan_id}.json')
+            decision_path = self.decision_path(scan_id)
             if not os.path.exists(decision_path):
                 continue
             decision_info = json.load(open(decision_path, 'r', encoding="utf-8"))
@@ -842,12 +898,13 @@ class EmbodiedVLESG3D(EmbodiedVLEBase):
                         else:
                             cur_dict['tgt_object_id_list'] = [int(decision['best_frontier_idx'])]
                         lang_data.append(cur_dict)
-        if self.random_drop_ratio > 0:
-            lang_data = random.sample(lang_data, int(len(lang_data) * (1 - self.random_drop_ratio)))
         return lang_data
 
 @DATASET_REGISTRY.register()
 class EmbodiedVLEGoat(EmbodiedVLEBase):
+    # decision json of a scan, per split under embodied_vle_dir
+    decision_dirs = {'train': 'goat-bench/train', 'val': 'goat-bench/val_seen'}
+
     def __init__(self, cfg, split):
         if split == 'test':
             split = 'val'
@@ -856,7 +913,7 @@ class EmbodiedVLEGoat(EmbodiedVLEBase):
         self.init_dataset_params(dataset_cfg)
         self.scan_ids = self._load_split(self.cfg, self.split)
         self.init_scan_data()
-        self.lang_data = self._load_lang()
+        self.lang_data = self.load_decision_data()
         # load image feature
         image_feat_dir = os.path.join(self.embodied_vle_dir, 'goat-clip-feat')
         image_feat_dict = {}
@@ -898,10 +955,7 @@ class EmbodiedVLEGoat(EmbodiedVLEBase):
     def _load_lang(self):
         lang_data = []
         for scan_id in self.scan_ids:
-            if self.split == 'train':
-                decision_path = os.path.join(self.embodied_vle_dir, 'goat-bench', 'train', f'{scan_id}.json')
-            else:
-                decision_path = os.path.join(self.embodied_vle_dir, 'goat-bench', 'val_seen', f'{scan_id}.json')
+            decision_path = self.decision_path(scan_id)
             if not os.path.exists(decision_path):
                 continue
             decision_info = json.load(open(decision_path, 'r', encoding="utf-8"))
@@ -939,6 +993,4 @@ class EmbodiedVLEGoat(EmbodiedVLEBase):
                         else:
                             cur_dict['tgt_object_id_list'] = [int(decision['best_frontier_idx'])]
                         lang_data.append(cur_dict)
-        if self.random_drop_ratio > 0:
-            lang_data = random.sample(lang_data, int(len(lang_data) * (1 - self.random_drop_ratio)))
         return lang_data
@@ -52,7 +52,8 @@ class InstSegDatasetWrapper(Dataset):
                 raise NotImplementedError(f'{self.offline_mask_source} is not implemented')
             
         # list collate
-        list_keys = ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_labels', 'full_masks', 'segment_masks', 'scan_id']
+        list_keys = ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_labels', 'full_masks', 'point_instance_ids', 'segment_masks', 'scan_id']
+        list_keys = [k for k in list_keys if k in batch[0].keys()]
         for k in list_keys:
             new_batch[k] = [sample.pop(k) for sample in batch]
 
@@ -127,7 +128,8 @@ class InstSegRecurrentDatasetWrapper(Dataset):
                     raise NotImplementedError(f'{self.offline_mask_source} is not implemented')
                 
             # list collate
-            list_keys = ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_ids_ori', 'instance_labels', 'instance_boxes', 'full_masks', 'segment_masks', 'scan_id']
+            list_keys = ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_ids_ori', 'instance_labels', 'instance_boxes', 'full_masks', 'point_instance_ids', 'segment_masks', 'scan_id']
+            list_keys = [k for k in list_keys if k in batch[0].keys()]
             for k in list_keys:
                 new_batch[k] = [sample.pop(k) for sample in batch]
 
@@ -12,7 +12,7 @@ import torch
 from torch.utils.data import Dataset
 
 from common.misc import rgetattr
-from ..data_utils import convert_pc_to_box, LabelConverter, build_rotate_mat, load_matrix_from_txt, \
+from ..data_utils import convert_pc_to_box, group_instance_points, LabelConverter, build_rotate_mat, load_matrix_from_txt, \
                         construct_bbox_corners, eval_ref_one_sample  
 from copy import deepcopy
 
@@ -97,23 +97,18 @@ class ScanNetBase(Dataset):
             one_scan['pcds'] = pcds
             # convert to gt object
             if options.get('load_inst_info', True):
-
-                def get_loc(obj_pcd):
-                    center = obj_pcd[:, :3].mean(0)
-                    size = obj_pcd[:, :3].max(0) - obj_pcd[:, :3].min(0)
-                    return list(center) + list(size)
-                
-                def get_box(obj_pcd):
-                    center, size = convert_pc_to_box(obj_pcd)
-                    return list(center) + list(size)
-                
-                # gt masks
-                obj_masks = instance_labels[None, :] == np.arange(instance_labels.max() + 1)[:, None] if instance_labels is not None else [] # ScanQA test
-                obj_boxes = np.array([get_box(pcds[mask]) for mask in obj_masks], dtype=np.float32)
-                obj_locs = np.array([get_loc(pcds[mask]) for mask in obj_masks], dtype=np.float32)
                 bg_obj_ids = [i for i, label in enumerate(inst_labels) if self.int2cat[label] in ['wall', 'floor', 'ceiling']]
-                bg_mask = [] if obj_masks == [] else obj_masks[bg_obj_ids].sum(0).astype(bool) # ScanQA test
-                one_scan['obj_masks'] = [np.nonzero(mask)[0] for mask in obj_masks]
+                if instance_labels is not None:
+                    # gt boxes (box center + size), locs (point mean + size) and point indices of all instances in one pass
+                    obj_masks, centers, sizes, means, _ = group_instance_points(pcds, instance_labels, np.arange(instance_labels.max() + 1))
+                    obj_boxes = np.concatenate([centers, sizes], axis=1).astype(np.float32)
+                    obj_locs = np.concatenate([means, sizes], axis=1).astype(np.float32)
+                    bg_mask = np.isin(instance_labels, bg_obj_ids)
+                else: # ScanQA test
+                    obj_masks, bg_mask = [], []
+                    obj_boxes = np.array([], dtype=np.float32)
+                    obj_locs = np.array([], dtype=np.float32)
+                one_scan['obj_masks'] = obj_masks
                 one_scan['bg_mask'] = bg_mask
                 one_scan['obj_loc'] = obj_locs
                 one_scan['obj_box'] = obj_boxes
@@ -455,7 +450,7 @@ class ScanNetBase(Dataset):
         
         if self.load_scan_options.get('load_segment_center', False):
             for scan_id in self.scan_ids:
-                points = deepcopy(self.scan_data[scan_id]['scene_pcds']) # mask3d points
+                points = self.scan_data[scan_id]['scene_pcds'] # mask3d points, only read
                 coordinates, color, normals, point2seg_id, labels = (
                     points[:, :3],
                     points[:, 3:6],
@@ -470,7 +465,8 @@ class ScanNetBase(Dataset):
         
         if self.load_scan_options.get('load_segment_mask', False):
            for scan_id in self.scan_ids:
-                labels = deepcopy(self.scan_data[scan_id]['scene_pcds'])[:, 9:12]
+                # copy only the label columns, map_to_scannet200_id writes in place
+                labels = self.scan_data[scan_id]['scene_pcds'][:, 9:12].copy()
                 # get ids
                 point2seg_id, point2inst_label, point2inst_id = labels[:, 0], labels[:, 1], labels[:, 2]
                 point2inst_label = self.map_to_scannet200_id(point2inst_label)
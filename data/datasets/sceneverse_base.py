@@ -12,7 +12,7 @@ import torch
 from torch.utils.data import Dataset
 
 from common.misc import rgetattr
-from ..data_utils import convert_pc_to_box, LabelConverter, build_rotate_mat, load_matrix_from_txt, \
+from ..data_utils import convert_pc_to_box, group_instance_points, LabelConverter, build_rotate_mat, load_matrix_from_txt, \
                         construct_bbox_corners, eval_ref_one_sample  
 from copy import deepcopy
 
@@ -193,27 +193,25 @@ class SceneVerseBase(Dataset):
                 inst_ids = []
                 inst_labels = []
                 bg_indices = np.full((points.shape[0], ), 1, dtype=np.bool_)
-                for inst_id in inst_to_label.keys():
-                    if inst_to_label[inst_id] in self.cat2int.keys():
-                        mask = instance_labels == inst_id
-                        if np.sum(mask) == 0:
-                            continue
-                        obj_pcds.append(pcds[mask])
-                        inst_ids.append(inst_id)
-                        inst_labels.append(self.cat2int[inst_to_label[inst_id]])
-                        if inst_to_label[inst_id] not in ['wall', 'floor', 'ceiling']:
-                            bg_indices[mask] = False
+                obj_center = []
+                obj_box_size = []
+                # group points and compute boxes for matching of all instances in one pass instead of one full mask per instance
+                candidate_ids = [inst_id for inst_id in inst_to_label.keys() if inst_to_label[inst_id] in self.cat2int.keys()]
+                groups = group_instance_points(pcds, instance_labels, candidate_ids)
+                for inst_id, indices, center, box_size in zip(candidate_ids, *groups[:3]):
+                    if len(indices) == 0:
+                        continue
+                    obj_pcds.append(pcds[indices])
+                    inst_ids.append(inst_id)
+                    inst_labels.append(self.cat2int[inst_to_label[inst_id]])
+                    obj_center.append(center.tolist())
+                    obj_box_size.append(box_size.tolist())
+                    if inst_to_label[inst_id] not in ['wall', 'floor', 'ceiling']:
+                        bg_indices[indices] = False
                 one_scan['obj_pcds'] = obj_pcds
                 one_scan['inst_labels'] = inst_labels
                 one_scan['inst_ids'] = inst_ids
                 one_scan['bg_pcds'] = pcds[bg_indices]
-                # calculate box for matching
-                obj_center = []
-                obj_box_size = []
-                for obj_pcd in obj_pcds:
-                    _c, _b = convert_pc_to_box(obj_pcd)
-                    obj_center.append(_c)
-                    obj_box_size.append(_b)
                 one_scan['obj_loc'] = obj_center
                 one_scan['obj_box'] = obj_box_size
                 # convert pc to pred object
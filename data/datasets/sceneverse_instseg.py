@@ -10,12 +10,12 @@ from torch_scatter import scatter_mean
 from transformers import AutoTokenizer
 import volumentations as V
 import albumentations as A
-import MinkowskiEngine as ME
 
 from data.build import DATASET_REGISTRY
+from data.voxelize import sparse_quantize
 from data.datasets.scannet_base import ScanNetBase
 from data.datasets.constant import CLASS_LABELS_200, PromptType
-from data.data_utils import make_bce_label
+from data.data_utils import make_bce_label, instance_mask_info
 import fpsample
 
 from data.datasets.sceneverse_base import SceneVerseBase
@@ -34,6 +34,8 @@ class SceneVerseInstSeg(SceneVerseBase):
         self.num_queries = instseg_options.get('num_queries', 120)
         self.query_sample_strategy = instseg_options.get('query_sample_strategy', 'fps')
         self.offline_mask_source = instseg_options.get('offline_mask_source', None)
+        # store per point instance ids (int32) and bool segment masks instead of dense long masks
+        self.compact_instance_masks = instseg_options.get('compact_instance_masks', True)
         assert self.query_sample_strategy in ['fps', 'gt']
         # load augmentations
         self.volume_augmentations = V.NoOp()
@@ -96,9 +98,6 @@ class SceneVerseInstSeg(SceneVerseBase):
             unique_inst_ids, indices, inverse_indices = np.unique(instance_labels_continous, return_index=True, return_inverse=True)
             unique_inst_labels = sem_labels[indices]
             n_inst = len(unique_inst_ids)
-            # instance to point mask
-            instance_range = np.arange(n_inst)[:, None]
-            full_masks = instance_range == inverse_indices
             # instance to segment mask
             n_segments = segment_id.max() + 1
             segment_masks = np.zeros((n_inst, n_segments), dtype=bool)
@@ -107,15 +106,14 @@ class SceneVerseInstSeg(SceneVerseBase):
             valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes)
             unique_inst_ids = unique_inst_ids[valid]
             unique_inst_labels = unique_inst_labels[valid]
-            full_masks = full_masks[valid]
             segment_masks = segment_masks[valid]
             
             inst_info = {
                 'instance_ids': torch.LongTensor(unique_inst_ids),
                 'instance_labels': torch.LongTensor(unique_inst_labels),
-                'full_masks': torch.LongTensor(full_masks),
-                'segment_masks': torch.LongTensor(segment_masks),
             }
+            # per point kept instance ids (int32) and bool segment masks, or dense long masks
+            inst_info.update(instance_mask_info(inverse_indices, valid, segment_masks, self.compact_instance_masks))
             scan_data['inst_info'] = inst_info
     
     def sample_query(self, voxel_coordinates, coordinates, obj_center):
@@ -188,7 +186,7 @@ class SceneVerseInstSeg(SceneVerseBase):
 
         # voxelize coorinates, features and labels
         voxel_coordinates = np.floor(coordinates / self.voxel_size)
-        _, unique_map, inverse_map = ME.utils.sparse_quantize(coordinates=voxel_coordinates, return_index=True, return_inverse=True)
+        _, unique_map, inverse_map = sparse_quantize(voxel_coordinates, return_index=True, return_inverse=True)
         voxel_coordinates = voxel_coordinates[unique_map]
         voxel_features = features[unique_map]
         voxel2seg_id = point2seg_id[unique_map]
@@ -0,0 +1,130 @@
+import time
+import tracemalloc
+
+import numpy as np
+
+from data.scan_store import write_pack, PackedScan
+
+'''
+Struct of arrays store of stage 2 decision records (Ovon / Goat / SG3D _load_lang output)
+one packed file (data/scan_store.py):
+    string table: strings (uint8 utf-8 bytes) + string_offsets (int64)
+    int32 columns: scan_id, episode_id, sentence, task_type (string ids, -1 if missing),
+                   sub_episode_id, time_step, is_object_decision
+    ragged columns: object_list, tgt_object_id_list (int32 values + int64 offsets),
+                    frontier_list (float32 (n, width) values + int64 offsets)
+'''
+STRING_FIELDS = ['scan_id', 'episode_id', 'sentence', 'task_type']
+INT_FIELDS = ['sub_episode_id', 'time_step', 'is_object_decision']
+RAGGED_INT_FIELDS = ['object_list', 'tgt_object_id_list']
+
+
+def _ragged(values_list, dtype, width=None):
+    lengths = np.array([len(v) for v in values_list], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    flat = [x for v in values_list for x in v]
+    shape = (len(flat), width) if width is not None else (len(flat),)
+    values = np.array(flat, dtype=dtype).reshape(shape)
+    return values, offsets
+
+
+def compile_decision_records(records, path):
+    strings = {}
+    def string_id(s):
+        return -1 if s is None else strings.setdefault(s, len(strings))
+    arrays = {}
+    for field in STRING_FIELDS:
+        arrays[field] = np.array([string_id(record.get(field, None)) for record in records], dtype=np.int32)
+    for field in INT_FIELDS:
+        arrays[field] = np.array([int(record[field]) for record in records], dtype=np.int32)
+    for field in RAGGED_INT_FIELDS:
+        arrays[field], arrays[field + '_offsets'] = _ragged([record[field] for record in records], np.int32)
+    widths = {len(frontier) for record in records for frontier in record['frontier_list']}
+    assert len(widths) <= 1, f'frontiers of different widths {widths}'
+    arrays['frontier_list'], arrays['frontier_list_offsets'] = _ragged([record['frontier_list'] for record in records], np.float32, widths.pop() if widths else 0)
+    encoded = [s.encode('utf-8') for s in strings]
+    arrays['strings'] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    arrays['string_offsets'] = np.concatenate([[0], np.cumsum([len(s) for s in encoded])]).astype(np.int64)
+    write_pack(path, arrays)
+    return path
+
+
+class DecisionRecords:
+    ''' Lazy read only records of a compiled decision store, record i is built on access as the dict _load_lang produced
+    '''
+    def __init__(self, path, indices=None):
+        self.path = path
+        self.indices = indices
+        self.pack = PackedScan(path, mmap=True)
+        self.columns = {name: self.pack.get(name) for name in self.pack.keys()}
+        self.length = len(self.columns['scan_id']) if indices is None else len(indices)
+
+    def __getstate__(self):
+        # workers reopen the memmap
+        return {'path': self.path, 'indices': self.indices}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['indices'])
+
+    def __len__(self):
+        return self.length
+
+    def subset(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.indices is not None:
+            indices = self.indices[indices]
+        return DecisionRecords(self.path, indices)
+
+    def __mul__(self, duplicate):
+        # list style repetition, used by the unified task wrapper
+        return self.subset(np.tile(np.arange(self.length), duplicate))
+
+    def string(self, string_id):
+        offsets = self.columns['string_offsets']
+        return bytes(self.columns['strings'][offsets[string_id]:offsets[string_id + 1]]).decode('utf-8')
+
+    def ragged(self, field, i):
+        offsets = self.columns[field + '_offsets']
+        return self.columns[field][offsets[i]:offsets[i + 1]].tolist()
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError(index)
+        i = int(self.indices[index]) if self.indices is not None else index
+        record = {}
+        for field in STRING_FIELDS:
+            string_id = int(self.columns[field][i])
+            if string_id >= 0:
+                record[field] = self.string(string_id)
+        record['sub_episode_id'] = int(self.columns['sub_episode_id'][i])
+        record['time_step'] = int(self.columns['time_step'][i])
+        record['is_object_decision'] = bool(self.columns['is_object_decision'][i])
+        for field in RAGGED_INT_FIELDS + ['frontier_list']:
+            record[field] = self.ragged(field, i)
+        return record
+
+
+def benchmark_decision_store(dataset, path):
+    # parse time and python heap of _load_lang vs opening and reading all records of the compiled store
+    tracemalloc.start()
+    start = time.time()
+    lang_data = dataset._load_lang()
+    json_time = time.time() - start
+    json_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    compile_decision_records(lang_data, path)
+    del lang_data
+    tracemalloc.start()
+    start = time.time()
+    records = DecisionRecords(path)
+    open_time = time.time() - start
+    store_memory = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    for i in range(len(records)):
+        records[i]
+    read_time = (time.time() - start) / max(len(records), 1)
+    tracemalloc.stop()
+    print(f"{dataset.__class__.__name__}: {len(records)} records, json {json_time:.2f} s / {json_memory / 2 ** 20:.1f} MB, "
+          f"store open {open_time * 1000:.1f} ms / {store_memory / 2 ** 20:.1f} MB, {read_time * 1e6:.1f} us/record")
@@ -0,0 +1,122 @@
+import os
+import json
+import glob
+import hashlib
+
+import numpy as np
+import torch
+
+from data.scan_store import write_pack, PackedScan
+from data.data_utils import frozen_to_tensor
+
+'''
+Disk cache of derived per scan artifacts, e.g. instance info extracted from raw labels
+entries live in <cache_dir>/<namespace>/<config hash>/<scan_id>.<source mtime hash>.pack,
+a change of the producing config or a newer source file misses and recomputes
+values are nested dicts / lists of arrays, tensors and json types, arrays are stored as packed scan
+buffers (data/scan_store.py) and read back as copies, the rest as a json structure
+'''
+# bump when the code producing cached artifacts changes
+DERIVED_CACHE_VERSION = 1
+STRUCTURE_KEY = '__structure__'
+
+
+def config_hash(config):
+    text = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def source_mtime(paths):
+    # latest modification time of the sources, directories also count their direct children
+    mtime = 0.0
+    for path in paths:
+        mtime = max(mtime, os.stat(path).st_mtime)
+        if os.path.isdir(path):
+            for entry in os.scandir(path):
+                mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+
+def _flatten(obj, arrays):
+    if isinstance(obj, torch.Tensor):
+        name = f'array_{len(arrays)}'
+        arrays[name] = obj.numpy()
+        return {'__tensor__': name}
+    if isinstance(obj, np.ndarray):
+        name = f'array_{len(arrays)}'
+        arrays[name] = obj
+        return {'__array__': name}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        # key value pairs keep int keys
+        return {'__dict__': [[k, _flatten(v, arrays)] for k, v in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_flatten(v, arrays) for v in obj]}
+    if isinstance(obj, list):
+        return [_flatten(v, arrays) for v in obj]
+    assert obj is None or isinstance(obj, (str, int, float, bool)), f'can not cache {type(obj)}'
+    return obj
+
+
+def _unflatten(structure, pack):
+    if isinstance(structure, dict):
+        if '__tensor__' in structure:
+            return frozen_to_tensor(pack.get(structure['__tensor__']))
+        if '__array__' in structure:
+            return pack.get(structure['__array__'])
+        if '__dict__' in structure:
+            return {k: _unflatten(v, pack) for k, v in structure['__dict__']}
+        if '__tuple__' in structure:
+            return tuple(_unflatten(v, pack) for v in structure['__tuple__'])
+    if isinstance(structure, list):
+        return [_unflatten(v, pack) for v in structure]
+    return structure
+
+
+class DerivedCache:
+    ''' Per scan artifacts on disk keyed by a hash of the producing config and the source files mtime
+    '''
+    def __init__(self, cache_dir, namespace, config):
+        self.config = dict(config, version=DERIVED_CACHE_VERSION)
+        self.cache_dir = os.path.join(cache_dir, namespace, config_hash(self.config))
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, scan_id, source_paths):
+        return os.path.join(self.cache_dir, f'{scan_id}.{config_hash(source_mtime(source_paths))}.pack')
+
+    def load(self, scan_id, source_paths):
+        path = self.path(scan_id, source_paths)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        self.hits += 1
+        # copies, entries stay in the scan data for the whole run and must not hold a mapping per scan
+        with PackedScan(path) as pack:
+            structure = json.loads(bytes(pack.get(STRUCTURE_KEY)).decode('utf-8'))
+            return _unflatten(structure, pack)
+
+    def save(self, scan_id, source_paths, obj):
+        path = self.path(scan_id, source_paths)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        arrays = {}
+        structure = _flatten(obj, arrays)
+        arrays[STRUCTURE_KEY] = np.frombuffer(json.dumps(structure).encode('utf-8'), dtype=np.uint8)
+        write_pack(path, arrays)
+        # drop entries of older sources
+        for stale_path in glob.glob(os.path.join(glob.escape(self.cache_dir), glob.escape(scan_id) + '.*.pack')):
+            if stale_path != path:
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    # removed by a concurrent writer of the same scan
+                    pass
+
+    def get_or_compute(self, scan_id, source_paths, compute_fn):
+        obj = self.load(scan_id, source_paths)
+        if obj is None:
+            obj = compute_fn()
+            self.save(scan_id, source_paths, obj)
+        return obj
+
@@ -0,0 +1,120 @@
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+
+from data.scan_store import write_pack, PackedScan
+from data.scan_index import get_scan_index
+
+'''
+Columnar per scan store of the stage 1 object feature dumps used by the VLE datasets
+one packed scan (data/scan_store.py) per scan, rows are object observations grouped by object id:
+    object_ids (M,) int64, sorted
+    offsets (M + 1,) int64, rows of object i are offsets[i]:offsets[i + 1]
+    object_feat (R, C) float16, object_open_vocab_feat (R, C') float16, object_score (R,) float16
+    object_box (R, 6) float32
+    row_sub_scan (R,) int32, index into sub_scan_ids (json) of the dump a row comes from
+'''
+FEATURE_COLUMNS = {
+    'object_feat': np.float16,
+    'object_open_vocab_feat': np.float16,
+    'object_score': np.float16,
+    'object_box': np.float32,
+}
+
+
+def object_feature_path(store_dir, dataset_name, scan_id):
+    return os.path.join(store_dir, dataset_name, scan_id + '.pack')
+
+
+def _to_numpy(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().numpy()
+    return np.asarray(value)
+
+
+def convert_object_features(feat_dir, dataset_name, scan_id, store_dir):
+    # merge the per sub scan torch dumps of one scan into one columnar pack
+    sub_scan_ids = get_scan_index(os.path.join(feat_dir, dataset_name)).startswith(scan_id)
+    assert len(sub_scan_ids) > 0
+    rows = {} # object id -> list of (sub scan index, {column: value})
+    for sub_scan_index, sub_scan_id in enumerate(sub_scan_ids):
+        feat = torch.load(os.path.join(feat_dir, dataset_name, sub_scan_id))
+        for obj_id, v in feat.items():
+            columns = [k for k in FEATURE_COLUMNS if k in v]
+            for i in range(len(v['object_feat'])):
+                rows.setdefault(int(obj_id), []).append((sub_scan_index, {k: _to_numpy(v[k][i]) for k in columns}))
+    object_ids = np.array(sorted(rows.keys()), dtype=np.int64)
+    counts = np.array([len(rows[obj_id]) for obj_id in object_ids], dtype=np.int64)
+    arrays = {
+        'object_ids': object_ids,
+        'offsets': np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        'row_sub_scan': np.array([sub_scan_index for obj_id in object_ids for sub_scan_index, _ in rows[obj_id]], dtype=np.int32),
+        'sub_scan_ids': np.frombuffer(json.dumps(sub_scan_ids).encode('utf-8'), dtype=np.uint8),
+    }
+    for name, dtype in FEATURE_COLUMNS.items():
+        values = [row[name] for obj_id in object_ids for _, row in rows[obj_id] if name in row]
+        if len(values) == len(arrays['row_sub_scan']) and len(values) > 0:
+            arrays[name] = np.stack(values).astype(dtype)
+    out_path = object_feature_path(store_dir, dataset_name, scan_id)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    write_pack(out_path, arrays)
+    return out_path
+
+
+class ObjectFeatureTable:
+    ''' Read only in memory columns of one scan's object features, stands in for query_feat_dict
+    supports `obj_id in table` and keys(), rows are sampled and gathered as tensors for many objects at once
+    '''
+    def __init__(self, path):
+        self.path = path
+        # columns are read as copies and the pack is closed, a table per scan holds no file descriptor or mapping
+        with PackedScan(path) as pack:
+            self.columns = {name: pack.get(name) for name in pack.keys()}
+        for column in self.columns.values():
+            column.flags.writeable = False
+        self.object_ids = self.columns['object_ids']
+        self.offsets = self.columns['offsets']
+        self.id_to_index = {obj_id: i for i, obj_id in enumerate(self.object_ids.tolist())}
+
+    def __getstate__(self):
+        # spawned workers read the pack again instead of receiving a pickled copy of the columns
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __contains__(self, obj_id):
+        return obj_id in self.id_to_index
+
+    def __len__(self):
+        return len(self.object_ids)
+
+    def keys(self):
+        return self.id_to_index.keys()
+
+    def sub_scan_ids(self):
+        return json.loads(bytes(self.columns['sub_scan_ids']).decode('utf-8'))
+
+    def sample_rows(self, obj_ids):
+        # one random observation per object, as random.randint over the object's feature list
+        index = np.array([self.id_to_index[obj_id] for obj_id in obj_ids], dtype=np.int64)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return start + (np.random.rand(len(index)) * (end - start)).astype(np.int64)
+
+    def gather(self, name, rows):
+        return torch.from_numpy(self.columns[name][rows].astype(np.float32))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert stage 1 object feature dumps into columnar per scan packs')
+    parser.add_argument('--embodied_feat', required=True)
+    parser.add_argument('--dataset', default='HM3D', choices=['ScanNet', 'HM3D'])
+    parser.add_argument('--out_dir', required=True)
+    parser.add_argument('--scan_list', required=True, help='text file with one scan id per line, e.g. the dataset split')
+    args = parser.parse_args()
+    scan_ids = [x.strip() for x in open(args.scan_list, 'r', encoding='utf-8') if x.strip()]
+    for scan_id in scan_ids:
+        convert_object_features(args.embodied_feat, args.dataset, scan_id, args.out_dir)
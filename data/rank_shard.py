@@ -0,0 +1,60 @@
+import heapq
+
+import numpy as np
+from torch.utils.data import Sampler
+
+from common.dist_utils import get_world_size, all_gather_unaligned
+
+'''
+Rank sharded loading, each rank builds its dataset from its own subset of scans (load_scan_options.rank_shard)
+scans are assigned by size, largest first to the least loaded rank, the assignment only depends on the
+scan ids and sizes so every rank computes the same one without communication
+'''
+
+
+def assign_scans(scan_ids, sizes, world_size):
+    # returns one list of scan ids per rank, each in the order of scan_ids
+    order = sorted(range(len(scan_ids)), key=lambda i: (-sizes[i], scan_ids[i]))
+    loads = [(0, rank) for rank in range(world_size)]
+    owner = [0] * len(scan_ids)
+    for i in order:
+        load, rank = heapq.heappop(loads)
+        owner[i] = rank
+        heapq.heappush(loads, (load + sizes[i], rank))
+    return [[scan_id for scan_id, r in zip(scan_ids, owner) if r == rank] for rank in range(world_size)]
+
+
+def shard_scan_ids(scan_ids, size_fn, rank, world_size):
+    if world_size == 1:
+        return scan_ids
+    sizes = {scan_id: size_fn(scan_id) for scan_id in scan_ids}
+    shards = assign_scans(list(scan_ids), [sizes[scan_id] for scan_id in scan_ids], world_size)
+    print(f'rank {rank}: {len(shards[rank])} / {len(scan_ids)} scans, size {sum(sizes[s] for s in shards[rank])} / {sum(sizes.values())}')
+    return shards[rank]
+
+
+class RankShardSampler(Sampler):
+    ''' Per epoch shuffle of a rank's local dataset, padded by repetition to the largest local dataset so that
+    every rank runs the same number of steps, as DistributedSampler pads the global index list
+    the epoch is set with set_epoch before iterating
+    '''
+    splits_ranks = True
+
+    def __init__(self, num_samples, shuffle=True, seed=0):
+        self.num_samples = num_samples
+        self.total_size = max(all_gather_unaligned(num_samples))
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(self.num_samples) if self.shuffle else np.arange(self.num_samples)
+        return iter(np.resize(indices, self.total_size).tolist())
+
+    def __len__(self):
+        return self.total_size
+
@@ -0,0 +1,86 @@
+import collections
+import weakref
+
+import numpy as np
+import torch
+
+
+def nbytes_of(obj):
+    # approximate memory of nested scan data, only arrays are counted
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, dict):
+        return sum(nbytes_of(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(nbytes_of(v) for v in obj)
+    return 0
+
+
+class ScanCache:
+    ''' Lazily populated scan dict with LRU eviction under a byte budget
+    scans are loaded by load_fn(scan_id) on first access, the most recent scan is never evicted
+    max_bytes bounds the process that owns the cache, dataloader workers each own a copy, and
+    scan_cache_worker_init gives every worker an empty cache with max_bytes / num_workers
+    '''
+    instances = weakref.WeakSet()
+
+    def __init__(self, scan_ids, load_fn, max_bytes):
+        self.scan_ids = list(scan_ids)
+        self.scan_id_set = set(self.scan_ids)
+        self.load_fn = load_fn
+        self.max_bytes = max_bytes
+        self.reset()
+        ScanCache.instances.add(self)
+
+    def reset(self):
+        self.scans = collections.OrderedDict()
+        self.scan_bytes = {}
+        self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.scan_ids)
+
+    def __contains__(self, scan_id):
+        return scan_id in self.scan_id_set
+
+    def __iter__(self):
+        return iter(self.scan_ids)
+
+    def keys(self):
+        return self.scan_ids
+
+    def __getitem__(self, scan_id):
+        if scan_id in self.scans:
+            self.scans.move_to_end(scan_id)
+            return self.scans[scan_id]
+        one_scan = self.load_fn(scan_id)
+        self.scans[scan_id] = one_scan
+        self.scan_bytes[scan_id] = nbytes_of(one_scan)
+        self.total_bytes += self.scan_bytes[scan_id]
+        while self.total_bytes > self.max_bytes and len(self.scans) > 1:
+            evicted_id, _ = self.scans.popitem(last=False)
+            self.total_bytes -= self.scan_bytes.pop(evicted_id)
+        return one_scan
+
+    def __getstate__(self):
+        # pickled copies, e.g. spawned workers, start empty, forked workers are reset by scan_cache_worker_init
+        state = self.__dict__.copy()
+        state['scans'] = collections.OrderedDict()
+        state['scan_bytes'] = {}
+        state['total_bytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        ScanCache.instances.add(self)
+
+
+def scan_cache_worker_init(worker_id):
+    # dataloader worker_init_fn, drops scans inherited by fork and splits the budget of every cache across the workers
+    num_workers = torch.utils.data.get_worker_info().num_workers
+    for cache in list(ScanCache.instances):
+        cache.reset()
+        cache.max_bytes = cache.max_bytes // num_workers
+
@@ -0,0 +1,87 @@
+import os
+import re
+import json
+import bisect
+
+'''
+Directory index shared by the datasets, each root is listed once per process (or read from a
+persisted manifest) and the entries of a scan are looked up by its scan id
+manifest: {'root': str, 'mtime': float, 'groups': {scan id: [sorted names]}}, stale once the directory mtime changes
+'''
+_SCAN_INDEX = {} # (root, manifest_dir) -> ScanDirectoryIndex
+# HM3D 00800-TEEsavR23oF, ScanNet scene0000_00
+SCAN_ID_PATTERN = re.compile(r'\d{5}-[A-Za-z0-9]{11}|scene\d{4}_\d{2}')
+
+
+def scan_key(name):
+    # scan id an entry belongs to, the name before the first '_' or '.' for other layouts
+    match = SCAN_ID_PATTERN.match(name)
+    return match.group(0) if match else re.split(r'[_.]', name)[0]
+
+
+def group_entries(names):
+    groups = {}
+    for name in sorted(names):
+        groups.setdefault(scan_key(name), []).append(name)
+    return groups
+
+
+class ScanDirectoryIndex:
+    ''' Entries of one directory grouped by scan id, a scan's entries are one dict lookup
+    '''
+    def __init__(self, root, manifest_dir=None):
+        self.root = root
+        self.manifest_path = None
+        if manifest_dir is not None:
+            self.manifest_path = os.path.join(manifest_dir, os.path.abspath(root).strip(os.sep).replace(os.sep, '_') + '.json')
+        mtime = os.stat(root).st_mtime
+        self.groups = self._load_manifest(mtime)
+        if self.groups is None:
+            self.groups = group_entries(os.listdir(root))
+            self._save_manifest(mtime)
+        self.keys = sorted(self.groups.keys())
+
+    def _load_manifest(self, mtime):
+        if self.manifest_path is None or not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        # flat manifests of older versions have no groups
+        if manifest['root'] != os.path.abspath(self.root) or manifest['mtime'] != mtime or 'groups' not in manifest:
+            return None
+        return manifest['groups']
+
+    def _save_manifest(self, mtime):
+        if self.manifest_path is None:
+            return
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = self.manifest_path + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'root': os.path.abspath(self.root), 'mtime': mtime, 'groups': self.groups}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def __len__(self):
+        return sum(len(names) for names in self.groups.values())
+
+    def startswith(self, prefix):
+        # same entries as [x for x in os.listdir(root) if x.startswith(prefix)], sorted
+        if SCAN_ID_PATTERN.fullmatch(prefix):
+            return list(self.groups.get(prefix, []))
+        # other prefixes, e.g. a sub trajectory: groups whose key starts with the prefix or is a prefix of it
+        start = bisect.bisect_left(self.keys, prefix)
+        end = start
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        keys = self.keys[start:end] + [prefix[:i] for i in range(1, len(prefix)) if prefix[:i] in self.groups]
+        return sorted(name for key in keys for name in self.groups[key] if name.startswith(prefix))
+
+    def group(self, scan_ids):
+        return {scan_id: self.startswith(scan_id) for scan_id in scan_ids}
+
+
+def get_scan_index(root, manifest_dir=None):
+    key = (os.path.abspath(root), manifest_dir)
+    if key not in _SCAN_INDEX:
+        _SCAN_INDEX[key] = ScanDirectoryIndex(root, manifest_dir)
+    return _SCAN_INDEX[key]
+
@@ -0,0 +1,140 @@
+import os
+import json
+import struct
+import argparse
+from uuid import uuid4
+
+import numpy as np
+
+'''
+Packed scan store, one file per scan instead of one file per array per sub frame
+HM3D scans also carry their meta json (per sub frame invalid point ratio) as a uint8 array
+layout: [array 0][array 1]...[json index][8 byte index offset][8 byte magic]
+index: {name: {'dtype': str, 'shape': list, 'offset': int}}, arrays are 64 byte aligned
+'''
+PACK_MAGIC = b'SCANPACK'
+PACK_ALIGN = 64
+PACK_SUFFIX = '.pack'
+
+# raw embodied scan layout, kind -> (dtype, per point columns)
+EMBODIED_SCAN_KINDS = {
+    'points': (np.float32, 6),
+    'instance_mask': (np.int64, None),
+    'super_points': (np.int64, None),
+}
+
+
+def write_pack(path, arrays):
+    # ranks and workers may write the same pack at once, each writes its own tmp file and the last replace wins
+    index = {}
+    tmp_path = f'{path}.{os.getpid()}.{uuid4().hex}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                f.write(b'\0' * (-f.tell() % PACK_ALIGN))
+                index[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': f.tell()}
+                f.write(array.tobytes())
+            index_offset = f.tell()
+            f.write(json.dumps(index).encode('utf-8'))
+            f.write(struct.pack('<Q', index_offset))
+            f.write(PACK_MAGIC)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class PackedScan:
+    ''' Read only access to a packed scan
+    mmap: arrays are zero-copy views of one np.memmap, which holds a file descriptor while any view is alive
+    otherwise get reads a private copy through a file that stays open until close(), use this for per scan files
+    '''
+    def __init__(self, path, mmap=False):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r') if mmap else None
+        self.file = None
+        with open(path, 'rb') as f:
+            f.seek(-16, os.SEEK_END)
+            index_offset, magic = struct.unpack('<Q', f.read(8))[0], f.read(8)
+            assert magic == PACK_MAGIC, f'{path} is not a packed scan'
+            f.seek(index_offset)
+            self.index = json.loads(f.read()[:-16].decode('utf-8'))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def keys(self):
+        return self.index.keys()
+
+    def get(self, name):
+        info = self.index[name]
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape']))
+        start = info['offset']
+        if self.buffer is None:
+            if self.file is None:
+                self.file = open(self.path, 'rb')
+            self.file.seek(start)
+            return np.fromfile(self.file, dtype=dtype, count=count).reshape(info['shape'])
+        return self.buffer[start:start + count * dtype.itemsize].view(dtype).reshape(info['shape'])
+
+    def close(self):
+        # memmap views handed out keep their mapping alive until they are released
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.buffer = None
+
+
+def packed_scan_path(packed_dir, dataset_name, scan_id):
+    return os.path.join(packed_dir, dataset_name, scan_id + PACK_SUFFIX)
+
+
+def pack_embodied_scan(embodied_base_dir, dataset_name, scan_id, packed_dir):
+    # arrays are stored raw, preprocessing stays in the dataset
+    base = os.path.join(embodied_base_dir, dataset_name)
+    arrays = {}
+    for sub_frame in sorted(os.listdir(os.path.join(base, 'points', scan_id))):
+        for kind, (dtype, columns) in EMBODIED_SCAN_KINDS.items():
+            array = np.fromfile(os.path.join(base, kind, scan_id, sub_frame), dtype=dtype)
+            arrays[f'{kind}/{sub_frame}'] = array.reshape(-1, columns) if columns else array
+        sub_frame_id = sub_frame.split('.')[0]
+        img_feat_path = os.path.join(base, 'img_feat', scan_id, f'{sub_frame_id}.npy')
+        if os.path.exists(img_feat_path):
+            arrays[f'img_feat/{sub_frame_id}.npy'] = np.load(img_feat_path)
+    meta_path = os.path.join(base, 'meta', f'{scan_id}.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            arrays[f'meta/{scan_id}.json'] = np.frombuffer(f.read(), dtype=np.uint8)
+    for kind in ['points_global', 'instance_mask_global']:
+        global_path = os.path.join(base, kind, f'{scan_id}.bin')
+        if os.path.exists(global_path):
+            dtype, columns = EMBODIED_SCAN_KINDS[kind.replace('_global', '')]
+            array = np.fromfile(global_path, dtype=dtype)
+            arrays[f'{kind}/{scan_id}.bin'] = array.reshape(-1, columns) if columns else array
+    out_path = packed_scan_path(packed_dir, dataset_name, scan_id)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    write_pack(out_path, arrays)
+    return out_path
+
+
+def open_fd_count():
+    return len(os.listdir('/proc/self/fd'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack embodied scans into one file per scan')
+    parser.add_argument('--embodied_base', required=True)
+    parser.add_argument('--dataset', default='ScanNet', choices=['ScanNet', 'HM3D'])
+    parser.add_argument('--out_dir', required=True)
+    args = parser.parse_args()
+    scan_ids = sorted(os.listdir(os.path.join(args.embodied_base, args.dataset, 'points')))
+    for scan_id in scan_ids:
+        pack_embodied_scan(args.embodied_base, args.dataset, scan_id, args.out_dir)
@@ -0,0 +1,116 @@
+import os
+import atexit
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+ARENA_ALIGN = 64
+
+
+def _open_segment(name):
+    # every process maps a segment once, all arrays of the arena are views of that mapping
+    if name not in SharedNDArray._segments:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python < 3.13, attaching registers the segment and the tracker would unlink it when a worker exits
+            shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        SharedNDArray._segments[name] = shm
+    return SharedNDArray._segments[name]
+
+
+def _attach_shared_array(name, offset, shape, dtype):
+    return SharedNDArray.attach(_open_segment(name), offset, shape, dtype)
+
+
+class SharedNDArray(np.ndarray):
+    ''' ndarray in a POSIX shared memory arena, pickles to a (name, offset, shape, dtype) handle instead of its data
+    one arena holds many arrays so that a process keeps one descriptor and one mapping per arena, not per array
+    views and copies behave like plain arrays when pickled
+    '''
+    _segments = {} # name -> SharedMemory, kept alive in this process
+    _created = set()
+    _creator_pid = None
+
+    @classmethod
+    def create_arena(cls, nbytes):
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        if cls._creator_pid is None:
+            cls._creator_pid = os.getpid()
+            atexit.register(cls.unlink_all)
+        cls._created.add(shm.name)
+        cls._segments[shm.name] = shm
+        return shm
+
+    @classmethod
+    def attach(cls, shm, offset, shape, dtype):
+        out = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).view(cls)
+        out._shm_name = shm.name
+        out._shm_offset = offset
+        return out
+
+    @classmethod
+    def unlink_all(cls):
+        if os.getpid() != cls._creator_pid:
+            return
+        for name in list(cls._created):
+            cls._segments.pop(name).unlink()
+        cls._created.clear()
+
+    def __array_finalize__(self, obj):
+        self._shm_name = None
+        self._shm_offset = 0
+
+    def __reduce__(self):
+        if self._shm_name is None:
+            return np.asarray(self).__reduce__()
+        return (_attach_shared_array, (self._shm_name, self._shm_offset, self.shape, self.dtype.str))
+
+
+def _collect_arrays(obj, slots):
+    # (container, key) of every numpy array to share in nested dicts and lists
+    items = obj.items() if isinstance(obj, dict) else enumerate(obj) if isinstance(obj, list) else []
+    for k, v in items:
+        if isinstance(v, np.ndarray):
+            if not isinstance(v, SharedNDArray) and not v.dtype.hasobject and v.size > 0:
+                slots.append((obj, k))
+        else:
+            _collect_arrays(v, slots)
+
+
+def share_arrays(obj):
+    # move numpy arrays of nested scan data into one shared memory arena, in place for dicts and lists
+    slots = []
+    _collect_arrays(obj, slots)
+    # arrays referenced from several places are stored once, originals are kept alive so that ids stay unique
+    originals = [container[k] for container, k in slots]
+    offsets = {}
+    nbytes = 0
+    for array in originals:
+        if id(array) not in offsets:
+            nbytes += -nbytes % ARENA_ALIGN
+            offsets[id(array)] = nbytes
+            nbytes += array.nbytes
+    if not offsets:
+        return obj
+    shm = SharedNDArray.create_arena(nbytes)
+    shared = {}
+    for (container, k), array in zip(slots, originals):
+        if id(array) not in shared:
+            shared[id(array)] = SharedNDArray.attach(shm, offsets[id(array)], array.shape, array.dtype)
+            shared[id(array)][...] = array
+        container[k] = shared[id(array)]
+    return obj
+
+
+def process_memory():
+    # private and shared resident memory of this process in bytes
+    memory = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            key = line.split(':')[0]
+            if key in ['VmRSS', 'RssAnon', 'RssShmem']:
+                memory[key] = int(line.split()[1]) * 1024
+    return memory
+
@@ -1,8 +1,7 @@
 import numpy as np
-from collections import Sequence
+from collections.abc import Sequence
 import torch
 # from torch_geometric.nn import voxel_grid
-from MinkowskiEngine.utils import sparse_quantize
 
 
 # def grid_sample(pos, batch_index, size, start=None, return_p2v=True):
@@ -143,26 +142,82 @@ def voxelize_and_inverse(coord, hash_type="fnv", mode=0):
     return uniq_idx, inv_idx
 
 
-from MinkowskiEngine.utils import sparse_quantize
+def ravel_hash_torch(coords):
+    """
+    Ravel int coordinates (N, D) into int64 keys after subtracting the min coordinates.
+    """
+    assert coords.ndim == 2
+    coords = coords - coords.min(0)[0]
+    dims = coords.max(0)[0] + 1
+    assert float(torch.prod(dims.double())) < 2 ** 62, "coordinate range too large for int64 keys"
+    keys = coords[:, 0].clone()
+    for j in range(1, coords.shape[1]):
+        keys = keys * dims[j] + coords[:, j]
+    return keys
+
+
+def quantize(coordinates, voxel_size=None):
+    """
+    Floor coordinates to int64 voxel coordinates, numpy or torch.
+    """
+    is_numpy = isinstance(coordinates, np.ndarray)
+    coordinates = torch.from_numpy(coordinates) if is_numpy else coordinates
+    if voxel_size is not None:
+        coordinates = coordinates / voxel_size
+    discrete_coordinates = torch.floor(coordinates).long()
+    return discrete_coordinates.numpy() if is_numpy else discrete_coordinates
+
+
+def sparse_quantize(coordinates, features=None, voxel_size=None, return_index=False, return_inverse=False,
+                    random_select=False, average_features=False):
+    """
+    Torch/numpy replacement of MinkowskiEngine.utils.sparse_quantize on the data path.
+    coordinates: (N, D) float or int, floored (after dividing by voxel_size if given)
+    returns (unique_coords[, unique_features][, unique_map][, inverse_map]) like sparse_quantize,
+    unique_coords[inverse_map] == floor(coordinates), numpy in numpy out, torch in torch out.
+    voxels are sorted by key and represented by their first point, or a random point with random_select.
+    features of a voxel are the representative's features, or the voxel mean with average_features.
+    """
+    is_numpy = isinstance(coordinates, np.ndarray)
+    coordinates = torch.from_numpy(coordinates) if is_numpy else coordinates
+    if features is not None and isinstance(features, np.ndarray):
+        features = torch.from_numpy(features)
+    discrete_coordinates = quantize(coordinates, voxel_size)
+    if len(discrete_coordinates) == 0:
+        unique_map = inverse_map = torch.zeros(0, dtype=torch.long)
+        counts = torch.zeros(0, dtype=torch.long)
+    else:
+        keys = ravel_hash_torch(discrete_coordinates)
+        _, inverse_map, counts = torch.unique(keys, sorted=True, return_inverse=True, return_counts=True)
+        # points grouped by voxel, stable so that the first point of a voxel comes first
+        order = torch.argsort(inverse_map, stable=True)
+        starts = torch.cumsum(counts, 0) - counts
+        if random_select:
+            starts = starts + (torch.rand(len(counts)) * counts).long()
+        unique_map = order[starts]
+    return_args = [discrete_coordinates[unique_map]]
+    if features is not None:
+        if average_features:
+            unique_features = torch.zeros((len(counts),) + features.shape[1:], dtype=torch.float64)
+            unique_features.index_add_(0, inverse_map, features.double())
+            unique_features = (unique_features / counts.view((-1,) + (1,) * (features.dim() - 1))).to(features.dtype if features.is_floating_point() else torch.float32)
+        else:
+            unique_features = features[unique_map]
+        return_args.append(unique_features)
+    if return_index:
+        return_args.append(unique_map)
+    if return_inverse:
+        return_args.append(inverse_map)
+    if is_numpy:
+        return_args = [x.numpy() for x in return_args]
+    return return_args[0] if len(return_args) == 1 else tuple(return_args)
 
 
 def voxel_rand(coord):
-    int_coord = np.floor(coord)
-    _, _, key = sparse_quantize(int_coord, return_index=True, return_inverse=True)
-    idx_sort = np.argsort(key)
-    key_sort = key[idx_sort]
-    _, count = np.unique(key_sort, return_counts=True)
-    idx_select = (
-        np.cumsum(np.insert(count, 0, 0)[0:-1])
-        + np.random.randint(0, count.max(), count.size) % count
-    )
-    idx_unique = idx_sort[idx_select]
+    _, idx_unique = sparse_quantize(coord, return_index=True, random_select=True)
     return idx_unique
 
 
 def voxel_rand_inverse(coord):
-    int_coord = np.floor(coord)
-    _, unique_map, inverse_map = sparse_quantize(
-        int_coord, return_index=True, return_inverse=True
-    )
-    return unique_map, inverse_map
\ No newline at end of file
+    _, unique_map, inverse_map = sparse_quantize(coord, return_index=True, return_inverse=True)
+    return unique_map, inverse_map
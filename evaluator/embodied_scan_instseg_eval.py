@@ -2,6 +2,7 @@ import gc
 import math
 import json
 import os
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
@@ -11,7 +12,7 @@ from torch_scatter import scatter_mean
 from torch.nn.functional import softmax
 from sklearn.cluster import DBSCAN
 
-from common.embodied_utils.instseg_utils import eval_instseg_flexible
+from common.embodied_utils.instseg_utils import eval_instseg_flexible, eval_instseg_reduced, InstSegAPAccumulator
 from data.data_utils import LabelConverter, pad_sequence
 from evaluator.build import EVALUATOR_REGISTRY, BaseEvaluator
 from common.metric_utils import IoU, ConfusionMatrix
@@ -69,8 +70,81 @@ class EmbodiedScanInstSegEvalEmpty(BaseEvaluator):
         torch.cuda.empty_cache()
         return True, {"target_metric": 0}
 
+class ScanStreamMixin:
+    ''' Routes the frames of a batch to their scans for the merging evaluators
+    without cfg.dataloader.scan_stream_eval frames come one per batch in scan order and a scan is flushed when the next
+    one starts, with it (data/batch_sampler.py ScanStreamBatchSampler) a batch holds frames of different scans, every
+    scan keeps its own state (new_scan_state, the representation manager by default) and is flushed after its last frame
+    '''
+
+    def init_scan_stream(self, cfg):
+        self.scan_stream = cfg.dataloader.get('scan_stream_eval', False)
+        self.scan_states = {}
+        self.finished_scans = set()
+
+    def new_scan_state(self):
+        return {'representation_manger': self.representation_manger.__class__()}
+
+    def same_scan_frame(self, data_dict, bid):
+        # called before merging a frame of the scan that is already being merged
+        pass
+
+    def switch_scan(self, scan_id):
+        if scan_id not in self.scan_states:
+            self.scan_states[scan_id] = self.new_scan_state()
+        for key, value in self.scan_states[scan_id].items():
+            setattr(self, key, value)
+        self.cur_scan_id = scan_id
+
+    def stream_batch(self, data_dict):
+        # merges every frame of the batch and returns the number of frames merged, repeated frames are not counted
+        return sum(self.stream_frame(data_dict, bid) for bid in range(len(data_dict['scan_id'])))
+
+    def stream_frame(self, data_dict, bid):
+        scan_id = data_dict['scan_id'][bid]
+        if not self.scan_stream:
+            # check whether dump data from representation manager to preds
+            if self.cur_scan_id is None:
+                self.cur_scan_id = scan_id
+            elif self.cur_scan_id != scan_id:
+                self.flush_representation_manager()
+                self.cur_scan_id = scan_id
+            else:
+                self.same_scan_frame(data_dict, bid)
+            self.merge_frame(data_dict, bid)
+            return True
+        assert 'last_frame' in data_dict, 'scan_stream_eval needs frames with last_frame (EmbodiedScanInstseg datasets)'
+        if scan_id in self.finished_scans:
+            # repeated frame that evens out the steps of the ranks
+            return False
+        started = scan_id in self.scan_states
+        self.switch_scan(scan_id)
+        if started:
+            self.same_scan_frame(data_dict, bid)
+        self.merge_frame(data_dict, bid)
+        if data_dict['last_frame'][bid]:
+            self.flush_representation_manager()
+            del self.scan_states[scan_id]
+            self.finished_scans.add(scan_id)
+        return True
+
+    def flush_scans(self):
+        if not self.scan_stream:
+            self.flush_representation_manager()
+            return
+        for scan_id in list(self.scan_states.keys()):
+            self.switch_scan(scan_id)
+            self.flush_representation_manager()
+            del self.scan_states[scan_id]
+
+    def reset_scans(self):
+        self.scan_states = {}
+        self.finished_scans = set()
+        if self.scan_stream:
+            self.cur_scan_id = None
+
 @EVALUATOR_REGISTRY.register()
-class EmbodiedScanInstSegEvalGTMerge(BaseEvaluator):
+class EmbodiedScanInstSegEvalGTMerge(ScanStreamMixin, BaseEvaluator):
     def __init__(self, cfg, accelerator, **kwargs):
         # config
         self.config = cfg
@@ -87,6 +161,7 @@ class EmbodiedScanInstSegEvalGTMerge(BaseEvaluator):
         # representation manager
         self.representation_manger = RepresentationManagerGT()
         self.cur_scan_id = None
+        self.init_scan_stream(cfg)
         # record
         self.preds = defaultdict(dict)
         # misc
@@ -106,14 +181,12 @@ class EmbodiedScanInstSegEvalGTMerge(BaseEvaluator):
         
     def update(self, data_dict):
         metrics = self.batch_metrics(data_dict)
-        # check whether dump data from representation manager to preds
-        scan_id = data_dict['scan_id'][0]
-        sub_frame_id = data_dict['sub_frame_id'][0]
-        if self.cur_scan_id is None:
-            self.cur_scan_id = scan_id
-        elif self.cur_scan_id != scan_id:
-            self.flush_representation_manager()
-            self.cur_scan_id = scan_id
+        # route every frame of the batch to its scan, see ScanStreamMixin, only frames merged for the first time count
+        metrics["total_count"] = self.stream_batch(data_dict)
+        # update representation
+        self.total_count += metrics["total_count"]
+
+    def merge_frame(self, data_dict, bid):
         # merge
         pred_masks = data_dict['predictions_mask'][-1]
         pred_logits = data_dict['predictions_class'][-1]
@@ -128,65 +201,60 @@ class EmbodiedScanInstSegEvalGTMerge(BaseEvaluator):
         raw_coordinates = data_dict['raw_coordinates']
         pred_indices = data_dict['indices']
         instance_ids_ori = data_dict['instance_ids_ori']
-        assert len(pred_masks) == 1
-        for bid in range(len(pred_masks)):
-            # get all stuff
-            masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
-            logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
-            for cls in self.filter_out_classes:
-                logits[:, cls] = -float('inf')
-            boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
-            scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
-            embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
-            feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
-            indices = pred_indices[bid]
-            indices[0] = indices[0].detach().cpu()
-            indices[1] = indices[1].detach().cpu()
-            ids = instance_ids_ori[bid].detach().cpu()
-            # filter out classes
-            masks = masks[:, indices[0]]
-            logits = logits[indices[0]]
-            boxes = boxes[indices[0]]
-            scores = scores[indices[0]]
-            embeds = embeds[indices[0]]
-            feats = feats[indices[0]]
-            ids = ids[indices[1]]
-            if masks.shape[1] == 0:
-                continue
-            # get mask scores heatmap
-            mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
-            # convert mask to full res
-            masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
-            masks = masks.numpy()
-            classes = classes.numpy()
-            boxes = boxes.numpy()
-            mask_scores = mask_scores.numpy()
-            scores = scores.numpy()
-            feats = feats.numpy()
-            embeds = embeds.numpy()
-            ids = ids.numpy()
-            # merge
-            predict_dict_list = [
-            {
-                'point_cloud': raw_coordinates[bid],
-                'pred_masks': masks,
-                'pred_classes': classes,
-                'pred_scores': scores,
-                'pred_mask_scores': mask_scores,
-                'pred_boxes': boxes,
-                'pred_feats': feats,
-                'open_vocab_feats': embeds,
-                'pred_ids': ids,
-            }]
-            self.representation_manger.merge(predict_dict_list)
-            
-        # update representation
-        self.total_count += metrics["total_count"]
+        # get all stuff
+        masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
+        logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
+        for cls in self.filter_out_classes:
+            logits[:, cls] = -float('inf')
+        boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
+        scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
+        embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
+        feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
+        indices = pred_indices[bid]
+        indices[0] = indices[0].detach().cpu()
+        indices[1] = indices[1].detach().cpu()
+        ids = instance_ids_ori[bid].detach().cpu()
+        # filter out classes
+        masks = masks[:, indices[0]]
+        logits = logits[indices[0]]
+        boxes = boxes[indices[0]]
+        scores = scores[indices[0]]
+        embeds = embeds[indices[0]]
+        feats = feats[indices[0]]
+        ids = ids[indices[1]]
+        if masks.shape[1] == 0:
+            return
+        # get mask scores heatmap
+        mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
+        # convert mask to full res
+        masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
+        masks = masks.numpy()
+        classes = classes.numpy()
+        boxes = boxes.numpy()
+        mask_scores = mask_scores.numpy()
+        scores = scores.numpy()
+        feats = feats.numpy()
+        embeds = embeds.numpy()
+        ids = ids.numpy()
+        # merge
+        predict_dict_list = [
+        {
+            'point_cloud': raw_coordinates[bid],
+            'pred_masks': masks,
+            'pred_classes': classes,
+            'pred_scores': scores,
+            'pred_mask_scores': mask_scores,
+            'pred_boxes': boxes,
+            'pred_feats': feats,
+            'open_vocab_feats': embeds,
+            'pred_ids': ids,
+        }]
+        self.representation_manger.merge(predict_dict_list)
 
     def batch_metrics(self, data_dict):
         metrics = {}
         metrics["total_count"] = len(data_dict['predictions_class'][0])
-        assert metrics["total_count"] == 1
+        assert metrics["total_count"] == 1 or self.scan_stream
         return metrics
 
     def reset(self):
@@ -195,9 +263,10 @@ class EmbodiedScanInstSegEvalGTMerge(BaseEvaluator):
         self.total_count = 0
         self.preds = defaultdict(dict)
         self.representation_manger.reset()
+        self.reset_scans()
 
     def record(self):        
-        self.flush_representation_manager()
+        self.flush_scans()
         # gather for metrics
         data = {'preds': list(self.preds.items())}
         data = gather_dict(self.accelerator, data)
@@ -223,7 +292,7 @@ class EmbodiedScanInstSegEvalGTMerge(BaseEvaluator):
 
 
 @EVALUATOR_REGISTRY.register()
-class EmbodiedScanInstSegEvalBoxMerge(BaseEvaluator):
+class EmbodiedScanInstSegEvalBoxMerge(ScanStreamMixin, BaseEvaluator):
     def __init__(self, cfg, accelerator, **kwargs):
         # config
         self.config = cfg
@@ -240,6 +309,14 @@ class EmbodiedScanInstSegEvalBoxMerge(BaseEvaluator):
         # representation manager
         self.representation_manger = RepresentationManager()
         self.cur_scan_id = None
+        self.init_scan_stream(cfg)
+        # every rank evaluates its own scans and only AP statistics are gathered, scans must not span ranks
+        self.reduce_scan_stats = cfg.eval.get('reduce_scan_stats', False)
+        assert not self.reduce_scan_stats or self.scan_stream or accelerator.num_processes == 1, 'reduce_scan_stats needs scan_stream_eval'
+        # AP statistics are accumulated as scans are flushed, only one scan's masks are held at a time
+        self.stream_ap = cfg.eval.get('stream_ap', False)
+        assert not self.stream_ap or self.scan_stream or accelerator.num_processes == 1, 'stream_ap needs scan_stream_eval'
+        self.ap_accumulator = InstSegAPAccumulator(['object'])
         # record
         self.preds = defaultdict(dict)
         # misc
@@ -278,19 +355,20 @@ class EmbodiedScanInstSegEvalBoxMerge(BaseEvaluator):
             pred_masks = pred_masks.T.numpy()            
         # fill preds
         self.preds[scan_id] = {'pred_scores': pred_scores, 'pred_masks': pred_masks, 'pred_classes': pred_classes}        
+        if self.stream_ap:
+            # reduce the scan to its AP statistics and drop its masks
+            self.ap_accumulator.add(*prepare_scan_pred(scan_id, self.preds.pop(scan_id), self.config, self.dataset_name, open_vocab=False))
         # reset
         self.representation_manger.reset()
         
     def update(self, data_dict):
         metrics = self.batch_metrics(data_dict)
-        # check whether dump data from representation manager to preds
-        scan_id = data_dict['scan_id'][0]
-        sub_frame_id = data_dict['sub_frame_id'][0]
-        if self.cur_scan_id is None:
-            self.cur_scan_id = scan_id
-        elif self.cur_scan_id != scan_id:
-            self.flush_representation_manager()
-            self.cur_scan_id = scan_id
+        # route every frame of the batch to its scan, see ScanStreamMixin, only frames merged for the first time count
+        metrics["total_count"] = self.stream_batch(data_dict)
+        # update representation
+        self.total_count += metrics["total_count"]
+
+    def merge_frame(self, data_dict, bid):
         # merge
         pred_masks = data_dict['predictions_mask'][-1]
         pred_logits = data_dict['predictions_class'][-1]
@@ -303,60 +381,55 @@ class EmbodiedScanInstSegEvalBoxMerge(BaseEvaluator):
         voxel2segment = data_dict['voxel2segment']
         segment_to_full_maps = data_dict['segment_to_full_maps']
         raw_coordinates = data_dict['raw_coordinates']
-        assert len(pred_masks) == 1
-        for bid in range(len(pred_masks)):
-            # get all stuff
-            masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
-            logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
-            boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
-            scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
-            embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
-            feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
-            # filter out classes
-            valid_query_mask = ~torch.isin(torch.argmax(logits, dim=-1), torch.tensor(self.filter_out_classes))
-            # filter out classes
-            masks = masks[:, valid_query_mask]
-            logits = logits[valid_query_mask]
-            boxes = boxes[valid_query_mask]
-            scores = scores[valid_query_mask]
-            embeds = embeds[valid_query_mask]
-            feats = feats[valid_query_mask]
-            if masks.shape[1] == 0:
-                continue
-            # remove 200 classes
-            logits = logits[:, :200]
-            # get mask scores heatmap
-            mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
-            # convert mask to full res
-            masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
-            masks = masks.numpy()
-            classes = classes.numpy()
-            boxes = boxes.numpy()
-            mask_scores = mask_scores.numpy()
-            scores = scores.numpy()
-            feats = feats.numpy()
-            embeds = embeds.numpy()
-            # merge
-            predict_dict_list = [
-            {
-                'point_cloud': raw_coordinates[bid],
-                'pred_masks': masks,
-                'pred_classes': classes,
-                'pred_scores': scores,
-                'pred_mask_scores': mask_scores,
-                'pred_boxes': boxes,
-                'pred_feats': feats,
-                'open_vocab_feats': embeds,
-            }]
-            self.representation_manger.merge(predict_dict_list)
-            
-        # update representation
-        self.total_count += metrics["total_count"]
+        # get all stuff
+        masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
+        logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
+        boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
+        scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
+        embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
+        feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
+        # filter out classes
+        valid_query_mask = ~torch.isin(torch.argmax(logits, dim=-1), torch.tensor(self.filter_out_classes))
+        # filter out classes
+        masks = masks[:, valid_query_mask]
+        logits = logits[valid_query_mask]
+        boxes = boxes[valid_query_mask]
+        scores = scores[valid_query_mask]
+        embeds = embeds[valid_query_mask]
+        feats = feats[valid_query_mask]
+        if masks.shape[1] == 0:
+            return
+        # remove 200 classes
+        logits = logits[:, :200]
+        # get mask scores heatmap
+        mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
+        # convert mask to full res
+        masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
+        masks = masks.numpy()
+        classes = classes.numpy()
+        boxes = boxes.numpy()
+        mask_scores = mask_scores.numpy()
+        scores = scores.numpy()
+        feats = feats.numpy()
+        embeds = embeds.numpy()
+        # merge
+        predict_dict_list = [
+        {
+            'point_cloud': raw_coordinates[bid],
+            'pred_masks': masks,
+            'pred_classes': classes,
+            'pred_scores': scores,
+            'pred_mask_scores': mask_scores,
+            'pred_boxes': boxes,
+            'pred_feats': feats,
+            'open_vocab_feats': embeds,
+        }]
+        self.representation_manger.merge(predict_dict_list)
 
     def batch_metrics(self, data_dict):
         metrics = {}
         metrics["total_count"] = len(data_dict['predictions_class'][0])
-        assert metrics["total_count"] == 1
+        assert metrics["total_count"] == 1 or self.scan_stream
         return metrics
 
     def reset(self):
@@ -365,18 +438,25 @@ class EmbodiedScanInstSegEvalBoxMerge(BaseEvaluator):
         self.total_count = 0
         self.preds = defaultdict(dict)
         self.representation_manger.reset()
+        self.reset_scans()
+        self.ap_accumulator.reset()
 
     def record(self):        
-        self.flush_representation_manager()
-        # gather for metrics
-        data = {'preds': list(self.preds.items())}
-        data = gather_dict(self.accelerator, data)
-        self.preds = dict(data['preds'])
+        self.flush_scans()
+        if not self.reduce_scan_stats and not self.stream_ap:
+            # gather for metrics
+            data = {'preds': list(self.preds.items())}
+            data = gather_dict(self.accelerator, data)
+            self.preds = dict(data['preds'])
         # judge result
-        if self.dataset_name == 'HM3D':
-            eval_results = eval_mask_hm3d(self.preds, self.config)
+        if self.stream_ap:
+            # statistics of every rank's own scans are gathered
+            eval_results = self.ap_accumulator.compute(reduce=True)
+            print(eval_results)
+        elif self.dataset_name == 'HM3D':
+            eval_results = eval_mask_hm3d(self.preds, self.config, reduce_stats=self.reduce_scan_stats)
         elif self.dataset_name == 'ScanNet':
-            eval_results = eval_mask_scannet(self.preds, self.config)
+            eval_results = eval_mask_scannet(self.preds, self.config, reduce_stats=self.reduce_scan_stats)
         else:
             raise NotImplementedError
         if eval_results[self.target_metric] > self.best_result:
@@ -392,7 +472,7 @@ class EmbodiedScanInstSegEvalBoxMerge(BaseEvaluator):
         return is_best, eval_results
 
 @EVALUATOR_REGISTRY.register()
-class EmbodiedScanInstSegEvalBoxMergeOpenVocab(BaseEvaluator):
+class EmbodiedScanInstSegEvalBoxMergeOpenVocab(ScanStreamMixin, BaseEvaluator):
     def __init__(self, cfg, accelerator, **kwargs):
         # config
         self.config = cfg
@@ -409,6 +489,14 @@ class EmbodiedScanInstSegEvalBoxMergeOpenVocab(BaseEvaluator):
         # representation manager
         self.representation_manger = RepresentationManager()
         self.cur_scan_id = None
+        self.init_scan_stream(cfg)
+        # every rank evaluates its own scans and only AP statistics are gathered, scans must not span ranks
+        self.reduce_scan_stats = cfg.eval.get('reduce_scan_stats', False)
+        assert not self.reduce_scan_stats or self.scan_stream or accelerator.num_processes == 1, 'reduce_scan_stats needs scan_stream_eval'
+        # AP statistics are accumulated as scans are flushed, only one scan's masks are held at a time
+        self.stream_ap = cfg.eval.get('stream_ap', False)
+        assert not self.stream_ap or self.scan_stream or accelerator.num_processes == 1, 'stream_ap needs scan_stream_eval'
+        self.ap_accumulator = InstSegAPAccumulator(CLASS_LABELS_200)
         # record
         self.preds = defaultdict(dict)
         # misc
@@ -448,19 +536,20 @@ class EmbodiedScanInstSegEvalBoxMergeOpenVocab(BaseEvaluator):
             pred_masks = pred_masks.T.numpy()            
         # fill preds
         self.preds[scan_id] = {'pred_scores': pred_scores, 'pred_masks': pred_masks, 'pred_openvocab': pred_openvocab}        
+        if self.stream_ap:
+            # reduce the scan to its AP statistics and drop its masks
+            self.ap_accumulator.add(*prepare_scan_pred(scan_id, self.preds.pop(scan_id), self.config, self.dataset_name, open_vocab=True))
         # reset
         self.representation_manger.reset()
         
     def update(self, data_dict):
         metrics = self.batch_metrics(data_dict)
-        # check whether dump data from representation manager to preds
-        scan_id = data_dict['scan_id'][0]
-        sub_frame_id = data_dict['sub_frame_id'][0]
-        if self.cur_scan_id is None:
-            self.cur_scan_id = scan_id
-        elif self.cur_scan_id != scan_id:
-            self.flush_representation_manager()
-            self.cur_scan_id = scan_id
+        # route every frame of the batch to its scan, see ScanStreamMixin, only frames merged for the first time count
+        metrics["total_count"] = self.stream_batch(data_dict)
+        # update representation
+        self.total_count += metrics["total_count"]
+
+    def merge_frame(self, data_dict, bid):
         # merge
         pred_masks = data_dict['predictions_mask'][-1]
         pred_logits = data_dict['predictions_class'][-1]
@@ -473,60 +562,55 @@ class EmbodiedScanInstSegEvalBoxMergeOpenVocab(BaseEvaluator):
         voxel2segment = data_dict['voxel2segment']
         segment_to_full_maps = data_dict['segment_to_full_maps']
         raw_coordinates = data_dict['raw_coordinates']
-        assert len(pred_masks) == 1
-        for bid in range(len(pred_masks)):
-            # get all stuff
-            masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
-            logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
-            boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
-            scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
-            embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
-            feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
-            # filter out classes
-            valid_query_mask = ~torch.isin(torch.argmax(logits, dim=-1), torch.tensor(self.filter_out_classes))
-            # filter out classes
-            masks = masks[:, valid_query_mask]
-            logits = logits[valid_query_mask]
-            boxes = boxes[valid_query_mask]
-            scores = scores[valid_query_mask]
-            embeds = embeds[valid_query_mask]
-            feats = feats[valid_query_mask]
-            if masks.shape[1] == 0:
-                continue
-            # remove 200 classes
-            logits = logits[:, :200]
-            # get mask scores heatmap
-            mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
-            # convert mask to full res
-            masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
-            masks = masks.numpy()
-            classes = classes.numpy()
-            boxes = boxes.numpy()
-            mask_scores = mask_scores.numpy()
-            scores = scores.numpy()
-            feats = feats.numpy()
-            embeds = embeds.numpy()
-            # merge
-            predict_dict_list = [
-            {
-                'point_cloud': raw_coordinates[bid],
-                'pred_masks': masks,
-                'pred_classes': classes,
-                'pred_scores': scores,
-                'pred_mask_scores': mask_scores,
-                'pred_boxes': boxes,
-                'pred_feats': feats,
-                'open_vocab_feats': embeds,
-            }]
-            self.representation_manger.merge(predict_dict_list)
-            
-        # update representation
-        self.total_count += metrics["total_count"]
+        # get all stuff
+        masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
+        logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
+        boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
+        scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
+        embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
+        feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
+        # filter out classes
+        valid_query_mask = ~torch.isin(torch.argmax(logits, dim=-1), torch.tensor(self.filter_out_classes))
+        # filter out classes
+        masks = masks[:, valid_query_mask]
+        logits = logits[valid_query_mask]
+        boxes = boxes[valid_query_mask]
+        scores = scores[valid_query_mask]
+        embeds = embeds[valid_query_mask]
+        feats = feats[valid_query_mask]
+        if masks.shape[1] == 0:
+            return
+        # remove 200 classes
+        logits = logits[:, :200]
+        # get mask scores heatmap
+        mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
+        # convert mask to full res
+        masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
+        masks = masks.numpy()
+        classes = classes.numpy()
+        boxes = boxes.numpy()
+        mask_scores = mask_scores.numpy()
+        scores = scores.numpy()
+        feats = feats.numpy()
+        embeds = embeds.numpy()
+        # merge
+        predict_dict_list = [
+        {
+            'point_cloud': raw_coordinates[bid],
+            'pred_masks': masks,
+            'pred_classes': classes,
+            'pred_scores': scores,
+            'pred_mask_scores': mask_scores,
+            'pred_boxes': boxes,
+            'pred_feats': feats,
+            'open_vocab_feats': embeds,
+        }]
+        self.representation_manger.merge(predict_dict_list)
 
     def batch_metrics(self, data_dict):
         metrics = {}
         metrics["total_count"] = len(data_dict['predictions_class'][0])
-        assert metrics["total_count"] == 1
+        assert metrics["total_count"] == 1 or self.scan_stream
         return metrics
 
     def reset(self):
@@ -535,18 +619,25 @@ class EmbodiedScanInstSegEvalBoxMergeOpenVocab(BaseEvaluator):
         self.total_count = 0
         self.preds = defaultdict(dict)
         self.representation_manger.reset()
+        self.reset_scans()
+        self.ap_accumulator.reset()
 
     def record(self):        
-        self.flush_representation_manager()
-        # gather for metrics
-        data = {'preds': list(self.preds.items())}
-        data = gather_dict(self.accelerator, data)
-        self.preds = dict(data['preds'])
+        self.flush_scans()
+        if not self.reduce_scan_stats and not self.stream_ap:
+            # gather for metrics
+            data = {'preds': list(self.preds.items())}
+            data = gather_dict(self.accelerator, data)
+            self.preds = dict(data['preds'])
         # judge result
-        if self.dataset_name == 'HM3D':
-            eval_results = eval_mask_open_vocab_hm3d(self.preds, self.config)
+        if self.stream_ap:
+            # statistics of every rank's own scans are gathered
+            eval_results = self.ap_accumulator.compute(reduce=True)
+            print(eval_results)
+        elif self.dataset_name == 'HM3D':
+            eval_results = eval_mask_open_vocab_hm3d(self.preds, self.config, reduce_stats=self.reduce_scan_stats)
         elif self.dataset_name == 'ScanNet':
-            eval_results = eval_mask_open_vocab_scannet(self.preds, self.config)
+            eval_results = eval_mask_open_vocab_scannet(self.preds, self.config, reduce_stats=self.reduce_scan_stats)
         else:
             raise NotImplementedError
         if eval_results[self.target_metric] > self.best_result:
@@ -562,7 +653,8 @@ class EmbodiedScanInstSegEvalBoxMergeOpenVocab(BaseEvaluator):
         return is_best, eval_results
 
 @EVALUATOR_REGISTRY.register()
-class EmbodiedScanInstSegEvalGTMergeSaveFeat(BaseEvaluator):
+class EmbodiedScanInstSegEvalGTMergeSaveFeat(ScanStreamMixin, BaseEvaluator):
+
     def __init__(self, cfg, accelerator, **kwargs):
         # config
         self.config = cfg
@@ -579,6 +671,7 @@ class EmbodiedScanInstSegEvalGTMergeSaveFeat(BaseEvaluator):
         # representation manager
         self.representation_manger = RepresentationManagerGT()
         self.cur_scan_id = None
+        self.init_scan_stream(cfg)
         # record
         self.preds = defaultdict(lambda: defaultdict(list)) # self.preds[object_id][attribute] = [] list 
         # misc
@@ -612,20 +705,23 @@ class EmbodiedScanInstSegEvalGTMergeSaveFeat(BaseEvaluator):
         torch.save(save_dict, os.path.join(self.save_dir, f"{scan_id}.pth"))
         self.representation_manger.reset()
         self.preds = defaultdict(lambda: defaultdict(list))
+
+    def new_scan_state(self):
+        return {'representation_manger': RepresentationManagerGT(), 'preds': defaultdict(lambda: defaultdict(list))}
+
+    def same_scan_frame(self, data_dict, bid):
+        sub_frame_id = data_dict['sub_frame_id'][bid]
+        if self.save_frame_interval != -1 and int(sub_frame_id) % self.save_frame_interval == 0:
+            self.flush_single_frame()
         
     def update(self, data_dict):
         metrics = self.batch_metrics(data_dict)
-        # check whether dump data from representation manager to preds
-        scan_id = data_dict['scan_id'][0]
-        sub_frame_id = data_dict['sub_frame_id'][0]
-        if self.cur_scan_id is None: # no memory
-            self.cur_scan_id = scan_id
-        elif self.cur_scan_id != scan_id: # new scan
-            self.flush_representation_manager()
-            self.cur_scan_id = scan_id
-        else: # same scan
-            if self.save_frame_interval != -1 and int(sub_frame_id) % self.save_frame_interval == 0:
-                self.flush_single_frame()
+        # route every frame of the batch to its scan, see ScanStreamMixin, only frames merged for the first time count
+        metrics["total_count"] = self.stream_batch(data_dict)
+        # update representation
+        self.total_count += metrics["total_count"]
+
+    def merge_frame(self, data_dict, bid):
         # merge
         pred_masks = data_dict['predictions_mask'][-1]
         pred_logits = data_dict['predictions_class'][-1]
@@ -640,65 +736,60 @@ class EmbodiedScanInstSegEvalGTMergeSaveFeat(BaseEvaluator):
         raw_coordinates = data_dict['raw_coordinates']
         pred_indices = data_dict['indices']
         instance_ids_ori = data_dict['instance_ids_ori']
-        assert len(pred_masks) == 1
-        for bid in range(len(pred_masks)):
-            # get all stuff
-            masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
-            logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
-            for cls in self.filter_out_classes:
-                logits[:, cls] = -float('inf')
-            boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
-            scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
-            embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
-            feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
-            indices = pred_indices[bid]
-            indices[0] = indices[0].detach().cpu()
-            indices[1] = indices[1].detach().cpu()
-            ids = instance_ids_ori[bid].detach().cpu()
-            # filter out classes
-            masks = masks[:, indices[0]]
-            logits = logits[indices[0]]
-            boxes = boxes[indices[0]]
-            scores = scores[indices[0]]
-            embeds = embeds[indices[0]]
-            feats = feats[indices[0]]
-            ids = ids[indices[1]]
-            if masks.shape[1] == 0:
-                continue
-            # get mask scores heatmap
-            mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
-            # convert mask to full res
-            masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
-            masks = masks.numpy()
-            classes = classes.numpy()
-            boxes = boxes.numpy()
-            mask_scores = mask_scores.numpy()
-            scores = scores.numpy()
-            feats = feats.numpy()
-            embeds = embeds.numpy()
-            ids = ids.numpy()
-            # merge
-            predict_dict_list = [
-            {
-                'point_cloud': raw_coordinates[bid],
-                'pred_masks': masks,
-                'pred_classes': classes,
-                'pred_scores': scores,
-                'pred_mask_scores': mask_scores,
-                'pred_boxes': boxes,
-                'pred_feats': feats,
-                'open_vocab_feats': embeds,
-                'pred_ids': ids,
-            }]
-            self.representation_manger.merge(predict_dict_list)
-            
-        # update representation
-        self.total_count += metrics["total_count"]
+        # get all stuff
+        masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
+        logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
+        for cls in self.filter_out_classes:
+            logits[:, cls] = -float('inf')
+        boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
+        scores = softmax(pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()], dim=1)[:, 1] # (q)
+        embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
+        feats = pred_feats[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 256)
+        indices = pred_indices[bid]
+        indices[0] = indices[0].detach().cpu()
+        indices[1] = indices[1].detach().cpu()
+        ids = instance_ids_ori[bid].detach().cpu()
+        # filter out classes
+        masks = masks[:, indices[0]]
+        logits = logits[indices[0]]
+        boxes = boxes[indices[0]]
+        scores = scores[indices[0]]
+        embeds = embeds[indices[0]]
+        feats = feats[indices[0]]
+        ids = ids[indices[1]]
+        if masks.shape[1] == 0:
+            return
+        # get mask scores heatmap
+        mask_scores, masks, classes, heatmap = get_mask_and_scores(logits, masks)
+        # convert mask to full res
+        masks = get_full_res_mask(masks, voxel_to_full_maps[bid].cpu(), segment_to_full_maps[bid].cpu())
+        masks = masks.numpy()
+        classes = classes.numpy()
+        boxes = boxes.numpy()
+        mask_scores = mask_scores.numpy()
+        scores = scores.numpy()
+        feats = feats.numpy()
+        embeds = embeds.numpy()
+        ids = ids.numpy()
+        # merge
+        predict_dict_list = [
+        {
+            'point_cloud': raw_coordinates[bid],
+            'pred_masks': masks,
+            'pred_classes': classes,
+            'pred_scores': scores,
+            'pred_mask_scores': mask_scores,
+            'pred_boxes': boxes,
+            'pred_feats': feats,
+            'open_vocab_feats': embeds,
+            'pred_ids': ids,
+        }]
+        self.representation_manger.merge(predict_dict_list)
 
     def batch_metrics(self, data_dict):
         metrics = {}
         metrics["total_count"] = len(data_dict['predictions_class'][0])
-        assert metrics["total_count"] == 1
+        assert metrics["total_count"] == 1 or self.scan_stream
         return metrics
 
     def reset(self):
@@ -707,9 +798,10 @@ class EmbodiedScanInstSegEvalGTMergeSaveFeat(BaseEvaluator):
         self.total_count = 0
         self.preds = defaultdict(dict)
         self.representation_manger.reset()
+        self.reset_scans()
 
     def record(self):        
-        self.flush_representation_manager()
+        self.flush_scans()
         # clean
         gc.collect()
         torch.cuda.empty_cache()
@@ -795,44 +887,6 @@ def eval_semantic_hm3d(preds, cfg):
     print(f"semantic class accuracy: {class_acc}, semantic similarity: {sem_sim}, correct semantic similarity: {correct_sem_sim}, incorrect semantic similarity: {incorrect_sem_sim}")
     return {'class_acc': class_acc, 'sem_sim': sem_sim}
 
-# inputs preds {'scan_id': 'pred_masks': masks, 'pred_classes': classes, 'pred_scores': scores}
-def eval_mask_hm3d(preds, cfg): 
-    # load meta data
-    base_dir = cfg.data.scene_verse_base
-    embodied_base_dir = cfg.data.embodied_base
-    # load label converter
-    int2cat = json.load(open(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2_raw_categories.json"),
-                                            'r', encoding="utf-8"))
-    cat2int = {w: i for i, w in enumerate(int2cat)}
-    label_converter = LabelConverter(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2-labels.combined.tsv"))
-    scannet_607_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "ScanNet", "scannet_sem_text_feature.pth"))
-    hm3d_sem_category_mapping = np.loadtxt(os.path.join(embodied_base_dir, "HM3D", "hm3dsem_category_mappings.tsv"), dtype=str, delimiter="\t", encoding="utf-8")
-    hm3d_raw_to_scannet607 = convert_gpt4
-    hm3d_raw_to_cat = {hm3d_sem_category_mapping[i, 0]: hm3d_sem_category_mapping[i, 1] for i in range(1, hm3d_sem_category_mapping.shape[0])}
-    hm3d_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "HM3D", "hm3d_sem_text_feature.pth")) 
-    # build gt_ids
-    gt_ids = {}
-    valid_scan_ids = list(preds.keys())
-    for scan_id in valid_scan_ids:
-        scan_id_ori = scan_id.split('_')[0]
-        instance_labels = np.fromfile(os.path.join(embodied_base_dir, 'HM3D', 'instance_mask_global',  f'{scan_id}.bin'), dtype=np.int64).reshape(-1)
-        inst_to_label = torch.load(os.path.join(embodied_base_dir, 'HM3D','instance_id_to_label', f'{scan_id_ori}_00.pth'))
-        gt_mask_list = []
-        for inst_id in inst_to_label.keys():
-            if inst_to_label[inst_id] in convert_gpt4.keys() and  label_converter.raw_name_to_scannet_raw_id[convert_gpt4[inst_to_label[inst_id]]] in label_converter.scannet_raw_id_to_scannet200_id and convert_gpt4[inst_to_label[inst_id]] not in ['wall', 'floor', 'ceiling']:
-                gt_mask_list.append(instance_labels == inst_id)
-        preds[scan_id]['pred_classes'] = np.ones(len(preds[scan_id]['pred_classes']))
-        cur_ids = np.zeros(preds[scan_id]['pred_masks'].shape[0])
-        for i, mask in enumerate(gt_mask_list):
-            cur_ids[mask] = 1 * 1000 + i + 1 # class * 1000 + object
-        gt_ids[scan_id] = cur_ids
-    # eval
-    eval_results = eval_instseg_flexible(preds, gt_ids, ['object'])
-    print(eval_results)
-    return eval_results
-
 # inputs preds {'scan_id': {'object_id': {'open_vocab_feat': open_vocab_feat, 'class_id': class_id}}}
 def eval_semantic_scannet(preds, cfg):
     # load meta data
@@ -888,147 +942,88 @@ def eval_semantic_scannet(preds, cfg):
     print(f"semantic class accuracy: {class_acc}, semantic similarity: {sem_sim}, correct semantic similarity: {correct_sem_sim}, incorrect semantic similarity: {incorrect_sem_sim}")
     return {'class_acc': class_acc, 'sem_sim': sem_sim}
         
-# inputs preds {'scan_id': 'pred_masks': masks, 'pred_classes': classes, 'pred_scores': scores}
-def eval_mask_scannet(preds, cfg): 
-    # load meta data
-    base_dir = cfg.data.scene_verse_base
-    embodied_base_dir = cfg.data.embodied_base
-    # load label converter
-    int2cat = json.load(open(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2_raw_categories.json"),
-                                            'r', encoding="utf-8"))
-    cat2int = {w: i for i, w in enumerate(int2cat)}
-    label_converter = LabelConverter(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2-labels.combined.tsv"))
-    scannet_607_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "ScanNet", "scannet_sem_text_feature.pth"))
-    hm3d_sem_category_mapping = np.loadtxt(os.path.join(embodied_base_dir, "HM3D", "hm3dsem_category_mappings.tsv"), dtype=str, delimiter="\t", encoding="utf-8")
-    hm3d_raw_to_scannet607 = convert_gpt4
-    hm3d_raw_to_cat = {hm3d_sem_category_mapping[i, 0]: hm3d_sem_category_mapping[i, 1] for i in range(1, hm3d_sem_category_mapping.shape[0])}
-    hm3d_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "HM3D", "hm3d_sem_text_feature.pth")) 
-    # build gt_ids
-    gt_ids = {}
-    valid_scan_ids = list(preds.keys())
-    for scan_id in valid_scan_ids:
-        instance_labels = np.fromfile(os.path.join(embodied_base_dir, 'ScanNet', 'instance_mask_global',  f'{scan_id}.bin'), dtype=np.int64).reshape(-1)
-        instance_labels = instance_labels - 1
-        instance_labels[instance_labels == -1] = -100
-        inst_to_label = torch.load(os.path.join(embodied_base_dir, 'ScanNet','instance_id_to_label', f'{scan_id}.pth'))
-        gt_mask_list = []
-        for inst_id in inst_to_label.keys():
-            if label_converter.raw_name_to_scannet_raw_id[inst_to_label[inst_id]] in label_converter.scannet_raw_id_to_scannet200_id and inst_to_label[inst_id] not in ['wall', 'floor', 'ceiling']:
-                gt_mask_list.append(instance_labels == inst_id)
-        preds[scan_id]['pred_classes'] = np.ones(len(preds[scan_id]['pred_classes']))
-        cur_ids = np.zeros(preds[scan_id]['pred_masks'].shape[0])
-        for i, mask in enumerate(gt_mask_list):
-            cur_ids[mask] = 1 * 1000 + i + 1 # class * 1000 + object
-        gt_ids[scan_id] = cur_ids
-    # eval
-    eval_results = eval_instseg_flexible(preds, gt_ids, ['object'])
-    print(eval_results)
-    return eval_results
 
-# inputs preds {'scan_id': 'pred_masks': masks, 'pred_scores': scores, 'pred_openvocab': openvocab}
-def eval_mask_open_vocab_scannet(preds, cfg): 
-    # load meta data
-    base_dir = cfg.data.scene_verse_base
-    embodied_base_dir = cfg.data.embodied_base
-    # load label converter
-    int2cat = json.load(open(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2_raw_categories.json"),
-                                            'r', encoding="utf-8"))
-    cat2int = {w: i for i, w in enumerate(int2cat)}
-    label_converter = LabelConverter(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2-labels.combined.tsv"))
-    scannet_607_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "ScanNet", "scannet_sem_text_feature.pth"))
-    hm3d_sem_category_mapping = np.loadtxt(os.path.join(embodied_base_dir, "HM3D", "hm3dsem_category_mappings.tsv"), dtype=str, delimiter="\t", encoding="utf-8")
-    hm3d_raw_to_scannet607 = convert_gpt4
-    hm3d_raw_to_cat = {hm3d_sem_category_mapping[i, 0]: hm3d_sem_category_mapping[i, 1] for i in range(1, hm3d_sem_category_mapping.shape[0])}
-    hm3d_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "HM3D", "hm3d_sem_text_feature.pth")) 
-    # build gt_ids
-    gt_ids = {}
-    valid_scan_ids = list(preds.keys())
-    for scan_id in valid_scan_ids:
-        instance_labels = np.fromfile(os.path.join(embodied_base_dir, 'ScanNet', 'instance_mask_global',  f'{scan_id}.bin'), dtype=np.int64).reshape(-1)
-        instance_labels = instance_labels - 1
-        instance_labels[instance_labels == -1] = -100
-        inst_to_label = torch.load(os.path.join(embodied_base_dir, 'ScanNet','instance_id_to_label', f'{scan_id}.pth'))
-        gt_mask_dict = defaultdict(list)
-        for inst_id in inst_to_label.keys():
-            if label_converter.raw_name_to_scannet_raw_id[inst_to_label[inst_id]] in label_converter.scannet_raw_id_to_scannet200_id and inst_to_label[inst_id] not in ['wall', 'floor', 'ceiling']:
-                scannet200_label = label_converter.scannet_raw_id_to_scannet200_id[label_converter.raw_name_to_scannet_raw_id[inst_to_label[inst_id]]]
-                gt_mask_dict[scannet200_label].append(instance_labels == inst_id)
-        cur_ids = np.zeros(preds[scan_id]['pred_masks'].shape[0])
-        for i, mask_list in gt_mask_dict.items():
-            for j, mask in enumerate(mask_list):
-                cur_ids[mask] = (i + 1) * 1000 + j + 1  # start from 1
-        gt_ids[scan_id] = cur_ids
-    # build pred classes
+@lru_cache(maxsize=None)
+def load_label_converter(base_dir):
+    return LabelConverter(os.path.join(base_dir, "ScanNet/annotations/meta_data/scannetv2-labels.combined.tsv"))
+
+@lru_cache(maxsize=None)
+def load_scannet_200_text_feat(base_dir, embodied_base_dir):
+    label_converter = load_label_converter(base_dir)
     scannet_607_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "ScanNet", "scannet_sem_text_feature.pth"))
     scannet_200_text_feat = []
     for i in range(200):
         scannet_200_text_feat.append(scannet_607_cat_to_text_embed[label_converter.scannet_raw_id_to_raw_name[VALID_CLASS_IDS_200[i]]])
-    scannet_200_text_feat = torch.stack(scannet_200_text_feat, dim=0) # N, 607
-    for scan_id in valid_scan_ids:
-        pred_classes = np.zeros(len(preds[scan_id]['pred_openvocab']))
-        for i in range(len(preds[scan_id]['pred_openvocab'])):
-            cur_openvocab = torch.Tensor(preds[scan_id]['pred_openvocab'][i])
-            cur_sim = torch.cosine_similarity(cur_openvocab, scannet_200_text_feat, dim=1)
-            pred_classes[i] = torch.argmax(cur_sim).item() + 1
-        preds[scan_id]['pred_classes'] = pred_classes
-    # convert pred
-    # eval
-    eval_results = eval_instseg_flexible(preds, gt_ids, CLASS_LABELS_200)
-    print(eval_results)
-    return eval_results
+    return torch.stack(scannet_200_text_feat, dim=0) # N, 607
 
-def eval_mask_open_vocab_hm3d(preds, cfg): 
-    # load meta data
-    base_dir = cfg.data.scene_verse_base
+def build_scan_gt_ids(scan_id, num_points, cfg, dataset_name, open_vocab):
+    # gt ids of one scan, class * 1000 + object + 1, class agnostic (class 1) unless open_vocab (scannet 200 class + 1)
     embodied_base_dir = cfg.data.embodied_base
-    # load label converter
-    int2cat = json.load(open(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2_raw_categories.json"),
-                                            'r', encoding="utf-8"))
-    cat2int = {w: i for i, w in enumerate(int2cat)}
-    label_converter = LabelConverter(os.path.join(base_dir,
-                                            "ScanNet/annotations/meta_data/scannetv2-labels.combined.tsv"))
-    scannet_607_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "ScanNet", "scannet_sem_text_feature.pth"))
-    hm3d_sem_category_mapping = np.loadtxt(os.path.join(embodied_base_dir, "HM3D", "hm3dsem_category_mappings.tsv"), dtype=str, delimiter="\t", encoding="utf-8")
-    hm3d_raw_to_scannet607 = convert_gpt4
-    hm3d_raw_to_cat = {hm3d_sem_category_mapping[i, 0]: hm3d_sem_category_mapping[i, 1] for i in range(1, hm3d_sem_category_mapping.shape[0])}
-    hm3d_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "HM3D", "hm3d_sem_text_feature.pth")) 
-    # build gt_ids
-    gt_ids = {}
-    valid_scan_ids = list(preds.keys())
-    for scan_id in valid_scan_ids:
+    label_converter = load_label_converter(cfg.data.scene_verse_base)
+    if dataset_name == 'HM3D':
         scan_id_ori = scan_id.split('_')[0]
         instance_labels = np.fromfile(os.path.join(embodied_base_dir, 'HM3D', 'instance_mask_global',  f'{scan_id}.bin'), dtype=np.int64).reshape(-1)
         inst_to_label = torch.load(os.path.join(embodied_base_dir, 'HM3D','instance_id_to_label', f'{scan_id_ori}_00.pth'))
-        gt_mask_dict = defaultdict(list)
-        for inst_id in inst_to_label.keys():
-            if inst_to_label[inst_id] in convert_gpt4.keys() and  label_converter.raw_name_to_scannet_raw_id[convert_gpt4[inst_to_label[inst_id]]] in label_converter.scannet_raw_id_to_scannet200_id and convert_gpt4[inst_to_label[inst_id]] not in ['wall', 'floor', 'ceiling']:
-                scannet200_label = label_converter.scannet_raw_id_to_scannet200_id[label_converter.raw_name_to_scannet_raw_id[convert_gpt4[inst_to_label[inst_id]]]]
-                gt_mask_dict[scannet200_label].append(instance_labels == inst_id)
-        cur_ids = np.zeros(preds[scan_id]['pred_masks'].shape[0])
-        for i, mask_list in gt_mask_dict.items():
-            for j, mask in enumerate(mask_list):
-                cur_ids[mask] = (i + 1) * 1000 + j + 1  # start from 1
-        gt_ids[scan_id] = cur_ids
-    # build pred classes
-    scannet_607_cat_to_text_embed = torch.load(os.path.join(embodied_base_dir, "ScanNet", "scannet_sem_text_feature.pth"))
-    scannet_200_text_feat = []
-    for i in range(200):
-        scannet_200_text_feat.append(scannet_607_cat_to_text_embed[label_converter.scannet_raw_id_to_raw_name[VALID_CLASS_IDS_200[i]]])
-    scannet_200_text_feat = torch.stack(scannet_200_text_feat, dim=0) # N, 607
-    for scan_id in valid_scan_ids:
-        pred_classes = np.zeros(len(preds[scan_id]['pred_openvocab']))
-        for i in range(len(preds[scan_id]['pred_openvocab'])):
-            cur_openvocab = torch.Tensor(preds[scan_id]['pred_openvocab'][i])
+        # hm3d raw names are mapped to scannet names
+        inst_to_name = {inst_id: convert_gpt4[name] for inst_id, name in inst_to_label.items() if name in convert_gpt4.keys()}
+    elif dataset_name == 'ScanNet':
+        instance_labels = np.fromfile(os.path.join(embodied_base_dir, 'ScanNet', 'instance_mask_global',  f'{scan_id}.bin'), dtype=np.int64).reshape(-1)
+        instance_labels = instance_labels - 1
+        instance_labels[instance_labels == -1] = -100
+        inst_to_label = torch.load(os.path.join(embodied_base_dir, 'ScanNet','instance_id_to_label', f'{scan_id}.pth'))
+        inst_to_name = inst_to_label
+    else:
+        raise NotImplementedError(f"Unknow dataset name: {dataset_name}")
+    gt_mask_dict = defaultdict(list)
+    for inst_id, name in inst_to_name.items():
+        if label_converter.raw_name_to_scannet_raw_id[name] in label_converter.scannet_raw_id_to_scannet200_id and name not in ['wall', 'floor', 'ceiling']:
+            label = label_converter.scannet_raw_id_to_scannet200_id[label_converter.raw_name_to_scannet_raw_id[name]] if open_vocab else 0
+            gt_mask_dict[label].append(instance_labels == inst_id)
+    cur_ids = np.zeros(num_points)
+    for i, mask_list in gt_mask_dict.items():
+        for j, mask in enumerate(mask_list):
+            cur_ids[mask] = (i + 1) * 1000 + j + 1  # start from 1
+    return cur_ids
+
+def prepare_scan_pred(scan_id, pred, cfg, dataset_name, open_vocab):
+    # prediction classes and gt ids of one scan for the AP evaluation
+    if open_vocab:
+        # classes from the most similar scannet 200 text feature
+        scannet_200_text_feat = load_scannet_200_text_feat(cfg.data.scene_verse_base, cfg.data.embodied_base)
+        pred_classes = np.zeros(len(pred['pred_openvocab']))
+        for i in range(len(pred['pred_openvocab'])):
+            cur_openvocab = torch.Tensor(pred['pred_openvocab'][i])
             cur_sim = torch.cosine_similarity(cur_openvocab, scannet_200_text_feat, dim=1)
             pred_classes[i] = torch.argmax(cur_sim).item() + 1
-        preds[scan_id]['pred_classes'] = pred_classes
-    # convert pred
+    else:
+        pred_classes = np.ones(len(pred['pred_classes']))
+    pred = {'pred_scores': pred['pred_scores'], 'pred_masks': pred['pred_masks'], 'pred_classes': pred_classes}
+    return pred, build_scan_gt_ids(scan_id, pred['pred_masks'].shape[0], cfg, dataset_name, open_vocab)
+
+# inputs preds {'scan_id': 'pred_masks': masks, 'pred_classes': classes, 'pred_scores': scores}
+# or with open_vocab {'scan_id': 'pred_masks': masks, 'pred_scores': scores, 'pred_openvocab': openvocab}
+def eval_mask(preds, cfg, dataset_name, open_vocab, reduce_stats=False):
+    class_labels = CLASS_LABELS_200 if open_vocab else ['object']
+    gt_ids = {}
+    for scan_id in list(preds.keys()):
+        preds[scan_id], gt_ids[scan_id] = prepare_scan_pred(scan_id, preds[scan_id], cfg, dataset_name, open_vocab)
     # eval
-    eval_results = eval_instseg_flexible(preds, gt_ids, CLASS_LABELS_200)
+    if reduce_stats:
+        # preds hold this rank's scans only, their AP statistics are gathered across ranks
+        eval_results = eval_instseg_reduced(preds, gt_ids, class_labels)
+    else:
+        eval_results = eval_instseg_flexible(preds, gt_ids, class_labels)
     print(eval_results)
-    return eval_results
\ No newline at end of file
+    return eval_results
+
+def eval_mask_hm3d(preds, cfg, reduce_stats=False):
+    return eval_mask(preds, cfg, 'HM3D', open_vocab=False, reduce_stats=reduce_stats)
+
+def eval_mask_scannet(preds, cfg, reduce_stats=False):
+    return eval_mask(preds, cfg, 'ScanNet', open_vocab=False, reduce_stats=reduce_stats)
+
+def eval_mask_open_vocab_scannet(preds, cfg, reduce_stats=False):
+    return eval_mask(preds, cfg, 'ScanNet', open_vocab=True, reduce_stats=reduce_stats)
+
+def eval_mask_open_vocab_hm3d(preds, cfg, reduce_stats=False):
+    return eval_mask(preds, cfg, 'HM3D', open_vocab=True, reduce_stats=reduce_stats)
@@ -1,12 +1,13 @@
 
 
 import gc
+import logging
 import os
 import numpy as np
 import quaternion
 from sklearn.cluster import KMeans
 import torch
-from torch_scatter import scatter_mean
+from torch_scatter import scatter_mean, scatter_add
 from transformers import AutoModel, AutoImageProcessor, AutoTokenizer
 import cv2
 from FastSAM.fastsam import FastSAM
@@ -20,13 +21,14 @@ import open3d as o3d
 import torch.nn.functional as F
 import albumentations as A
 import MinkowskiEngine as ME
+from data.voxelize import sparse_quantize
 from data.datasets.embodied_instseg_wrapper import EmbodiedInstSegDatasetWrapper
 from data.data_utils import pad_sequence
 from torch.utils.data import default_collate
 from merge_utils import RepresentationManager
 import time
 
-from model.query3d_vle import Query3DVLE
+logger = logging.getLogger(__name__)
 
 def timeit(func):
     def wrapper(*args, **kwargs):
@@ -125,7 +127,7 @@ def stage1_collote_fn(batch):
     new_batch['voxel_features'] = voxel_features
             
     # list collate
-    list_keys = ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_labels', 'instance_boxes', 'instance_ids_ori', 'full_masks', 'segment_masks', 'scan_id', 'segment_labels', 'query_selection_ids', 'instance_hm3d_labels', 'instance_hm3d_text_embeds']
+    list_keys = ['voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_labels', 'instance_boxes', 'instance_ids_ori', 'full_masks', 'point_instance_ids', 'segment_masks', 'scan_id', 'segment_labels', 'query_selection_ids', 'instance_hm3d_labels', 'instance_hm3d_text_embeds']
     list_keys = [k for k in list_keys if k in batch[0].keys()]
     for k in list_keys:
         new_batch[k] = [sample.pop(k) for sample in batch]
@@ -143,6 +145,79 @@ def stage1_collote_fn(batch):
     new_batch.update(default_collate(batch))
     return new_batch
 
+def pack_by_token_budget(lengths, token_budget):
+    # sort frames by segment count (descending) and greedily pack them so that
+    # the padded size of each micro batch (batch size * max length) stays within budget
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    packs = []
+    cur = []
+    for i in order:
+        if len(cur) > 0 and lengths[cur[0]] * (len(cur) + 1) > token_budget:
+            packs.append(cur)
+            cur = []
+        cur.append(i)
+    if len(cur) > 0:
+        packs.append(cur)
+    return packs
+
+def padding_waste(lengths, packs):
+    # ratio of padded slots to all slots
+    total = sum(len(p) * max(lengths[i] for i in p) for p in packs)
+    return 1.0 - sum(lengths) / max(total, 1)
+
+def postprocess_stage1_batch(stage1_output_data_dict, batch, filter_out_classes=(0, 2, 35)):
+    # batched version of the per frame postprocess, frames are flattened with offsets instead of looping over batch
+    pred_masks = stage1_output_data_dict['predictions_mask'][-1] # (B, S, N)
+    pred_logits = F.softmax(stage1_output_data_dict['predictions_class'][-1], dim=-1) # (B, N, 201)
+    pred_boxes = stage1_output_data_dict['predictions_box'][-1] # (B, N, 6)
+    pred_scores = F.softmax(stage1_output_data_dict['predictions_score'][-1], dim=-1)[:, :, 1] # (B, N)
+    pred_query = stage1_output_data_dict['query_feat'] # (B, N, 768)
+    pred_embeds = stage1_output_data_dict['openvocab_query_feat'] # (B, N, 768)
+    B, S, N = pred_masks.shape
+    device = pred_masks.device
+    batch_ids = torch.arange(B, device=device)
+    # filter out padded queries and wall floor ceiling
+    filter_out_classes = torch.tensor(filter_out_classes, device=device)
+    valid_query_mask = batch['query_pad_masks'].bool() & ~torch.isin(torch.argmax(pred_logits, dim=-1), filter_out_classes) # (B, N)
+    classes = torch.argmax(pred_logits[..., :-1], dim=-1) # ignore last logit (201 for no class), (B, N)
+    # voxel level masks, segment ids are offset by bid * S
+    voxel_counts = torch.tensor([len(v) for v in batch['voxel2segment']], device=device)
+    voxel_batch_ids = torch.repeat_interleave(batch_ids, voxel_counts)
+    voxel_offsets = torch.cumsum(voxel_counts, dim=0) - voxel_counts
+    voxel_logits = pred_masks.reshape(B * S, N)[torch.cat(batch['voxel2segment']) + voxel_batch_ids * S] # (sum V, N)
+    heatmap = voxel_logits.float().sigmoid()
+    voxel_masks = (voxel_logits > 0).float()
+    mask_scores = scatter_add(heatmap * voxel_masks, voxel_batch_ids, dim=0, dim_size=B) / (scatter_add(voxel_masks, voxel_batch_ids, dim=0, dim_size=B) + 1e-6) # (B, N)
+    # keep the valid queries before going to full resolution, valid queries first in query order, padded to the
+    # largest valid count of the batch
+    num_valid = valid_query_mask.sum(1).cpu()
+    max_valid = int(num_valid.max()) if B > 0 else 0
+    if max_valid == 0:
+        return [None] * B
+    query_order = torch.argsort((~valid_query_mask).int(), dim=1, stable=True)[:, :max_valid] # (B, max_valid)
+    voxel_masks = voxel_masks.gather(1, query_order[voxel_batch_ids]) # (sum V, max_valid)
+    # polish mask, full res points -> full res segments -> full res points
+    point_counts = [len(m) for m in batch['voxel_to_full_maps']]
+    point_batch_ids = torch.repeat_interleave(batch_ids, torch.tensor(point_counts, device=device))
+    point_voxel_ids = torch.cat(batch['voxel_to_full_maps']) + voxel_offsets[point_batch_ids]
+    point_seg_ids = torch.cat(batch['segment_to_full_maps']) + point_batch_ids * S
+    masks = scatter_mean(voxel_masks[point_voxel_ids], point_seg_ids, dim=0, dim_size=B * S) > 0.5
+    masks = masks[point_seg_ids] # (sum P, max_valid)
+    # single device to host copy
+    masks = masks.cpu().split(point_counts)
+    valid_query_mask = valid_query_mask.cpu()
+    classes, boxes, scores, mask_scores = classes.cpu(), pred_boxes.detach().cpu(), pred_scores.detach().cpu(), mask_scores.cpu()
+    query, embeds = pred_query.detach().cpu(), pred_embeds.detach().cpu()
+    pred_dict_list = []
+    for bid in range(B):
+        valid = valid_query_mask[bid]
+        if num_valid[bid] == 0:
+            pred_dict_list.append(None)
+            continue
+        pred_dict_list.append({'point_cloud': batch['raw_coordinates'][bid], 'pred_masks': masks[bid][:, :num_valid[bid]].float().numpy(), 'pred_classes': classes[bid][valid].numpy(), 'pred_boxes': boxes[bid][valid].numpy(),
+                               'pred_scores': scores[bid][valid].numpy(), 'pred_mask_scores': mask_scores[bid][valid].numpy(), 'pred_feats': query[bid][valid].numpy(), 'open_vocab_feats': embeds[bid][valid].numpy()})
+    return pred_dict_list
+
 def batch_to_cuda(batch):
     for key in batch:
         if isinstance(batch[key], torch.Tensor):
@@ -152,7 +227,7 @@ def batch_to_cuda(batch):
     return batch
 
 class PQ3DModel:
-    def __init__(self, stage1_dir, stage2_dir, min_decision_num=None):
+    def __init__(self, stage1_dir, stage2_dir, min_decision_num=None, stage1_token_budget=2048):
         # get four models, sam, dino, pq3d stage1, pq3d stage2
         # dino
         processor = AutoImageProcessor.from_pretrained('facebook/dinov2-large')
@@ -173,6 +248,9 @@ class PQ3DModel:
         self.pq3d_stage1.load_state_dict(torch.load(os.path.join(stage1_dir, 'pytorch_model.bin'), map_location='cpu'))
         self.pq3d_stage1.eval()
         self.pq3d_stage1.cuda()
+        # decision only reads query feat and last layer predictions
+        self.pq3d_stage1.set_outputs(['query_feat'])
+        self.pq3d_stage1.unified_encoder.last_layer_only_eval = True
         # merge manager
         self.representation_manager = RepresentationManager()
         # pq3d stage2
@@ -189,11 +267,14 @@ class PQ3DModel:
         # decision params
         self.frontier_selection_mode = 'model'
         self.min_decision_num = min_decision_num if min_decision_num is not None else 3
+        # max padded segments (batch size * max segment num) per stage1 micro batch
+        self.stage1_token_budget = stage1_token_budget
     
     def reset(self):
         self.representation_manager.reset()
         
     def decision(self, color_list, depth_list, agent_state_list, frontier_waypoints, sentence, decision_num, image_feat=None):
+        start_time = time.time()
         torch.cuda.empty_cache()
         gc.collect()  
         torch.cuda.ipc_collect()
@@ -330,7 +411,7 @@ class PQ3DModel:
             # voxelize
             voxel_size= 0.02
             voxel_coordinates = np.floor(coordinates / voxel_size)
-            _, unique_map, inverse_map = ME.utils.sparse_quantize(coordinates=voxel_coordinates, return_index=True, return_inverse=True)
+            _, unique_map, inverse_map = sparse_quantize(voxel_coordinates, return_index=True, return_inverse=True)
             voxel_coordinates = voxel_coordinates[unique_map]
             voxel_features = features[unique_map]
             voxel2seg_id = point2seg_id[unique_map]
@@ -360,59 +441,22 @@ class PQ3DModel:
                 'mv_seg_pad_masks': torch.ones(len(seg_center), dtype=torch.bool),  
             }
             batch.append(data_dict)
-        batch = stage1_collote_fn(batch)
-        batch = batch_to_cuda(batch)
-        with torch.no_grad():
-            stage1_output_data_dict = self.pq3d_stage1(batch) 
-        # get all predictions
-        pred_dict_list = []
-        pred_masks = stage1_output_data_dict['predictions_mask'][-1] # (B, S, N)
-        pred_logits = torch.functional.F.softmax(stage1_output_data_dict['predictions_class'][-1], dim=-1) # ignore last logit (201 for no class), (B, N, 201)
-        pred_boxes = stage1_output_data_dict['predictions_box'][-1] # (B, N, 6)
-        pred_scores = torch.functional.F.softmax(stage1_output_data_dict['predictions_score'][-1], dim=-1)[:, :, 1] # (B, N)
-        pred_query = stage1_output_data_dict['query_feat']
-        pred_embeds = stage1_output_data_dict['openvocab_query_feat']
-        query_pad_masks = batch['query_pad_masks']
-        voxel2segment = batch['voxel2segment']
-        voxel_to_full_maps = batch['voxel_to_full_maps']
-        segment_to_full_maps = batch['segment_to_full_maps']
-        raw_coordinates = batch['raw_coordinates']
-        for bid in range(len(pred_masks)):
-            masks = pred_masks[bid].detach().cpu()[voxel2segment[bid].cpu()][:, query_pad_masks[bid].cpu()]
-            logits = pred_logits[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 201)
-            boxes = pred_boxes[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 6)
-            scores = pred_scores[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q)
-            query = pred_query[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
-            embeds = pred_embeds[bid].detach().cpu()[query_pad_masks[bid].cpu()] # (q, 768)
-            # filter out wall floor ceiling
-            valid_query_mask = ~torch.isin(torch.argmax(logits, dim=-1), torch.tensor([0, 2, 35]))
-            masks = masks[:, valid_query_mask]
-            logits = logits[valid_query_mask][..., :-1]
-            boxes = boxes[valid_query_mask]
-            scores = scores[valid_query_mask]
-            query = query[valid_query_mask]
-            embeds = embeds[valid_query_mask]
-            if masks.shape[1] == 0:
-                continue
-            # get masks and scores
-            heatmap = masks.float().sigmoid()
-            masks = (masks > 0).float()
-            mask_scores = (heatmap * masks).sum(0) / (masks.sum(0) + 1e-6)
-            classes = torch.argmax(logits, dim=1)
-            # polish mask
-            masks = masks.detach().cpu()[voxel_to_full_maps[bid].cpu()]  # full res
-            masks = scatter_mean(masks, segment_to_full_maps[bid].cpu(), dim=0)  # full res segments
-            masks = (masks > 0.5).float()
-            masks = masks.detach().cpu()[segment_to_full_maps[bid].cpu()]  # full res points
-            # add to dict
-            masks = masks.numpy()
-            classes = classes.numpy()
-            boxes = boxes.numpy()
-            mask_scores = mask_scores.numpy()
-            scores = scores.numpy()
-            query = query.numpy()
-            embeds = embeds.numpy()
-            pred_dict_list.append({'point_cloud': raw_coordinates[bid], 'pred_masks': masks, 'pred_classes': classes, 'pred_boxes': boxes, 'pred_scores': scores, 'pred_mask_scores': mask_scores, 'pred_feats': query, 'open_vocab_feats': embeds})
+        # pack frames into micro batches by segment count to reduce padding
+        seg_counts = [len(data_dict['seg_center']) for data_dict in batch]
+        packs = pack_by_token_budget(seg_counts, self.stage1_token_budget)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Stage1 frames {len(seg_counts)}, micro batches {len(packs)}, padding waste {padding_waste(seg_counts, packs):.2%} (single batch {padding_waste(seg_counts, [list(range(len(seg_counts)))]):.2%})")
+        # get all predictions, keep original frame order for merging
+        frame_pred_dicts = [None] * len(batch)
+        for pack in packs:
+            micro_batch = stage1_collote_fn([batch[i] for i in pack])
+            micro_batch = batch_to_cuda(micro_batch)
+            with torch.no_grad():
+                stage1_output_data_dict = self.pq3d_stage1(micro_batch)
+                micro_pred_dicts = postprocess_stage1_batch(stage1_output_data_dict, micro_batch)
+            for i, pred_dict in zip(pack, micro_pred_dicts):
+                frame_pred_dicts[i] = pred_dict
+        pred_dict_list = [pred_dict for pred_dict in frame_pred_dicts if pred_dict is not None]
         # start to merge
         self.representation_manager.merge(pred_dict_list)
         torch.cuda.empty_cache()
@@ -532,6 +576,7 @@ class PQ3DModel:
                 random_frontier_idx = np.random.randint(len(frontier_locs))
                 target_position = frontier_locs[random_frontier_idx].numpy()[:3]
         target_position[[1, 2]] = target_position[[2, 1]]
+        logger.debug(f"Decision took {time.time() - start_time:.4f} seconds")
         return target_position, is_object_decision
 
             
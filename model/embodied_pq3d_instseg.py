@@ -12,6 +12,7 @@ from optim.utils import no_decay_param_group
 from model.mask3d import CoordinateEncoder
 from torch_scatter import scatter_mean, scatter
 from torch.nn.utils.rnn import pad_sequence
+from modules.layers.ragged import lengths_to_cu_seqlens, ragged_to_padded
 
 def scatter_norm(points, idx):
     ''' Normalize positions of same-segment in a unit sphere of diameter 1
@@ -41,6 +42,10 @@ class EmbodiedPQ3DInstSegModel(BaseModel):
         self.skip_query_encoder_mask_pred = cfg.model.get('skip_query_encoder_mask_pred', False)
         self.init_query_by_feat = cfg.model.get('init_query_by_feat', False)
         self.add_geometry_to_segment = cfg.model.get('add_geometry_to_segment', False)
+        # segments of the batch as ragged (S_total, D) rows with cu_seqlens instead of padded (B, max_seg, D), see modules/layers/ragged.py
+        self.ragged_segments = cfg.model.get('ragged_segments', False)
+        # auxiliary outputs written to data_dict, the last layer predictions are always kept
+        self.set_outputs(cfg.model.get('outputs', ['query_feat', 'predictions']))
         # build feature encoder
         for input in self.inputs:
             encoder = input + '_encoder'
@@ -90,34 +95,50 @@ class EmbodiedPQ3DInstSegModel(BaseModel):
         # the semantics of the attention mask in pytorch (True as masked) is the opposite as Huggingface Transformers (False as masked)  
         fts_locs = data_dict['seg_center']
         fts_pos = self.coord_encoder(fts_locs[:, :, :3], input_range=[coord_min, coord_max])
+        max_seg = fts_locs.shape[1]
+        cu_seqlens = None
+        if self.ragged_segments:
+            valid = data_dict['seg_pad_masks'].bool()
+            # offsets of the schema collator if it built them (ragged_offsets), padded rows are a suffix of every sample
+            if 'ragged_offsets' in data_dict and 'seg_pad_masks' in data_dict['ragged_offsets']:
+                cu_seqlens = data_dict['ragged_offsets']['seg_pad_masks']
+            else:
+                cu_seqlens = lengths_to_cu_seqlens(valid.sum(1))
+            fts_locs, fts_pos = fts_locs[valid], fts_pos[valid]
         for input in self.inputs:
             feat, mask, pos = None, None, None
             if input == 'mv':
                 feat = self.mv_encoder(obj_feats = data_dict['mv_seg_fts'])
                 mask = data_dict['mv_seg_pad_masks'].logical_not()
+                if self.ragged_segments:
+                    # ragged memories share the segment rows and the mask head averages them without a per memory count
+                    assert torch.equal(data_dict['mv_seg_pad_masks'].bool(), valid), 'ragged_segments needs mv_seg_pad_masks equal to seg_pad_masks'
+                    feat, mask = feat[valid], None
                 pos = fts_pos
             elif input == 'voxel':
                 voxel_features = data_dict['voxel_features']
                 voxel_coordinates = data_dict['voxel_coordinates']
                 x = ME.SparseTensor(coordinates=voxel_coordinates, features=voxel_features[:, :-3], device=voxel_features.device)
                 voxel2segment = data_dict['voxel2segment']
-                feat = self.voxel_encoder(x, voxel2segment, max_seg=fts_locs.shape[1])
+                feat = self.voxel_encoder(x, voxel2segment, max_seg=max_seg, cu_seqlens=cu_seqlens)
                 if self.add_geometry_to_segment:
-                    for bid in range(len(voxel2segment)):
-                        sp_idx = voxel2segment[bid]
-                        all_xyz = data_dict['coordinates'][bid]
-                        norm_xyz, _ = scatter_norm(all_xyz, sp_idx)
-                        all_xyz_segment = scatter(self.pts_proj1(norm_xyz), sp_idx, dim=0, reduce='max', dim_size=fts_locs.shape[1])
-                        for i in range(len(feat)):
-                            feat[i][bid] = feat[i][bid] + all_xyz_segment
+                    all_xyz_segment = self.encode_segment_geometry(data_dict['coordinates'], voxel2segment, max_seg)
+                    if self.ragged_segments:
+                        all_xyz_segment = all_xyz_segment[valid]
                     for i in range(len(feat)):        
-                        feat[i] = self.feat_proj(torch.cat([feat[i], fts_locs], dim=-1)) 
+                        feat[i] = self.feat_proj(torch.cat([feat[i] + all_xyz_segment, fts_locs], dim=-1)) 
                 mask = data_dict['seg_pad_masks'].logical_not()
-                data_dict['voxel_feat'] = {'feat': feat[-1].detach().cpu(), 'mask': mask.detach().cpu()}
+                if 'voxel_feat' in self.outputs:
+                    # stored padded for the downstream consumers
+                    voxel_feat = ragged_to_padded(feat[-1], cu_seqlens) if self.ragged_segments else feat[-1]
+                    data_dict['voxel_feat'] = {'feat': voxel_feat.detach().cpu(), 'mask': mask.detach().cpu()}
+                if self.ragged_segments:
+                    mask = None
                 pos = fts_pos
             else:
                 raise NotImplementedError(f"Unknow input type: {input}")
-            input_dict[input] = [feat, mask, pos]
+            # ragged memories carry their cu_seqlens, the mask is set to the (S_total, Q) attention mask by the query encoder
+            input_dict[input] = [feat, mask, pos] if cu_seqlens is None else [feat, mask, pos, cu_seqlens]
         # build offline attention mask for guided mask training
         offline_attn_masks = None
         # generate features for mask head
@@ -136,7 +157,11 @@ class EmbodiedPQ3DInstSegModel(BaseModel):
         else:
             mask_head_partial = None
         # generate features for spatial attention
-        if self.unified_encoder.spatial_selfattn:
+        if self.unified_encoder.spatial_selfattn and getattr(self.unified_encoder, 'spatial_chunk_size', None):
+            # pairwise locs are computed per query block inside the spatial attention
+            assert self.pairwise_rel_type == 'center', f"Chunked spatial attention does not support {self.pairwise_rel_type}"
+            pairwise_locs = query_locs[:, :, :3]
+        elif self.unified_encoder.spatial_selfattn:
             pairwise_locs = calc_pairwise_locs(query_locs[:, :, :3], None, 
                                            pairwise_rel_type=self.pairwise_rel_type, spatial_dist_norm=True,
                                            spatial_dim=self.spatial_dim)
@@ -153,7 +178,10 @@ class EmbodiedPQ3DInstSegModel(BaseModel):
                 query_selection_ids = data_dict['query_selection_ids']
                 query_feat_list = []
                 for bid in range(len(query_selection_ids)):
-                    query_feat = segment_feature[bid][query_selection_ids[bid]]
+                    if self.ragged_segments:
+                        query_feat = segment_feature[cu_seqlens[bid] + query_selection_ids[bid]]
+                    else:
+                        query_feat = segment_feature[bid][query_selection_ids[bid]]
                     query_feat_list.append(query_feat)
                 query_feat = pad_sequence(query_feat_list, batch_first=True) * self.input_weights[input]
                 input_query_feat_list.append(query_feat)
@@ -162,18 +190,21 @@ class EmbodiedPQ3DInstSegModel(BaseModel):
             input_dict['query'] = (query, input_dict['query'][1], input_dict['query'][2])
         # unified encoding                           
         query, predictions_score, predictions_class, predictions_mask, predictions_box = self.unified_encoder(input_dict, pairwise_locs, mask_head_partial)
-        data_dict['query_feat'] = query
+        if 'query_feat' in self.outputs:
+            data_dict['query_feat'] = query
         
         # task head
         for head in self.heads:
             if head == 'mask':
-                if self.skip_query_encoder_mask_pred:
-                    mask_head_partial = partial(self.mask_head, query_locs=query_locs, seg_fts_for_match=seg_fts_for_match, seg_masks=data_dict['seg_pad_masks'].logical_not(),
-                                    offline_attn_masks=offline_attn_masks, skip_prediction=False)
+                if self.skip_query_encoder_mask_pred or 'predictions' not in self.outputs:
+                    # drop per-layer predictions so that they can be freed
                     predictions_score = []
                     predictions_class = []
                     predictions_mask = []
                     predictions_box = []
+                if self.skip_query_encoder_mask_pred:
+                    mask_head_partial = partial(self.mask_head, query_locs=query_locs, seg_fts_for_match=seg_fts_for_match, seg_masks=data_dict['seg_pad_masks'].logical_not(),
+                                    offline_attn_masks=offline_attn_masks, skip_prediction=False)
                 pred_scores, pred_logits, pred_masks, pred_boxes, _ = mask_head_partial(query=query)
                 predictions_score.append(pred_scores)
                 predictions_class.append(pred_logits)
@@ -192,6 +223,22 @@ class EmbodiedPQ3DInstSegModel(BaseModel):
        
         return data_dict
 
+    def encode_segment_geometry(self, coordinates, voxel2segment, max_seg):
+        # all samples are processed at once, segment ids are offset by bid * max_seg
+        seg_offsets = torch.arange(len(voxel2segment), device=coordinates[0].device) * max_seg
+        num_voxels = torch.tensor([len(sp_idx) for sp_idx in voxel2segment], device=coordinates[0].device)
+        sp_idx = torch.cat(voxel2segment) + torch.repeat_interleave(seg_offsets, num_voxels)
+        norm_xyz, _ = scatter_norm(torch.cat(coordinates), sp_idx)
+        all_xyz_segment = scatter(self.pts_proj1(norm_xyz), sp_idx, dim=0, reduce='max', dim_size=len(voxel2segment) * max_seg)
+        return all_xyz_segment.view(len(voxel2segment), max_seg, -1) # (B, S, D)
+
+    def set_outputs(self, outputs):
+        # outputs: subset of ['voxel_feat', 'query_feat', 'predictions'], others are not stored or copied to host
+        for output in outputs:
+            if output not in ['voxel_feat', 'query_feat', 'predictions']:
+                raise NotImplementedError(f"Unknow output type: {output}")
+        self.outputs = set(outputs)
+
     def get_opt_params(self):
         def get_lr(cfg, default_lr):
             return default_lr if cfg is None or cfg.get("lr") is None else cfg.get("lr")
@@ -130,7 +130,11 @@ class Query3DVLE(BaseModel):
             input_dict[input] = [feat, mask, pos]
         mask_head_partial = None
         # generate features for spatial attention
-        if self.unified_encoder.spatial_selfattn:
+        if self.unified_encoder.spatial_selfattn and getattr(self.unified_encoder, 'spatial_chunk_size', None):
+            # pairwise locs are computed per query block inside the spatial attention
+            assert self.pairwise_rel_type == 'center', f"Chunked spatial attention does not support {self.pairwise_rel_type}"
+            pairwise_locs = query_locs[:, :, :3]
+        elif self.unified_encoder.spatial_selfattn:
             pairwise_locs = calc_pairwise_locs(query_locs[:, :, :3], None, 
                                            pairwise_rel_type=self.pairwise_rel_type, spatial_dist_norm=True,
                                            spatial_dim=self.spatial_dim)
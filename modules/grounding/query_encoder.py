@@ -6,6 +6,7 @@ from modules.utils import layer_repeat
 from modules.weights import _init_weights_bert
 from modules.utils import get_activation_fn
 from modules.layers.transformers import MultiHeadAttentionSpatial
+from modules.layers.ragged import ragged_cross_attention
 
 
 @GROUNDING_REGISTRY.register()
@@ -51,11 +52,15 @@ class QueryEncoder(nn.Module):
 @GROUNDING_REGISTRY.register()
 class QueryMaskEncoder(nn.Module):
     def __init__(self, cfg, memories=[], memory_dropout=0.0, hidden_size=768, num_attention_heads=12, num_layers=4,
-                share_layer=False, spatial_selfattn=False, structure='sequential', drop_memories_test=[], use_self_mask=False, num_blocks=1):
+                share_layer=False, spatial_selfattn=False, structure='sequential', drop_memories_test=[], use_self_mask=False, num_blocks=1,
+                last_layer_only_eval=False, spatial_chunk_size=None):
         super().__init__()
 
         self.spatial_selfattn = spatial_selfattn
-        query_encoder_layer = QueryEncoderLayer(hidden_size, num_attention_heads, memories, spatial_selfattn=spatial_selfattn, structure=structure, memory_dropout=memory_dropout, drop_memories_test=drop_memories_test)
+        # if set, the caller passes query centers instead of pairwise locs and spatial attention runs in query blocks
+        self.spatial_chunk_size = spatial_chunk_size
+        query_encoder_layer = QueryEncoderLayer(hidden_size, num_attention_heads, memories, spatial_selfattn=spatial_selfattn, structure=structure, memory_dropout=memory_dropout, drop_memories_test=drop_memories_test,
+                                                spatial_chunk_size=spatial_chunk_size)
         self.unified_encoder = layer_repeat(query_encoder_layer, num_layers, share_layer)
 
         self.apply(_init_weights_bert)
@@ -65,6 +70,9 @@ class QueryMaskEncoder(nn.Module):
         self.use_self_mask = use_self_mask
         self.num_heads = num_attention_heads
         self.num_blocks = num_blocks
+        # in eval, skip per-layer predictions and only compute the attention masks later layers need,
+        # the caller runs the full mask head once on the final query
+        self.last_layer_only_eval = last_layer_only_eval
 
     def forward(self, input_dict, pairwise_locs, mask_head=None):
             
@@ -72,18 +80,25 @@ class QueryMaskEncoder(nn.Module):
         
         query = input_dict['query'][0]
         voxel_feat = input_dict['voxel'][0] if 'voxel' in input_dict.keys() else None
+        last_layer_only = self.last_layer_only_eval and not self.training
 
         for block_counter in range(self.num_blocks):
             for i, layer in enumerate(self.unified_encoder):
-                if mask_head is not None:
+                attn_mask = None
+                if mask_head is not None and not last_layer_only:
                     output_score, output_class, outputs_mask, output_box, attn_mask = mask_head(query)
                     predictions_score.append(output_score)
                     predictions_class.append(output_class)
                     predictions_mask.append(outputs_mask)  
                     predictions_box.append(output_box)
+                elif mask_head is not None and self.use_self_mask:
+                    attn_mask = mask_head(query, attn_mask_only=True)
                 if self.use_self_mask:
-                    attn_mask[attn_mask.all(-1)] = False # prevent query to attend to no point
-                    attn_mask = attn_mask.repeat_interleave(self.num_heads, 0)
+                    assert attn_mask is not None, "use_self_mask requires a mask head that returns attention masks"
+                    if attn_mask.ndim == 3:
+                        # padded (B, Q, S) mask, ragged (S_total, Q) masks are shared by the heads and fixed per sample
+                        attn_mask[attn_mask.all(-1)] = False # prevent query to attend to no point
+                        attn_mask = attn_mask.repeat_interleave(self.num_heads, 0)
                     for memory in input_dict.keys():
                         if memory in ['query', 'prompt']:
                             continue
@@ -221,9 +236,10 @@ class Mask3DSegLevelQueryEncoder(nn.Module):
                 if 'voxel' in input_dict:
                     input_dict['voxel'][0] = voxel_feats_multi_scale[i]
                 
-                # update attn mask
-                attn_mask[attn_mask.all(-1)] = False # prevent query to attend to no point
-                attn_mask = attn_mask.repeat_interleave(self.num_heads, 0)
+                # update attn mask, ragged (S_total, Q) masks are shared by the heads
+                if attn_mask.ndim == 3:
+                    attn_mask[attn_mask.all(-1)] = False # prevent query to attend to no point
+                    attn_mask = attn_mask.repeat_interleave(self.num_heads, 0)
                 for memory in input_dict.keys():
                     if memory in ['query', 'prompt']:
                         continue
@@ -237,10 +253,11 @@ class Mask3DSegLevelQueryEncoder(nn.Module):
         return query, predictions_class, predictions_mask
 
 class QueryEncoderLayer(nn.Module):
-    def __init__(self, d_model, nhead, memories, dim_feedforward=2048, dropout=0.1, activation="relu", prenorm=False, spatial_selfattn=False, structure='mixed', memory_dropout=0, drop_memories_test=[]):
+    def __init__(self, d_model, nhead, memories, dim_feedforward=2048, dropout=0.1, activation="relu", prenorm=False, spatial_selfattn=False, structure='mixed', memory_dropout=0, drop_memories_test=[],
+                 spatial_chunk_size=None):
         super().__init__()
         if spatial_selfattn:
-            self.self_attn = SpatialSelfAttentionLayer(d_model, nhead, dropout=dropout, activation=activation, normalize_before=prenorm, batch_first=True)
+            self.self_attn = SpatialSelfAttentionLayer(d_model, nhead, dropout=dropout, activation=activation, normalize_before=prenorm, batch_first=True, chunk_size=spatial_chunk_size)
         else:
             self.self_attn = SelfAttentionLayer(d_model, nhead, dropout=dropout, activation=activation, normalize_before=prenorm, batch_first=True)
         cross_attn_layer = CrossAttentionLayer(d_model, nhead, dropout=dropout, activation=activation, normalize_before=prenorm, batch_first=True) 
@@ -260,14 +277,19 @@ class QueryEncoderLayer(nn.Module):
         def sequential_ca(query, memories):
             for memory in memories:
                 cross_attn = self.memory2ca[memory]
-                feat, mask, pos = input_dict[memory] 
-                if mask.ndim == 2:
+                feat, mask, pos = input_dict[memory][:3]
+                # ragged segment memories carry their cu_seqlens, the mask is a (S_total, Q) attention mask or None
+                cu_seqlens = input_dict[memory][3] if len(input_dict[memory]) > 3 else None
+                if cu_seqlens is not None:
+                    memory_key_padding_mask = None
+                    attn_mask = mask
+                elif mask.ndim == 2:
                     memory_key_padding_mask = mask
                     attn_mask = None
                 else:
                     memory_key_padding_mask = None
                     attn_mask = mask
-                query = cross_attn(tgt=query, memory=feat, attn_mask=attn_mask, memory_key_padding_mask = memory_key_padding_mask, query_pos = query_pos, pos = pos)
+                query = cross_attn(tgt=query, memory=feat, attn_mask=attn_mask, memory_key_padding_mask = memory_key_padding_mask, query_pos = query_pos, pos = pos, cu_seqlens = cu_seqlens)
             return query
 
         def parallel_ca(query, memories):
@@ -275,14 +297,19 @@ class QueryEncoderLayer(nn.Module):
             query_list = []
             for memory in memories:
                 cross_attn = self.memory2ca[memory]
-                feat, mask, pos = input_dict[memory] 
-                if mask.ndim == 2:
+                feat, mask, pos = input_dict[memory][:3]
+                # ragged segment memories carry their cu_seqlens, the mask is a (S_total, Q) attention mask or None
+                cu_seqlens = input_dict[memory][3] if len(input_dict[memory]) > 3 else None
+                if cu_seqlens is not None:
+                    memory_key_padding_mask = None
+                    attn_mask = mask
+                elif mask.ndim == 2:
                     memory_key_padding_mask = mask
                     attn_mask = None
                 else:
                     memory_key_padding_mask = None
                     attn_mask = mask
-                update = cross_attn(tgt=query, memory=feat, attn_mask=attn_mask, memory_key_padding_mask = memory_key_padding_mask, query_pos = query_pos, pos = pos)
+                update = cross_attn(tgt=query, memory=feat, attn_mask=attn_mask, memory_key_padding_mask = memory_key_padding_mask, query_pos = query_pos, pos = pos, cu_seqlens = cu_seqlens)
                 query_list.append(update)
             # training time memory dropout
             if self.training and self.memory_dropout > 0.0:
@@ -428,6 +455,18 @@ class CrossAttentionLayer(nn.Module):
     def with_pos_embed(self, tensor, pos):
         return tensor if pos is None else tensor + pos
 
+    def attend(self, query, key, value, attn_mask, memory_key_padding_mask, cu_seqlens):
+        if cu_seqlens is not None:
+            # ragged memory (S_total, D) with a (S_total, Q) attention mask, see modules/layers/ragged.py
+            return ragged_cross_attention(self.multihead_attn, query, key, value, cu_seqlens, attn_mask)
+        return self.multihead_attn(
+            query=query,
+            key=key,
+            value=value,
+            attn_mask=attn_mask,
+            key_padding_mask=memory_key_padding_mask,
+        )[0]
+
     def forward_post(
         self,
         tgt,
@@ -436,14 +475,10 @@ class CrossAttentionLayer(nn.Module):
         memory_key_padding_mask=None,
         pos=None,
         query_pos=None,
+        cu_seqlens=None,
     ):
-        tgt2 = self.multihead_attn(
-            query=self.with_pos_embed(tgt, query_pos),
-            key=self.with_pos_embed(memory, pos),
-            value=memory,
-            attn_mask=attn_mask,
-            key_padding_mask=memory_key_padding_mask,
-        )[0]
+        tgt2 = self.attend(self.with_pos_embed(tgt, query_pos), self.with_pos_embed(memory, pos), memory,
+                           attn_mask, memory_key_padding_mask, cu_seqlens)
         tgt = tgt + self.dropout(tgt2)
         tgt = self.norm(tgt)
 
@@ -457,16 +492,12 @@ class CrossAttentionLayer(nn.Module):
         memory_key_padding_mask=None,
         pos=None,
         query_pos=None,
+        cu_seqlens=None,
     ):
         tgt2 = self.norm(tgt)
 
-        tgt2 = self.multihead_attn(
-            query=self.with_pos_embed(tgt2, query_pos),
-            key=self.with_pos_embed(memory, pos),
-            value=memory,
-            attn_mask=attn_mask,
-            key_padding_mask=memory_key_padding_mask,
-        )[0]
+        tgt2 = self.attend(self.with_pos_embed(tgt2, query_pos), self.with_pos_embed(memory, pos), memory,
+                           attn_mask, memory_key_padding_mask, cu_seqlens)
         tgt = tgt + self.dropout(tgt2)
 
         return tgt
@@ -479,6 +510,7 @@ class CrossAttentionLayer(nn.Module):
         memory_key_padding_mask=None,
         pos=None,
         query_pos=None,
+        cu_seqlens=None,
     ):
         if self.normalize_before:
             return self.forward_pre(
@@ -488,9 +520,10 @@ class CrossAttentionLayer(nn.Module):
                 memory_key_padding_mask,
                 pos,
                 query_pos,
+                cu_seqlens,
             )
         return self.forward_post(
-            tgt, memory, attn_mask, memory_key_padding_mask, pos, query_pos
+            tgt, memory, attn_mask, memory_key_padding_mask, pos, query_pos, cu_seqlens
         )
 
 
@@ -551,7 +584,7 @@ class SpatialSelfAttentionLayer(nn.Module):
         activation="relu",
         normalize_before=False,
         batch_first=False,
-        spatial_multihead=True, spatial_dim=5, spatial_attn_fusion='mul'
+        spatial_multihead=True, spatial_dim=5, spatial_attn_fusion='mul', chunk_size=None
     ):
         super().__init__()
         self.self_attn = MultiHeadAttentionSpatial(
@@ -559,6 +592,7 @@ class SpatialSelfAttentionLayer(nn.Module):
             spatial_multihead=spatial_multihead,
             spatial_dim=spatial_dim,
             spatial_attn_fusion=spatial_attn_fusion,
+            chunk_size=chunk_size,
         )
 
         self.norm = nn.LayerNorm(d_model)
@@ -624,3 +658,4 @@ class SpatialSelfAttentionLayer(nn.Module):
             tgt, attn_mask, tgt_key_padding_mask, query_pos,
             pairwise_locs
         )
+
@@ -5,6 +5,7 @@ from MinkowskiEngine.MinkowskiPooling import MinkowskiAvgPooling
 
 from modules.build import HEADS_REGISTRY
 from modules.utils import get_mlp_head, layer_repeat
+from modules.layers.ragged import ragged_mask_logits, ragged_to_padded
 
 
 @HEADS_REGISTRY.register()
@@ -225,9 +226,14 @@ class MaskHeadSegLevelWithBox(nn.Module):
         mask_pred_layer = MaskPredictionLayer(hidden_size)
         self.mask_pred_list = layer_repeat(mask_pred_layer, len(memories_for_match))
 
-    def forward(self, query, query_locs, seg_fts_for_match, seg_masks, offline_attn_masks=None, skip_prediction=False):
+    def forward(self, query, query_locs, seg_fts_for_match, seg_masks, offline_attn_masks=None, skip_prediction=False, attn_mask_only=False):
+        # attn_mask_only: only return the attention mask, used by the query encoder in last layer only inference
+        if attn_mask_only:
+            if skip_prediction or offline_attn_masks is not None:
+                return offline_attn_masks
+            return self.predict_mask(query, seg_fts_for_match, seg_masks)[1]
         if skip_prediction:
-            return None, None, offline_attn_masks
+            return None, None, None, None, offline_attn_masks
         cls_logits = self.cls_head(query)
         cls_logits[..., self.filter_out_classes] = float("-inf")
         query_activation_logits = self.query_activation_head(query)
@@ -235,6 +241,16 @@ class MaskHeadSegLevelWithBox(nn.Module):
         box_size_prediction = torch.exp(box_prediction[:, :, 3:])
         box_prediction = torch.cat([box_prediction[:, :, :3] + query_locs[:, :, :3], box_size_prediction], dim=-1)
         
+        mask_logits, attn_mask = self.predict_mask(query, seg_fts_for_match, seg_masks)
+            
+        if offline_attn_masks is not None:
+            attn_mask = offline_attn_masks
+        return query_activation_logits, cls_logits, mask_logits, box_prediction, attn_mask
+
+    def predict_mask(self, query, seg_fts_for_match, seg_masks):
+        # returns (B, S, Q) mask logits and the attention mask, (B, Q, S) or (S_total, Q) for ragged segments
+        if len(seg_fts_for_match[0]) > 3:
+            return self.predict_mask_ragged(query, seg_fts_for_match)
         mask_logits_list = []
         pad_mask_list = []
         for seg_fts, mask_pred_layer in zip(seg_fts_for_match, self.mask_pred_list):
@@ -244,12 +260,15 @@ class MaskHeadSegLevelWithBox(nn.Module):
             pad_mask_list.append(mask[..., None].logical_not())
         mask_logits = sum(mask_logits_list) / (sum(pad_mask_list) + 1e-8)
         mask_logits[seg_masks] = -1e6
-            
-        if offline_attn_masks is not None:
-            attn_mask = offline_attn_masks
-        else:
-            attn_mask = mask_logits.sigmoid().permute(0, 2, 1).detach() < 0.5
-        return query_activation_logits, cls_logits, mask_logits, box_prediction, attn_mask
+        return mask_logits, mask_logits.sigmoid().permute(0, 2, 1).detach() < 0.5
+
+    def predict_mask_ragged(self, query, seg_fts_for_match):
+        # every memory covers the same segment rows (the model asserts equal paddings), so the mean over memories is
+        # the padded path's division by the valid count, padded only for the returned logits
+        cu_seqlens = seg_fts_for_match[0][3]
+        mask_logits = sum(ragged_mask_logits(mask_pred_layer.q_proj(query), mask_pred_layer.k_proj(seg_fts[0]), cu_seqlens)
+                          for seg_fts, mask_pred_layer in zip(seg_fts_for_match, self.mask_pred_list)) / len(seg_fts_for_match)
+        return ragged_to_padded(mask_logits, cu_seqlens, pad=-1e6), mask_logits.sigmoid().detach() < 0.5
 
 @HEADS_REGISTRY.register()
 class OpenVocabHead(nn.Module):
@@ -0,0 +1,85 @@
+import torch
+import torch.nn.functional as F
+from torch_scatter import scatter_mean
+
+'''
+Ragged (varlen) segments, the segments of all samples are concatenated along dim 0 and sample b owns rows
+cu_seqlens[b]:cu_seqlens[b + 1], as the cumulative sequence offsets of varlen attention kernels
+attention masks over segments are (S_total, Q), True as masked, and are shared by all heads
+'''
+
+
+def lengths_to_cu_seqlens(lengths):
+    cu_seqlens = torch.zeros(len(lengths) + 1, dtype=torch.long, device=lengths.device)
+    torch.cumsum(lengths, 0, out=cu_seqlens[1:])
+    return cu_seqlens
+
+
+def padded_to_ragged(padded, valid):
+    # valid: (B, S) True for real rows, real rows are a prefix of every sample
+    return padded[valid]
+
+
+def ragged_to_padded(flat, cu_seqlens, pad=0):
+    lengths = cu_seqlens[1:] - cu_seqlens[:-1]
+    max_len = int(lengths.max()) if len(lengths) else 0
+    padded = flat.new_full((len(lengths), max_len, *flat.shape[1:]), pad)
+    batch_ids = torch.repeat_interleave(torch.arange(len(lengths), device=flat.device), lengths)
+    rows = torch.arange(len(flat), device=flat.device) - cu_seqlens[batch_ids]
+    padded[batch_ids, rows] = flat
+    return padded
+
+
+def ragged_segment_pool(point_feats, point2segment, cu_seqlens):
+    # one scatter over the batch, point2segment are per sample segment ids
+    segment_ids = torch.cat([p2s + cu_seqlens[b] for b, p2s in enumerate(point2segment)])
+    return scatter_mean(torch.cat(point_feats), segment_ids, dim=0, dim_size=int(cu_seqlens[-1]))
+
+
+def ragged_cross_attention(attn, query, key, value, cu_seqlens, attn_mask=None):
+    ''' nn.MultiheadAttention (batch_first, same kdim / vdim) of padded queries over ragged keys
+    query: (B, Q, D), key / value: (S_total, D), attn_mask: (S_total, Q) True as masked or None
+    keys are projected once for the whole batch, every sample attends only to its own segments,
+    a query whose segments are all masked attends to all of them (as the padded path's attn_mask.all(-1) fix)
+    '''
+    assert attn.batch_first and attn._qkv_same_embed_dim
+    B, Q, D = query.shape
+    H = attn.num_heads
+    w_q, w_k, w_v = attn.in_proj_weight.chunk(3)
+    b_q, b_k, b_v = attn.in_proj_bias.chunk(3) if attn.in_proj_bias is not None else (None, None, None)
+    q = F.linear(query, w_q, b_q).view(B, Q, H, D // H).transpose(1, 2)
+    k = F.linear(key, w_k, b_k).view(-1, H, D // H)
+    v = F.linear(value, w_v, b_v).view(-1, H, D // H)
+    if attn.bias_k is not None:
+        bias_k, bias_v = attn.bias_k.view(1, H, D // H), attn.bias_v.view(1, H, D // H)
+    dropout_p = attn.dropout if attn.training else 0.0
+    out = []
+    for b in range(B):
+        start, end = int(cu_seqlens[b]), int(cu_seqlens[b + 1])
+        k_b, v_b = k[start:end], v[start:end]
+        allowed = None
+        if attn_mask is not None:
+            allowed = attn_mask[start:end].T.logical_not()
+            allowed[~allowed.any(-1)] = True
+        extra = []
+        if attn.bias_k is not None:
+            extra.append((bias_k, bias_v))
+        if attn.add_zero_attn:
+            extra.append((k.new_zeros(1, H, D // H), v.new_zeros(1, H, D // H)))
+        for extra_k, extra_v in extra:
+            k_b, v_b = torch.cat([k_b, extra_k]), torch.cat([v_b, extra_v])
+            if allowed is not None:
+                allowed = torch.cat([allowed, allowed.new_ones(Q, 1)], dim=1)
+        if len(k_b) == 0:
+            out.append(q.new_zeros(H, Q, D // H))
+            continue
+        out.append(F.scaled_dot_product_attention(q[b], k_b.transpose(0, 1), v_b.transpose(0, 1),
+                                                  attn_mask=allowed, dropout_p=dropout_p))
+    out = torch.stack(out).transpose(1, 2).reshape(B, Q, D)
+    return attn.out_proj(out)
+
+
+def ragged_mask_logits(query, key, cu_seqlens):
+    # (S_total, Q) segment x query logits, key_b @ query_b^T per sample instead of a padded (B, S, Q) einsum
+    return torch.cat([key[int(cu_seqlens[b]):int(cu_seqlens[b + 1])] @ query[b].T for b in range(len(query))], dim=0)
+
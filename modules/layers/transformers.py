@@ -7,7 +7,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor, nn
 
-from modules.utils import get_activation_fn
+from modules.utils import get_activation_fn, calc_pairwise_max_dists, calc_pairwise_locs_chunk
 
 
 class CrossAttentionLayer(nn.Module):
@@ -158,10 +158,13 @@ class TransformerEncoderLayer(nn.Module):
 class MultiHeadAttentionSpatial(nn.Module):
     def __init__(
             self, d_model, n_head, dropout=0.1, spatial_multihead=True, spatial_dim=5,
-            spatial_attn_fusion='mul',
+            spatial_attn_fusion='mul', chunk_size=None,
     ):
         super().__init__()
         assert d_model % n_head == 0, 'd_model: %d, n_head: %d' % (d_model, n_head)
+        # chunk_size: if set, pairwise_locs passed to forward are object centers (b, l, 3) and the
+        # pairwise features and attention are computed per query block ('center' pairwise_rel_type)
+        self.chunk_size = chunk_size
 
         self.n_head = n_head
         self.d_model = d_model
@@ -191,6 +194,24 @@ class MultiHeadAttentionSpatial(nn.Module):
         q = einops.rearrange(self.w_qs(q), 'b l (head k) -> head b l k', head=self.n_head)
         k = einops.rearrange(self.w_ks(k), 'b t (head k) -> head b t k', head=self.n_head)
         v = einops.rearrange(self.w_vs(v), 'b t (head v) -> head b t v', head=self.n_head)
+        if self.chunk_size is None:
+            output, fused_attn = self.attend(q, k, v, pairwise_locs, key_padding_mask, residual)
+        else:
+            # the full attention map is never built, no fused_attn is returned
+            obj_centers = pairwise_locs
+            max_dists = calc_pairwise_max_dists(obj_centers, chunk_size=self.chunk_size)
+            output = []
+            for start in range(0, q.size(2), self.chunk_size):
+                end = min(start + self.chunk_size, q.size(2))
+                block_locs = calc_pairwise_locs_chunk(obj_centers, start, end, max_dists, spatial_dim=self.spatial_dim)
+                output.append(self.attend(q[:, :, start:end], k, v, block_locs, key_padding_mask, residual[:, start:end])[0])
+            output = torch.cat(output, dim=2)
+            fused_attn = None
+        output = einops.rearrange(output, 'head b l v -> b l (head v)')
+        output = self.fc(output)
+        return output, fused_attn
+
+    def attend(self, q, k, v, pairwise_locs, key_padding_mask, residual):
         attn = torch.einsum('hblk,hbtk->hblt', q, k) / np.sqrt(q.shape[-1])
 
         if self.spatial_attn_fusion in ['mul', 'bias', 'add']:
@@ -235,8 +256,6 @@ class MultiHeadAttentionSpatial(nn.Module):
         assert torch.sum(torch.isnan(fused_attn) == 0), print(fused_attn)
 
         output = torch.einsum('hblt,hbtv->hblv', fused_attn, v)
-        output = einops.rearrange(output, 'head b l v -> b l (head v)')
-        output = self.fc(output)
         return output, fused_attn
 
 
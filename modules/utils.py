@@ -32,6 +32,15 @@ def layer_repeat(module, N, share_layer=False):
         return nn.ModuleList([copy.deepcopy(module) for _ in range(N - 1)] + [module])
 
 
+def profiler_peak_cpu_memory(prof):
+    # peak of allocated cpu memory from a torch.profiler run with profile_memory=True
+    current, peak = 0, 0
+    for evt in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += evt.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
 #########################################################
 # Specific modules helpers
 #########################################################
@@ -46,9 +55,7 @@ def calc_pairwise_locs(obj_centers, obj_whls, eps=1e-10, pairwise_rel_type='cent
         )
         return pairwise_locs
 
-    pairwise_locs = einops.repeat(obj_centers, 'b l d -> b l 1 d') \
-                    - einops.repeat(obj_centers, 'b l d -> b 1 l d')
-    pairwise_dists = torch.sqrt(torch.sum(pairwise_locs ** 2, 3) + eps)  # (b, l, l)
+    pairwise_locs, pairwise_dists = _pairwise_offsets(obj_centers, obj_centers, eps) # (b, l, l)
     if spatial_dist_norm:
         max_dists = torch.max(pairwise_dists.view(pairwise_dists.size(0), -1), dim=1)[0]
         norm_pairwise_dists = pairwise_dists / einops.repeat(max_dists, 'b -> b 1 1')
@@ -58,15 +65,10 @@ def calc_pairwise_locs(obj_centers, obj_whls, eps=1e-10, pairwise_rel_type='cent
     if spatial_dim == 1:
         return norm_pairwise_dists.unsqueeze(3)
 
-    pairwise_dists_2d = torch.sqrt(torch.sum(pairwise_locs[..., :2] ** 2, 3) + eps)
     if pairwise_rel_type == 'center':
-        pairwise_locs = torch.stack(
-            [norm_pairwise_dists, pairwise_locs[..., 2] / pairwise_dists,
-             pairwise_dists_2d / pairwise_dists, pairwise_locs[..., 1] / pairwise_dists_2d,
-             pairwise_locs[..., 0] / pairwise_dists_2d],
-            dim=3
-        )
-    elif pairwise_rel_type == 'vertical_bottom':
+        return _center_pairwise_locs(pairwise_locs, pairwise_dists, norm_pairwise_dists, eps, spatial_dim)
+    pairwise_dists_2d = torch.sqrt(torch.sum(pairwise_locs[..., :2] ** 2, 3) + eps)
+    if pairwise_rel_type == 'vertical_bottom':
         bottom_centers = torch.clone(obj_centers)
         bottom_centers[:, :, 2] -= obj_whls[:, :, 2]
         bottom_pairwise_locs = einops.repeat(bottom_centers, 'b l d -> b l 1 d') \
@@ -86,11 +88,50 @@ def calc_pairwise_locs(obj_centers, obj_whls, eps=1e-10, pairwise_rel_type='cent
         pairwise_locs = pairwise_locs[..., 1:]
     return pairwise_locs
 
+def _pairwise_offsets(row_centers, obj_centers, eps=1e-10):
+    # offsets and distances from every row center to every object center, (b, r, l, d) and (b, r, l)
+    pairwise_locs = einops.repeat(row_centers, 'b l d -> b l 1 d') \
+                    - einops.repeat(obj_centers, 'b l d -> b 1 l d')
+    pairwise_dists = torch.sqrt(torch.sum(pairwise_locs ** 2, 3) + eps)
+    return pairwise_locs, pairwise_dists
+
+def _center_pairwise_locs(pairwise_locs, pairwise_dists, norm_pairwise_dists, eps=1e-10, spatial_dim=5):
+    # pairwise_rel_type='center' features: normalized distance, vertical and horizontal angles
+    pairwise_dists_2d = torch.sqrt(torch.sum(pairwise_locs[..., :2] ** 2, 3) + eps)
+    pairwise_locs = torch.stack(
+        [norm_pairwise_dists, pairwise_locs[..., 2] / pairwise_dists,
+         pairwise_dists_2d / pairwise_dists, pairwise_locs[..., 1] / pairwise_dists_2d,
+         pairwise_locs[..., 0] / pairwise_dists_2d],
+        dim=3
+    )
+    if spatial_dim == 4:
+        pairwise_locs = pairwise_locs[..., 1:]
+    return pairwise_locs
+
+def calc_pairwise_max_dists(obj_centers, eps=1e-10, chunk_size=256):
+    # per batch max pairwise distance, computed by row blocks without the (b, l, l) distance map
+    max_dists = []
+    for start in range(0, obj_centers.size(1), chunk_size):
+        _, pairwise_dists = _pairwise_offsets(obj_centers[:, start:start + chunk_size], obj_centers, eps)
+        max_dists.append(torch.max(pairwise_dists.view(pairwise_dists.size(0), -1), dim=1)[0])
+    return torch.stack(max_dists, 1).max(1)[0]
+
+def calc_pairwise_locs_chunk(obj_centers, start, end, max_dists=None, eps=1e-10, spatial_dim=5):
+    # rows [start, end) of calc_pairwise_locs with pairwise_rel_type='center', (b, end - start, l, spatial_dim)
+    # max_dists from calc_pairwise_max_dists, None for no distance normalization
+    pairwise_locs, pairwise_dists = _pairwise_offsets(obj_centers[:, start:end], obj_centers, eps)
+    if max_dists is not None:
+        norm_pairwise_dists = pairwise_dists / einops.repeat(max_dists, 'b -> b 1 1')
+    else:
+        norm_pairwise_dists = pairwise_dists
+
+    if spatial_dim == 1:
+        return norm_pairwise_dists.unsqueeze(3)
+    return _center_pairwise_locs(pairwise_locs, pairwise_dists, norm_pairwise_dists, eps, spatial_dim)
+
 def calc_pairwise_locs_mv(obj_centers, pairwise_rel_type='center', spatial_dist_norm=True, spatial_dim=5):
     eps=1e-10
-    pairwise_locs = einops.repeat(obj_centers, 'b l d -> b l 1 d') \
-                    - einops.repeat(obj_centers, 'b l d -> b 1 l d')
-    pairwise_dists = torch.sqrt(torch.sum(pairwise_locs ** 2, 3) + eps)  # (b, l, l)
+    pairwise_locs, pairwise_dists = _pairwise_offsets(obj_centers, obj_centers, eps) # (b, l, l)
     if spatial_dist_norm:
         max_dists = torch.max(pairwise_dists.view(pairwise_dists.size(0), -1), dim=1)[0]
         norm_pairwise_dists = pairwise_dists / einops.repeat(max_dists, 'b -> b 1 1')
@@ -100,14 +141,8 @@ def calc_pairwise_locs_mv(obj_centers, pairwise_rel_type='center', spatial_dist_
     if spatial_dim == 1:
         return norm_pairwise_dists.unsqueeze(3)
 
-    pairwise_dists_2d = torch.sqrt(torch.sum(pairwise_locs[..., :2] ** 2, 3) + eps)
     if pairwise_rel_type == 'center':
-        pairwise_locs = torch.stack(
-            [norm_pairwise_dists, pairwise_locs[..., 2] / pairwise_dists,
-             pairwise_dists_2d / pairwise_dists, pairwise_locs[..., 1] / pairwise_dists_2d,
-             pairwise_locs[..., 0] / pairwise_dists_2d],
-            dim=3
-        )
+        return _center_pairwise_locs(pairwise_locs, pairwise_dists, norm_pairwise_dists, eps, spatial_dim)
 
     if spatial_dim == 4:
         pairwise_locs = pairwise_locs[..., 1:]
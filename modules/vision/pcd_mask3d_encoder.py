@@ -15,6 +15,7 @@ from modules.third_party.mask3d.helpers_3detr import GenericMLP
 from modules.third_party.mask3d.position_embedding import PositionEmbeddingCoordsSine
 
 from modules.build import VISION_REGISTRY
+from modules.layers.ragged import ragged_segment_pool
 
 @VISION_REGISTRY.register()
 class PCDMask3DEncoder(nn.Module):
@@ -135,7 +136,8 @@ class PCDMask3DSegLevelEncoder(nn.Module):
             feat = self.pooltr(feat)
         return feat
             
-    def forward(self, x, point2segment, max_seg):
+    def forward(self, x, point2segment, max_seg, cu_seqlens=None):
+        # cu_seqlens: pool into ragged (S_total, D) segment features instead of (B, max_seg, D), see modules/layers/ragged.py
         with self.context():
             # minkowski backbone
             pcds_features, aux = self.backbone(x)
@@ -145,8 +147,11 @@ class PCDMask3DSegLevelEncoder(nn.Module):
             feat = aux[hlevel]
             feat = self.upsampling(feat, hlevel)
             assert feat.shape[0] == pcds_features.shape[0]
-            batch_feat = [self.scatter_fn(f, p2s, dim=0, dim_size=max_seg) for f, p2s in zip(feat.decomposed_features, point2segment)]
-            batch_feat = torch.stack(batch_feat)
+            if cu_seqlens is not None:
+                batch_feat = ragged_segment_pool(feat.decomposed_features, point2segment, cu_seqlens)
+            else:
+                batch_feat = [self.scatter_fn(f, p2s, dim=0, dim_size=max_seg) for f, p2s in zip(feat.decomposed_features, point2segment)]
+                batch_feat = torch.stack(batch_feat)
             batch_feat = feat_proj(batch_feat)
             multi_scale_seg_feats.append(batch_feat)
         
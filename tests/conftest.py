@@ -0,0 +1,131 @@
+import os
+import sys
+
+import pytest
+
+# tests import the repo packages the same way run.py does, from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def tiny_instseg_cfg(memories=('voxel', 'mv'), hidden_size=32, mv_feat_size=16, **model_options):
+    ''' EmbodiedPQ3DInstSegModel config of configs/embodied-pq3d-final/embodied_scan_instseg.yaml with small sizes
+    '''
+    from omegaconf import OmegaConf
+    memories = list(memories)
+    model = {
+        'name': 'EmbodiedPQ3DInstSegModel',
+        'memories': memories,
+        'hidden_size': hidden_size,
+        'obj_loc': {'spatial_dim': 5, 'dim_loc': 3, 'pairwise_rel_type': 'center'},
+        'voxel_encoder': {
+            'name': 'PCDMask3DSegLevelEncoder',
+            'args': {
+                'backbone_kwargs': {
+                    'config': {'dialations': [1, 1, 1, 1], 'conv1_kernel_size': 5, 'bn_momentum': 0.02},
+                    'in_channels': 3, 'out_channels': 20, 'out_fpn': True,
+                },
+                'hlevels': [0, 1, 2, 3], 'hidden_size': hidden_size, 'dropout': 0.0,
+            },
+        },
+        'mv_encoder': {
+            'name': 'ObjectEncoder',
+            'args': {'input_feat_size': mv_feat_size, 'hidden_size': hidden_size, 'use_projection': True, 'use_cls_head': False, 'dropout': 0.0},
+        },
+        'unified_encoder': {
+            'name': 'QueryMaskEncoder',
+            'args': {'hidden_size': hidden_size, 'num_attention_heads': 4, 'num_layers': 2, 'spatial_selfattn': True,
+                     'memories': memories, 'structure': 'parallel', 'use_self_mask': True, 'num_blocks': 1},
+        },
+        'heads': ['mask'],
+        'mask_head': {
+            'name': 'MaskHeadSegLevelWithBox',
+            'args': {'hidden_size': hidden_size, 'num_targets': 11, 'memories_for_match': memories, 'filter_out_classes': []},
+        },
+    }
+    model.update(model_options)
+    return OmegaConf.create({'model': model})
+
+
+def build_tiny_instseg_model(seed=0, **cfg_options):
+    import torch
+    import modules  # noqa: F401, fills the module registries
+    from model.embodied_pq3d_instseg import EmbodiedPQ3DInstSegModel
+    torch.manual_seed(seed)
+    return EmbodiedPQ3DInstSegModel(tiny_instseg_cfg(**cfg_options)).eval()
+
+
+def synthetic_instseg_batch(num_segments=(12, 7), num_queries=5, points_per_segment=8, mv_feat_size=16, seed=0, device='cpu'):
+    ''' Collated stage-1 batch of random scans, segments are padded to the longest scan like the collate functions do
+    '''
+    import torch
+    from torch_scatter import scatter_mean
+    g = torch.Generator().manual_seed(seed)
+    batch_size, max_seg = len(num_segments), max(num_segments)
+    data_dict = {
+        'voxel_coordinates': [], 'voxel_features': [], 'voxel2segment': [], 'coordinates': [],
+        'seg_center': torch.zeros(batch_size, max_seg, 3),
+        'seg_pad_masks': torch.zeros(batch_size, max_seg, dtype=torch.bool),
+        'mv_seg_fts': torch.zeros(batch_size, max_seg, mv_feat_size),
+        'query_locs': torch.zeros(batch_size, num_queries, 3),
+        'query_pad_masks': torch.ones(batch_size, num_queries, dtype=torch.bool),
+        'query_selection_ids': [],
+    }
+    for bid, n in enumerate(num_segments):
+        assert n >= num_queries
+        # distinct voxels of a 16^3 grid so that sparse tensors keep every voxel
+        num_voxels = n * points_per_segment
+        cells = torch.randperm(16 ** 3, generator=g)[:num_voxels]
+        voxel_coordinates = torch.stack([cells // 256, cells // 16 % 16, cells % 16], dim=1)
+        coordinates = voxel_coordinates.float() * 0.02
+        voxel2segment = torch.arange(n).repeat_interleave(points_per_segment)[torch.randperm(num_voxels, generator=g)]
+        color = torch.rand(num_voxels, 3, generator=g)
+        data_dict['voxel_coordinates'].append(torch.cat([torch.full((num_voxels, 1), bid), voxel_coordinates], dim=1).int())
+        data_dict['voxel_features'].append(torch.cat([color, coordinates], dim=1))
+        data_dict['voxel2segment'].append(voxel2segment)
+        data_dict['coordinates'].append(coordinates)
+        data_dict['seg_center'][bid, :n] = scatter_mean(coordinates, voxel2segment, dim=0)
+        data_dict['seg_pad_masks'][bid, :n] = True
+        data_dict['mv_seg_fts'][bid, :n] = torch.randn(n, mv_feat_size, generator=g)
+        query_selection_ids = torch.randperm(n, generator=g)[:num_queries]
+        data_dict['query_selection_ids'].append(query_selection_ids)
+        data_dict['query_locs'][bid] = data_dict['seg_center'][bid, query_selection_ids]
+    data_dict['voxel_coordinates'] = torch.cat(data_dict['voxel_coordinates'])
+    data_dict['voxel_features'] = torch.cat(data_dict['voxel_features'])
+    data_dict['mv_seg_pad_masks'] = data_dict['seg_pad_masks'].clone()
+    data_dict['coord_min'] = torch.stack([c.min(0)[0] for c in data_dict['coordinates']])
+    data_dict['coord_max'] = torch.stack([c.max(0)[0] for c in data_dict['coordinates']])
+    return move_to(data_dict, device)
+
+
+def move_to(data, device):
+    import torch
+    if isinstance(data, torch.Tensor):
+        return data.to(device)
+    if isinstance(data, dict):
+        return {k: move_to(v, device) for k, v in data.items()}
+    if isinstance(data, list):
+        return [move_to(v, device) for v in data]
+    return data
+
+
+@pytest.fixture
+def instseg_model():
+    pytest.importorskip('torch')
+    pytest.importorskip('torch_scatter')
+    pytest.importorskip('MinkowskiEngine')
+    return build_tiny_instseg_model
+
+
+@pytest.fixture
+def instseg_batch():
+    pytest.importorskip('torch')
+    pytest.importorskip('torch_scatter')
+    return synthetic_instseg_batch
+
+
+@pytest.fixture(params=['cpu', 'cuda'])
+def device(request):
+    torch = pytest.importorskip('torch')
+    if request.param == 'cuda' and not torch.cuda.is_available():
+        pytest.skip('CUDA is not available')
+    return request.param
@@ -0,0 +1,71 @@
+import os
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+pytest.importorskip('torch_scatter')
+
+from data.datasets.batch_augmentor import BatchPointAugmentor
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs/instseg/augmentation/volumentations_aug.yaml')
+NUM_SAMPLES = 400
+NUM_POINTS = 512
+
+
+def room_points(seed=0):
+    return (np.random.default_rng(seed).random((NUM_POINTS, 3)) * [6, 4, 2.5]).astype(np.float32)
+
+
+def sample_statistics(samples):
+    # per sample centroid, spread and extent, (num_samples, 9)
+    return np.stack([np.concatenate([s.mean(0), s.std(0), s.max(0) - s.min(0)]) for s in samples])
+
+
+def assert_same_distribution(stats_a, stats_b):
+    # means within 4 standard errors, spreads within 20 %
+    se = np.sqrt(stats_a.var(0) / len(stats_a) + stats_b.var(0) / len(stats_b))
+    assert (np.abs(stats_a.mean(0) - stats_b.mean(0)) <= 4 * se + 1e-6).all()
+    np.testing.assert_allclose(stats_a.std(0), stats_b.std(0), rtol=0.2, atol=1e-3)
+
+
+def batched_samples(augmentor, points, seed):
+    generator = torch.Generator().manual_seed(seed)
+    batch_ids = torch.arange(NUM_SAMPLES).repeat_interleave(len(points))
+    out = augmentor(torch.from_numpy(points).repeat(NUM_SAMPLES, 1), batch_ids, NUM_SAMPLES, generator)
+    return list(out.numpy().reshape(NUM_SAMPLES, len(points), 3))
+
+
+def test_per_sample_calls_match_one_batched_call():
+    # get_scene calls the augmentor once per sample
+    augmentor = BatchPointAugmentor.from_volumentations(CONFIG)
+    points = room_points()
+    generator = torch.Generator().manual_seed(1)
+    per_sample = [augmentor(torch.from_numpy(points), generator=generator).numpy() for _ in range(NUM_SAMPLES)]
+    assert_same_distribution(sample_statistics(per_sample), sample_statistics(batched_samples(augmentor, points, seed=2)))
+
+
+def test_matches_volumentations_statistics():
+    V = pytest.importorskip('volumentations')
+    from pathlib import Path
+    points = room_points()
+    random.seed(0)
+    np.random.seed(0)
+    volume_augmentations = V.load(Path(CONFIG), data_format="yaml")
+    reference = []
+    for _ in range(NUM_SAMPLES):
+        # flip and volumentations chain of EmbodiedScanInstseg.get_scene without batch_augmentation
+        flip = np.array([random.random() < 0.5 for i in (0, 1)] + [False])
+        coordinates = np.where(flip, points.max(0) + points.min(0) - points, points)
+        reference.append(volume_augmentations(points=coordinates, normals=None, features=None, labels=None)['points'])
+    augmentor = BatchPointAugmentor.from_volumentations(CONFIG)
+    assert_same_distribution(sample_statistics(reference), sample_statistics(batched_samples(augmentor, points, seed=0)))
+
+
+def test_identity_without_transforms():
+    augmentor = BatchPointAugmentor(flip_axes=())
+    points = torch.from_numpy(room_points())
+    out = augmentor(points)
+    assert out.dtype == points.dtype
+    assert torch.equal(out, points)
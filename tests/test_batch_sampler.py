@@ -0,0 +1,80 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+
+from data.batch_sampler import BudgetBatchSampler
+
+
+def sample_sizes(num_samples=500, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.stack([rng.integers(100, 5000, num_samples), rng.integers(10, 300, num_samples)], axis=1)
+
+
+def rank_samplers(sizes, num_replicas, **kwargs):
+    return [BudgetBatchSampler(sizes, [20000, None], num_replicas=num_replicas, rank=rank, bucket_size=100, seed=3, **kwargs)
+            for rank in range(num_replicas)]
+
+
+def test_len_is_stable_during_the_epoch():
+    sampler = rank_samplers(sample_sizes(), 2)[0]
+    sampler.set_epoch(1)
+    length = len(sampler)
+    iterator = iter(sampler)
+    next(iterator)
+    assert len(sampler) == length and sampler.epoch == 1
+    assert len(list(iterator)) == length - 1
+
+
+def test_epoch_only_changes_with_set_epoch():
+    sampler = rank_samplers(sample_sizes(), 1)[0]
+    first, again = list(sampler), list(sampler)
+    assert first == again
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+    assert sorted(i for batch in list(sampler) for i in batch) == list(range(len(sampler.sizes)))
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_ranks_get_equal_steps(drop_last):
+    sizes = sample_sizes()
+    samplers = rank_samplers(sizes, 3, drop_last=drop_last)
+    for epoch in range(3):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        lengths = [len(list(sampler)) for sampler in samplers]
+        assert len(set(lengths)) == 1 and lengths[0] == len(samplers[0])
+        for batch in samplers[0].all_batches():
+            assert len(batch) * sizes[batch, 0].max() <= 20000 or len(batch) == 1
+
+
+def test_drop_last_drops_random_batches():
+    # with the cost order cut the dropped remainder would always be the most expensive batches
+    sizes = sample_sizes()
+    single, dropped = rank_samplers(sizes, 1)[0], rank_samplers(sizes, 7, drop_last=True)[0]
+    cheaper_dropped = []
+    for epoch in range(10):
+        single.set_epoch(epoch)
+        dropped.set_epoch(epoch)
+        batches = single.all_batches()
+        if len(batches) % 7 == 0:
+            continue
+        kept = {tuple(batch) for batch in dropped.all_batches()}
+        assert len(kept) == len(batches) // 7 * 7
+        costs = {tuple(batch): len(batch) * sizes[batch, 0].max() for batch in batches}
+        dropped_costs = [cost for batch, cost in costs.items() if batch not in kept]
+        cheaper_dropped.append(min(dropped_costs) < max(costs[batch] for batch in kept))
+    assert len(cheaper_dropped) > 0 and any(cheaper_dropped)
+
+
+@pytest.mark.parametrize('num_samples', [1, 2, 5])
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_fewer_batches_than_ranks(num_samples, drop_last):
+    # every rank still gets one step, batches are repeated cyclically instead of leaving ranks without batches
+    sizes = sample_sizes(num_samples)
+    samplers = rank_samplers(sizes, 8, drop_last=drop_last)
+    assert len(samplers[0].all_batches()) == 8
+    rank_batches = [list(sampler) for sampler in samplers]
+    assert all(len(batches) == 1 for batches in rank_batches)
+    assert sorted(set(i for batches in rank_batches for batch in batches for i in batch)) == list(range(num_samples))
+
@@ -0,0 +1,94 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from data.collator import SchemaCollator
+from data.data_utils import pad_sequence
+
+SCHEMA = {
+    'voxel_coordinates': 'sparse_coords', 'voxel_features': 'concat',
+    'voxel2segment': 'list', 'scan_id': 'list',
+    'coord_min': 'stack',
+    'seg_center': 'pad', 'seg_pad_masks': 'pad', 'instance_labels': 'pad',
+}
+PAD_VALUES = {'instance_labels': -100}
+
+
+def synthetic_samples(batch_size=3, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    samples = []
+    for b in range(batch_size):
+        num_voxels, num_segments = 20 + 7 * b, 5 + 3 * (b % 2)
+        samples.append({
+            'voxel_coordinates': torch.randint(0, 50, (num_voxels, 3), generator=g, dtype=torch.int32),
+            'voxel_features': torch.rand(num_voxels, 6, generator=g),
+            'voxel2segment': torch.randint(0, num_segments, (num_voxels,), generator=g),
+            'scan_id': f'scene{b:04d}_00',
+            'coord_min': torch.rand(3, generator=g),
+            # numpy fields are collated as tensors
+            'seg_center': torch.rand(num_segments, 3, generator=g).numpy(),
+            'seg_pad_masks': torch.ones(num_segments, dtype=torch.bool),
+            'instance_labels': torch.randint(0, 200, (num_segments - 2,), generator=g),
+            'last_frame': b == batch_size - 1,
+        })
+    return samples
+
+
+def clone_samples(samples):
+    return [{k: v.clone() if isinstance(v, torch.Tensor) else v.copy() if isinstance(v, np.ndarray) else v for k, v in sample.items()} for sample in samples]
+
+
+def test_fields_are_collated_by_kind():
+    samples = synthetic_samples()
+    expected = clone_samples(samples)
+    batch = SchemaCollator(SCHEMA, PAD_VALUES, pin_memory=False)(samples)
+    assert set(batch.keys()) == set(SCHEMA) | {'last_frame'}
+    coords = torch.cat([torch.cat([torch.full((len(s['voxel_coordinates']), 1), b, dtype=torch.int32), s['voxel_coordinates']], dim=1)
+                        for b, s in enumerate(expected)])
+    assert batch['voxel_coordinates'].dtype == torch.int32 and torch.equal(batch['voxel_coordinates'], coords)
+    assert torch.equal(batch['voxel_features'], torch.cat([s['voxel_features'] for s in expected]))
+    assert all(torch.equal(a, s['voxel2segment']) for a, s in zip(batch['voxel2segment'], expected))
+    assert batch['scan_id'] == [s['scan_id'] for s in expected]
+    assert torch.equal(batch['coord_min'], torch.stack([s['coord_min'] for s in expected]))
+    assert torch.equal(batch['seg_center'], pad_sequence([torch.from_numpy(s['seg_center']) for s in expected]))
+    assert torch.equal(batch['seg_pad_masks'], pad_sequence([s['seg_pad_masks'] for s in expected]))
+    assert torch.equal(batch['instance_labels'], pad_sequence([s['instance_labels'] for s in expected], pad=-100))
+    assert torch.equal(batch['last_frame'], torch.tensor([False, False, True]))
+
+
+def test_ragged_offsets():
+    samples = synthetic_samples()
+    expected = clone_samples(samples)
+    batch = SchemaCollator(SCHEMA, PAD_VALUES, pin_memory=False, ragged_offsets=True)(samples)
+    assert set(batch['ragged_offsets']) == {k for k, kind in SCHEMA.items() if kind in ['sparse_coords', 'concat', 'pad']}
+    for key, offsets in batch['ragged_offsets'].items():
+        lengths = torch.tensor([len(s[key]) for s in expected])
+        assert torch.equal(offsets, torch.cat([torch.zeros(1, dtype=torch.long), lengths.cumsum(0)])), key
+    # the concatenated rows of sample b are offsets[b]:offsets[b + 1]
+    offsets = batch['ragged_offsets']['voxel_features']
+    for b, sample in enumerate(expected):
+        assert torch.equal(batch['voxel_features'][offsets[b]:offsets[b + 1]], sample['voxel_features'])
+
+
+def test_matches_the_per_field_loop():
+    pytest.importorskip('MinkowskiEngine')
+    from benchmarks.collator import reference_collate
+    samples = synthetic_samples(seed=1)
+    for sample in samples:
+        sample['seg_center'] = torch.from_numpy(sample['seg_center'])
+    expected = reference_collate(SCHEMA, PAD_VALUES)(clone_samples(samples))
+    batch = SchemaCollator(SCHEMA, PAD_VALUES, pin_memory=False)(samples)
+    assert batch.keys() == expected.keys()
+    for key, value in expected.items():
+        if isinstance(value, torch.Tensor):
+            assert batch[key].dtype == value.dtype and torch.equal(batch[key], value), key
+        elif key != 'voxel2segment':
+            assert batch[key] == value, key
+
+
+def test_recurrent_wrapper_keeps_its_list_keys():
+    wrapper = pytest.importorskip('data.datasets.embodied_instseg_wrapper')
+    list_keys = {k for k, kind in wrapper.EMBODIED_RECURRENT_INSTSEG_COLLATE_SCHEMA.items() if kind == 'list'}
+    assert list_keys == {'voxel2segment', 'coordinates', 'voxel_to_full_maps', 'segment_to_full_maps', 'raw_coordinates', 'instance_ids', 'instance_labels',
+                         'instance_boxes', 'instance_ids_ori', 'full_masks', 'segment_masks', 'scan_id', 'segment_labels', 'query_selection_ids'}
@@ -0,0 +1,95 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+np = pytest.importorskip('numpy')
+embodied_vle = pytest.importorskip('data.datasets.embodied_vle')
+
+SCAN_IDS = ['00800-TEEsavR23oF', '00801-HaxA7YrQdEC']
+
+
+def decision_record(scan_id, time_step):
+    return {'scan_id': scan_id, 'episode_id': 'ep0', 'sub_episode_id': 0, 'time_step': time_step, 'sentence': 'find the chair',
+            'is_object_decision': True, 'object_list': [1, 2, 3], 'tgt_object_id_list': [2], 'frontier_list': [[0.0, 1.0, 2.0]]}
+
+
+def stub_ovon_dataset(tmp_path, vle_dir='vle'):
+    # the attributes load_decision_data reads, _load_lang counts its calls instead of parsing the jsons
+    dataset = embodied_vle.EmbodiedVLEOvon.__new__(embodied_vle.EmbodiedVLEOvon)
+    dataset.split = 'train'
+    dataset.scan_ids = SCAN_IDS
+    dataset.embodied_vle_dir = str(tmp_path / vle_dir)
+    dataset.embodided_feat_dir = str(tmp_path / 'feat')
+    dataset.load_scan_options = {'decision_store_dir': str(tmp_path / 'store')}
+    dataset.random_drop_ratio = 0
+    dataset.calls = 0
+
+    def load_lang():
+        dataset.calls += 1
+        return [decision_record(scan_id, t) for scan_id in SCAN_IDS for t in range(3)]
+    dataset._load_lang = load_lang
+    return dataset
+
+
+@pytest.fixture
+def decision_jsons(tmp_path):
+    paths = []
+    for vle_dir in ['vle', 'vle_new']:
+        os.makedirs(tmp_path / vle_dir / 'ovon' / 'train')
+        for scan_id in SCAN_IDS:
+            path = tmp_path / vle_dir / 'ovon' / 'train' / f'{scan_id}.json'
+            path.write_text('{}')
+            paths.append(path)
+    return paths
+
+
+def test_store_is_reused_for_unchanged_sources(tmp_path, decision_jsons):
+    records = stub_ovon_dataset(tmp_path).load_decision_data()
+    dataset = stub_ovon_dataset(tmp_path)
+    reloaded = dataset.load_decision_data()
+    assert dataset.calls == 0
+    assert len(reloaded) == len(records) == 6
+    assert reloaded[4]['scan_id'] == SCAN_IDS[1] and reloaded[4]['time_step'] == 1
+
+
+def test_changed_decision_json_recompiles(tmp_path, decision_jsons):
+    stub_ovon_dataset(tmp_path).load_decision_data()
+    path = decision_jsons[0]
+    os.utime(path, (os.stat(path).st_atime, os.stat(path).st_mtime + 10))
+    dataset = stub_ovon_dataset(tmp_path)
+    dataset.load_decision_data()
+    assert dataset.calls == 1
+    # same mtime, different size
+    mtime = os.stat(path).st_mtime
+    path.write_text('{"ep0": []}')
+    os.utime(path, (os.stat(path).st_atime, mtime))
+    dataset = stub_ovon_dataset(tmp_path)
+    dataset.load_decision_data()
+    assert dataset.calls == 1
+
+
+def test_other_decision_dir_recompiles(tmp_path, decision_jsons):
+    stub_ovon_dataset(tmp_path).load_decision_data()
+    dataset = stub_ovon_dataset(tmp_path, vle_dir='vle_new')
+    dataset.load_decision_data()
+    assert dataset.calls == 1
+
+
+def test_concurrent_compiles_publish_one_complete_store(tmp_path, decision_jsons):
+    # all ranks miss the store for the same key and compile it at the same time
+    barrier = threading.Barrier(4)
+
+    def load(_):
+        dataset = stub_ovon_dataset(tmp_path)
+        barrier.wait()
+        records = dataset.load_decision_data()
+        return dataset.calls, [records[i]['time_step'] for i in range(len(records))]
+
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(load, range(4)))
+    assert all(time_steps == [0, 1, 2] * 2 for _, time_steps in results)
+    store = os.listdir(tmp_path / 'store')
+    assert len(store) == 1 and store[0].endswith('.pack')
+    assert embodied_vle.DecisionRecords(str(tmp_path / 'store' / store[0]))[5]['time_step'] == 2
@@ -0,0 +1,127 @@
+import glob
+import os
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from data.derived_cache import DerivedCache
+
+SCAN_ID = 'scene0000_00'
+
+
+def derived_labels():
+    return {0: {'sem_labels': np.arange(5), 'inst_info': {'instance_ids': torch.arange(3), 'instance_text_labels': ['chair', 'table']}}}
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source.bin'
+    np.arange(10).tofile(path)
+    return str(path)
+
+
+class CountingCompute:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return derived_labels()
+
+
+def test_hit_returns_the_saved_artifacts(tmp_path, source):
+    compute_fn = CountingCompute()
+    cache = DerivedCache(str(tmp_path / 'cache'), 'test', {'ignore_label': -100})
+    first = cache.get_or_compute(SCAN_ID, [source], compute_fn)
+    second = cache.get_or_compute(SCAN_ID, [source], compute_fn)
+    assert compute_fn.calls == 1 and (cache.hits, cache.misses) == (1, 1)
+    assert list(second.keys()) == [0]
+    assert np.array_equal(first[0]['sem_labels'], second[0]['sem_labels'])
+    assert torch.equal(first[0]['inst_info']['instance_ids'], second[0]['inst_info']['instance_ids'])
+    assert second[0]['inst_info']['instance_text_labels'] == ['chair', 'table']
+
+
+def test_config_change_misses(tmp_path, source):
+    compute_fn = CountingCompute()
+    DerivedCache(str(tmp_path / 'cache'), 'test', {'ignore_label': -100}).get_or_compute(SCAN_ID, [source], compute_fn)
+    DerivedCache(str(tmp_path / 'cache'), 'test', {'ignore_label': -1}).get_or_compute(SCAN_ID, [source], compute_fn)
+    assert compute_fn.calls == 2
+
+
+def test_newer_source_misses_and_replaces_the_entry(tmp_path, source):
+    compute_fn = CountingCompute()
+    cache = DerivedCache(str(tmp_path / 'cache'), 'test', {'ignore_label': -100})
+    cache.get_or_compute(SCAN_ID, [source], compute_fn)
+    os.utime(source, (os.stat(source).st_atime, os.stat(source).st_mtime + 10))
+    cache.get_or_compute(SCAN_ID, [source], compute_fn)
+    assert compute_fn.calls == 2
+    assert len(glob.glob(os.path.join(cache.cache_dir, f'{SCAN_ID}.*.pack'))) == 1
+
+
+def test_label_mapping_is_part_of_the_key():
+    embodied_scan = pytest.importorskip('data.datasets.embodied_scan')
+    from data.datasets.hm3d_label_convert import convert_gpt4
+
+    def stub_dataset(raw_name_to_scannet_raw_id, hm3d_raw_to_scannet607=convert_gpt4):
+        dataset = embodied_scan.EmbodiedScanInstseg.__new__(embodied_scan.EmbodiedScanInstseg)
+        dataset.cat2int = {'chair': 0, 'table': 1}
+        dataset.label_converter = types.SimpleNamespace(raw_name_to_scannet_raw_id=raw_name_to_scannet_raw_id,
+                                                        scannet_raw_id_to_scannet200_id={2: 0, 5: 1})
+        dataset.hm3d_raw_to_scannet607 = hm3d_raw_to_scannet607
+        dataset.hm3d_raw_to_cat = {'armchair': 'chair'}
+        return dataset
+
+    reference = stub_dataset({'chair': 2, 'table': 5}).label_mapping_hash()
+    assert stub_dataset({'chair': 2, 'table': 5}).label_mapping_hash() == reference
+    # an edited labels tsv or gpt4 category map keys a different cache directory
+    assert stub_dataset({'chair': 2, 'table': 7}).label_mapping_hash() != reference
+    assert stub_dataset({'chair': 2, 'table': 5}, dict(convert_gpt4, armchair='sofa')).label_mapping_hash() != reference
+
+
+def test_hits_hold_no_file_or_mapping(tmp_path, source):
+    from data.scan_store import open_fd_count
+    cache = DerivedCache(str(tmp_path / 'cache'), 'test', {'ignore_label': -100})
+    cache.save(SCAN_ID, [source], derived_labels())
+    fds = open_fd_count()
+    loaded = [cache.load(SCAN_ID, [source]) for _ in range(20)]
+    assert open_fd_count() == fds
+    assert all(isinstance(obj[0]['sem_labels'], np.ndarray) and not isinstance(obj[0]['sem_labels'], np.memmap) for obj in loaded)
+
+
+def large_labels():
+    # large enough that concurrent writes of the same entry overlap
+    return {0: {'sem_labels': np.arange(2 ** 20), 'inst_info': {'instance_ids': torch.arange(2 ** 18)}}}
+
+
+def save_worker(rank, cache_dir, source, repeats):
+    # a rank without rank_shard missing the cache for the same scan as all other ranks
+    cache = DerivedCache(cache_dir, 'test', {'ignore_label': -100})
+    for _ in range(repeats):
+        cache.save(SCAN_ID, [source], large_labels())
+        assert cache.load(SCAN_ID, [source]) is not None
+
+
+def assert_single_complete_entry(cache, source):
+    loaded = cache.load(SCAN_ID, [source])
+    assert np.array_equal(loaded[0]['sem_labels'], large_labels()[0]['sem_labels'])
+    assert torch.equal(loaded[0]['inst_info']['instance_ids'], large_labels()[0]['inst_info']['instance_ids'])
+    assert os.listdir(cache.cache_dir) == [os.path.basename(cache.path(SCAN_ID, [source]))]
+
+
+def test_concurrent_process_saves(tmp_path, source):
+    mp = pytest.importorskip('torch.multiprocessing')
+    cache_dir = str(tmp_path / 'cache')
+    mp.spawn(save_worker, args=(cache_dir, source, 5), nprocs=4)
+    assert_single_complete_entry(DerivedCache(cache_dir, 'test', {'ignore_label': -100}), source)
+
+
+def test_concurrent_thread_saves(tmp_path, source):
+    # same pid, e.g. threads of one loader process
+    cache_dir = str(tmp_path / 'cache')
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda rank: save_worker(rank, cache_dir, source, 5), range(4)))
+    assert_single_complete_entry(DerivedCache(cache_dir, 'test', {'ignore_label': -100}), source)
@@ -0,0 +1,156 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+
+class HostCopyCounter:
+    ''' Counts device to host transfers requested through Tensor.cpu / .item / .tolist / .numpy
+    '''
+    def __init__(self, monkeypatch):
+        self.count = 0
+        for name in ['cpu', 'item', 'tolist', 'numpy']:
+            monkeypatch.setattr(torch.Tensor, name, self.wrap(getattr(torch.Tensor, name)))
+
+    def wrap(self, fn):
+        def counted(tensor, *args, **kwargs):
+            self.count += 1
+            return fn(tensor, *args, **kwargs)
+        return counted
+
+
+def output_tensors(data_dict):
+    tensors = [data_dict['query_feat']]
+    for key in ['predictions_score', 'predictions_class', 'predictions_mask', 'predictions_box']:
+        tensors.extend(data_dict[key])
+    return tensors
+
+
+def test_default_outputs_stay_on_device(instseg_model, instseg_batch, device, monkeypatch):
+    model = instseg_model(memories=['mv']).to(device)
+    data_dict = instseg_batch(device=device)
+    counter = HostCopyCounter(monkeypatch)
+    with torch.no_grad():
+        data_dict = model(data_dict)
+    assert counter.count == 0
+    assert 'voxel_feat' not in data_dict
+    for tensor in output_tensors(data_dict):
+        assert tensor.device.type == device
+    # per-layer predictions of the query encoder plus the final one
+    assert len(data_dict['predictions_mask']) == model.unified_encoder.num_blocks * len(model.unified_encoder.unified_encoder) + 1
+
+
+def test_voxel_feat_copied_to_host_only_when_requested(instseg_model, instseg_batch, device, monkeypatch):
+    model = instseg_model(memories=['voxel', 'mv']).to(device)
+    counter = HostCopyCounter(monkeypatch)
+    counts = {}
+    for outputs in [['query_feat', 'predictions'], ['voxel_feat', 'query_feat', 'predictions']]:
+        model.set_outputs(outputs)
+        data_dict = instseg_batch(device=device)
+        counter.count = 0
+        with torch.no_grad():
+            data_dict = model(data_dict)
+        counts[len(outputs)] = counter.count
+        assert ('voxel_feat' in data_dict) == ('voxel_feat' in outputs)
+    # the voxel backbone may read coordinates on host, the only extra transfers are the feature and mask copies
+    assert counts[3] - counts[2] == 2
+    assert data_dict['voxel_feat']['feat'].device.type == 'cpu'
+
+
+def test_without_predictions_only_last_layer_is_kept(instseg_model, instseg_batch):
+    model = instseg_model(memories=['mv'], outputs=['query_feat'])
+    with torch.no_grad():
+        data_dict = model(instseg_batch())
+    assert 'query_feat' in data_dict
+    for key in ['predictions_score', 'predictions_class', 'predictions_mask', 'predictions_box']:
+        assert len(data_dict[key]) == 1
+
+
+def test_unknown_output_is_rejected(instseg_model):
+    with pytest.raises(NotImplementedError):
+        instseg_model(memories=['mv'], outputs=['query_feat', 'voxel'])
+
+
+def reference_segment_geometry(model, coordinates, voxel2segment, max_seg):
+    # per-sample loop of add_geometry_to_segment before it was batched
+    from torch_scatter import scatter
+    from model.embodied_pq3d_instseg import scatter_norm
+    all_xyz_segment = []
+    for bid in range(len(voxel2segment)):
+        sp_idx = voxel2segment[bid]
+        norm_xyz, _ = scatter_norm(coordinates[bid], sp_idx)
+        all_xyz_segment.append(scatter(model.pts_proj1(norm_xyz), sp_idx, dim=0, reduce='max', dim_size=max_seg))
+    return torch.stack(all_xyz_segment)
+
+
+@pytest.mark.parametrize('num_segments', [(12, 7), (5, 9, 9), (6,)])
+def test_segment_geometry_matches_per_sample_loop(instseg_model, instseg_batch, num_segments):
+    model = instseg_model(memories=['voxel'], add_geometry_to_segment=True)
+    data_dict = instseg_batch(num_segments=num_segments)
+    max_seg = data_dict['seg_center'].shape[1]
+    with torch.no_grad():
+        # the batching itself (offsets, normalization, max pooling, padding) is exact
+        pts_proj1 = model.pts_proj1
+        model.pts_proj1 = torch.nn.Identity()
+        batched = model.encode_segment_geometry(data_dict['coordinates'], data_dict['voxel2segment'], max_seg)
+        reference = reference_segment_geometry(model, data_dict['coordinates'], data_dict['voxel2segment'], max_seg)
+        assert torch.equal(batched, reference)
+        # the projection runs on all rows at once, BLAS may block the rows differently
+        model.pts_proj1 = pts_proj1
+        batched = model.encode_segment_geometry(data_dict['coordinates'], data_dict['voxel2segment'], max_seg)
+        reference = reference_segment_geometry(model, data_dict['coordinates'], data_dict['voxel2segment'], max_seg)
+        assert batched.shape == (len(num_segments), max_seg, model.hidden_size)
+        torch.testing.assert_close(batched, reference, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('memories', [['mv'], ['voxel', 'mv']])
+@pytest.mark.parametrize('num_segments', [(12, 7), (5, 9, 6)])
+def test_ragged_segments_match_padded(instseg_model, instseg_batch, memories, num_segments):
+    padded_model = instseg_model(memories=memories)
+    ragged_model = instseg_model(memories=memories, ragged_segments=True)
+    ragged_model.load_state_dict(padded_model.state_dict())
+    with torch.no_grad():
+        padded = padded_model(instseg_batch(num_segments=num_segments))
+        ragged = ragged_model(instseg_batch(num_segments=num_segments))
+    torch.testing.assert_close(ragged['query_feat'], padded['query_feat'], rtol=1e-4, atol=1e-5)
+    for key in ['predictions_score', 'predictions_class', 'predictions_mask', 'predictions_box']:
+        assert len(ragged[key]) == len(padded[key])
+        for ragged_layer, padded_layer in zip(ragged[key], padded[key]):
+            torch.testing.assert_close(ragged_layer, padded_layer, rtol=1e-4, atol=1e-5)
+
+
+def test_ragged_segments_reject_other_mv_padding(instseg_model, instseg_batch):
+    model = instseg_model(memories=['mv'], ragged_segments=True)
+    data_dict = instseg_batch()
+    data_dict['mv_seg_pad_masks'][0, 0] = False
+    with pytest.raises(AssertionError):
+        with torch.no_grad():
+            model(data_dict)
+
+
+@pytest.mark.parametrize('memories', [['mv'], ['voxel', 'mv']])
+@pytest.mark.parametrize('use_self_mask', [True, False])
+@pytest.mark.parametrize('skip_query_encoder_mask_pred', [False, True])
+def test_last_layer_only_eval_matches_full_path(instseg_model, instseg_batch, memories, use_self_mask, skip_query_encoder_mask_pred):
+    full_model = instseg_model(memories=memories, skip_query_encoder_mask_pred=skip_query_encoder_mask_pred)
+    last_model = instseg_model(memories=memories, skip_query_encoder_mask_pred=skip_query_encoder_mask_pred)
+    last_model.load_state_dict(full_model.state_dict())
+    for model in [full_model, last_model]:
+        model.unified_encoder.use_self_mask = use_self_mask
+    last_model.unified_encoder.last_layer_only_eval = True
+    if use_self_mask and skip_query_encoder_mask_pred:
+        # without offline masks there is no self attention mask on either path
+        for model in [full_model, last_model]:
+            with pytest.raises(AssertionError):
+                with torch.no_grad():
+                    model(instseg_batch())
+        return
+    with torch.no_grad():
+        full = full_model(instseg_batch())
+        last = last_model(instseg_batch())
+    # without per-layer predictions only the final mask head output is returned
+    num_layers = last_model.unified_encoder.num_blocks * len(last_model.unified_encoder.unified_encoder)
+    assert len(full['predictions_mask']) == (1 if skip_query_encoder_mask_pred else num_layers + 1)
+    torch.testing.assert_close(last['query_feat'], full['query_feat'], rtol=1e-5, atol=1e-6)
+    for key in ['predictions_score', 'predictions_class', 'predictions_mask', 'predictions_box']:
+        assert len(last[key]) == 1
+        torch.testing.assert_close(last[key][-1], full[key][-1], rtol=1e-5, atol=1e-6)
@@ -0,0 +1,312 @@
+import os
+import types
+import random
+from copy import deepcopy
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+embodied_scan = pytest.importorskip('data.datasets.embodied_scan')
+
+from data.data_utils import freeze_arrays
+from data.datasets.constant import VALID_CLASS_IDS_200
+
+
+def stub_instseg_dataset(use_open_vocabulary=False, compact_instance_masks=True):
+    # the attributes extract_scan_inst_info reads, labels are synthetic names mapped to the real scannet200 raw ids
+    dataset = embodied_scan.EmbodiedScanInstseg.__new__(embodied_scan.EmbodiedScanInstseg)
+    raw_ids = list(VALID_CLASS_IDS_200[:20]) + [12, 20, 25, 1500]  # the last ones are not scannet200 classes
+    names = [f'class{raw_id}' for raw_id in raw_ids]
+    dataset.label_converter = types.SimpleNamespace(
+        raw_name_to_scannet_raw_id=dict(zip(names, raw_ids)),
+        scannet_raw_id_to_scannet200_id={k: v for v, k in enumerate(VALID_CLASS_IDS_200)},
+    )
+    dataset.cat2int = {name: i for i, name in enumerate(names)}
+    dataset.ignore_label = -100
+    dataset.num_labels = 200
+    dataset.filter_out_classes = [0, 2]
+    dataset.use_open_vocabulary = use_open_vocabulary
+    dataset.compact_instance_masks = compact_instance_masks
+    return dataset
+
+
+def synthetic_scan(dataset, num_frames=4, num_points=3000, num_instances=25, num_segments=120, seed=0):
+    rng = np.random.default_rng(seed)
+    names = list(dataset.cat2int.keys()) + ['unknown0', 'unknown1']  # unknown names are not in cat2int
+    inst_to_label = {inst_id: names[rng.integers(len(names))] for inst_id in range(num_instances)}
+    one_scan = {'inst_to_label': inst_to_label, 'inst_to_text_label': {k: f'text {v}' for k, v in inst_to_label.items()}, 'sub_frames': {}}
+    for sub_frame_id in range(num_frames):
+        # -100 for no object and ids without annotation, segments are contiguous 0..n-1 as in the loaded scans
+        instance_labels = rng.choice(np.concatenate([np.arange(num_instances + 5), [-100]]), num_points)
+        segment_id = np.concatenate([np.arange(num_segments), rng.integers(0, num_segments, num_points - num_segments)])
+        rng.shuffle(segment_id)
+        # one more segment with equal instance counts exercises the majority tie breaking
+        segment_id = np.concatenate([segment_id, np.full(4, num_segments)])
+        instance_labels = np.concatenate([instance_labels, [2, 1, 2, 1]])
+        one_scan['sub_frames'][sub_frame_id] = {'pcds': rng.random((len(segment_id), 6)), 'segment_id': segment_id, 'instance_labels': instance_labels}
+    return one_scan
+
+
+def reference_map_to_scannet200_id(dataset, labels):
+    label_info = dataset.label_converter.scannet_raw_id_to_scannet200_id
+    labels[~np.isin(labels, list(label_info))] = dataset.ignore_label
+    for k in label_info:
+        labels[labels == k] = label_info[k]
+    return labels
+
+
+def reference_extract_scan_inst_info(self, one_scan):
+    # per instance and per segment loops before extract_scan_inst_info was vectorized
+    for sub_frame_id in one_scan['sub_frames'].keys():
+        scan_data = one_scan['sub_frames'][sub_frame_id]
+        pcds = scan_data['pcds']
+        segment_id = scan_data['segment_id']
+        instance_labels = scan_data['instance_labels']
+        inst_to_label = one_scan['inst_to_label']
+        inst_to_text_label = one_scan['inst_to_text_label']
+        sem_labels = np.zeros(pcds.shape[0]) + self.ignore_label
+        for inst_id in inst_to_label.keys():
+            if inst_to_label[inst_id] in self.cat2int.keys():
+                mask = instance_labels == inst_id
+                if np.sum(mask) == 0:
+                    continue
+                sem_labels[mask] = int(self.label_converter.raw_name_to_scannet_raw_id[inst_to_label[inst_id]])
+        sem_labels = reference_map_to_scannet200_id(self, sem_labels).astype(int)
+        scan_data['sem_labels'] = sem_labels
+        inst_label_mapper = {}
+        max_inst_id = 0
+        for inst_id in np.unique(instance_labels):
+            if inst_id in inst_to_label.keys():
+                inst_label_mapper[inst_id] = max_inst_id
+                max_inst_id += 1
+            else:
+                inst_label_mapper[inst_id] = -1
+        scan_data['inst_label_mapper'] = inst_label_mapper
+        instance_labels_continous = np.vectorize(lambda x: inst_label_mapper.get(x, x))(instance_labels)
+        scan_data['instance_labels_continuous'] = instance_labels_continous.astype(int)
+        unique_inst_ids, indices, inverse_indices = np.unique(instance_labels_continous, return_index=True, return_inverse=True)
+        unique_inst_labels = sem_labels[indices]
+        n_inst = len(unique_inst_ids)
+        full_masks = np.arange(n_inst)[:, None] == inverse_indices
+        n_segments = segment_id.max() + 1
+        segment_masks = np.zeros((n_inst, n_segments), dtype=bool)
+        segment_labels = np.ones(n_segments) * self.ignore_label
+        for cur_seg_id in range(n_segments):
+            cur_inst_id = np.bincount(inverse_indices[segment_id == cur_seg_id]).argmax()
+            segment_masks[cur_inst_id, cur_seg_id] = True
+            segment_labels[cur_seg_id] = unique_inst_labels[cur_inst_id]
+        segment_labels[segment_labels == self.ignore_label] = self.num_labels
+        if self.use_open_vocabulary:
+            valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (segment_masks.sum(1) > 0)
+        else:
+            valid = (unique_inst_ids != -1) & ~np.isin(unique_inst_labels, self.filter_out_classes) & (unique_inst_labels != self.ignore_label) & (segment_masks.sum(1) > 0)
+        unique_inst_ids = unique_inst_ids[valid]
+        unique_inst_labels = unique_inst_labels[valid]
+        full_masks = full_masks[valid]
+        segment_masks = segment_masks[valid]
+        inverse_inst_label_mapper = {v: k for k, v in inst_label_mapper.items()}
+        instance_text_labels = [inst_to_text_label[inverse_inst_label_mapper[inst_id]] for inst_id in unique_inst_ids]
+        scan_data['inst_info'] = {
+            'instance_ids_ori': torch.LongTensor([inverse_inst_label_mapper[inst_id] for inst_id in unique_inst_ids]),
+            'instance_ids': torch.LongTensor(unique_inst_ids),
+            'instance_labels': torch.LongTensor(unique_inst_labels),
+            'full_masks': torch.LongTensor(full_masks),
+            'segment_masks': torch.LongTensor(segment_masks),
+            'segment_labels': torch.LongTensor(segment_labels),
+            'instance_text_labels': instance_text_labels,
+        }
+
+
+@pytest.mark.parametrize('use_open_vocabulary', [False, True])
+@pytest.mark.parametrize('compact_instance_masks', [False, True])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_extract_scan_inst_info_matches_loops(use_open_vocabulary, compact_instance_masks, seed):
+    dataset = stub_instseg_dataset(use_open_vocabulary, compact_instance_masks)
+    one_scan = synthetic_scan(dataset, seed=seed)
+    reference = synthetic_scan(dataset, seed=seed)
+    dataset.extract_scan_inst_info(one_scan)
+    reference_extract_scan_inst_info(dataset, reference)
+    assert one_scan['extract_inst_info']
+    for sub_frame_id, expected in reference['sub_frames'].items():
+        scan_data = one_scan['sub_frames'][sub_frame_id]
+        for key in ['sem_labels', 'instance_labels_continuous']:
+            assert scan_data[key].dtype == expected[key].dtype
+            assert np.array_equal(scan_data[key], expected[key])
+        assert scan_data['inst_label_mapper'] == expected['inst_label_mapper']
+        inst_info, expected_info = scan_data['inst_info'], expected['inst_info']
+        for key in ['instance_ids_ori', 'instance_ids', 'instance_labels', 'segment_labels']:
+            assert torch.equal(inst_info[key], expected_info[key]), key
+        assert inst_info['instance_text_labels'] == expected_info['instance_text_labels']
+        assert torch.equal(inst_info['segment_masks'].long(), expected_info['segment_masks'])
+        if compact_instance_masks:
+            # point_instance_ids holds the row of every point's kept instance, -1 for none
+            point_instance_ids = inst_info['point_instance_ids'].long()
+            full_masks = torch.arange(len(expected_info['full_masks']))[:, None] == point_instance_ids[None]
+            assert torch.equal(full_masks.long(), expected_info['full_masks'])
+        else:
+            assert torch.equal(inst_info['full_masks'], expected_info['full_masks'])
+
+
+def stub_scene_dataset(compute_local_box, use_aug, compact_instance_masks=True, seed=0):
+    # the attributes get_scene reads, on one synthetic scan with extracted instance info
+    dataset = stub_instseg_dataset(compact_instance_masks=compact_instance_masks)
+    one_scan = synthetic_scan(dataset, seed=seed)
+    dataset.extract_scan_inst_info(one_scan)
+    rng = np.random.default_rng(seed)
+    one_scan['pcds_global'] = rng.random((5000, 6))
+    one_scan['instance_labels_global'] = rng.integers(-1, 30, 5000)
+    dataset.scan_data = {'scan0': one_scan}
+    dataset.split = 'train' if use_aug else 'val'
+    dataset.use_aug = use_aug
+    dataset.batch_augmentor = None
+    dataset.volume_augmentations = embodied_scan.V.NoOp()
+    dataset.image_augmentations = embodied_scan.A.NoOp()
+    dataset.normalize_color = embodied_scan.A.Normalize(mean=[0.47, 0.43, 0.37], std=[0.28, 0.27, 0.27])
+    dataset.voxel_size = 0.02
+    dataset.query_sample_strategy = 'segment'
+    dataset.compute_local_box = compute_local_box
+    dataset.dataset_name = 'HM3D'
+    return dataset
+
+
+def assert_same(a, b, key=''):
+    assert type(a) == type(b), key
+    if isinstance(a, dict):
+        assert a.keys() == b.keys(), key
+        for k in a:
+            assert_same(a[k], b[k], f'{key}.{k}')
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b), key
+        for i, (x, y) in enumerate(zip(a, b)):
+            assert_same(x, y, f'{key}.{i}')
+    elif isinstance(a, torch.Tensor):
+        assert a.dtype == b.dtype and torch.equal(a, b), key
+    elif isinstance(a, np.ndarray):
+        assert a.dtype == b.dtype and np.array_equal(a, b), key
+    else:
+        assert a == b, key
+
+
+def get_scenes(dataset, seed=0):
+    random.seed(seed)
+    torch.manual_seed(seed)
+    return [dataset.get_scene('scan0', sub_frame_id) for sub_frame_id in dataset.scan_data['scan0']['sub_frames']]
+
+
+@pytest.mark.parametrize('compute_local_box', [False, True])
+@pytest.mark.parametrize('use_aug', [False, True])
+@pytest.mark.parametrize('compact_instance_masks', [False, True])
+def test_get_scene_on_frozen_scan_data_is_unchanged(compute_local_box, use_aug, compact_instance_masks):
+    # the frozen scan data gives the samples the old per sample deep copies of writable scan data gave
+    dataset = stub_scene_dataset(compute_local_box, use_aug, compact_instance_masks)
+    reference = stub_scene_dataset(compute_local_box, use_aug, compact_instance_masks)
+    reference.scan_data = deepcopy(reference.scan_data)
+    freeze_arrays(dataset.scan_data)
+    samples = get_scenes(dataset)
+    assert_same(samples, get_scenes(reference))
+    assert compute_local_box == ('instance_boxes' in samples[0])
+
+
+def scribble(value):
+    # in place write on every tensor, array and list of a sample
+    if isinstance(value, torch.Tensor):
+        value.logical_not_() if value.dtype == torch.bool else value.add_(1)
+    elif isinstance(value, np.ndarray):
+        value += 1
+    elif isinstance(value, list):
+        value.append('scribble')
+
+
+@pytest.mark.parametrize('compute_local_box', [False, True])
+@pytest.mark.parametrize('use_aug', [False, True])
+def test_modified_samples_leave_scan_data_untouched(compute_local_box, use_aug):
+    dataset = stub_scene_dataset(compute_local_box, use_aug)
+    freeze_arrays(dataset.scan_data)
+    snapshot = deepcopy(dataset.scan_data)
+    samples = get_scenes(dataset)
+    for sample in samples:
+        for value in sample.values():
+            scribble(value)
+    assert_same(dataset.scan_data, snapshot)
+    # the next samples are drawn from the untouched scan data
+    assert_same(get_scenes(dataset), get_scenes(stub_scene_dataset(compute_local_box, use_aug)))
+
+
+def instseg_loss(hlevels=2, num_blocks=1):
+    from omegaconf import OmegaConf
+    loss_module = pytest.importorskip('optim.loss.embodied_scan_instseg_loss')
+    cfg = OmegaConf.create({'model': {
+        'voxel_encoder': {'args': {'hlevels': list(range(hlevels))}},
+        'unified_encoder': {'args': {'num_blocks': num_blocks}},
+        'EmbodiedScanInstSegLoss': {'cost_class': 0.5, 'cost_score': 0.5, 'cost_mask': 1, 'cost_dice': 1, 'cost_box': 1, 'cost_open_vocab': 1,
+                                    'score_weight': [0.1, 1], 'matcher': {'cost_score': 0.5, 'cost_mask': 1.0, 'cost_dice': 1.0}},
+    }})
+    return loss_module.EmbodiedScanInstSegLoss(cfg)
+
+
+def random_predictions(batch, num_layers=3, num_classes=202, embed_dim=8, seed=0):
+    # predictions of every layer for the padded segments and queries of the batch
+    g = torch.Generator().manual_seed(seed)
+    bs, num_segments = batch['seg_pad_masks'].shape
+    num_queries = batch['query_pad_masks'].shape[1]
+    return {
+        'predictions_mask': [torch.randn(bs, num_segments, num_queries, generator=g) for _ in range(num_layers)],
+        'predictions_class': [torch.randn(bs, num_queries, num_classes, generator=g) for _ in range(num_layers)],
+        'predictions_box': [torch.rand(bs, num_queries, 6, generator=g) for _ in range(num_layers)],
+        'predictions_score': [torch.randn(bs, num_queries, 2, generator=g) for _ in range(num_layers)],
+        'openvocab_query_feat': torch.randn(bs, num_queries, embed_dim, generator=g),
+    }
+
+
+def test_compact_and_dense_masks_give_the_same_loss():
+    wrapper = pytest.importorskip('data.datasets.embodied_scan_instseg_wrapper')
+    from data.collator import SchemaCollator
+    batches = {}
+    for compact_instance_masks in [True, False]:
+        dataset = stub_scene_dataset(compute_local_box=True, use_aug=False, compact_instance_masks=compact_instance_masks)
+        freeze_arrays(dataset.scan_data)
+        samples = get_scenes(dataset)
+        for sample in samples:
+            sample['instance_text_embeds'] = torch.ones(len(sample['instance_ids']), 8)
+        batches[compact_instance_masks] = SchemaCollator(wrapper.INSTSEG_COLLATE_SCHEMA)(samples)
+    compact, dense = batches[True], batches[False]
+    assert 'full_masks' not in compact and 'point_instance_ids' not in dense
+    for point_instance_ids, full_masks in zip(compact['point_instance_ids'], dense['full_masks']):
+        assert torch.equal((torch.arange(len(full_masks))[:, None] == point_instance_ids.long()).long(), full_masks)
+    for segment_masks, dense_segment_masks in zip(compact['segment_masks'], dense['segment_masks']):
+        assert segment_masks.dtype == torch.bool and torch.equal(segment_masks.long(), dense_segment_masks)
+    for key in ['instance_boxes', 'instance_labels', 'segment_labels', 'instance_ids_ori']:
+        assert_same(compact[key], dense[key], key)
+    loss = instseg_loss()
+    results = {}
+    for name, batch in [('compact', compact), ('dense', dense)]:
+        data_dict = dict(batch, **random_predictions(batch))
+        total, losses = loss(data_dict)
+        results[name] = (total, losses, data_dict['indices'])
+    (total, losses, indices), (dense_total, dense_losses, dense_indices) = results['compact'], results['dense']
+    assert torch.is_tensor(total) and torch.equal(total, dense_total)
+    assert losses.keys() == dense_losses.keys()
+    for key in losses:
+        assert torch.equal(torch.as_tensor(losses[key]), torch.as_tensor(dense_losses[key])), key
+    for (queries, targets), (dense_queries, dense_targets) in zip(indices, dense_indices):
+        assert torch.equal(queries, dense_queries) and torch.equal(targets, dense_targets)
+    assert sum(len(queries) for queries, _ in indices) > 0
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_packed_scan_mmap_option(tmp_path, mmap):
+    from data.scan_store import packed_scan_path, write_pack
+    dataset = embodied_scan.EmbodiedScanInstseg.__new__(embodied_scan.EmbodiedScanInstseg)
+    dataset.dataset_name = 'ScanNet'
+    dataset.load_scan_options = {'packed_scan_dir': str(tmp_path), 'packed_scan_mmap': mmap}
+    path = packed_scan_path(str(tmp_path), 'ScanNet', 'scene0000_00')
+    os.makedirs(os.path.dirname(path))
+    points = np.arange(60, dtype=np.float32).reshape(-1, 6)
+    write_pack(path, {'points/0.bin': points})
+    with dataset._open_packed_scan('scene0000_00') as packed_scan:
+        array = packed_scan.get('points/0.bin')
+        assert np.array_equal(array, points)
+        # mmap arrays are read only views of the pack, copies otherwise
+        assert isinstance(array.base, np.memmap) == mmap
+        assert array.flags.writeable != mmap
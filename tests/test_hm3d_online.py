@@ -0,0 +1,110 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+torch_scatter = pytest.importorskip('torch_scatter')
+
+# the hm3d-online scripts import their helpers from their own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'hm3d-online'))
+hm3d_data_utils = pytest.importorskip('data_utils')
+
+
+def synthetic_stage1(num_segments=(9, 14, 6, 11), num_queries=10, num_classes=201, seed=0):
+    # collated stage-1 batch and outputs, padded queries and segments, queries of wall floor ceiling classes
+    # and one frame where every query is filtered out
+    g = torch.Generator().manual_seed(seed)
+    B, S, N = len(num_segments), max(num_segments), num_queries
+    batch = {'voxel2segment': [], 'voxel_to_full_maps': [], 'segment_to_full_maps': [], 'raw_coordinates': [],
+             'query_pad_masks': torch.zeros(B, N, dtype=torch.bool)}
+    for bid, n in enumerate(num_segments):
+        num_voxels = int(torch.randint(n, 4 * n, (1,), generator=g))
+        voxel2segment = torch.cat([torch.arange(n), torch.randint(0, n, (num_voxels - n,), generator=g)])
+        num_points = int(torch.randint(num_voxels, 3 * num_voxels, (1,), generator=g))
+        voxel_to_full_maps = torch.cat([torch.arange(num_voxels), torch.randint(0, num_voxels, (num_points - num_voxels,), generator=g)])
+        batch['voxel2segment'].append(voxel2segment)
+        batch['voxel_to_full_maps'].append(voxel_to_full_maps)
+        # full resolution segments of the points, not always the segment of their voxel
+        segment_to_full_maps = voxel2segment[voxel_to_full_maps].clone()
+        noisy = torch.rand(num_points, generator=g) < 0.2
+        segment_to_full_maps[noisy] = torch.randint(0, n, (int(noisy.sum()),), generator=g)
+        batch['segment_to_full_maps'].append(segment_to_full_maps)
+        batch['raw_coordinates'].append(torch.rand(num_points, 6, generator=g).numpy())
+        batch['query_pad_masks'][bid, :int(torch.randint(N // 2, N + 1, (1,), generator=g))] = True
+    predictions_class = torch.randn(B, N, num_classes, generator=g)
+    # some queries predict the filtered classes, every query of frame 2
+    filtered = torch.rand(B, N, generator=g) < 0.3
+    filtered[2] = True
+    predictions_class[filtered, torch.tensor([0, 2, 35])[torch.randint(0, 3, (int(filtered.sum()),), generator=g)]] += 100
+    outputs = {
+        'predictions_mask': [torch.randn(B, S, N, generator=g) * 2],
+        'predictions_class': [predictions_class],
+        'predictions_box': [torch.rand(B, N, 6, generator=g)],
+        'predictions_score': [torch.randn(B, N, 2, generator=g)],
+        'query_feat': torch.randn(B, N, 16, generator=g),
+        'openvocab_query_feat': torch.randn(B, N, 16, generator=g),
+    }
+    return outputs, batch
+
+
+def reference_postprocess(stage1_output_data_dict, batch):
+    # per frame loop of PQ3DModel.decision before postprocess_stage1_batch, frames without valid queries are skipped
+    pred_dict_list = []
+    pred_masks = stage1_output_data_dict['predictions_mask'][-1]
+    pred_logits = torch.functional.F.softmax(stage1_output_data_dict['predictions_class'][-1], dim=-1)
+    pred_boxes = stage1_output_data_dict['predictions_box'][-1]
+    pred_scores = torch.functional.F.softmax(stage1_output_data_dict['predictions_score'][-1], dim=-1)[:, :, 1]
+    pred_query = stage1_output_data_dict['query_feat']
+    pred_embeds = stage1_output_data_dict['openvocab_query_feat']
+    query_pad_masks = batch['query_pad_masks']
+    for bid in range(len(pred_masks)):
+        masks = pred_masks[bid][batch['voxel2segment'][bid]][:, query_pad_masks[bid]]
+        logits = pred_logits[bid][query_pad_masks[bid]]
+        boxes = pred_boxes[bid][query_pad_masks[bid]]
+        scores = pred_scores[bid][query_pad_masks[bid]]
+        query = pred_query[bid][query_pad_masks[bid]]
+        embeds = pred_embeds[bid][query_pad_masks[bid]]
+        valid_query_mask = ~torch.isin(torch.argmax(logits, dim=-1), torch.tensor([0, 2, 35]))
+        masks = masks[:, valid_query_mask]
+        logits = logits[valid_query_mask][..., :-1]
+        boxes, scores, query, embeds = boxes[valid_query_mask], scores[valid_query_mask], query[valid_query_mask], embeds[valid_query_mask]
+        if masks.shape[1] == 0:
+            continue
+        heatmap = masks.float().sigmoid()
+        masks = (masks > 0).float()
+        mask_scores = (heatmap * masks).sum(0) / (masks.sum(0) + 1e-6)
+        classes = torch.argmax(logits, dim=1)
+        masks = masks[batch['voxel_to_full_maps'][bid]]
+        masks = torch_scatter.scatter_mean(masks, batch['segment_to_full_maps'][bid], dim=0)
+        masks = (masks > 0.5).float()
+        masks = masks[batch['segment_to_full_maps'][bid]]
+        pred_dict_list.append((bid, {'point_cloud': batch['raw_coordinates'][bid], 'pred_masks': masks.numpy(), 'pred_classes': classes.numpy(), 'pred_boxes': boxes.numpy(),
+                                     'pred_scores': scores.numpy(), 'pred_mask_scores': mask_scores.numpy(), 'pred_feats': query.numpy(), 'open_vocab_feats': embeds.numpy()}))
+    return pred_dict_list
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_postprocess_stage1_batch_matches_frame_loop(seed):
+    import numpy as np
+    outputs, batch = synthetic_stage1(seed=seed)
+    expected = reference_postprocess(outputs, batch)
+    pred_dict_list = hm3d_data_utils.postprocess_stage1_batch(outputs, batch)
+    assert len(pred_dict_list) == len(batch['voxel2segment'])
+    # frames without valid queries are None, the others match the loop in frame order
+    assert pred_dict_list[2] is None
+    assert [bid for bid, pred_dict in enumerate(pred_dict_list) if pred_dict is not None] == [bid for bid, _ in expected]
+    for bid, expected_dict in expected:
+        pred_dict = pred_dict_list[bid]
+        assert pred_dict.keys() == expected_dict.keys()
+        assert pred_dict['point_cloud'] is expected_dict['point_cloud']
+        for key in ['pred_masks', 'pred_classes']:
+            assert np.array_equal(pred_dict[key], expected_dict[key]), key
+        for key in ['pred_boxes', 'pred_scores', 'pred_mask_scores', 'pred_feats', 'open_vocab_feats']:
+            assert np.allclose(pred_dict[key], expected_dict[key], atol=1e-6), key
+
+
+def test_postprocess_stage1_batch_without_valid_queries():
+    outputs, batch = synthetic_stage1()
+    batch['query_pad_masks'][:] = False
+    assert hm3d_data_utils.postprocess_stage1_batch(outputs, batch) == [None] * 4
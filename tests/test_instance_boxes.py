@@ -0,0 +1,144 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from data.data_utils import convert_pc_to_box, convert_pcs_to_boxes, group_instance_points, local_instance_boxes
+
+
+def scene_points(num_points=4000, num_instances=20, seed=0):
+    # ids -1 for no object, instances 3 and 7 have no points
+    rng = np.random.default_rng(seed)
+    coordinates = (rng.random((num_points, 6)) * np.array([8.0, 8.0, 3.0, 1.0, 1.0, 1.0]) - 1.0).astype(np.float32)
+    instance_ids = rng.integers(-1, num_instances, num_points)
+    instance_ids[np.isin(instance_ids, [3, 7])] = -1
+    return coordinates, instance_ids
+
+
+def reference_boxes(coordinates, instance_ids, query_ids):
+    # the old per instance mask loop, ids without points are skipped because convert_pc_to_box needs points
+    boxes = {}
+    for i in query_ids:
+        mask = instance_ids == i
+        if mask.any():
+            center, size = convert_pc_to_box(coordinates[mask])
+            boxes[i] = (np.nonzero(mask)[0], np.array(center), np.array(size), coordinates[mask][:, :3].mean(0))
+    return boxes
+
+
+@pytest.mark.parametrize('as_tensor', [False, True])
+def test_convert_pcs_to_boxes_matches_mask_loop(as_tensor):
+    coordinates, instance_ids = scene_points()
+    expected = reference_boxes(coordinates, instance_ids, range(20))
+    inputs = (torch.from_numpy(coordinates), torch.from_numpy(instance_ids)) if as_tensor else (coordinates, instance_ids)
+    centers, sizes, means, counts = convert_pcs_to_boxes(*inputs)
+    assert isinstance(centers, torch.Tensor) == as_tensor
+    centers, sizes, means, counts = (np.asarray(x) for x in (centers, sizes, means, counts))
+    assert len(centers) == 20
+    for i in range(20):
+        if i in expected:
+            indices, center, size, mean = expected[i]
+            assert counts[i] == len(indices)
+            assert np.allclose(centers[i], center, atol=1e-6) and np.allclose(sizes[i], size, atol=1e-6)
+            assert np.allclose(means[i], mean, atol=1e-5)
+        else:
+            # no points, zero box
+            assert counts[i] == 0 and not centers[i].any() and not sizes[i].any()
+    # negative ids are ignored
+    assert counts.sum() == (instance_ids >= 0).sum()
+
+
+def test_convert_pcs_to_boxes_empty():
+    centers, sizes, means, counts = convert_pcs_to_boxes(np.zeros((0, 3), dtype=np.float32), np.zeros(0, dtype=np.int64))
+    assert centers.shape == sizes.shape == means.shape == (0, 3) and counts.shape == (0,)
+
+
+def test_scannet_objects_match_mask_loop():
+    # obj_masks, obj_box, obj_loc and bg_mask of ScanNetBase against the old dense (n_inst, N) mask computation
+    coordinates, instance_ids = scene_points()
+    num_instances = instance_ids.max() + 1
+    bg_obj_ids = [0, 5, 3]
+    obj_masks, centers, sizes, means, _ = group_instance_points(coordinates, instance_ids, np.arange(num_instances))
+    expected = reference_boxes(coordinates, instance_ids, range(num_instances))
+    dense_masks = instance_ids[None, :] == np.arange(num_instances)[:, None]
+    assert len(obj_masks) == num_instances
+    for i in range(num_instances):
+        assert np.array_equal(obj_masks[i], np.nonzero(dense_masks[i])[0])
+        if i in expected:
+            _, center, size, mean = expected[i]
+            assert np.allclose(centers[i], center, atol=1e-6) and np.allclose(sizes[i], size, atol=1e-6)
+            # obj_loc is the point mean with the box size
+            assert np.allclose(means[i], mean, atol=1e-5)
+        else:
+            assert not sizes[i].any()
+    assert np.array_equal(np.isin(instance_ids, bg_obj_ids), dense_masks[bg_obj_ids].sum(0).astype(bool))
+
+
+def test_sceneverse_objects_match_mask_loop():
+    # SceneVerseBase queries the ids of inst_to_label, which can be negative, missing from the scene or unsorted
+    coordinates, instance_ids = scene_points()
+    instance_ids[:50] = -5
+    query_ids = [12, -5, 3, 0, 25, 7, 19, -1]
+    indices, centers, sizes, _, counts = group_instance_points(coordinates, instance_ids, query_ids)
+    expected = reference_boxes(coordinates, instance_ids, query_ids)
+    assert len(indices) == len(query_ids)
+    for k, i in enumerate(query_ids):
+        if i in expected:
+            mask_indices, center, size, _ = expected[i]
+            assert np.array_equal(indices[k], mask_indices) and counts[k] == len(mask_indices)
+            assert np.allclose(centers[k], center, atol=1e-6) and np.allclose(sizes[k], size, atol=1e-6)
+        else:
+            assert len(indices[k]) == 0 and counts[k] == 0
+    assert len(group_instance_points(coordinates, instance_ids, [])[0]) == 0
+
+
+def local_scene(num_points=3000, num_global_points=6000, seed=0):
+    # local frame with 10 kept instances whose original ids are scattered over the global scan,
+    # ids 40 and 41 have no global points and fall back to the local points
+    rng = np.random.default_rng(seed)
+    instance_ids = torch.tensor([2, 40, 5, 17, 41, 0, 9, 33, 11, 28])
+    point_instance_ids = torch.from_numpy(rng.integers(-1, len(instance_ids), num_points))
+    point_instance_ids[:len(instance_ids)] = torch.arange(len(instance_ids))
+    coordinates = torch.from_numpy(rng.random((num_points, 3)).astype(np.float32) * 4)
+    global_coordinates = (rng.random((num_global_points, 3)) * 8).astype(np.float32)
+    global_inst_labels = rng.integers(-1, 39, num_global_points)
+    global_inst_labels[:39] = np.arange(39)
+    return instance_ids, coordinates, point_instance_ids, global_coordinates, global_inst_labels
+
+
+def reference_local_boxes(instance_ids, coordinates, full_masks, global_coordinates, global_inst_labels):
+    # the old EmbodiedScanInstseg compute_local_box loop
+    instance_boxes = []
+    for j, instance_id in enumerate(instance_ids):
+        local_pcds = global_coordinates[global_inst_labels == instance_id.item()]
+        if local_pcds.shape[0] == 0:
+            local_box = convert_pc_to_box(coordinates[full_masks[j].bool()].numpy())
+        else:
+            local_box = convert_pc_to_box(local_pcds)
+        instance_boxes.append(torch.tensor(local_box[0] + local_box[1], dtype=torch.float32))
+    return torch.stack(instance_boxes, dim=0)
+
+
+@pytest.mark.parametrize('compact_instance_masks', [True, False])
+@pytest.mark.parametrize('global_as_tensor', [False, True])
+def test_local_instance_boxes_match_loop(compact_instance_masks, global_as_tensor):
+    instance_ids, coordinates, point_instance_ids, global_coordinates, global_inst_labels = local_scene()
+    full_masks = (torch.arange(len(instance_ids))[:, None] == point_instance_ids).long()
+    expected = reference_local_boxes(instance_ids, coordinates, full_masks, global_coordinates, global_inst_labels)
+    local_masks = point_instance_ids.int() if compact_instance_masks else full_masks
+    if global_as_tensor:
+        global_coordinates, global_inst_labels = torch.from_numpy(global_coordinates), torch.from_numpy(global_inst_labels)
+    boxes = local_instance_boxes(instance_ids, coordinates, local_masks, global_coordinates, global_inst_labels)
+    assert boxes.dtype == torch.float32 and boxes.shape == (len(instance_ids), 6)
+    assert torch.allclose(boxes, expected, atol=1e-6)
+    # the fallback instances use the local points
+    for j in (1, 4):
+        local_box = convert_pc_to_box(coordinates[point_instance_ids == j].numpy())
+        assert torch.allclose(boxes[j], torch.tensor(local_box[0] + local_box[1]), atol=1e-6)
+
+
+def test_local_instance_boxes_empty():
+    _, coordinates, _, global_coordinates, global_inst_labels = local_scene()
+    boxes = local_instance_boxes(torch.zeros(0, dtype=torch.long), coordinates, torch.full((len(coordinates),), -1),
+                                 global_coordinates, global_inst_labels)
+    assert boxes.shape == (0, 6) and boxes.dtype == torch.float32
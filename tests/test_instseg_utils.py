@@ -0,0 +1,114 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from common.embodied_utils.instseg_utils import (InstSegAPAccumulator, assign_instances_for_scan, compute_averages, eval_instseg_flexible,
+                                                 eval_instseg_reduced, evaluate_matches, instseg_meta)
+
+
+def class_labels(num_classes=4):
+    return [f'class{i}' for i in range(num_classes)]
+
+
+def synthetic_scan(i, num_classes, seed, num_points=3000):
+    # gt ids class * 1000 + object, predictions as noisy copies of the gt masks plus random masks
+    rng = np.random.default_rng((seed, i))
+    num_objects = int(rng.integers(2, 12))
+    ids = np.zeros(num_points)
+    labels = rng.integers(1, num_points // 150, num_points)
+    for j in range(num_objects):
+        ids[labels == j + 1] = int(rng.integers(1, num_classes + 1)) * 1000 + j + 1
+    masks, classes = [], []
+    for gt_id in np.unique(ids[ids > 0]):
+        mask = (ids == gt_id) ^ (rng.random(num_points) < 0.05)
+        masks.append(mask)
+        classes.append(int(gt_id // 1000) if rng.random() < 0.8 else int(rng.integers(1, num_classes + 1)))
+    for _ in range(int(rng.integers(0, 5))):
+        masks.append(rng.random(num_points) < 0.1)
+        classes.append(int(rng.integers(1, num_classes + 1)))
+    # repeated scores exercise the tie handling of the precision recall curve
+    scores = np.round(rng.random(len(masks)), 1)
+    return {'pred_masks': np.stack(masks, axis=1), 'pred_classes': np.array(classes), 'pred_scores': scores}, ids
+
+
+def synthetic_scans(num_scans=20, num_classes=4, seed=0):
+    preds, gt_ids = {}, {}
+    for i in range(num_scans):
+        preds[f'scene{i:04d}_00'], gt_ids[f'scene{i:04d}_00'] = synthetic_scan(i, num_classes, seed)
+    return preds, gt_ids
+
+
+def flatten(avgs, labels):
+    return np.array([avgs['all_ap'], avgs['all_ap_50%'], avgs['all_ap_25%']] +
+                    [avgs['classes'][c][k] for c in labels for k in ['ap', 'ap50%', 'ap25%']], dtype=np.float64)
+
+
+def reduce_worker(rank, world_size, init_file, result_dir):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+    preds, gt_ids = synthetic_scans()
+    # every rank evaluates only its own scans, only their statistics are gathered
+    scan_ids = sorted(preds.keys())[rank::world_size]
+    result = eval_instseg_reduced({s: preds[s] for s in scan_ids}, gt_ids, class_labels())
+    torch.save(result, os.path.join(result_dir, f'{rank}.pth'))
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize('world_size', [2, 3])
+def test_reduced_ap_equals_single_process_ap(tmp_path, world_size):
+    mp.spawn(reduce_worker, args=(world_size, str(tmp_path / 'init'), str(tmp_path)), nprocs=world_size)
+    preds, gt_ids = synthetic_scans()
+    expected = flatten(eval_instseg_flexible(preds, gt_ids, class_labels()), class_labels())
+    assert not np.isnan(expected[0])
+    for rank in range(world_size):
+        result = torch.load(tmp_path / f'{rank}.pth')
+        assert np.array_equal(flatten(result, class_labels()), expected, equal_nan=True), rank
+
+
+def test_reduced_ap_without_process_group():
+    preds, gt_ids = synthetic_scans()
+    result = eval_instseg_reduced(preds, gt_ids, class_labels())
+    expected = eval_instseg_flexible(preds, gt_ids, class_labels())
+    assert np.array_equal(flatten(result, class_labels()), flatten(expected, class_labels()), equal_nan=True)
+
+
+def reference_ap(preds, gt_ids, labels):
+    # matches of all scans held at once and evaluated together by evaluate_matches
+    VALID_CLASS_IDS, ID_TO_LABEL, opt = instseg_meta(labels)
+    matches = {}
+    for scan_id in preds.keys():
+        gt2pred, pred2gt = assign_instances_for_scan(preds[scan_id], gt_ids[scan_id], VALID_CLASS_IDS, labels, ID_TO_LABEL, opt)
+        matches[scan_id] = {'gt': gt2pred, 'pred': pred2gt}
+    return compute_averages(evaluate_matches(matches, labels, opt), labels, opt)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('num_classes', [1, 4])
+def test_ap_accumulator_equals_evaluate_matches(seed, num_classes):
+    labels = class_labels(num_classes)
+    preds, gt_ids = synthetic_scans(num_classes=num_classes, seed=seed)
+    expected = reference_ap(preds, gt_ids, labels)
+    accumulator = InstSegAPAccumulator(labels)
+    for scan_id in preds.keys():
+        # scans are added one at a time, their masks are not kept
+        accumulator.add(preds[scan_id], gt_ids[scan_id])
+    assert accumulator.num_scans == len(preds)
+    assert np.array_equal(flatten(accumulator.compute(), labels), flatten(expected, labels), equal_nan=True)
+
+
+def test_ap_accumulator_reset():
+    labels = class_labels()
+    preds, gt_ids = synthetic_scans(num_scans=6)
+    accumulator = InstSegAPAccumulator(labels)
+    for i in range(3):
+        accumulator.add(*synthetic_scan(i, len(labels), seed=5))
+    accumulator.reset()
+    assert accumulator.num_scans == 0 and not accumulator.counts.any()
+    for scan_id in preds.keys():
+        accumulator.add(preds[scan_id], gt_ids[scan_id])
+    assert np.array_equal(flatten(accumulator.compute(), labels), flatten(reference_ap(preds, gt_ids, labels), labels), equal_nan=True)
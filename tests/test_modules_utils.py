@@ -0,0 +1,16 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('einops')
+
+from modules.utils import calc_pairwise_locs, calc_pairwise_locs_chunk, calc_pairwise_max_dists
+
+
+@pytest.mark.parametrize('spatial_dim', [1, 4, 5])
+@pytest.mark.parametrize('spatial_dist_norm', [True, False])
+def test_pairwise_locs_chunks_match_full_map(spatial_dim, spatial_dist_norm):
+    obj_centers = torch.rand(2, 37, 3, generator=torch.Generator().manual_seed(0)) * 5
+    full = calc_pairwise_locs(obj_centers, None, pairwise_rel_type='center', spatial_dist_norm=spatial_dist_norm, spatial_dim=spatial_dim)
+    max_dists = calc_pairwise_max_dists(obj_centers, chunk_size=8) if spatial_dist_norm else None
+    chunks = [calc_pairwise_locs_chunk(obj_centers, start, start + 10, max_dists, spatial_dim=spatial_dim) for start in range(0, 37, 10)]
+    assert torch.equal(torch.cat(chunks, dim=1), full)
@@ -0,0 +1,58 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from data.object_feature_store import ObjectFeatureTable, convert_object_features, object_feature_path
+from data.scan_store import open_fd_count
+
+SCAN_ID = '00800-TEEsavR23oF'
+
+
+def write_feature_dumps(feat_dir, num_sub_scans=3, num_objects=6, seed=0):
+    # stage 1 dumps: {object id: {column: list of per observation values}} per sub scan
+    g = torch.Generator().manual_seed(seed)
+    dump_dir = feat_dir / 'HM3D'
+    dump_dir.mkdir(parents=True)
+    dumps = []
+    for i in range(num_sub_scans):
+        dump = {}
+        for obj_id in range(num_objects):
+            n = int(torch.randint(0, 3, (1,), generator=g))
+            if n == 0:
+                continue
+            dump[obj_id] = {'object_feat': list(torch.randn(n, 8, generator=g)), 'object_open_vocab_feat': list(torch.randn(n, 4, generator=g)),
+                            'object_score': list(torch.rand(n, generator=g)), 'object_box': list(torch.randn(n, 6, generator=g))}
+        torch.save(dump, dump_dir / f'{SCAN_ID}_{i:02d}.pth')
+        dumps.append(dump)
+    # an other scan sharing the directory
+    torch.save({0: {'object_feat': [torch.zeros(8)], 'object_box': [torch.zeros(6)]}}, dump_dir / '00801-HaxA7YrQdEC_00.pth')
+    return dumps
+
+
+def test_table_matches_the_dumps(tmp_path):
+    dumps = write_feature_dumps(tmp_path / 'feat')
+    path = convert_object_features(str(tmp_path / 'feat'), 'HM3D', SCAN_ID, str(tmp_path / 'store'))
+    assert path == object_feature_path(str(tmp_path / 'store'), 'HM3D', SCAN_ID)
+    table = ObjectFeatureTable(path)
+    assert table.sub_scan_ids() == [f'{SCAN_ID}_{i:02d}.pth' for i in range(len(dumps))]
+    expected_ids = sorted({obj_id for dump in dumps for obj_id in dump})
+    assert sorted(table.keys()) == expected_ids and len(table) == len(expected_ids)
+    for obj_id in expected_ids:
+        # rows of an object are its observations in sub scan order
+        expected = torch.stack([feat for dump in dumps if obj_id in dump for feat in dump[obj_id]['object_feat']])
+        start, end = table.offsets[table.id_to_index[obj_id]], table.offsets[table.id_to_index[obj_id] + 1]
+        torch.testing.assert_close(table.gather('object_feat', np.arange(start, end)), expected.half().float())
+    rows = table.sample_rows(expected_ids * 20)
+    index = np.array([table.id_to_index[obj_id] for obj_id in expected_ids * 20])
+    assert ((rows >= table.offsets[index]) & (rows < table.offsets[index + 1])).all()
+
+
+def test_tables_hold_no_file_or_mapping(tmp_path):
+    write_feature_dumps(tmp_path / 'feat')
+    path = convert_object_features(str(tmp_path / 'feat'), 'HM3D', SCAN_ID, str(tmp_path / 'store'))
+    fds = open_fd_count()
+    tables = [ObjectFeatureTable(path) for _ in range(50)]
+    assert open_fd_count() == fds
+    for column in tables[0].columns.values():
+        assert not isinstance(column, np.memmap) and not column.flags.writeable
@@ -0,0 +1,93 @@
+import os
+import types
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from data.rank_shard import RankShardSampler, assign_scans, shard_scan_ids
+from common.dist_utils import get_world_size
+
+BATCH_SIZE = 4
+
+
+def synthetic_split(num_scans=60, seed=0):
+    # scan ids and frame counts, sample (scan, frame) of the global dataset is its position in the frame list
+    rng = np.random.default_rng(seed)
+    scan_ids = [f'scene{i:04d}_00' for i in range(num_scans)]
+    sizes = rng.integers(1, 40, num_scans).tolist()
+    frames = [(scan_id, frame) for scan_id, size in zip(scan_ids, sizes) for frame in range(size)]
+    return scan_ids, sizes, frames
+
+
+def rank_worker(rank, world_size, init_file, result_dir, num_epochs):
+    dist.init_process_group('gloo', init_method=f'file://{init_file}', rank=rank, world_size=world_size)
+    scan_ids, sizes, frames = synthetic_split()
+    local_scan_ids = shard_scan_ids(scan_ids, dict(zip(scan_ids, sizes)).get, rank, get_world_size())
+    # local dataset: the frames of the rank's own scans, as the datasets build them with rank_shard
+    local_frames = [frame for frame in frames if frame[0] in set(local_scan_ids)]
+    sampler = RankShardSampler(len(local_frames), seed=0)
+    loader = DataLoader(local_frames, batch_size=BATCH_SIZE, sampler=sampler, drop_last=True, collate_fn=list)
+    epochs = []
+    for epoch in range(num_epochs):
+        sampler.set_epoch(epoch)
+        epochs.append({'len': len(loader), 'batches': list(loader)})
+    torch.save({'scan_ids': local_scan_ids, 'frames': local_frames, 'epochs': epochs}, os.path.join(result_dir, f'{rank}.pth'))
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize('world_size', [2, 4])
+def test_shards_are_disjoint_cover_the_dataset_and_run_equal_steps(tmp_path, world_size):
+    num_epochs = 2
+    mp.spawn(rank_worker, args=(world_size, str(tmp_path / 'init'), str(tmp_path), num_epochs), nprocs=world_size)
+    results = [torch.load(tmp_path / f'{rank}.pth') for rank in range(world_size)]
+    scan_ids, sizes, frames = synthetic_split()
+    # every scan on exactly one rank, every frame of the dataset in exactly one local dataset
+    assigned = [scan_id for result in results for scan_id in result['scan_ids']]
+    assert sorted(assigned) == sorted(scan_ids)
+    local_frames = [frame for result in results for frame in result['frames']]
+    assert sorted(local_frames) == sorted(frames)
+    loads = [len(result['frames']) for result in results]
+    assert max(loads) - min(loads) <= max(sizes)
+    for epoch in range(num_epochs):
+        steps = [len(result['epochs'][epoch]['batches']) for result in results]
+        assert len(set(steps)) == 1 and steps[0] == max(loads) // BATCH_SIZE
+        for result in results:
+            assert result['epochs'][epoch]['len'] == steps[0]
+            # samples of a rank come from its own scans, each at most twice (padding to the largest rank)
+            seen = [frame for batch in result['epochs'][epoch]['batches'] for frame in batch]
+            assert {frame[0] for frame in seen} <= set(result['scan_ids'])
+            counts = np.unique(np.array([result['frames'].index(frame) for frame in seen]), return_counts=True)[1]
+            assert counts.max() <= -(-max(loads) // len(result['frames']))
+    for result in results:
+        assert result['epochs'][0]['batches'] != result['epochs'][1]['batches']
+
+
+def test_epoch_only_changes_with_set_epoch():
+    sampler = RankShardSampler(100, seed=0)
+    first = list(sampler)
+    assert list(sampler) == first and sampler.epoch == 0
+    sampler.set_epoch(1)
+    assert list(sampler) != first and sorted(sampler) == list(range(100))
+
+
+def test_assignment_is_balanced():
+    scan_ids, sizes, _ = synthetic_split()
+    shards = assign_scans(scan_ids, sizes, 4)
+    loads = [sum(size for scan_id, size in zip(scan_ids, sizes) if scan_id in shard) for shard in shards]
+    assert max(loads) - min(loads) <= max(sizes)
+
+
+def test_scheduler_counts_the_steps_of_all_ranks():
+    trainer_build = pytest.importorskip('trainer.build')
+    loader = DataLoader(list(range(100)), batch_size=BATCH_SIZE, sampler=RankShardSampler(100), drop_last=True)
+    trainer = types.SimpleNamespace(accelerator=types.SimpleNamespace(num_processes=4))
+    assert trainer_build.BaseTrainer.global_steps_per_epoch(trainer, loader) == 4 * len(loader)
+    # the global length of other loaders is sharded by prepare
+    plain = DataLoader(list(range(100)), batch_size=BATCH_SIZE, shuffle=True, drop_last=True)
+    assert trainer_build.BaseTrainer.global_steps_per_epoch(trainer, plain) == len(plain)
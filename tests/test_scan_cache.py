@@ -0,0 +1,61 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+
+from torch.utils.data import DataLoader, Dataset
+
+from data.scan_cache import ScanCache, scan_cache_worker_init, nbytes_of
+
+
+def load_scan(scan_id):
+    return {'pcds': np.zeros((1000, 6), dtype=np.float32)}
+
+
+SCAN_BYTES = nbytes_of(load_scan(None))
+
+
+def test_lru_stays_within_budget():
+    scan_ids = [f'scan{i:03d}' for i in range(50)]
+    cache = ScanCache(scan_ids, load_scan, max_bytes=4 * SCAN_BYTES)
+    for scan_id in scan_ids + scan_ids[::-1]:
+        cache[scan_id]
+        assert cache.total_bytes <= cache.max_bytes
+    assert len(cache.scans) == 4
+    assert list(cache.scans) == scan_ids[:4][::-1]
+    assert 'scan010' in cache and 'scan999' not in cache
+    assert len(cache) == len(scan_ids)
+
+
+class CacheStatsDataset(Dataset):
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, index):
+        cached_before = len(self.cache.scans)
+        self.cache[self.cache.scan_ids[index]]
+        return torch.tensor([cached_before, self.cache.max_bytes])
+
+
+@pytest.mark.parametrize('context', ['fork', 'spawn'])
+def test_workers_start_empty_with_split_budget(context):
+    import multiprocessing
+    if context not in multiprocessing.get_all_start_methods():
+        pytest.skip(f'{context} is not available')
+    scan_ids = [f'scan{i:03d}' for i in range(8)]
+    cache = ScanCache(scan_ids, load_scan, max_bytes=8 * SCAN_BYTES)
+    # the main process fills its cache, e.g. while computing sample sizes
+    for scan_id in scan_ids:
+        cache[scan_id]
+    loader = DataLoader(CacheStatsDataset(cache), batch_size=len(scan_ids), num_workers=2, worker_init_fn=scan_cache_worker_init,
+                        multiprocessing_context=context)
+    stats = torch.cat(list(loader))
+    # with batch_size covering the split one worker sees every scan from an empty cache
+    assert stats[0, 0] == 0
+    assert (stats[:, 1] == cache.max_bytes // 2).all()
+    assert (stats[:, 0] <= 4).all()
+    # the parent cache is untouched
+    assert len(cache.scans) == 8
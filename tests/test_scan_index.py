@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+
+from data import scan_index
+from data.scan_index import ScanDirectoryIndex, get_scan_index, scan_key
+
+NAMES = ['00800-TEEsavR23oF_0', '00800-TEEsavR23oF_1', '00800-TEEsavR23oF_10', '00801-HaxA7YrQdEC_0.pth',
+         'scene0000_00_0.pth', 'scene0000_00_12.pth', 'scene0000_01_0.pth', 'scene0001_00.pth',
+         'other_a', 'otherb', 'other.json']
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    for name in NAMES:
+        (root / name).touch()
+    return str(root)
+
+
+def listed(root, prefix):
+    return sorted(x for x in os.listdir(root) if x.startswith(prefix))
+
+
+def test_scan_key():
+    assert scan_key('00800-TEEsavR23oF_10') == '00800-TEEsavR23oF'
+    assert scan_key('scene0000_01_0.pth') == 'scene0000_01'
+    assert scan_key('other_a') == 'other' and scan_key('other.json') == 'other'
+
+
+@pytest.mark.parametrize('prefix', ['00800-TEEsavR23oF', '00800-TEEsavR23oF_1', '00801-HaxA7YrQdEC', '00802-missing00000',
+                                    'scene0000_00', 'scene0000', 'scene0001_00', 'other', 'othe', 'other_', '0', ''])
+def test_startswith_matches_listdir(root, prefix):
+    index = ScanDirectoryIndex(root)
+    assert index.startswith(prefix) == listed(root, prefix)
+    assert len(index) == len(NAMES)
+
+
+def test_manifest_is_grouped_and_reused(root, tmp_path, monkeypatch):
+    manifest_dir = str(tmp_path / 'manifest')
+    index = ScanDirectoryIndex(root, manifest_dir)
+    with open(index.manifest_path) as f:
+        manifest = json.load(f)
+    assert manifest['groups']['00800-TEEsavR23oF'] == ['00800-TEEsavR23oF_0', '00800-TEEsavR23oF_1', '00800-TEEsavR23oF_10']
+    assert sum(len(names) for names in manifest['groups'].values()) == len(NAMES)
+    # a second index reads the manifest instead of listing the directory
+    monkeypatch.setattr(scan_index.os, 'listdir', None)
+    assert ScanDirectoryIndex(root, manifest_dir).groups == index.groups
+
+
+def test_stale_or_flat_manifest_is_rebuilt(root, tmp_path):
+    manifest_dir = str(tmp_path / 'manifest')
+    index = ScanDirectoryIndex(root, manifest_dir)
+    (tmp_path / 'root' / 'scene0002_00_0.pth').touch()
+    os.utime(root, (os.stat(root).st_atime, os.stat(root).st_mtime + 10))
+    assert ScanDirectoryIndex(root, manifest_dir).startswith('scene0002_00') == ['scene0002_00_0.pth']
+    # manifests of the flat layout
+    with open(index.manifest_path, 'w') as f:
+        json.dump({'root': os.path.abspath(root), 'mtime': os.stat(root).st_mtime, 'entries': ['stale']}, f)
+    assert ScanDirectoryIndex(root, manifest_dir).startswith('scene0002_00') == ['scene0002_00_0.pth']
+
+
+def test_get_scan_index_is_cached(root):
+    assert get_scan_index(root) is get_scan_index(root)
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from data.scan_store import PackedScan, write_pack, open_fd_count
+
+
+def synthetic_arrays(num_frames=50, seed=0):
+    rng = np.random.default_rng(seed)
+    arrays = {}
+    for i in range(num_frames):
+        num_points = int(rng.integers(100, 1000))
+        arrays[f'points/{i:05d}.bin'] = rng.random((num_points, 6), dtype=np.float32)
+        arrays[f'super_points/{i:05d}.bin'] = rng.integers(0, 30, num_points)
+    arrays['meta/scan.json'] = np.frombuffer(b'{"00000": 0.5}', dtype=np.uint8)
+    return arrays
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_packed_scan_round_trip(tmp_path, mmap):
+    arrays = synthetic_arrays()
+    path = str(tmp_path / 'scan.pack')
+    write_pack(path, arrays)
+    with PackedScan(path, mmap=mmap) as scan:
+        assert set(scan.keys()) == set(arrays.keys())
+        for name, array in arrays.items():
+            loaded = scan.get(name)
+            assert loaded.dtype == array.dtype
+            assert np.array_equal(loaded, array)
+
+
+def mapped_file_count(directory):
+    with open('/proc/self/maps') as f:
+        return len({line.split()[-1] for line in f if str(directory) in line})
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs procfs')
+def test_copied_scans_keep_no_descriptors_or_maps(tmp_path):
+    # loaded arrays outlive their scan files, as in eager dataset loading
+    paths = []
+    for i in range(20):
+        paths.append(str(tmp_path / f'scan_{i}.pack'))
+        write_pack(paths[-1], synthetic_arrays(num_frames=5, seed=i))
+    fds = open_fd_count()
+    loaded = []
+    for path in paths:
+        with PackedScan(path) as scan:
+            loaded.append({name: scan.get(name) for name in scan.keys()})
+    assert open_fd_count() == fds
+    assert mapped_file_count(tmp_path) == 0
+    # zero-copy views keep one mapping per scan alive
+    mapped = [PackedScan(path, mmap=True).get('points/00000.bin') for path in paths]
+    assert mapped_file_count(tmp_path) == len(paths)
+    del mapped
+    assert mapped_file_count(tmp_path) == 0
@@ -0,0 +1,122 @@
+import types
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+instseg_eval = pytest.importorskip('evaluator.embodied_scan_instseg_eval')
+
+from torch.utils.data import ConcatDataset, Dataset
+
+from data.batch_sampler import ScanStreamBatchSampler, supports_scan_stream
+
+
+def frame_scan_ids(num_scans=7, seed=0):
+    rng = np.random.default_rng(seed)
+    return [f'scan{s}' for s in range(num_scans) for _ in range(rng.integers(1, 12))]
+
+
+class FrameList(list):
+    def reset(self):
+        self.clear()
+
+
+class RecordingStream(instseg_eval.ScanStreamMixin):
+    ''' ScanStreamMixin with merge and flush recording the frames instead of building masks
+    '''
+    def __init__(self, scan_stream=True):
+        self.representation_manger = FrameList()
+        self.cur_scan_id = None
+        self.init_scan_stream(types.SimpleNamespace(dataloader={'scan_stream_eval': scan_stream}))
+        self.merged, self.flushed = [], {}
+
+    def new_scan_state(self):
+        return {'representation_manger': FrameList()}
+
+    def merge_frame(self, data_dict, bid):
+        self.representation_manger.append(data_dict['index'][bid])
+        self.merged.append(data_dict['index'][bid])
+
+    def flush_representation_manager(self):
+        assert self.cur_scan_id not in self.flushed
+        self.flushed[self.cur_scan_id] = list(self.representation_manger)
+        self.representation_manger.reset()
+
+
+def stream_batch(stream, scan_ids, batch):
+    data_dict = {
+        'index': batch,
+        'scan_id': [scan_ids[i] for i in batch],
+        'last_frame': [i + 1 == len(scan_ids) or scan_ids[i + 1] != scan_ids[i] for i in batch],
+    }
+    return stream.stream_batch(data_dict)
+
+
+@pytest.mark.parametrize('num_replicas', [1, 2, 3])
+@pytest.mark.parametrize('batch_size', [1, 4])
+def test_repeated_frames_are_not_counted(num_replicas, batch_size):
+    scan_ids = frame_scan_ids()
+    samplers = [ScanStreamBatchSampler(scan_ids, batch_size, num_replicas=num_replicas, rank=rank) for rank in range(num_replicas)]
+    assert len({len(sampler) for sampler in samplers}) == 1
+    total_count, flushed = 0, {}
+    for sampler in samplers:
+        stream = RecordingStream()
+        total_count += sum(stream_batch(stream, scan_ids, batch) for batch in sampler)
+        stream.flush_scans()
+        assert not flushed.keys() & stream.flushed.keys()
+        flushed.update(stream.flushed)
+        # every frame of the rank is merged once even when the last one is repeated to even out the steps
+        assert sorted(stream.merged) == sorted(set(i for batch in sampler for i in batch))
+    assert total_count == len(scan_ids)
+    # every scan is flushed once with all of its frames in order
+    for scan_id in set(scan_ids):
+        assert flushed[scan_id] == [i for i, s in enumerate(scan_ids) if s == scan_id]
+
+
+def test_scan_stream_needs_last_frame():
+    stream = RecordingStream()
+    with pytest.raises(AssertionError):
+        stream.stream_batch({'index': [0], 'scan_id': ['scan0']})
+
+
+def test_index_order_counts_every_frame():
+    scan_ids = frame_scan_ids()
+    stream = RecordingStream(scan_stream=False)
+    total_count = sum(stream.stream_batch({'index': [i], 'scan_id': [scan_ids[i]]}) for i in range(len(scan_ids)))
+    stream.flush_scans()
+    assert total_count == len(scan_ids)
+    assert sum(len(frames) for frames in stream.flushed.values()) == len(scan_ids)
+
+
+class FrameDataset(Dataset):
+    def __init__(self, scan_ids):
+        self.scan_ids = scan_ids
+
+    def __len__(self):
+        return len(self.scan_ids)
+
+    def sample_scan_ids(self):
+        return self.scan_ids
+
+
+class PlainDataset(Dataset):
+    def __len__(self):
+        return 3
+
+
+class Wrapper(Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def test_supports_scan_stream():
+    frames = FrameDataset(frame_scan_ids())
+    assert supports_scan_stream(frames)
+    assert supports_scan_stream(Wrapper(frames))
+    assert supports_scan_stream(ConcatDataset([frames, Wrapper(frames)]))
+    assert not supports_scan_stream(PlainDataset())
+    assert not supports_scan_stream(Wrapper(PlainDataset()))
+    assert not supports_scan_stream(ConcatDataset([frames, PlainDataset()]))
@@ -0,0 +1,97 @@
+import copy
+import multiprocessing
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from torch.utils.data import DataLoader, Dataset
+
+from data.shared_memory import SharedNDArray, share_arrays
+
+pytestmark = pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='needs POSIX shared memory in /dev/shm')
+
+
+def synthetic_split(num_scans=200, num_frames=10, num_points=300, seed=0):
+    # the nested layout of EmbodiedScanInstseg.scan_data, 6200 arrays
+    rng = np.random.default_rng(seed)
+    split = {}
+    for i in range(num_scans):
+        split[f'scan{i:04d}'] = {
+            'sub_frames': {j: {
+                'pcds': rng.random((num_points, 6), dtype=np.float32),
+                'instance_labels': rng.integers(-100, 20, num_points),
+                'segment_id': rng.integers(0, 50, num_points),
+            } for j in range(num_frames)},
+            'pcds_global': rng.random((num_points * 4, 6), dtype=np.float32),
+            'inst_to_label': {0: 'chair'},
+        }
+    return split
+
+
+def shm_usage():
+    # descriptors and mappings of shared memory segments in this process
+    fds = [os.readlink(f'/proc/self/fd/{fd}') for fd in os.listdir('/proc/self/fd')]
+    with open('/proc/self/maps') as f:
+        maps = {line.split()[-1] for line in f if '/dev/shm/' in line}
+    return sum(fd.startswith('/dev/shm/') for fd in fds), len(maps)
+
+
+def checksum(scan):
+    return float(sum(frame['pcds'].sum() + frame['instance_labels'].sum() + frame['segment_id'].sum() for frame in scan['sub_frames'].values())
+                 + scan['pcds_global'].sum())
+
+
+class ScanDataset(Dataset):
+    def __init__(self, scan_data):
+        self.scan_data = scan_data
+        self.scan_ids = list(scan_data.keys())
+
+    def __len__(self):
+        return len(self.scan_ids)
+
+    def __getitem__(self, index):
+        scan = self.scan_data[self.scan_ids[index]]
+        assert isinstance(scan['sub_frames'][0]['pcds'], SharedNDArray)
+        return (index, checksum(scan)) + shm_usage()
+
+
+def test_split_is_shared_through_one_segment():
+    split = synthetic_split()
+    reference = copy.deepcopy(split)
+    fds, maps = shm_usage()
+    share_arrays(split)
+    new_fds, new_maps = shm_usage()
+    assert new_fds - fds == 1
+    assert new_maps - maps == 1
+    for scan_id, scan in split.items():
+        assert isinstance(scan['pcds_global'], SharedNDArray)
+        assert scan['inst_to_label'] == reference[scan_id]['inst_to_label']
+        for j, frame in scan['sub_frames'].items():
+            for name, array in frame.items():
+                assert array.dtype == reference[scan_id]['sub_frames'][j][name].dtype
+                assert np.array_equal(array, reference[scan_id]['sub_frames'][j][name])
+    # sharing again is a no-op
+    share_arrays(split)
+    assert shm_usage() == (new_fds, new_maps)
+
+
+@pytest.mark.parametrize('context', ['fork', 'spawn'])
+def test_workers_map_the_split_once(context):
+    if context not in multiprocessing.get_all_start_methods():
+        pytest.skip(f'{context} is not available')
+    split = share_arrays(synthetic_split())
+    expected = {i: checksum(split[scan_id]) for i, scan_id in enumerate(split)}
+    loader = DataLoader(ScanDataset(split), batch_size=None, num_workers=2, multiprocessing_context=context)
+    seen = set()
+    for index, value, fds, maps in loader:
+        seen.add(index)
+        assert value == pytest.approx(expected[index])
+        # the arena of this split plus, under fork, segments inherited from earlier tests
+        assert fds <= len(SharedNDArray._segments)
+        assert maps <= len(SharedNDArray._segments)
+        if context == 'spawn':
+            assert fds == 1 and maps == 1
+    assert seen == set(expected)
@@ -0,0 +1,30 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('einops')
+
+from modules.layers.transformers import MultiHeadAttentionSpatial
+from modules.utils import calc_pairwise_locs
+
+
+@pytest.mark.parametrize('spatial_attn_fusion', ['mul', 'bias', 'add', 'ctx', 'cond'])
+@pytest.mark.parametrize('spatial_multihead', [True, False])
+@pytest.mark.parametrize('length, chunk_size', [(37, 8), (37, 64), (16, 16)])
+def test_chunked_attention_matches_full(spatial_attn_fusion, spatial_multihead, length, chunk_size):
+    torch.manual_seed(0)
+    attn = MultiHeadAttentionSpatial(32, 4, spatial_multihead=spatial_multihead, spatial_dim=5,
+                                     spatial_attn_fusion=spatial_attn_fusion).eval()
+    x = torch.randn(3, length, 32)
+    obj_centers = torch.rand(3, length, 3) * 5
+    # padded keys in the middle of the chunks and at the end, one sample without padding
+    key_padding_mask = torch.zeros(3, length, dtype=torch.bool)
+    key_padding_mask[0, length // 2:] = True
+    key_padding_mask[1, 3::5] = True
+    pairwise_locs = calc_pairwise_locs(obj_centers, None, pairwise_rel_type='center', spatial_dist_norm=True, spatial_dim=5)
+    with torch.no_grad():
+        full, full_attn = attn(x, x, x, pairwise_locs, key_padding_mask=key_padding_mask)
+        attn.chunk_size = chunk_size
+        chunked, chunked_attn = attn(x, x, x, obj_centers, key_padding_mask=key_padding_mask)
+    assert full_attn is not None and chunked_attn is None
+    assert chunked.shape == full.shape == (3, length, 32)
+    torch.testing.assert_close(chunked, full, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,86 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from data.voxelize import sparse_quantize
+
+
+def room_points(num_points=5000, seed=0):
+    # negative coordinates and several points per 0.1 voxel
+    rng = np.random.default_rng(seed)
+    return (rng.random((num_points, 3)) * np.array([2.0, 2.0, 1.0]) - 0.5).astype(np.float32)
+
+
+@pytest.mark.parametrize('voxel_size', [None, 0.1])
+@pytest.mark.parametrize('random_select', [False, True])
+def test_unique_map_and_inverse_map(voxel_size, random_select):
+    coordinates = torch.from_numpy(room_points() * (10 if voxel_size is None else 1))
+    floored = torch.floor(coordinates / (voxel_size or 1)).long()
+    torch.manual_seed(0)
+    unique_coords, unique_map, inverse_map = sparse_quantize(coordinates, voxel_size=voxel_size, return_index=True,
+                                                             return_inverse=True, random_select=random_select)
+    # round trip, every point maps back to its own voxel
+    assert torch.equal(unique_coords[inverse_map], floored)
+    assert len(unique_coords) == len(torch.unique(floored, dim=0)) < len(coordinates)
+    # voxels are unique and every representative lies inside the voxel it represents
+    assert len(torch.unique(unique_coords, dim=0)) == len(unique_coords)
+    assert torch.equal(floored[unique_map], unique_coords)
+    assert torch.equal(inverse_map[unique_map], torch.arange(len(unique_coords)))
+    if not random_select:
+        # the first point of every voxel
+        first = torch.full((len(unique_coords),), len(coordinates), dtype=torch.long).scatter_reduce(0, inverse_map, torch.arange(len(coordinates)), 'amin')
+        assert torch.equal(unique_map, first)
+
+
+def test_random_select_varies_the_representative():
+    coordinates = torch.from_numpy(room_points())
+    maps = []
+    for seed in range(2):
+        torch.manual_seed(seed)
+        maps.append(sparse_quantize(coordinates, voxel_size=0.1, return_index=True, random_select=True)[1])
+    assert not torch.equal(maps[0], maps[1])
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.float64, torch.int64])
+def test_average_features_are_voxel_means(dtype):
+    coordinates = torch.from_numpy(room_points())
+    features = (torch.rand(len(coordinates), 4) * 100).to(dtype)
+    unique_coords, unique_features, inverse_map = sparse_quantize(coordinates, features, voxel_size=0.1, return_inverse=True,
+                                                                  average_features=True)
+    assert unique_features.dtype == (dtype if dtype.is_floating_point else torch.float32)
+    expected = torch.stack([features[inverse_map == v].double().mean(0) for v in range(len(unique_coords))])
+    torch.testing.assert_close(unique_features.double(), expected, rtol=1e-6, atol=1e-4)
+
+
+def test_representative_features():
+    coordinates = torch.from_numpy(room_points())
+    features = torch.rand(len(coordinates), 3)
+    _, unique_features, unique_map = sparse_quantize(coordinates, features, voxel_size=0.1, return_index=True)
+    assert torch.equal(unique_features, features[unique_map])
+
+
+@pytest.mark.parametrize('as_numpy', [True, False])
+def test_empty_input(as_numpy):
+    coordinates = np.zeros((0, 3), dtype=np.float32)
+    features = np.zeros((0, 6), dtype=np.float32)
+    if not as_numpy:
+        coordinates, features = torch.from_numpy(coordinates), torch.from_numpy(features)
+    unique_coords, unique_features, unique_map, inverse_map = sparse_quantize(
+        coordinates, features, voxel_size=0.1, return_index=True, return_inverse=True, average_features=True)
+    assert unique_coords.shape == (0, 3) and unique_features.shape == (0, 6)
+    assert len(unique_map) == len(inverse_map) == 0
+
+
+def test_numpy_in_numpy_out_torch_in_torch_out():
+    points = room_points()
+    features = np.random.default_rng(0).random((len(points), 3))
+    numpy_outputs = sparse_quantize(points, features, voxel_size=0.1, return_index=True, return_inverse=True)
+    torch_outputs = sparse_quantize(torch.from_numpy(points), torch.from_numpy(features), voxel_size=0.1, return_index=True, return_inverse=True)
+    assert all(isinstance(x, np.ndarray) for x in numpy_outputs)
+    assert all(isinstance(x, torch.Tensor) for x in torch_outputs)
+    for numpy_output, torch_output in zip(numpy_outputs, torch_outputs):
+        assert np.array_equal(numpy_output, torch_output.numpy())
+    # only coordinates, a single array instead of a tuple
+    assert isinstance(sparse_quantize(points, voxel_size=0.1), np.ndarray)
+    assert isinstance(sparse_quantize(torch.from_numpy(points), voxel_size=0.1), torch.Tensor)
@@ -10,6 +10,7 @@ import numpy as np
 from accelerate import Accelerator, DistributedDataParallelKwargs
 from accelerate.logging import get_logger
 from accelerate.utils import set_seed, InitProcessGroupKwargs
+from accelerate.data_loader import prepare_data_loader
 from fvcore.common.registry import Registry
 import torch
 import wandb
@@ -88,7 +89,7 @@ class BaseTrainer():
         if self.mode == "test":
             total_steps = 1
         else:
-            total_steps = (len(self.data_loaders["train"]) * cfg.solver.epochs) // gradient_accumulation_steps
+            total_steps = (self.global_steps_per_epoch(self.data_loaders["train"]) * cfg.solver.epochs) // gradient_accumulation_steps
         self.loss, self.optimizer, self.scheduler = build_optim(cfg, self.model.get_opt_params(),
                                                                 total_steps= total_steps)
 
@@ -100,7 +101,7 @@ class BaseTrainer():
 
         # Training details
         self.epochs = cfg.solver.epochs
-        self.total_steps = 1 if self.mode == "test" else len(self.data_loaders["train"]) * cfg.solver.epochs
+        self.total_steps = 1 if self.mode == "test" else self.global_steps_per_epoch(self.data_loaders["train"]) * cfg.solver.epochs
         self.grad_norm = cfg.solver.get("grad_norm")
 
         # Load pretrain model weights
@@ -112,9 +113,9 @@ class BaseTrainer():
         self.model, self.loss, self.optimizer, self.scheduler = self.accelerator.prepare(self.model, self.loss, self.optimizer, self.scheduler)
         for name, loader in self.data_loaders.items():
             if isinstance(loader, list):
-                loader = self.accelerator.prepare(*loader)
+                loader = [self.prepare_loader(l) for l in loader]
             else:
-                loader = self.accelerator.prepare(loader)
+                loader = self.prepare_loader(loader)
             self.data_loaders[name] = loader
         self.accelerator.register_for_checkpointing(self.exp_tracker)
 
@@ -123,6 +124,26 @@ class BaseTrainer():
         if cfg.resume:
             self.resume()
 
+    def global_steps_per_epoch(self, loader):
+        # batches of all ranks per epoch, the prepared scheduler steps once per rank and optimizer step
+        # samplers that split ranks report the per rank length, other loaders the global one until prepared
+        if getattr(loader.batch_sampler, 'splits_ranks', False) or getattr(loader.sampler, 'splits_ranks', False):
+            return len(loader) * self.accelerator.num_processes
+        return len(loader)
+
+    def set_train_epoch(self, epoch):
+        # samplers that split ranks shuffle per epoch, the epoch is set before iterating and stays fixed during it
+        loader = self.data_loaders["train"]
+        for sampler in [loader.batch_sampler, getattr(loader.batch_sampler, 'sampler', None), loader.sampler]:
+            if getattr(sampler, 'splits_ranks', False):
+                sampler.set_epoch(epoch)
+
+    def prepare_loader(self, loader):
+        if getattr(loader.batch_sampler, 'splits_ranks', False) or getattr(loader.sampler, 'splits_ranks', False):
+            # batches are already split across ranks by the sampler, only place them on device
+            return prepare_data_loader(loader, self.accelerator.device, num_processes=1, process_index=0, put_on_device=True)
+        return self.accelerator.prepare(loader)
+
     def forward(self, data_dict):
         return self.model(data_dict)
 
@@ -29,6 +29,7 @@ class EmbodiedStage1Trainer(BaseTrainer):
 
     def train_step(self, epoch):
         self.model.train()
+        self.set_train_epoch(epoch)
         loader = self.data_loaders["train"]
         pbar = tqdm(range(len(loader)), disable=(not self.accelerator.is_main_process), desc=f"[Epoch {epoch + 1}/{self.epochs}]")
         for i, data_dict in enumerate(loader):